@@ -0,0 +1,56 @@
+#!/bin/sh
+
+# Auto-detect MAIN_DIR from script location
+SCRIPT_DIR="$(cd "$(dirname "$0")" && pwd)"
+export MAIN_DIR="$(cd "${SCRIPT_DIR}/.." && pwd)"
+cd ${MAIN_DIR}
+
+# The benchmark runs offline: the tokenizers are saved here once (the only download)
+export TOKENIZER_DIR="./data/tokenizers"
+export SRC_TOKENIZER="EleutherAI/pythia-1b"
+export TGT_TOKENIZER="microsoft/biogpt"
+for TOKENIZER in ${SRC_TOKENIZER} ${TGT_TOKENIZER}; do
+  if [ ! -d "${TOKENIZER_DIR}/$(basename ${TOKENIZER})" ]; then
+    python -c "from transformers import AutoTokenizer; AutoTokenizer.from_pretrained('${TOKENIZER}').save_pretrained('${TOKENIZER_DIR}/$(basename ${TOKENIZER})')"
+  fi
+done
+
+# Leave empty for generated PubMed-like abstracts, or set to a JSONL file (e.g. the head of pubmed-corpus.json)
+export SAMPLE=""
+export NUM_DOCS=2000
+export RESULTS="./log/tokenizer_benchmark.json"
+# Written by the first run, later runs report regressions against it (rerun with --update-baseline after an intended change)
+export BASELINE="./log/tokenizer_benchmark.baseline.json"
+
+# Process and tokenizer thread counts of the grid: 1 and every core
+CPU_CORES=$(nproc 2>/dev/null || echo 4)
+if [ ${CPU_CORES} -gt 1 ]; then
+  export PROCS="1,${CPU_CORES}"
+else
+  export PROCS="1"
+fi
+export THREADS=${PROCS}
+export BATCH_SIZES="1,32,1000"
+
+if [ -n "${SAMPLE}" ]; then
+  SAMPLE_PARAMETERS="-s ${SAMPLE}"
+else
+  SAMPLE_PARAMETERS=""
+fi
+if [ ! -f "${BASELINE}" ]; then
+  BASELINE_PARAMETERS="--baseline ${BASELINE} --update-baseline"
+else
+  BASELINE_PARAMETERS="--baseline ${BASELINE}"
+fi
+
+mkdir -p ./log
+python -u src/tokenizer_benchmark.py \
+  -t pythia=${TOKENIZER_DIR}/$(basename ${SRC_TOKENIZER}) \
+  -t biogpt=${TOKENIZER_DIR}/$(basename ${TGT_TOKENIZER}) \
+  ${SAMPLE_PARAMETERS} \
+  -n ${NUM_DOCS} \
+  -b ${BATCH_SIZES} \
+  -p ${PROCS} \
+  -j ${THREADS} \
+  -o ${RESULTS} \
+  ${BASELINE_PARAMETERS} 2>&1 | tee ./log/tokenizer_benchmark.log
@@ -9,6 +9,19 @@ export CACHE_DIR="${MAIN_DIR}/data/cache"
 # export TRAIN_FILE="${MAIN_DIR}/data/pretrain-corpus/lang-code-math-mix.json"
 # PubMed corpus (run prepare_pubmed_corpus_hf.py first to generate this)
 export TRAIN_FILE="${MAIN_DIR}/data/pretrain-corpus/pubmed-corpus.json"
+# Set to a corpus manifest (e.g. the deduplicated shards of dedup_corpus.sh) to read it instead
+# export CORPUS_MANIFEST="${MAIN_DIR}/data/pretrain-corpus/pubmed-corpus-dedup/manifest.json"
+export CORPUS_MANIFEST=""
+if [ -n "${CORPUS_MANIFEST}" ]; then
+  INPUT_PARAMETERS="--corpus_manifest ${CORPUS_MANIFEST}"
+else
+  INPUT_PARAMETERS="--train_file ${TRAIN_FILE}"
+fi
+# Set to the socket of a running `python src/tokenizer_service.py -s ...` so the workers share its tokenizers
+export TOKENIZER_SERVICE=""
+if [ -n "${TOKENIZER_SERVICE}" ]; then
+  INPUT_PARAMETERS="${INPUT_PARAMETERS} --tokenizer_service ${TOKENIZER_SERVICE}"
+fi
 
 # Source Tokenizer
 export MODLE_PATH1="EleutherAI/pythia-1b"
@@ -26,19 +39,15 @@ export GLOVE_TRAIN_PATH2="${MAIN_DIR}/data/pretrain-dataset/mix-biogpt-glove"
 
 export MATRIX_EVAL_PATH="${MAIN_DIR}/data/pretrain-dataset/pythia-2-biogpt-glove-eval-mix"
 
-# Auto-detect CPU workers (75% of cores, max 64)
-CPU_CORES=$(nproc 2>/dev/null || echo 4)
-NUM_WORKERS=$((CPU_CORES * 3 / 4))
-[ $NUM_WORKERS -gt 64 ] && NUM_WORKERS=64
-[ $NUM_WORKERS -lt 1 ] && NUM_WORKERS=1
-export NUM_WORKERS
+# NUM_WORKERS (one per core, or per core of CPU_BUDGET) and single-threaded tokenizers / BLAS in each of them
+eval "$(python src/resource_policy.py -s tokenize --print-env)"
 
 tokenize () {
   # Removed offline flags to allow model downloads if needed
   python -u src/process_dataset.py \
     --model_name_or_path ${MODLE_PATH} \
     --tokenizer_name ${TOKENIZER_PATH} \
-    --train_file ${TRAIN_FILE} \
+    ${INPUT_PARAMETERS} \
     --only_tokenize \
     --cache_dir ${CACHE_DIR} \
     --dataset_path_in_disk ${DATASET_PATH} \
@@ -51,14 +60,14 @@ MODLE_PATH=$MODLE_PATH1
 TOKENIZER_PATH=$TOKENIZER_PATH1
 DATASET_PATH=$DATASET_PATH1
 
-printf "\n### Tokenize ${TRAIN_FILE} into the token ID corpus ${DATASET_PATH1} with tokenizer ${TOKENIZER_PATH1} ... ###\n\n"
+printf "\n### Tokenize ${CORPUS_MANIFEST:-${TRAIN_FILE}} into the token ID corpus ${DATASET_PATH1} with tokenizer ${TOKENIZER_PATH1} ... ###\n\n"
 tokenize
 
 MODLE_PATH=$MODLE_PATH2
 TOKENIZER_PATH=$TOKENIZER_PATH2
 DATASET_PATH=$DATASET_PATH2
 
-printf "\n### Tokenize ${TRAIN_FILE} into the token ID corpus ${DATASET_PATH2} with tokenizer ${TOKENIZER_PATH2} ... ###\n\n"
+printf "\n### Tokenize ${CORPUS_MANIFEST:-${TRAIN_FILE}} into the token ID corpus ${DATASET_PATH2} with tokenizer ${TOKENIZER_PATH2} ... ###\n\n"
 tokenize
 
 MIN_LEN=0
@@ -0,0 +1,23 @@
+#!/bin/sh
+
+# Auto-detect MAIN_DIR from script location
+SCRIPT_DIR="$(cd "$(dirname "$0")" && pwd)"
+export MAIN_DIR="$(cd "${SCRIPT_DIR}/.." && pwd)"
+cd ${MAIN_DIR}
+
+# Shards written by `prepare_pubmed_corpus_hf.py --output-format arrow`
+export INPUT_MANIFEST="./data/pretrain-corpus/pubmed-corpus/manifest.json"
+export OUTPUT_DIR="./data/pretrain-corpus/pubmed-corpus-dedup"
+# Hashes of every document kept so far, later corpus increments are checked against it
+export INDEX_DIR="./data/pretrain-corpus/dedup-index"
+
+# NUM_WORKERS (one per core, or per core of CPU_BUDGET) and single-threaded tokenizers / BLAS in each of them
+eval "$(python src/resource_policy.py -s dedup --print-env)"
+
+mkdir -p ./log
+python -u src/dedup_corpus.py \
+  -i ${INPUT_MANIFEST} \
+  -o ${OUTPUT_DIR} \
+  -x ${INDEX_DIR} \
+  -n ${NUM_WORKERS} \
+  -t 0.8 2>&1 | tee ./log/dedup_corpus.log
@@ -2,59 +2,128 @@
 """
 Script to download PubMed abstracts from HuggingFace and convert to TokAlign JSONL format.
 Target: ~1 billion tokens (approximately 3.3 million abstracts)
+
+With --streaming, the source is read shard by shard (without downloading the whole dataset) and the build stops as
+soon as the target is reached. After every batch, a cursor (source shard, offset in it, tokens and abstracts so far,
+bytes written) is saved next to the output (`pubmed-corpus.json.cursor.json`); a later run with the same source
+truncates the output to the cursor and resumes from it. The source can be a HuggingFace dataset, a local directory or
+a list of data files (local paths or http(s) URLs):
+    python script/prepare_pubmed_corpus_hf.py --streaming
+    python script/prepare_pubmed_corpus_hf.py --streaming --data-files http://host/shard-0.jsonl http://host/shard-1.jsonl
+
+With --output-format arrow (or parquet), the corpus is written as size-bounded shards with the `text` and the token
+count of each abstract, listed with their totals in `pubmed-corpus/manifest.json` (see src/corpus_manifest.py), which
+process_dataset.py reads with `--corpus_manifest`. When streaming, the cursor then moves with every completed shard.
+
+Tokens are counted with --tokenizer and, with --target-tokenizer (e.g. microsoft/biogpt), the tokenizer of the adapted
+model; --budget-on picks which one --target-tokens applies to. With --count-mode estimate, abstracts are not tokenized:
+each tokenizer's tokens per character are calibrated on --calibration-docs abstracts (a seeded random sample, or the
+first ones of the stream) and the tokens of every abstract are estimated from its length. --selection random takes a
+seeded random subset of the abstracts instead of the first ones in dataset order (without --streaming); with estimated
+counts, the subset is chosen up front from the abstract lengths. The settings, calibration (with the error of the
+estimated total on held-out abstracts) and totals are written to `pubmed-corpus.json.budget.json`:
+    python script/prepare_pubmed_corpus_hf.py --count-mode estimate --selection random --target-tokenizer microsoft/biogpt --budget-on target
+
+With --tokenizer-service, exact counts come from a running src/tokenizer_service.py (which loads each tokenizer once
+and batches the requests of all workers) instead of a tokenizer loaded by every worker.
 """
 
+import argparse
 import json
+import os
 import sys
+from collections import deque
 from pathlib import Path
+import numpy as np
+import pyarrow.compute as pc
 from transformers import AutoTokenizer
 from tqdm import tqdm
-from multiprocessing import Pool, cpu_count
+from multiprocessing import Pool
 
 # Try to import datasets, install if not available
 try:
-    from datasets import load_dataset
+    from datasets import load_dataset, load_dataset_builder
 except ImportError:
     print("Installing datasets...")
     import subprocess
     subprocess.check_call([sys.executable, "-m", "pip", "install", "datasets"])
-    from datasets import load_dataset
+    from datasets import load_dataset, load_dataset_builder
 
 # Configuration
 MAIN_DIR = Path(__file__).parent.parent
+sys.path.insert(0, str(MAIN_DIR / "src"))
+from corpus_manifest import SHARD_FORMATS, CorpusShardWriter
+from resource_policy import apply_policy
+from tokenizer_service import TokenizerClient
+
+DATASET_NAME = "uiyunkim-hub/pubmed-abstract"
 OUTPUT_FILE = MAIN_DIR / "data" / "pretrain-corpus" / "pubmed-corpus.json"
 TARGET_TOKENS = 1_000_000_000  # 1 billion tokens
 TOKENIZER_NAME = "EleutherAI/pythia-1b"  # Use Pythia tokenizer for counting
 BATCH_SIZE = 1000  # Process this many abstracts at once
 NUM_WORKERS = None  # None = auto-detect (capped at 32), or set to specific number
 MAX_WORKERS = 32  # Maximum number of workers to use (prevents overhead with too many cores)
+SHARD_SIZE_MB = 256  # Text per shard with --output-format arrow/parquet
+MIN_CHARS = 50  # Shorter abstracts are skipped
+CALIBRATION_DOCS = 2000  # Abstracts tokenized to calibrate the tokens-per-character estimate
+DATA_FILE_FORMATS = {".json": "json", ".jsonl": "json", ".parquet": "parquet", ".csv": "csv"}
 
 
-# Global tokenizer for worker processes (initialized once per worker)
-_worker_tokenizer = None
+# Global token counters, dataset and output format for worker processes (initialized once per worker)
+_worker_counters = None
+_worker_budget_on = "source"
+_worker_dataset = None
+_worker_output_format = "jsonl"
 
-def init_worker(tokenizer_name):
-    """Initialize tokenizer in each worker process."""
-    global _worker_tokenizer
-    _worker_tokenizer = AutoTokenizer.from_pretrained(tokenizer_name)
+def load_counter(tokenizer_name, tokenizer_service=None):
+    """The tokenizer, or its client when tokenizers are served by src/tokenizer_service.py."""
+    if tokenizer_service:
+        return TokenizerClient(tokenizer_service, tokenizer_name)
+    return AutoTokenizer.from_pretrained(tokenizer_name)
 
-def process_abstract_batch(batch):
+def init_worker(counters, dataset=None, output_format="jsonl", budget_on="source", tokenizer_service=None):
+    """
+    Initialize the token counters in each worker process, and the memory-mapped dataset workers read rows from.
+    `counters` maps `source`/`target` to `("exact", tokenizer name)` or `("estimate", tokens per character)`.
     """
-    Process a batch of abstracts in parallel.
+    global _worker_counters, _worker_budget_on, _worker_dataset, _worker_output_format
+    _worker_counters = {
+        name: (mode, load_counter(counter, tokenizer_service) if mode == "exact" else counter)
+        for name, (mode, counter) in counters.items()
+    }
+    _worker_budget_on = budget_on
+    _worker_dataset = dataset
+    _worker_output_format = output_format
+
+def count_tokens(abstracts, mode, counter):
+    """Token count of each abstract, from a tokenizer (in one batched call) or estimated from its characters."""
+    if not abstracts:
+        return []
+    if mode == "exact" and isinstance(counter, TokenizerClient):
+        return counter.count(abstracts, add_special_tokens=False)
+    if mode == "exact":
+        encodings = counter(abstracts, add_special_tokens=False, return_attention_mask=False, return_token_type_ids=False)
+        return [len(input_ids) for input_ids in encodings["input_ids"]]
+    return [max(1, round(counter * len(abstract))) for abstract in abstracts]
+
+def process_abstracts(abstracts):
+    """
+    Filter, count the tokens of and format a list of abstracts.
     
     Args:
-        batch: List of dataset items
+        abstracts: List of abstract strings
     
     Returns:
-        List of (json_line, token_count) tuples
+        (output, counts), the output being `(JSONL text,)` or, for shards, `(kept abstracts, budget token count of
+        each)`, and the counts the numbers of abstracts kept and skipped and of tokens (`total_tokens` for the budget
+        tokenizer, `total_tokens_<name>` for each tokenizer)
     """
-    global _worker_tokenizer
-    results = []
+    kept = []
     skipped_empty = 0
     skipped_short = 0
     
-    for item in batch:
-        abstract = item.get('abstract', '').strip()
+    for abstract in abstracts:
+        abstract = (abstract or '').strip()
         
         # Skip empty abstracts
         if not abstract:
@@ -62,127 +131,411 @@ def process_abstract_batch(batch):
             continue
         
         # Skip very short abstracts
-        if len(abstract) < 50:
+        if len(abstract) < MIN_CHARS:
             skipped_short += 1
             continue
         
-        # Tokenize
-        tokens = _worker_tokenizer.encode(abstract, add_special_tokens=False)
-        token_count = len(tokens)
-        
-        # Format as JSONL
-        json_obj = {"text": abstract}
-        json_line = json.dumps(json_obj, ensure_ascii=False)
-        
-        results.append((json_line, token_count))
+        kept.append(abstract)
     
-    return results, skipped_empty, skipped_short
+    token_counts = {name: count_tokens(kept, mode, counter) for name, (mode, counter) in _worker_counters.items()}
+    budget_counts = token_counts[_worker_budget_on]
+    
+    if _worker_output_format == "jsonl":
+        # Format as JSONL
+        output = ("".join(json.dumps({"text": abstract}, ensure_ascii=False) + "\n" for abstract in kept),)
+    else:
+        output = (kept, budget_counts)
+    counts = {
+        "total_abstracts": len(kept),
+        "total_tokens": sum(budget_counts),
+        "skipped_empty": skipped_empty,
+        "skipped_short": skipped_short,
+        **{f"total_tokens_{name}": sum(counts) for name, counts in token_counts.items()},
+    }
+    return output, counts
 
+def process_row_range(row_range):
+    """Process the abstracts of rows [start, end) of the worker's dataset (only the row range is pickled)."""
+    start, end = row_range
+    return process_abstracts(_worker_dataset[start:end]["abstract"])
+
+def process_row_indices(indices):
+    """Process the abstracts of the given rows of the worker's dataset."""
+    return process_abstracts(_worker_dataset[indices]["abstract"])
+
+
+def counted_tokenizers(args):
+    """Tokenizers counted, by role: `source` (--tokenizer) and, with --target-tokenizer, `target`."""
+    tokenizers = {"source": args.tokenizer}
+    if args.target_tokenizer:
+        tokenizers["target"] = args.target_tokenizer
+    return tokenizers
+
+
+def calibrate(tokenizer_name, abstracts, tokenizer_service=None):
+    """
+    Tokens per character of a tokenizer on a sample of (valid, stripped) abstracts, and the relative error of the
+    total token count of the second half of the sample estimated from a ratio fitted on the first half.
+    """
+    tokenizer = load_counter(tokenizer_name, tokenizer_service)
+    tokens = np.array(count_tokens(abstracts, "exact", tokenizer), dtype=np.float64)
+    chars = np.array([len(abstract) for abstract in abstracts], dtype=np.float64)
+    half = len(abstracts) // 2
+    holdout_error = None
+    if half > 0:
+        fitted = tokens[:half].sum() / chars[:half].sum()
+        holdout_error = float(abs(fitted * chars[half:].sum() - tokens[half:].sum()) / tokens[half:].sum())
+    return {
+        "tokenizer": tokenizer_name,
+        "tokens_per_char": float(tokens.sum() / chars.sum()),
+        "num_docs": len(abstracts),
+        "holdout_error": holdout_error,
+    }
+
+
+def token_counters(args, calibration=None, sample=None):
+    """
+    (counters for `init_worker`, calibration by role). With --count-mode estimate, tokens are estimated from the
+    characters of each abstract with the ratio of `calibration` (of a resumed cursor) or calibrated on `sample()`.
+    """
+    tokenizers = counted_tokenizers(args)
+    if args.count_mode == "exact":
+        return {name: ("exact", tokenizer) for name, tokenizer in tokenizers.items()}, None
+    if calibration is None:
+        abstracts = sample()
+        if not abstracts:
+            raise ValueError("No valid abstract to calibrate the token estimate on.")
+        calibration = {name: calibrate(tokenizer, abstracts, args.tokenizer_service) for name, tokenizer in tokenizers.items()}
+    for name, result in calibration.items():
+        error = "n/a" if result["holdout_error"] is None else f"{100 * result['holdout_error']:.2f}%"
+        print(f"   {name} tokenizer {result['tokenizer']}: {result['tokens_per_char']:.4f} tokens/char "
+              f"on {result['num_docs']:,} abstracts, held-out total error {error}")
+    return {name: ("estimate", result["tokens_per_char"]) for name, result in calibration.items()}, calibration
+
+
+def valid_abstracts(abstracts):
+    """The stripped abstracts `process_abstracts` keeps."""
+    return [abstract for abstract in ((abstract or '').strip() for abstract in abstracts) if len(abstract) >= MIN_CHARS]
+
+
+def stripped_lengths(dataset):
+    """Characters of each stripped abstract of an Arrow-backed dataset, computed without converting rows to Python."""
+    column = dataset.data.column("abstract")
+    return pc.utf8_length(pc.utf8_trim_whitespace(column)).fill_null(0).to_numpy(zero_copy_only=False)
+
+
+class JsonlWriter:
+    """Appends JSONL text to the output file, truncated first to `output_bytes`."""
+
+    def __init__(self, output_file, output_bytes=0, sync=True):
+        Path(output_file).parent.mkdir(parents=True, exist_ok=True)
+        # drops the lines written after the last cursor
+        with open(output_file, 'ab') as f:
+            f.truncate(output_bytes)
+        self.file = open(output_file, 'a', encoding='utf-8')
+        self.sync = sync
+
+    def add(self, text):
+        """Write a batch, returns whether it is durable (always, when syncing)."""
+        self.file.write(text)
+        if self.sync:
+            self.file.flush()
+            os.fsync(self.file.fileno())
+        return self.sync
+
+    def close(self):
+        self.file.close()
+        return False
+
+
+def output_path(args):
+    """The JSONL file, or the folder of the shards (`pubmed-corpus.json` -> `pubmed-corpus/`)."""
+    output_file = Path(args.output_file)
+    return output_file if args.output_format == "jsonl" else output_file.with_suffix("")
+
+
+def open_writer(args, state=None, sync=True):
+    """Writer of the output format, positioned at the cursor `state` (None starts over)."""
+    if args.output_format == "jsonl":
+        return JsonlWriter(output_path(args), 0 if state is None else state["output_bytes"], sync=sync)
+    return CorpusShardWriter(
+        str(output_path(args)),
+        args.output_format,
+        args.shard_size_mb,
+        tokenizer=counted_tokenizers(args)[args.budget_on],
+        token_counts=args.count_mode,
+        num_shards=None if state is None else state["output_shards"],
+    )
+
+
+def writer_position(writer):
+    """Position of the durable output, saved in the cursor."""
+    if isinstance(writer, JsonlWriter):
+        return {"output_bytes": writer.file.tell()}
+    return {"output_shards": writer.num_shards}
+
+
+def has_output(args):
+    output = output_path(args)
+    if args.output_format == "jsonl":
+        return output.exists() and output.stat().st_size > 0
+    return any(output.glob("shard-*"))
+
+
+def budget_path(output_file):
+    """Token counting settings, calibration and totals of the last build."""
+    return Path(str(output_file) + ".budget.json")
+
+
+def cursor_path(output_file):
+    return Path(str(output_file) + ".cursor.json")
+
+
+def load_cursor(output_file):
+    path = cursor_path(output_file)
+    if not path.exists():
+        return None
+    with open(path, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+
+def save_cursor(output_file, cursor):
+    """Write the cursor atomically, so a crash leaves either the previous or the new one."""
+    path = cursor_path(output_file)
+    tmp_path = Path(str(path) + ".tmp")
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(cursor, f, indent="\t")
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+def resolve_shards(source, data_files=None):
+    """(builder name, sorted shard files) of a HuggingFace dataset, a local directory or explicit data files."""
+    if data_files:
+        suffixes = {Path(data_file.split("?")[0].removesuffix(".gz")).suffix for data_file in data_files}
+        if len(suffixes) != 1 or suffixes.pop() not in DATA_FILE_FORMATS:
+            raise ValueError(f"Data files must share one format of {sorted(DATA_FILE_FORMATS)}: {data_files}")
+        builder_name = DATA_FILE_FORMATS[Path(data_files[0].split("?")[0].removesuffix(".gz")).suffix]
+        return builder_name, list(data_files)
+    # only resolves the file list, nothing is downloaded
+    builder = load_dataset_builder(source)
+    return builder.name, sorted(builder.config.data_files["train"])
+
+
+def stream_batches(builder_name, shards, shard_index=0, offset=0, batch_size=BATCH_SIZE):
+    """
+    Yields (abstracts, cursor) with the cursor just after the batch: (shard index, rows read in that shard). Batches
+    do not cross shards, the cursor after the last batch of a shard points at the start of the next one. Batches are
+    read as Arrow tables and only the `abstract` column is converted to Python.
+    """
+    for index in range(shard_index, len(shards)):
+        shard = load_dataset(builder_name, data_files=[shards[index]], split="train", streaming=True)
+        skip = offset if index == shard_index else 0
+        position = 0
+        for batch in shard.with_format("arrow").iter(batch_size=batch_size):
+            # the rows before the cursor are skipped here, `IterableDataset.skip` would drop the Arrow formatting
+            if position + batch.num_rows <= skip:
+                position += batch.num_rows
+                continue
+            if position < skip:
+                batch = batch.slice(skip - position)
+                position = skip
+            position += batch.num_rows
+            yield batch.column("abstract").to_pylist(), (index, position)
+        yield [], (index + 1, 0)
+
+
+def ordered_results(pool, batches, window):
+    """Process batches on the pool in order, with at most `window` batches read ahead (`imap` would read them all)."""
+    pending = deque()
+    for batch, cursor in batches:
+        pending.append((pool.apply_async(process_abstracts, (batch,)), cursor))
+        if len(pending) >= window:
+            result, cursor = pending.popleft()
+            yield result.get(), cursor
+    while pending:
+        result, cursor = pending.popleft()
+        yield result.get(), cursor
+
+
+def count_keys(args):
+    """Counts summed over the batches: abstracts kept and skipped, tokens of the budget and of each tokenizer."""
+    return ["total_tokens", "total_abstracts", "skipped_empty", "skipped_short"] + [
+        f"total_tokens_{name}" for name in counted_tokenizers(args)
+    ]
+
+
+def build_streaming(args, num_workers):
+    """Streaming, resumable build, see the module docstring."""
+    output = output_path(args)
+    print(f"\n📥 Resolving the shards of {args.data_files or args.source}")
+    builder_name, shards = resolve_shards(args.source, args.data_files)
+    print(f"✓ {len(shards)} {builder_name} shards")
+
+    state = {
+        "source": args.source if not args.data_files else None,
+        "shards": shards,
+        "output_format": args.output_format,
+        "tokenizers": counted_tokenizers(args),
+        "count_mode": args.count_mode,
+        "budget_on": args.budget_on,
+        "calibration": None,
+        "shard_index": 0,
+        "offset": 0,
+        **dict.fromkeys(count_keys(args), 0),
+    }
+    cursor = load_cursor(output)
+    if cursor is not None:
+        if cursor["shards"] != shards:
+            raise ValueError(f"The cursor {cursor_path(output)} was written for other source shards, remove it to start over.")
+        if cursor.get("output_format", "jsonl") != args.output_format:
+            raise ValueError(f"The cursor {cursor_path(output)} was written for {cursor.get('output_format', 'jsonl')} output.")
+        # cursors of builds before token estimates counted exactly with --tokenizer
+        counting = {"tokenizers": {"source": args.tokenizer}, "count_mode": "exact", "budget_on": "source"}
+        counting.update({key: cursor[key] for key in counting if key in cursor})
+        if counting != {key: state[key] for key in counting}:
+            raise ValueError(f"The cursor {cursor_path(output)} was written counting tokens with {counting}.")
+        state.update(cursor)
+        if "total_tokens_source" not in cursor:
+            state["total_tokens_source"] = cursor["total_tokens"]
+        print(f"↻ Resuming at shard {state['shard_index']} row {state['offset']:,} with {state['total_tokens']:,} tokens")
+    elif has_output(args):
+        raise ValueError(f"{output} exists without a cursor, remove it to start over.")
+
+    writer = open_writer(args, state if cursor is not None else None)
+    state.update(writer_position(writer))
+    if state["total_tokens"] >= args.target_tokens or state["shard_index"] >= len(shards):
+        writer.close()
+        print("✓ Nothing left to do")
+        return state
+
+    def sample():
+        # the first valid abstracts of the stream (a resumed build reuses the calibration of the cursor)
+        abstracts = []
+        for batch, _ in stream_batches(builder_name, shards, batch_size=args.batch_size):
+            abstracts.extend(valid_abstracts(batch))
+            if len(abstracts) >= args.calibration_docs:
+                break
+        return abstracts[:args.calibration_docs]
+
+    counters, state["calibration"] = token_counters(args, state["calibration"], sample)
+
+    # counts of the batches not yet durable in the output
+    pending = dict.fromkeys(count_keys(args), 0)
+
+    def commit(position):
+        state.update({key: state[key] + value for key, value in pending.items()})
+        state.update(shard_index=position[0], offset=position[1], **writer_position(writer))
+        pending.update(dict.fromkeys(pending, 0))
+        save_cursor(output, state)
+
+    batches = stream_batches(builder_name, shards, state["shard_index"], state["offset"], args.batch_size)
+    position = (state["shard_index"], state["offset"])
+    initargs = (counters, None, args.output_format, args.budget_on, args.tokenizer_service)
+    with Pool(processes=num_workers, initializer=init_worker, initargs=initargs) as pool, \
+            tqdm(total=args.target_tokens, initial=state["total_tokens"], unit="tok", desc="Collecting tokens") as progress:
+        for (output_batch, counts), position in ordered_results(pool, batches, 2 * num_workers):
+            for key, value in counts.items():
+                pending[key] += value
+            if writer.add(*output_batch):
+                commit(position)
+            progress.update(counts["total_tokens"])
+            if state["total_tokens"] + pending["total_tokens"] >= args.target_tokens:
+                print(f"\n✓ Reached target of {args.target_tokens:,} tokens!")
+                break
+    if writer.close():
+        commit(position)
+    return state
+
+
+def build(args, num_workers):
+    """Download the whole dataset and convert it (the output is rewritten from scratch)."""
+    output = output_path(args)
 
-def main():
-    """Main function to download and format PubMed abstracts."""
-    print("=" * 70)
-    print("PubMed Abstract Corpus Preparation from HuggingFace")
-    print("=" * 70)
-    
-    # Load tokenizer for counting tokens
-    print(f"\n🔤 Loading tokenizer: {TOKENIZER_NAME}")
-    try:
-        tokenizer = AutoTokenizer.from_pretrained(TOKENIZER_NAME)
-        print("✓ Tokenizer loaded")
-    except Exception as e:
-        print(f"✗ Failed to load tokenizer: {e}")
-        sys.exit(1)
-    
     # Load dataset from HuggingFace
-    print(f"\n📥 Loading dataset from HuggingFace: uiyunkim-hub/pubmed-abstract")
+    print(f"\n📥 Loading dataset from HuggingFace: {args.source}")
     print("   Note: You may need to login using `huggingface-cli login` if the dataset is gated")
     try:
-        dataset = load_dataset("uiyunkim-hub/pubmed-abstract", split="train")
+        if args.data_files:
+            builder_name, data_files = resolve_shards(args.source, args.data_files)
+            dataset = load_dataset(builder_name, data_files=data_files, split="train")
+        else:
+            dataset = load_dataset(args.source, split="train")
         print(f"✓ Dataset loaded: {len(dataset):,} abstracts")
     except Exception as e:
         print(f"✗ Failed to load dataset: {e}")
         print("   Try running: huggingface-cli login")
         sys.exit(1)
     
-    # Create output directory
-    OUTPUT_FILE.parent.mkdir(parents=True, exist_ok=True)
-    
-    # Process abstracts and write to JSONL format
-    print(f"\n📝 Converting to JSONL format...")
-    print(f"   Target: {TARGET_TOKENS:,} tokens")
-    print(f"   Output: {OUTPUT_FILE}")
-    
-    # Determine number of workers
-    if NUM_WORKERS is not None:
-        num_workers = NUM_WORKERS
-    else:
-        # Auto-detect but cap at MAX_WORKERS to avoid overhead
-        detected_cores = cpu_count()
-        num_workers = min(detected_cores, MAX_WORKERS)
-        if detected_cores > MAX_WORKERS:
-            print(f"   Detected {detected_cores} CPU cores, capping at {MAX_WORKERS} workers")
+    # Process abstracts and write to JSONL format (or shards)
+    print(f"\n📝 Converting to {args.output_format} format...")
+    print(f"   Target: {args.target_tokens:,} tokens")
+    print(f"   Output: {output}")
     
     print(f"   Using {num_workers} CPU cores for parallel processing")
-    print(f"   Batch size: {BATCH_SIZE} abstracts per batch\n")
+    print(f"   Batch size: {args.batch_size} abstracts per batch\n")
     
-    total_tokens = 0
-    total_abstracts = 0
-    skipped_empty = 0
-    skipped_short = 0
+    totals = dict.fromkeys(count_keys(args), 0)
     
-    # Create batches - process in chunks to avoid loading entire dataset into memory
-    # We'll process the dataset iteratively rather than converting to list
-    print(f"   Creating batches from dataset (this may take a moment for large datasets)...")
-    
-    # Process in chunks to avoid memory issues
-    # We'll create batches on-the-fly rather than loading everything
-    def create_batches():
-        """Generator that yields batches from the dataset."""
-        batch = []
-        for item in dataset:
-            batch.append(item)
-            if len(batch) >= BATCH_SIZE:
-                yield batch
-                batch = []
-        if batch:  # Yield remaining items
-            yield batch
-    
-    # Count total batches (approximate, for progress bar)
+    # Workers read row ranges (or rows) of the memory-mapped dataset themselves (pickling a memory-mapped dataset
+    # only sends its cache file paths), so the main process never builds or pickles the rows
+    dataset = dataset.select_columns(["abstract"])
     total_items = len(dataset)
-    total_batches = (total_items + BATCH_SIZE - 1) // BATCH_SIZE
-    print(f"   Dataset has {total_items:,} items, will create ~{total_batches:,} batches\n")
+    rng = np.random.default_rng(args.seed)
+    if args.selection == "random" or args.count_mode == "estimate":
+        lengths = stripped_lengths(dataset)
+        valid = lengths >= MIN_CHARS
+
+    def sample():
+        # a seeded random sample of the valid abstracts
+        rows = np.flatnonzero(valid)
+        rows = np.sort(rng.choice(rows, size=min(args.calibration_docs, len(rows)), replace=False))
+        return valid_abstracts(dataset[rows]["abstract"])
+
+    counters, calibration = token_counters(args, sample=sample)
+    if args.selection == "first":
+        tasks = [(start, min(start + args.batch_size, total_items)) for start in range(0, total_items, args.batch_size)]
+        process = process_row_range
+    else:
+        order = rng.permutation(total_items)
+        if args.count_mode == "estimate":
+            # the shortest prefix of the permutation reaching the target by estimate, read in dataset order
+            _, ratio = counters[args.budget_on]
+            estimates = np.where(valid, np.maximum(1, np.round(ratio * lengths)), 0)[order]
+            order = np.sort(order[:np.searchsorted(np.cumsum(estimates), args.target_tokens) + 1])
+            print(f"   Selected {len(order):,} random abstracts, ~{int(estimates[:len(order)].sum()):,} estimated tokens")
+        tasks = [np.sort(order[start:start + args.batch_size]) for start in range(0, len(order), args.batch_size)]
+        process = process_row_indices
+    print(f"   Dataset has {total_items:,} items, will create {len(tasks):,} batches\n")
     
     print(f"   Initializing {num_workers} worker processes (this may take a moment)...")
     
-    with open(OUTPUT_FILE, 'w', encoding='utf-8') as jsonfile:
+    writer = open_writer(args, sync=False)
+    try:
         try:
             # Process batches in parallel
-            # Initialize each worker with the tokenizer
-            with Pool(processes=num_workers, initializer=init_worker, initargs=(TOKENIZER_NAME,)) as pool:
+            # Initialize each worker with the tokenizer and the dataset
+            initargs = (counters, dataset, args.output_format, args.budget_on, args.tokenizer_service)
+            with Pool(processes=num_workers, initializer=init_worker, initargs=initargs) as pool:
                 print("   Workers initialized. Starting batch processing...\n")
                 
                 # Use imap for progress tracking
-                batch_generator = create_batches()
-                results = pool.imap(process_abstract_batch, batch_generator)
+                results = pool.imap(process, tasks)
                 
-                for batch_results, batch_empty, batch_short in tqdm(
+                for output_batch, counts in tqdm(
                     results, 
-                    total=total_batches,
+                    total=len(tasks),
                     desc="Processing batches"
                 ):
-                    skipped_empty += batch_empty
-                    skipped_short += batch_short
-                    
                     # Write results from this batch
-                    for json_line, token_count in batch_results:
-                        jsonfile.write(json_line + "\n")
-                        total_tokens += token_count
-                        total_abstracts += 1
+                    writer.add(*output_batch)
+                    for key, value in counts.items():
+                        totals[key] += value
                     
                     # Check if we've reached target
-                    if total_tokens >= TARGET_TOKENS:
-                        print(f"\n✓ Reached target of {TARGET_TOKENS:,} tokens!")
+                    if totals["total_tokens"] >= args.target_tokens:
+                        print(f"\n✓ Reached target of {args.target_tokens:,} tokens!")
                         break
         except KeyboardInterrupt:
             print("\n⚠ Interrupted by user. Partial results saved.")
@@ -191,26 +544,117 @@ def main():
             print(f"\n✗ Error during processing: {e}")
             print("   Partial results may have been saved.")
             raise
+    finally:
+        writer.close()
+    
+    return totals, calibration, total_items
+
+
+def main():
+    """Main function to download and format PubMed abstracts."""
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-s", "--source", type=str, default=DATASET_NAME, help="HuggingFace dataset or local directory.")
+    parser.add_argument("-d", "--data-files", type=str, nargs="+", default=None, help="Data files (paths or http(s) URLs) read instead of --source.")
+    parser.add_argument("-o", "--output-file", type=str, default=str(OUTPUT_FILE))
+    parser.add_argument("-t", "--target-tokens", type=int, default=TARGET_TOKENS)
+    parser.add_argument("-k", "--tokenizer", type=str, default=TOKENIZER_NAME)
+    parser.add_argument("-b", "--batch-size", type=int, default=BATCH_SIZE)
+    parser.add_argument("-n", "--num-workers", type=int, default=NUM_WORKERS)
+    parser.add_argument("--streaming", action="store_true", help="Stream the source and resume from the cursor next to the output.")
+    parser.add_argument("-f", "--output-format", type=str, default="jsonl", choices=("jsonl",) + SHARD_FORMATS, help="A JSONL file, or arrow/parquet shards with a manifest.")
+    parser.add_argument("--shard-size-mb", type=float, default=SHARD_SIZE_MB, help="Text per shard with --output-format arrow/parquet.")
+    parser.add_argument("--count-mode", type=str, default="exact", choices=("exact", "estimate"), help="Tokenize every abstract, or estimate its tokens from its characters with a calibrated ratio.")
+    parser.add_argument("--calibration-docs", type=int, default=CALIBRATION_DOCS, help="Abstracts tokenized to calibrate --count-mode estimate.")
+    parser.add_argument("--target-tokenizer", type=str, default=None, help="Also count tokens with this tokenizer (e.g. microsoft/biogpt).")
+    parser.add_argument("--budget-on", type=str, default="source", choices=("source", "target"), help="Tokenizer the --target-tokens budget is counted with: --tokenizer or --target-tokenizer.")
+    parser.add_argument("--selection", type=str, default="first", choices=("first", "random"), help="Take abstracts in dataset order, or a seeded random subset (not with --streaming).")
+    parser.add_argument("--seed", type=int, default=42, help="Seed of --selection random and of the calibration sample.")
+    parser.add_argument("--tokenizer-service", type=str, default=None, help="Socket of src/tokenizer_service.py, counting with its tokenizers instead of one per worker.")
+    args = parser.parse_args()
+    if args.budget_on == "target" and not args.target_tokenizer:
+        parser.error("--budget-on target needs --target-tokenizer.")
+    if args.selection == "random" and args.streaming:
+        parser.error("--selection random needs the whole dataset, it is not available with --streaming.")
+
+    print("=" * 70)
+    print("PubMed Abstract Corpus Preparation from HuggingFace")
+    print("=" * 70)
     
+    # Load tokenizers for counting tokens
+    for tokenizer_name in counted_tokenizers(args).values():
+        print(f"\n🔤 Loading tokenizer: {tokenizer_name}")
+        try:
+            len(load_counter(tokenizer_name, args.tokenizer_service))
+            print("✓ Tokenizer loaded")
+        except Exception as e:
+            print(f"✗ Failed to load tokenizer: {e}")
+            sys.exit(1)
+    
+    output = output_path(args)
+
+    # Determine number of workers: one single-threaded tokenizer per core, capped at MAX_WORKERS to avoid overhead
+    plan = apply_policy("corpus")
+    num_workers = args.num_workers if args.num_workers is not None else min(plan["num_procs"], MAX_WORKERS)
+
+    if args.streaming:
+        print(f"\n📝 Streaming to {args.output_format} format...")
+        print(f"   Target: {args.target_tokens:,} tokens")
+        print(f"   Output: {output}")
+        print(f"   Using {num_workers} CPU cores, {args.batch_size} abstracts per batch")
+        totals = build_streaming(args, num_workers)
+        calibration, total_items = totals["calibration"], None
+    else:
+        totals, calibration, total_items = build(args, num_workers)
+    total_tokens, total_abstracts = totals["total_tokens"], totals["total_abstracts"]
+    skipped_empty, skipped_short = totals["skipped_empty"], totals["skipped_short"]
+    tokenizers = counted_tokenizers(args)
+    budget = {
+        "count_mode": args.count_mode,
+        "selection": args.selection,
+        "seed": args.seed,
+        "budget_on": args.budget_on,
+        "target_tokens": args.target_tokens,
+        "tokenizers": tokenizers,
+        "calibration": calibration,
+        "total_abstracts": total_abstracts,
+        "total_tokens": {name: totals[f"total_tokens_{name}"] for name in tokenizers},
+    }
+    with open(budget_path(output), 'w', encoding='utf-8') as f:
+        json.dump(budget, f, indent="\t")
+
     print(f"\n{'='*70}")
     print("✓ Process completed!")
     print(f"{'='*70}")
     print(f"\n📊 Statistics:")
     print(f"   Total abstracts: {total_abstracts:,}")
-    print(f"   Total tokens: {total_tokens:,}")
+    estimated = " (estimated)" if args.count_mode == "estimate" else ""
+    for name, tokenizer_name in tokenizers.items():
+        budget_mark = ", budget" if name == args.budget_on else ""
+        print(f"   Total tokens ({tokenizer_name}{budget_mark}): {totals[f'total_tokens_{name}']:,}{estimated}")
     print(f"   Skipped (empty): {skipped_empty:,}")
     print(f"   Skipped (too short): {skipped_short:,}")
-    print(f"   Output file: {OUTPUT_FILE}")
-    print(f"   File size: {OUTPUT_FILE.stat().st_size / (1024**3):.2f} GB")
-    
-    if total_tokens < TARGET_TOKENS:
-        print(f"\n⚠ Note: Collected {total_tokens:,} tokens (target: {TARGET_TOKENS:,})")
-        print(f"   This is normal - the dataset has {len(dataset):,} total abstracts")
-        print(f"   You can use all available abstracts or adjust TARGET_TOKENS")
-    
-    print(f"\n📁 Output file ready: {OUTPUT_FILE}")
-    print(f"   You can now use this file in convert2glove_corpus.sh")
+    if args.output_format == "jsonl":
+        print(f"   Output file: {output}")
+        print(f"   File size: {output.stat().st_size / (1024**3):.2f} GB")
+    else:
+        shards = list(output.glob("shard-*"))
+        print(f"   Output shards: {len(shards)} in {output}")
+        print(f"   Shard size: {sum(shard.stat().st_size for shard in shards) / (1024**3):.2f} GB")
+
+    if total_tokens < args.target_tokens:
+        print(f"\n⚠ Note: Collected {total_tokens:,} tokens (target: {args.target_tokens:,})")
+        if total_items is not None:
+            print(f"   This is normal - the dataset has {total_items:,} total abstracts")
+        else:
+            print(f"   This is normal - every shard of the source was read")
+        print(f"   You can use all available abstracts or adjust --target-tokens")
 
+    if args.output_format == "jsonl":
+        print(f"\n📁 Output file ready: {output}")
+        print(f"   You can now use this file in convert2glove_corpus.sh")
+    else:
+        print(f"\n📁 Output shards ready: {output}")
+        print(f"   You can now pass --corpus_manifest {output / 'manifest.json'} to process_dataset.py")
 
 if __name__ == "__main__":
     main()
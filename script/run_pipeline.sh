@@ -0,0 +1,18 @@
+#!/bin/sh
+
+# Auto-detect MAIN_DIR from script location
+SCRIPT_DIR="$(cd "$(dirname "$0")" && pwd)"
+export MAIN_DIR="$(cd "${SCRIPT_DIR}/.." && pwd)"
+cd ${MAIN_DIR}
+
+# JSON file of paths / parameters overriding the defaults (see `python src/pipeline.py --print-config`), or empty
+export PIPELINE_CONFIG=""
+if [ -n "${PIPELINE_CONFIG}" ]; then
+  CONFIG_PARAMETERS="-c ${PIPELINE_CONFIG}"
+else
+  CONFIG_PARAMETERS=""
+fi
+
+# Arguments are passed on, e.g. `bash script/run_pipeline.sh align --set pivot_count=500` or `--dry-run`
+mkdir -p ./log
+python -u src/pipeline.py ${CONFIG_PARAMETERS} "$@" 2>&1 | tee ./log/pipeline.log
@@ -19,6 +19,8 @@ export GLOVE_VECTOR_PATH2="${MAIN_DIR}/data/vec-mix-biogpt.txt"
 export TGT_ID_2_SRC_ID_GOLD_PATH="${MAIN_DIR}/data/Vocab_count/biogpt2pythia.json"
 # The output path of token alignment matrix
 export TGT_ID_2_SRC_ID_RES_PATH="${MAIN_DIR}/data/pythia2biogpt/align_matrix.json"
+# How each target token was aligned (gold / aligned / random)
+export TGT_PROVENANCE_PATH="${MAIN_DIR}/data/pythia2biogpt/align_provenance.json"
 
 
 # Stage-1: train glove vectors
@@ -54,4 +56,5 @@ python src/cal_trans_matrix.py \
     -s2 ${VOCAB_SIZE2} \
     -r -n 300 \
     -g ${TGT_ID_2_SRC_ID_GOLD_PATH} \
-    -o ${TGT_ID_2_SRC_ID_RES_PATH}
+    -o ${TGT_ID_2_SRC_ID_RES_PATH} \
+    -p ${TGT_PROVENANCE_PATH}
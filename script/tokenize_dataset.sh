@@ -11,26 +11,40 @@ export TOKENIZER_PATH="./data/pythia2biogpt/TokAlign-Init-1B"
 
 # export TRAIN_FILE="./data/pretrain-corpus/pile00.json"
 export TRAIN_FILE="./data/pretrain-corpus/pubmed-corpus.json"
+# Set to the manifest of shards written by `prepare_pubmed_corpus_hf.py --output-format arrow` (or deduplicated by
+# dedup_corpus.sh) to read them instead
+# export CORPUS_MANIFEST="./data/pretrain-corpus/pubmed-corpus-dedup/manifest.json"
+export CORPUS_MANIFEST=""
 
 # export DATASET_PATH="./data/pretrain-dataset/pile00-biogpt-tokenized"
 export DATASET_PATH="./data/pretrain-dataset/pubmed-biogpt-tokenized"
 
-# Auto-detect CPU workers (75% of cores, max 64)
-CPU_CORES=$(nproc 2>/dev/null || echo 4)
-NUM_WORKERS=$((CPU_CORES * 3 / 4))
-[ $NUM_WORKERS -gt 64 ] && NUM_WORKERS=64
-[ $NUM_WORKERS -lt 1 ] && NUM_WORKERS=1
-export NUM_WORKERS
+# NUM_WORKERS (one per core, or per core of CPU_BUDGET) and single-threaded tokenizers / BLAS in each of them
+eval "$(python src/resource_policy.py -s tokenize --print-env)"
 export BLOCK_SIZE=2048
+# Set to "--record_doc_boundaries" to store document lengths for `--use_doc_boundaries` in clm_train.py
+export ADD_PARAMETERS=""
+
+if [ -n "${CORPUS_MANIFEST}" ]; then
+  INPUT_PARAMETERS="--corpus_manifest ${CORPUS_MANIFEST}"
+else
+  INPUT_PARAMETERS="--train_file ${TRAIN_FILE}"
+fi
+# Set to the socket of a running `python src/tokenizer_service.py -s ...` so the workers share its tokenizers
+export TOKENIZER_SERVICE=""
+if [ -n "${TOKENIZER_SERVICE}" ]; then
+  INPUT_PARAMETERS="${INPUT_PARAMETERS} --tokenizer_service ${TOKENIZER_SERVICE}"
+fi
 
 # HF_DATASETS_OFFLINE=1 TRANSFORMERS_OFFLINE=1  # Commented out to allow model downloads if needed
 
 python -u src/process_dataset.py \
   --model_name_or_path ${MODLE_PATH} \
   --tokenizer_name ${TOKENIZER_PATH} \
-  --train_file ${TRAIN_FILE} \
+  ${INPUT_PARAMETERS} \
   --cache_dir ${CACHE_DIR} \
   --dataset_path_in_disk ${DATASET_PATH} \
   --preprocessing_num_workers ${NUM_WORKERS} \
   --block_size ${BLOCK_SIZE} \
+  ${ADD_PARAMETERS} \
   --output_dir ./log 2>&1 | tee ./log/process_dataset.log
\ No newline at end of file
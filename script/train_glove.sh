@@ -10,9 +10,11 @@ make
 
 CORPUS=$1
 SAVE_FILE=$2
-VOCAB_FILE=vocab.src.txt
-COOCCURRENCE_FILE=cooccurrence.src.bin
-COOCCURRENCE_SHUF_FILE=cooccurrence.shuf.src.bin
+# Intermediate files are named after the save file, so two trainings can run in the same folder at once
+SAVE_NAME=$(basename $SAVE_FILE)
+VOCAB_FILE=vocab.${SAVE_NAME}.txt
+COOCCURRENCE_FILE=cooccurrence.${SAVE_NAME}.bin
+COOCCURRENCE_SHUF_FILE=cooccurrence.shuf.${SAVE_NAME}.bin
 BUILDDIR=build
 VERBOSE=2
 # Reduce MEMORY to avoid integer overflow in GloVe's shuffle.c array_size calculation
@@ -24,7 +26,8 @@ VECTOR_SIZE=300
 MAX_ITER=15
 WINDOW_SIZE=15
 BINARY=2
-NUM_THREADS=64
+# Cores given by src/pipeline.py (or any CPU_BUDGET), 64 otherwise
+NUM_THREADS=${CPU_BUDGET:-64}
 X_MAX=10
 
 if hash python 2>/dev/null; then
@@ -9,86 +9,73 @@ cd ${MAIN_DIR}
 GPUNUM=$(nvidia-smi --list-gpus 2>/dev/null | wc -l || echo 1)
 CUDA_VISIBLE_DEVICES=$(seq -s, 0 $((GPUNUM-1)) 2>/dev/null || echo 0)
 export CUDA_VISIBLE_DEVICES
-GPU_MEMORY_MB=$(nvidia-smi --query-gpu=memory.total --format=csv,noheader,nounits 2>/dev/null | head -1 || echo 24000)
-CPU_CORES=$(nproc 2>/dev/null || echo 4)
-
-# Set batch size based on GPU memory
-if [ $GPU_MEMORY_MB -ge 80000 ]; then
-    TRAIN_BS=16
-elif [ $GPU_MEMORY_MB -ge 40000 ]; then
-    TRAIN_BS=8
-elif [ $GPU_MEMORY_MB -ge 24000 ]; then
-    TRAIN_BS=4
-else
-    TRAIN_BS=2
-fi
 
-# Calculate gradient accumulation (target effective batch = 128)
+# Effective batch over all GPUs; the micro-batch and gradient accumulation are chosen by the planner below
 TARGET_EFFECTIVE_BATCH=128
-GRADIENT_ACC=$((TARGET_EFFECTIVE_BATCH / (GPUNUM * TRAIN_BS)))
-[ $GRADIENT_ACC -lt 1 ] && GRADIENT_ACC=1
 
-# Set CPU workers (75% of cores, max 64)
-NUM_WORKERS=$((CPU_CORES * 3 / 4))
-[ $NUM_WORKERS -gt 64 ] && NUM_WORKERS=64
-[ $NUM_WORKERS -lt 1 ] && NUM_WORKERS=1
+# NUM_WORKERS data loader workers per rank (its share of the cores, or of CPU_BUDGET, less one) and the threads of
+# every rank, so the GPUNUM ranks do not oversubscribe the cores
+eval "$(python src/resource_policy.py -s train -r ${GPUNUM} --print-env)"
 
 export GPUNUM
-export TRAIN_BS
-export GRADIENT_ACC
-export NUM_WORKERS
 export MASTER_PORT=16899
 
 export MODEL="1b"
 
 export TGT="biogpt"
 
-# Use the initialized model from init_model.sh
-MODEL_NAME="./data/pythia2${TGT}/TokAlign-Init-1B"
+# Use the initialized model from init_model.sh (the paths can be set in the environment, e.g. by src/pipeline.py)
+MODEL_NAME=${MODEL_NAME:-"./data/pythia2${TGT}/TokAlign-Init-1B"}
 
 # export DATASET_PATH="./data/pretrain-dataset/pile00-${TGT}-tokenized"
-export DATASET_PATH="./data/pretrain-dataset/pubmed-${TGT}-tokenized"
-
-# Generate DeepSpeed config dynamically based on GPU count
-CONFIG_FILE="${MAIN_DIR}/data/Deepspeed-Configs/zero3.yaml"
-mkdir -p "$(dirname ${CONFIG_FILE})"
-cat > ${CONFIG_FILE} << EOF
-compute_environment: LOCAL_MACHINE
-deepspeed_config:
-  deepspeed_multinode_launcher: standard
-  offload_optimizer_device: none
-  offload_param_device: none
-  zero3_init_flag: true
-  zero3_save_16bit_model: true
-  zero_hpz_partition_size: ${GPUNUM}
-  zero_stage: 3
-distributed_type: DEEPSPEED
-downcast_bf16: 'no'
-machine_rank: 0
-main_training_function: main
-mixed_precision: bf16
-num_machines: 1
-num_processes: ${GPUNUM}
-rdzv_backend: static
-same_network: true
-tpu_env: []
-tpu_use_cluster: false
-tpu_use_sudo: false
-use_cpu: false
-EOF
-export CONFIG_FILE
+export DATASET_PATH=${DATASET_PATH:-"./data/pretrain-dataset/pubmed-${TGT}-tokenized"}
+# General-domain token store mixed into the full phase against regressions (tokenized with tokenize_dataset.sh), e.g.
+# "./data/pretrain-dataset/pile00-${TGT}-tokenized"; empty trains on DATASET_PATH only.
+export GENERAL_DATASET_PATH=${GENERAL_DATASET_PATH:-""}
+export GENERAL_WEIGHT=${GENERAL_WEIGHT:-0.2}
 
 export EVAL_BS=1
 
-export BLOCK_SIZE=2048
+export BLOCK_SIZE=${BLOCK_SIZE:-2048}
+export CHECKPOINT_POLICY="all"
+# Sequence length warmup `length:until_step,...` with the same tokens per step (e.g. "512:500,1024:1000"), empty trains on
+# BLOCK_SIZE blocks throughout.
+export SEQ_LENGTH_WARMUP=""
 
 export SEED=0
 
-export LR=6.4e-4
-export NUM_STEPS=2500
+# Choose ZeRO-2 / ZeRO-3 (and CPU offloading), the micro-batch size and gradient accumulation from a memory estimate
+# of the model, and write the accelerate config. Both phases run in one process group, so plan for all parameters.
+CONFIG_FILE="${MAIN_DIR}/data/Accelerate-Configs/${TGT}_plan.yaml"
+eval $(python src/distributed_planner.py \
+    -m ${MODEL_NAME} \
+    -s ${BLOCK_SIZE} \
+    -p ${CHECKPOINT_POLICY} \
+    -t all \
+    -g ${TARGET_EFFECTIVE_BATCH} \
+    -n ${GPUNUM} \
+    -o ${CONFIG_FILE} \
+    --print-env)
+export CONFIG_FILE
+echo "Distributed strategy: ${DISTRIBUTED_STRATEGY}, micro-batch ${TRAIN_BS}, gradient accumulation ${GRADIENT_ACC}, global batch ${GLOBAL_BATCH_SIZE}"
+
+# Stage-1 (embed-only) and stage-2 (all parameters) run as two phases of a single training run.
+export LR_S1=6.4e-4
+export LR_S2=5e-5
+export NUM_STEPS_S1=2500
+export NUM_STEPS_S2=2500
+# Switch to stage-2 early if the smoothed stage-1 loss does not improve for this many steps (0 disables).
+export PLATEAU_PATIENCE_S1=0
 export NUM_SAVE_STEPS=2500
-export EVAL_STEP=10000
-# NUM_WORKERS set by hardware detection above
+export EVAL_STEP=500
+# Fixed held-out blocks evaluated every EVAL_STEP steps (perplexity / bits-per-byte per token provenance group), e.g.
+# 256 (0 trains without evaluation).
+export EVAL_BLOCKS=0
+export TGT_PROVENANCE_PATH=${TGT_PROVENANCE_PATH:-"${MAIN_DIR}/data/pythia2${TGT}/align_provenance.json"}
+# Oversample blocks with rare aligned / random target tokens during the first steps, e.g. ${NUM_STEPS_S1} for the
+# embed-only phase (0 samples uniformly). Not available with GENERAL_DATASET_PATH.
+export RARE_TOKEN_SAMPLING_STEPS=0
+# NUM_WORKERS set by the resource policy above
 export LOGGING_STEPS=1
 
 export RESUME=False
@@ -97,7 +84,27 @@ export TRAIN_START_IDX=0
 
 export ADD_PARAMETERS=""
 
-PREFIX="${MODEL}/${SEED}_${TGT}_S1"
+if [ "${EVAL_BLOCKS}" -gt 0 ];
+then
+ADD_PARAMETERS="${ADD_PARAMETERS} --evaluation_strategy steps --eval_steps ${EVAL_STEP} --eval_blocks ${EVAL_BLOCKS} --per_device_eval_batch_size ${EVAL_BS}"
+fi
+
+if [ -n "${SEQ_LENGTH_WARMUP}" ];
+then
+ADD_PARAMETERS="${ADD_PARAMETERS} --seq_length_warmup ${SEQ_LENGTH_WARMUP}"
+fi
+
+if [ -f "${TGT_PROVENANCE_PATH}" ];
+then
+ADD_PARAMETERS="${ADD_PARAMETERS} --token_provenance_path ${TGT_PROVENANCE_PATH}"
+fi
+
+if [ "${RARE_TOKEN_SAMPLING_STEPS}" -gt 0 ];
+then
+ADD_PARAMETERS="${ADD_PARAMETERS} --rare_token_sampling_steps ${RARE_TOKEN_SAMPLING_STEPS}"
+fi
+
+PREFIX="${MODEL}/${SEED}_${TGT}"
 
 if [ "${RESUME}" != "False" ];
 then
@@ -105,54 +112,35 @@ PREFIX="${PREFIX}_resume"
 ADD_PARAMETERS="${ADD_PARAMETERS} --resume_from_checkpoint ${RESUME}"
 fi
 
-MODEL_DIR="${MAIN_DIR}/log/$PREFIX"
+MODEL_DIR=${MODEL_DIR:-"${MAIN_DIR}/log/$PREFIX"}
 LOG_FILE="${MAIN_DIR}/log/${PREFIX}.log"
 
 mkdir -p $MODEL_DIR
 
+PHASE_FILE="${MODEL_DIR}/phases.json"
+cat > ${PHASE_FILE} << EOF
+[
+  {"name": "embed_only", "trainable": ["embed"], "max_steps": ${NUM_STEPS_S1}, "learning_rate": ${LR_S1},
+   "lr_scheduler_type": "cosine", "warmup_ratio": 0.03, "plateau_patience": ${PLATEAU_PATIENCE_S1}},
+  {"name": "full", "trainable": "all", "max_steps": ${NUM_STEPS_S2}, "learning_rate": ${LR_S2},
+   "lr_scheduler_type": "cosine", "warmup_ratio": 0.03}
+]
+EOF
 
-accelerate launch \
-    --config_file ${CONFIG_FILE} \
-    --main_process_port ${MASTER_PORT} \
-    --num_processes ${GPUNUM} \
-    --num_machines 1 src/clm_train.py \
-    --model_name ${MODEL_NAME} \
-    --tokenizer_path ${MODEL_NAME} \
-    --dataset_name ${DATASET_PATH} \
-    --max_seq_length ${BLOCK_SIZE} \
-    --max_steps ${NUM_STEPS} \
-    --logging_steps ${LOGGING_STEPS} \
-    --save_steps ${NUM_SAVE_STEPS} \
-    --num_workers ${NUM_WORKERS} \
-    --bf16 True \
-    --packing True \
-    --output_dir ${MODEL_DIR} \
-    --per_device_train_batch_size ${TRAIN_BS} \
-    --gradient_accumulation_steps ${GRADIENT_ACC} \
-    --use_gradient_checkpointing \
-    --learning_rate ${LR}  \
-    --lr_scheduler_type "cosine" \
-    --weight_decay 0.01 \
-    --ignore_data_skip True \
-    --train_start_idx ${TRAIN_START_IDX} \
-    ${ADD_PARAMETERS} \
-    --warmup_ratio 0.03 \
-    --finetune_embed_only True \
-    --use_flash_attn True 2>&1 >$LOG_FILE
-
-# STAGE-2
-MODEL_NAME="./$MODEL_DIR/checkpoint-$NUM_STEPS"
-LR=5e-5
-export TRAIN_START_IDX=2560000
-
-export ADD_PARAMETERS=""
-
-PREFIX="${MODEL}/${SEED}_${TGT}_S2"
-
-MODEL_DIR="${MAIN_DIR}/log/$PREFIX"
-LOG_FILE="${MAIN_DIR}/log/${PREFIX}.log"
-
-mkdir -p $MODEL_DIR
+if [ -n "${GENERAL_DATASET_PATH}" ];
+then
+MIXTURE_FILE="${MODEL_DIR}/mixture.json"
+cat > ${MIXTURE_FILE} << EOF
+{
+  "sources": {"pubmed": "${DATASET_PATH}", "general": "${GENERAL_DATASET_PATH}"},
+  "stages": [
+    {"phase": "embed_only", "weights": {"pubmed": 1.0}},
+    {"weights": {"pubmed": $(python -c "print(1 - ${GENERAL_WEIGHT})"), "general": ${GENERAL_WEIGHT}}}
+  ]
+}
+EOF
+ADD_PARAMETERS="${ADD_PARAMETERS} --dataset_mixture ${MIXTURE_FILE}"
+fi
 
 accelerate launch \
     --config_file ${CONFIG_FILE} \
@@ -163,7 +151,7 @@ accelerate launch \
     --tokenizer_path ${MODEL_NAME} \
     --dataset_name ${DATASET_PATH} \
     --max_seq_length ${BLOCK_SIZE} \
-    --max_steps ${NUM_STEPS} \
+    --phase_schedule ${PHASE_FILE} \
     --logging_steps ${LOGGING_STEPS} \
     --save_steps ${NUM_SAVE_STEPS} \
     --num_workers ${NUM_WORKERS} \
@@ -173,12 +161,8 @@ accelerate launch \
     --per_device_train_batch_size ${TRAIN_BS} \
     --gradient_accumulation_steps ${GRADIENT_ACC} \
     --use_gradient_checkpointing \
-    --learning_rate ${LR}  \
-    --lr_scheduler_type "cosine" \
-    --weight_decay 0.01 \
+    --checkpoint_policy ${CHECKPOINT_POLICY} \
     --ignore_data_skip True \
     --train_start_idx ${TRAIN_START_IDX} \
     ${ADD_PARAMETERS} \
-    --warmup_ratio 0.03 \
     --use_flash_attn True 2>&1 >$LOG_FILE
-  
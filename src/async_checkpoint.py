@@ -0,0 +1,322 @@
+"""
+Asynchronous checkpointing: the training loop only pays for copying the weights and optimizer state to (pinned) host
+memory, and a background thread writes them as sharded safetensors while training continues.
+
+Each checkpoint is written to `checkpoint-N.tmp` and committed by renaming it to `checkpoint-N` once complete, so a
+crash never leaves a partial `checkpoint-N` behind; only the last `save_total_limit` committed checkpoints are kept.
+The stall of the training loop (waiting for the previous write + snapshot) and the background write time of every
+checkpoint are appended to `checkpoint_stats.jsonl` in the output directory.
+
+The layout is the one of `Trainer._save_checkpoint` (`model-0000X-of-0000Y.safetensors` + index, `optimizer.pt`,
+`scheduler.pt`, `rng_state.pth`, `trainer_state.json`), so `--resume_from_checkpoint` works as usual.
+"""
+import glob
+import json
+import os
+import re
+import shutil
+import threading
+import time
+
+import torch
+from safetensors.torch import save_file
+from transformers import PreTrainedModel, TrainerCallback, TrainerControl, TrainerState, TrainingArguments
+from transformers.trainer import OPTIMIZER_NAME, SCHEDULER_NAME, TRAINER_STATE_NAME, TRAINING_ARGS_NAME
+from transformers.trainer_utils import PREFIX_CHECKPOINT_DIR
+from transformers.utils import SAFE_WEIGHTS_INDEX_NAME, SAFE_WEIGHTS_NAME, WEIGHTS_NAME
+from transformers.utils.hub import convert_file_size_to_int
+
+STATS_NAME = "checkpoint_stats.jsonl"
+
+
+class HostSnapshot:
+    """Copies (nested) state dicts to host memory, reusing pinned buffers from one checkpoint to the next."""
+
+    def __init__(self, pin_memory=None):
+        self.pin_memory = torch.cuda.is_available() if pin_memory is None else pin_memory
+        self.buffers = {}
+
+    def _copy(self, key, tensor):
+        buffer = self.buffers.get(key)
+        if buffer is None or buffer.shape != tensor.shape or buffer.dtype != tensor.dtype:
+            buffer = torch.empty(tensor.shape, dtype=tensor.dtype, device="cpu", pin_memory=self.pin_memory)
+            self.buffers[key] = buffer
+        buffer.copy_(tensor.detach(), non_blocking=self.pin_memory)
+        return buffer
+
+    def _snapshot(self, key, value):
+        if torch.is_tensor(value):
+            return self._copy(key, value)
+        if isinstance(value, dict):
+            return {k: self._snapshot(key + (k,), v) for k, v in value.items()}
+        if isinstance(value, (list, tuple)):
+            return type(value)(self._snapshot(key + (i,), v) for i, v in enumerate(value))
+        return value
+
+    def __call__(self, state_dict, prefix=""):
+        snapshot = self._snapshot((prefix,), state_dict)
+        if self.pin_memory:
+            torch.cuda.synchronize()
+        return snapshot
+
+
+def shard_state_dict(state_dict, max_shard_size="10GB"):
+    """Split a state dict into shards of at most `max_shard_size` bytes (a tensor larger than that gets its own shard)."""
+    max_shard_size = convert_file_size_to_int(max_shard_size)
+    shards, current, current_size = [], {}, 0
+    for name, tensor in state_dict.items():
+        size = tensor.numel() * tensor.element_size()
+        if current and current_size + size > max_shard_size:
+            shards.append(current)
+            current, current_size = {}, 0
+        current[name] = tensor
+        current_size += size
+    if current or not shards:
+        shards.append(current)
+    return shards
+
+
+def save_sharded_safetensors(state_dict, save_directory, max_shard_size="10GB"):
+    """
+    Save a state dict in the sharded safetensors layout of `save_pretrained` (a single `model.safetensors` when it
+    fits in one shard). Tensors sharing storage (tied weights) are saved once. Returns the number of bytes written.
+    """
+    os.makedirs(save_directory, exist_ok=True)
+    seen, unique = set(), {}
+    for name, tensor in state_dict.items():
+        key = (tensor.untyped_storage().data_ptr(), tensor.storage_offset(), tuple(tensor.shape))
+        if key in seen:
+            continue
+        seen.add(key)
+        unique[name] = tensor.contiguous()
+
+    shards = shard_state_dict(unique, max_shard_size)
+    total_size = 0
+    weight_map = {}
+    for i, shard in enumerate(shards):
+        if len(shards) == 1:
+            filename = SAFE_WEIGHTS_NAME
+        else:
+            filename = SAFE_WEIGHTS_NAME.replace(".safetensors", f"-{i + 1:05d}-of-{len(shards):05d}.safetensors")
+        save_file(shard, os.path.join(save_directory, filename), metadata={"format": "pt"})
+        for name, tensor in shard.items():
+            weight_map[name] = filename
+            total_size += tensor.numel() * tensor.element_size()
+    if len(shards) > 1:
+        with open(os.path.join(save_directory, SAFE_WEIGHTS_INDEX_NAME), "w") as f:
+            json.dump({"metadata": {"total_size": total_size}, "weight_map": weight_map}, f, indent=2, sort_keys=True)
+    return total_size
+
+
+def shard_saved_model(output_dir, max_shard_size="10GB"):
+    """
+    Re-save a model written as a single file (FSDP / DeepSpeed save one `pytorch_model.bin`) as sharded safetensors,
+    in-process.
+    """
+    bin_path = os.path.join(output_dir, WEIGHTS_NAME)
+    safe_path = os.path.join(output_dir, SAFE_WEIGHTS_NAME)
+    if os.path.exists(bin_path):
+        state_dict = torch.load(bin_path, map_location="cpu", mmap=True, weights_only=True)
+        save_sharded_safetensors(state_dict, output_dir, max_shard_size=max_shard_size)
+        os.remove(bin_path)
+    elif os.path.exists(safe_path) and os.path.getsize(safe_path) > convert_file_size_to_int(max_shard_size):
+        from safetensors.torch import load_file
+
+        state_dict = load_file(safe_path)
+        save_sharded_safetensors(state_dict, output_dir, max_shard_size=max_shard_size)
+        # the single file is only removed once the shards and their index are written
+        if os.path.exists(os.path.join(output_dir, SAFE_WEIGHTS_INDEX_NAME)):
+            os.remove(safe_path)
+
+
+def commit_checkpoint(staging_dir, final_dir):
+    """
+    Atomically publish `staging_dir` as `final_dir`, keeping files other writers already put in `final_dir`. An
+    existing `final_dir` is renamed aside and only deleted once `staging_dir` took its place.
+    """
+    previous_dir = None
+    if os.path.isdir(final_dir):
+        # copied rather than moved, so that `final_dir` stays complete until it is replaced
+        for name in os.listdir(final_dir):
+            source, target = os.path.join(final_dir, name), os.path.join(staging_dir, name)
+            if os.path.exists(target):
+                continue
+            if os.path.isdir(source):
+                shutil.copytree(source, target)
+            else:
+                shutil.copy2(source, target)
+        previous_dir = final_dir + ".old"
+        shutil.rmtree(previous_dir, ignore_errors=True)
+        os.rename(final_dir, previous_dir)
+    os.rename(staging_dir, final_dir)
+    if previous_dir is not None:
+        shutil.rmtree(previous_dir)
+
+
+def rotate_checkpoints(output_dir, save_total_limit):
+    """Delete the oldest committed checkpoints beyond `save_total_limit`."""
+    if not save_total_limit:
+        return
+    pattern = re.compile(rf"^{PREFIX_CHECKPOINT_DIR}-(\d+)$")
+    checkpoints = []
+    for path in glob.glob(os.path.join(output_dir, f"{PREFIX_CHECKPOINT_DIR}-*")):
+        match = pattern.match(os.path.basename(path))
+        if match and os.path.isdir(path):
+            checkpoints.append((int(match.group(1)), path))
+    for _, path in sorted(checkpoints)[:-save_total_limit]:
+        shutil.rmtree(path, ignore_errors=True)
+
+
+class AsyncCheckpointer:
+    """
+    Runs checkpoint writes in a background thread, one at a time: a new save first waits for the previous one, so at
+    most one snapshot is held in host memory.
+        Args:
+            output_dir (str): Directory of the `checkpoint-N` folders and of `checkpoint_stats.jsonl`.
+            save_total_limit (int): Number of committed checkpoints to keep. Keep all if None.
+    """
+
+    def __init__(self, output_dir, save_total_limit=None):
+        self.output_dir = output_dir
+        self.save_total_limit = save_total_limit
+        self.thread = None
+        self.error = None
+        self.releases = {}
+
+    def wait(self):
+        """Block until the write in flight is committed. Returns the time waited."""
+        start = time.perf_counter()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise RuntimeError("Asynchronous checkpoint write failed.") from error
+        return time.perf_counter() - start
+
+    def release(self, step):
+        """Allow the checkpoint of `step` to be committed (see `submit`)."""
+        event = self.releases.pop(step, None)
+        if event is not None:
+            event.set()
+
+    def submit(self, step, write_fn, stats=None, wait_release=False):
+        """
+        Write `checkpoint-{step}` with `write_fn(staging_dir)` in the background, then commit and rotate.
+        With `wait_release`, the commit also waits for `release(step)`, e.g. until the `on_save` callbacks ran.
+        """
+        staging_dir = os.path.join(self.output_dir, f"{PREFIX_CHECKPOINT_DIR}-{step}.tmp")
+        final_dir = os.path.join(self.output_dir, f"{PREFIX_CHECKPOINT_DIR}-{step}")
+        release = None
+        if wait_release:
+            release = self.releases[step] = threading.Event()
+        stats = dict(stats or {}, step=step)
+
+        def run():
+            try:
+                start = time.perf_counter()
+                os.makedirs(staging_dir, exist_ok=True)
+                stats["bytes"] = write_fn(staging_dir)
+                stats["write_s"] = time.perf_counter() - start
+                if release is not None:
+                    release.wait()
+                commit_checkpoint(staging_dir, final_dir)
+                rotate_checkpoints(self.output_dir, self.save_total_limit)
+                with open(os.path.join(self.output_dir, STATS_NAME), "a") as f:
+                    f.write(json.dumps(stats) + "\n")
+            except Exception as e:
+                self.error = e
+
+        self.thread = threading.Thread(target=run, name=f"checkpoint-{step}", daemon=True)
+        self.thread.start()
+        return staging_dir
+
+    def close(self):
+        for step in list(self.releases):
+            self.release(step)
+        self.wait()
+
+
+def _async_save_checkpoint(trainer, checkpointer, max_shard_size, original_save_checkpoint):
+    snapshot = HostSnapshot()
+
+    def _save_checkpoint(model, trial, metrics=None):
+        args = trainer.args
+        unwrapped = trainer.accelerator.unwrap_model(trainer.model)
+        if (
+            trainer.is_deepspeed_enabled
+            or trainer.is_fsdp_enabled
+            or not isinstance(unwrapped, PreTrainedModel)
+            or args.push_to_hub
+            or args.metric_for_best_model is not None
+            or trial is not None
+        ):
+            # sharded engines, adapters and best-model tracking go through the synchronous Trainer path
+            return original_save_checkpoint(model, trial, metrics=metrics)
+
+        start = time.perf_counter()
+        wait_s = checkpointer.wait()
+        trainer.store_flos()
+        step = trainer.state.global_step
+        staging_dir = os.path.join(checkpointer.output_dir, f"{PREFIX_CHECKPOINT_DIR}-{step}.tmp")
+        os.makedirs(staging_dir, exist_ok=True)
+
+        # small files are written synchronously, every rank writes its RNG state
+        if not args.save_only_model:
+            trainer._save_rng_state(staging_dir)
+        if args.should_save:
+            unwrapped.config.save_pretrained(staging_dir)
+            if getattr(unwrapped, "generation_config", None) is not None and unwrapped.can_generate():
+                unwrapped.generation_config.save_pretrained(staging_dir)
+            if trainer.tokenizer is not None:
+                trainer.tokenizer.save_pretrained(staging_dir)
+            torch.save(args, os.path.join(staging_dir, TRAINING_ARGS_NAME))
+            if not args.save_only_model:
+                torch.save(trainer.lr_scheduler.state_dict(), os.path.join(staging_dir, SCHEDULER_NAME))
+            trainer.state.stateful_callbacks["TrainerControl"] = trainer.control.state()
+            trainer.state.save_to_json(os.path.join(staging_dir, TRAINER_STATE_NAME))
+
+            snapshot_start = time.perf_counter()
+            model_state = snapshot(unwrapped.state_dict(), prefix="model")
+            optimizer_state = None if args.save_only_model else snapshot(trainer.optimizer.state_dict(), prefix="optimizer")
+            snapshot_s = time.perf_counter() - snapshot_start
+
+            def write(directory):
+                size = save_sharded_safetensors(model_state, directory, max_shard_size=max_shard_size)
+                if optimizer_state is not None:
+                    torch.save(optimizer_state, os.path.join(directory, OPTIMIZER_NAME))
+                    size += os.path.getsize(os.path.join(directory, OPTIMIZER_NAME))
+                return size
+
+            stats = {"wait_s": wait_s, "snapshot_s": snapshot_s, "stall_s": time.perf_counter() - start}
+            checkpointer.submit(step, write, stats=stats, wait_release=True)
+        if args.world_size > 1:
+            trainer.accelerator.wait_for_everyone()
+
+    return _save_checkpoint
+
+
+class AsyncCheckpointCallback(TrainerCallback):
+    """Releases the commit of a checkpoint once the `on_save` callbacks before it ran, and drains writes at the end."""
+
+    def __init__(self, checkpointer):
+        self.checkpointer = checkpointer
+
+    def on_save(self, args: TrainingArguments, state: TrainerState, control: TrainerControl, **kwargs):
+        self.checkpointer.release(state.global_step)
+        return control
+
+    def on_train_end(self, args: TrainingArguments, state: TrainerState, control: TrainerControl, **kwargs):
+        self.checkpointer.close()
+        return control
+
+
+def enable_async_checkpointing(trainer, max_shard_size="10GB"):
+    """
+    Make `trainer` save its `checkpoint-N` folders asynchronously. The callback is added last, so that files written
+    by other callbacks' `on_save` (e.g. `phase_schedule.json`) are part of the committed checkpoint.
+    """
+    checkpointer = AsyncCheckpointer(trainer.args.output_dir, save_total_limit=trainer.args.save_total_limit)
+    trainer._save_checkpoint = _async_save_checkpoint(trainer, checkpointer, max_shard_size, trainer._save_checkpoint)
+    trainer.add_callback(AsyncCheckpointCallback(checkpointer))
+    return checkpointer
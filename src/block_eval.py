@@ -0,0 +1,154 @@
+"""
+Bounded periodic evaluation on a fixed held-out set of blocks.
+
+A seeded selection of `num_blocks` validation blocks is materialized once (through the same `ConstantLengthDataset`
+path as training) and evaluated in no-grad batches. Per-token losses are reduced in a single vectorized pass
+(`bincount` over the provenance group of each target token), which gives:
+    loss / perplexity / bpb: over all target tokens, bpb being bits per UTF-8 byte of the target text.
+    {group}_perplexity / {group}_bpb / {group}_token_frac: per target-token provenance group (gold / aligned /
+    random, see token_provenance.py), when the provenance file is given.
+
+The LM head is applied `chunk_size` positions at a time, so the full-vocab logits of a batch are never materialized.
+"""
+import copy
+import itertools
+import math
+
+import numpy as np
+import torch
+import torch.distributed as dist
+import torch.nn.functional as F
+
+from token_provenance import PROVENANCE_GROUPS
+
+
+def materialize_eval_blocks(valid_dataset, num_blocks, seed=42):
+    """
+    Materialize `num_blocks` blocks of a `ConstantLengthDataset`, reading its rows in a seeded random order.
+    Returns a dict of `[num_blocks, seq_length]` LongTensors (`input_ids`, `labels` and `position_ids` if present), or
+    None when no block is available (empty validation split or `num_blocks` 0).
+    """
+    if num_blocks <= 0 or len(valid_dataset.dataset) == 0:
+        print("No evaluation blocks are available, block evaluation is skipped.")
+        return None
+    rng = np.random.default_rng(seed)
+    source = copy.copy(valid_dataset)
+    source.dataset = valid_dataset.dataset.select(rng.permutation(len(valid_dataset.dataset)))
+    source.infinite = False
+    source.shuffle = False
+    examples = list(itertools.islice(source.token_iter() if source.need_tokenize else source.direct_iter(), num_blocks))
+    if not examples:
+        print("No evaluation blocks are available, block evaluation is skipped.")
+        return None
+    if len(examples) < num_blocks:
+        print(f"Only {len(examples)} evaluation blocks are available, fewer than the {num_blocks} requested.")
+    return {key: torch.stack([example[key] for example in examples]) for key in examples[0]}
+
+
+def token_byte_lengths(tokenizer, vocab_size):
+    """
+    UTF-8 length of each token as it appears in running text (including its leading space), measured as the growth of
+    the decoded string when the token follows a short prefix. Special and out-of-tokenizer ids have length 0.
+    """
+    prefix = tokenizer("a", add_special_tokens=False)["input_ids"]
+    prefix_len = len(tokenizer.decode(prefix).encode("utf-8"))
+    special_ids = set(tokenizer.all_special_ids)
+    lengths = np.zeros(vocab_size, dtype=np.int32)
+    for token_id in range(min(len(tokenizer), vocab_size)):
+        if token_id in special_ids:
+            continue
+        lengths[token_id] = max(len(tokenizer.decode(prefix + [token_id]).encode("utf-8")) - prefix_len, 0)
+    return lengths
+
+
+@torch.no_grad()
+def evaluate_blocks(model, blocks, batch_size=8, token_groups=None, token_bytes=None, group_names=PROVENANCE_GROUPS, chunk_size=1024):
+    """
+    Evaluate a causal LM on materialized blocks, sharded over the processes of a distributed run.
+        Args:
+            token_groups (np.ndarray): Per-token group index into `group_names` (-1 for unknown), see
+                `load_token_provenance`. Only overall metrics are reported if None.
+            token_bytes (np.ndarray): Per-token UTF-8 length (`token_byte_lengths`) for bits-per-byte.
+    """
+    if hasattr(model, "get_base_model"):
+        model = model.get_base_model()
+    decoder = model.base_model
+    lm_head = model.get_output_embeddings()
+    device = next(model.parameters()).device
+
+    num_groups = len(group_names) + 1
+    groups = torch.as_tensor(token_groups if token_groups is not None else np.zeros(1, dtype=np.int64), dtype=torch.long, device=device)
+    nbytes = torch.as_tensor(token_bytes if token_bytes is not None else np.zeros(1), dtype=torch.float64, device=device)
+    # rows: loss sum, token count, byte count; columns: unknown group then `group_names`
+    sums = torch.zeros(3, num_groups, dtype=torch.float64, device=device)
+
+    num_processes = dist.get_world_size() if dist.is_initialized() else 1
+    process_index = dist.get_rank() if dist.is_initialized() else 0
+    num_blocks = blocks["input_ids"].shape[0] // num_processes * num_processes
+    indices = torch.arange(process_index, num_blocks, num_processes)
+    for start in range(0, len(indices), batch_size):
+        batch = {key: value[indices[start : start + batch_size]].to(device) for key, value in blocks.items()}
+        hidden = decoder(input_ids=batch["input_ids"], position_ids=batch.get("position_ids"), use_cache=False)[0]
+        hidden = hidden[:, :-1].reshape(-1, hidden.shape[-1])
+        labels = batch["labels"][:, 1:].reshape(-1)
+        losses = torch.cat([
+            F.cross_entropy(lm_head(hidden[i : i + chunk_size]).float(), labels[i : i + chunk_size].clamp(min=0), reduction="none")
+            for i in range(0, labels.shape[0], chunk_size)
+        ])
+
+        valid = (labels != -100).double()
+        targets = labels.clamp(min=0)
+        group_idx = groups[targets] + 1 if token_groups is not None else torch.zeros_like(targets)
+        sums[0] += torch.bincount(group_idx, weights=losses.double() * valid, minlength=num_groups)
+        sums[1] += torch.bincount(group_idx, weights=valid, minlength=num_groups)
+        if token_bytes is not None:
+            sums[2] += torch.bincount(group_idx, weights=nbytes[targets] * valid, minlength=num_groups)
+
+    if num_processes > 1:
+        dist.all_reduce(sums)
+    sums = sums.cpu().numpy()
+
+    def group_metrics(loss_sum, count, byte_count, prefix=""):
+        metrics = {f"{prefix}loss": loss_sum / count, f"{prefix}perplexity": math.exp(min(loss_sum / count, 100))}
+        if token_bytes is not None and byte_count > 0:
+            metrics[f"{prefix}bpb"] = loss_sum / math.log(2) / byte_count
+        return metrics
+
+    total = sums.sum(axis=1)
+    metrics = group_metrics(*total) if total[1] > 0 else {}
+    if token_groups is not None:
+        for name, (loss_sum, count, byte_count) in zip(("unknown",) + tuple(group_names), sums.T):
+            if count > 0:
+                metrics.update(group_metrics(loss_sum, count, byte_count, prefix=f"{name}_"))
+                metrics[f"{name}_token_frac"] = count / total[1]
+    return metrics
+
+
+def enable_block_eval(trainer, blocks, token_groups=None, token_bytes=None):
+    """
+    Replace `trainer.evaluate` (run every `eval_steps` with `evaluation_strategy="steps"`) by `evaluate_blocks` on
+    the materialized `blocks`, logged with the `eval_` prefix.
+    """
+
+    def evaluate(eval_dataset=None, ignore_keys=None, metric_key_prefix="eval"):
+        model = trainer.model
+        was_training = model.training
+        model.eval()
+        device_type = next(model.parameters()).device.type
+        dtype = torch.bfloat16 if trainer.args.bf16 else torch.float16 if trainer.args.fp16 else None
+        with torch.autocast(device_type=device_type, dtype=dtype, enabled=dtype is not None):
+            metrics = evaluate_blocks(
+                model,
+                blocks,
+                batch_size=trainer.args.per_device_eval_batch_size,
+                token_groups=token_groups,
+                token_bytes=token_bytes,
+            )
+        model.train(was_training)
+        metrics = {f"{metric_key_prefix}_{key}": value for key, value in metrics.items()}
+        trainer.log(metrics)
+        trainer.control = trainer.callback_handler.on_evaluate(trainer.args, trainer.state, trainer.control, metrics)
+        return metrics
+
+    trainer.evaluate = evaluate
+    return trainer
@@ -0,0 +1,138 @@
+"""
+Rare-token-aware block sampling for the embed-only stage.
+
+The embeddings that need the most training are the target tokens aligned by GloVe similarity or by the random
+fallback (see token_provenance.py), and among them the rare ones, which a uniform pass over the packed blocks seldom
+shows to the model. Each token gets a need score
+    need[t] = group_weights[provenance[t]] * frequency[t] ** -frequency_power
+from its provenance group and its frequency in the training set, and each packed block the sum of the needs of its
+tokens. Blocks are then drawn with replacement from
+    p[b] = (1 - mix) / num_blocks + mix * score[b] / sum(score)
+so every block keeps a non-zero probability. The scores are computed once, in a vectorized pass over the memory-mapped
+Arrow rows, into a compact float32 array (`block_scores.npy`, one entry per block) reused by later runs.
+"""
+import argparse
+import hashlib
+import json
+import os
+
+import numpy as np
+from datasets import load_from_disk
+
+from token_provenance import group_values_per_token, load_token_provenance, parse_group_values
+
+BLOCK_SCORES_NAME = "block_scores.npy"
+
+
+def _iter_token_batches(dataset, content_field="input_ids", batch_size=10000):
+    """(flat token ids, row offsets) of each batch of rows, read from the Arrow table without Python lists."""
+    for batch in dataset.with_format("arrow").iter(batch_size=batch_size):
+        column = batch[content_field].combine_chunks()
+        offsets = column.offsets.to_numpy()
+        yield column.flatten().to_numpy(), offsets - offsets[0]
+
+
+def token_frequencies(dataset, vocab_size, content_field="input_ids"):
+    """Count of each token id in a tokenized dataset."""
+    counts = np.zeros(vocab_size, dtype=np.int64)
+    for token_ids, _ in _iter_token_batches(dataset, content_field):
+        counts += np.bincount(token_ids, minlength=vocab_size)[:vocab_size]
+    return counts
+
+
+def token_needs(groups, frequencies, group_weights, frequency_power=0.5):
+    """Per-token need score: the weight of its provenance group, scaled up for rare tokens."""
+    needs = group_values_per_token(groups, group_weights, unknown_value=0.0).astype(np.float64)
+    return needs * np.maximum(frequencies, 1).astype(np.float64) ** -frequency_power
+
+
+def block_scores(dataset, needs, content_field="input_ids"):
+    """Sum of the token needs of every block, as a float32 array of `len(dataset)` entries."""
+    scores = []
+    for token_ids, offsets in _iter_token_batches(dataset, content_field):
+        cumulative = np.concatenate([[0.0], np.cumsum(needs[token_ids])])
+        scores.append(cumulative[offsets[1:]] - cumulative[offsets[:-1]])
+    return np.concatenate(scores).astype(np.float32)
+
+
+def sampling_probabilities(scores, mix=0.5):
+    uniform = np.full(len(scores), 1.0 / len(scores))
+    if scores.sum() <= 0:
+        return uniform
+    return (1 - mix) * uniform + mix * scores.astype(np.float64) / scores.astype(np.float64).sum()
+
+
+def file_sha1(path):
+    sha1 = hashlib.sha1()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            sha1.update(chunk)
+    return sha1.hexdigest()
+
+
+def compute_block_scores(dataset, provenance_path, vocab_size, group_weights, frequency_power=0.5, content_field="input_ids", cache_path=None):
+    """
+    Block scores of a tokenized dataset, loaded from `cache_path` when it was computed with the same settings, the same
+    provenance file content and the same dataset (its `datasets` fingerprint). The settings are stored next to the
+    array (`<cache_path>.json`).
+    """
+    settings = {
+        "num_blocks": len(dataset),
+        "dataset_fingerprint": getattr(dataset, "_fingerprint", None),
+        "provenance_path": os.path.abspath(provenance_path),
+        "provenance_sha1": file_sha1(provenance_path),
+        "vocab_size": vocab_size,
+        "group_weights": group_weights,
+        "frequency_power": frequency_power,
+    }
+    if cache_path is not None and os.path.exists(cache_path) and os.path.exists(cache_path + ".json"):
+        with open(cache_path + ".json", "r") as f:
+            if json.load(f) == settings:
+                return np.load(cache_path, mmap_mode="r")
+
+    groups = load_token_provenance(provenance_path, vocab_size=vocab_size)
+    frequencies = token_frequencies(dataset, vocab_size, content_field)
+    scores = block_scores(dataset, token_needs(groups, frequencies, group_weights, frequency_power), content_field)
+    if cache_path is not None:
+        os.makedirs(os.path.dirname(os.path.abspath(cache_path)), exist_ok=True)
+        np.save(cache_path, scores)
+        with open(cache_path + ".json", "w") as f:
+            json.dump(settings, f, indent="\t")
+    return scores
+
+
+def rare_token_sample_indices(scores, num_samples, mix=0.5, seed=42):
+    """
+    `num_samples` block indices drawn with replacement from the rare-token distribution, followed by one uniform pass
+    over every block in order (the data of the later training steps).
+    """
+    probabilities = sampling_probabilities(np.asarray(scores), mix=mix)
+    rng = np.random.default_rng(seed)
+    sampled = rng.choice(len(scores), size=num_samples, replace=True, p=probabilities)
+    uniform_mean, sampled_mean = float(np.mean(scores)), float(np.mean(np.asarray(scores)[sampled])) if num_samples > 0 else 0.0
+    print(f"Rare-token sampling of {num_samples} blocks: mean block score {sampled_mean:.4g} (uniform {uniform_mean:.4g}).")
+    return np.concatenate([sampled, np.arange(len(scores))])
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-d", "--dataset-path", type=str, required=True, help="Tokenized dataset saved by process_dataset.py.")
+    parser.add_argument("-p", "--provenance-path", type=str, required=True, help="Token provenance written by cal_trans_matrix.py.")
+    parser.add_argument("-v", "--vocab-size", type=int, required=True)
+    parser.add_argument("-g", "--group-weights", type=str, default="gold=0,aligned=1,random=2")
+    parser.add_argument("-a", "--frequency-power", type=float, default=0.5)
+    parser.add_argument("-o", "--output-path", type=str, default=None, help=f"Defaults to `{BLOCK_SCORES_NAME}` in the train split folder.")
+
+    args = parser.parse_args()
+
+    train_data = load_from_disk(args.dataset_path)["train"]
+    output_path = args.output_path or os.path.join(args.dataset_path, "train", BLOCK_SCORES_NAME)
+    scores = compute_block_scores(
+        train_data,
+        args.provenance_path,
+        args.vocab_size,
+        parse_group_values(args.group_weights),
+        frequency_power=args.frequency_power,
+        cache_path=output_path,
+    )
+    print(f"{len(scores)} block scores saved to {output_path} (mean {scores.mean():.4g}, max {scores.max():.4g}).")
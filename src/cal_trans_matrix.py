@@ -3,6 +3,8 @@ import json
 from tqdm import tqdm
 import random
 import argparse
+from token_provenance import PROVENANCE_GROUPS, save_token_provenance
+from resource_policy import apply_policy
 
 def load_glove_model(File):
     print("Loading Glove Model")
@@ -99,8 +101,10 @@ if __name__ == '__main__':
     parser.add_argument("-v", "--vanilla-representation", action='store_true')
     parser.add_argument("-n", "--pivotal-token-number", type=int, default=300)
     parser.add_argument("-o", "--output-path", type=str, default="./data/pythia2gemma/glove.json")
+    parser.add_argument("-p", "--provenance-output-path", type=str, default=None, help="Where to save how each target token was aligned (gold / aligned / random).")
 
     args = parser.parse_args()
+    apply_policy("linalg")
 
     # new tokenizer glove path
     g_p1 = args.target_glove_vector_path
@@ -138,18 +142,21 @@ if __name__ == '__main__':
     sim = np.matmul(rep1, rep2.T)
 
     td = {}
+    provenance = {group: [] for group in PROVENANCE_GROUPS}
     tids = [str(tid) for tid in range(g_vocab_len1)]
     supl_id = 0
     for tid in tqdm(tids, desc="Get the max prob target idx"):
         # gold label
         if tid in t2l_supl:
             td[tid] = t2l_supl[tid]
+            provenance["gold"].append(int(tid))
             supl_id += 1
             continue
 
         # missing token id: random pick
         if tid not in ids1:
             td[tid] = random.randint(0, g_vocab_len2-1)
+            provenance["random"].append(int(tid))
             supl_id += 1
             continue
 
@@ -164,8 +171,13 @@ if __name__ == '__main__':
             lid = ids2[lix.pop()]
 
         td[tid] = int(lid)
+        provenance["aligned"].append(int(tid))
 
     print(f"{supl_id} ids are suppled with gold transition dictionary.")
 
     with open(tgt_path, "w") as f:
         json.dump(td, f, indent="\t")
+
+    if args.provenance_output_path is not None:
+        save_token_provenance(provenance, args.provenance_output_path)
+        print(", ".join(f"{len(ids)} {group}" for group, ids in provenance.items()) + " target tokens.")
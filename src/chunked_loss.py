@@ -0,0 +1,116 @@
+"""
+Chunked LM head + cross-entropy for causal LM training.
+
+The `[batch, seq, vocab]` logits (and their float32 upcast for the loss) are never materialized: the forward pass
+projects `chunk_size` positions at a time and only keeps their log-sum-exp, and the backward pass recomputes the
+logits of one chunk at a time to build the gradients. Peak memory scales with `chunk_size * vocab` instead of
+`batch * seq * vocab`.
+"""
+import torch
+import torch.nn.functional as F
+from transformers.modeling_outputs import CausalLMOutputWithPast
+
+
+class ChunkedLinearCrossEntropy(torch.autograd.Function):
+    """Mean cross-entropy of `hidden @ weight.T` against `labels`, ignoring `ignore_index` (as `nn.CrossEntropyLoss`)."""
+
+    @staticmethod
+    def forward(ctx, hidden, weight, labels, chunk_size, ignore_index):
+        # hidden: [N, H], weight: [V, H], labels: [N]
+        num_tokens = hidden.shape[0]
+        lse = torch.empty(num_tokens, dtype=torch.float32, device=hidden.device)
+        loss_sum = torch.zeros((), dtype=torch.float32, device=hidden.device)
+        for start in range(0, num_tokens, chunk_size):
+            end = min(start + chunk_size, num_tokens)
+            logits = (hidden[start:end] @ weight.t()).float()
+            chunk_labels = labels[start:end]
+            valid = chunk_labels != ignore_index
+            chunk_lse = torch.logsumexp(logits, dim=-1)
+            target_logits = logits.gather(1, chunk_labels.clamp(min=0).unsqueeze(1)).squeeze(1)
+            loss_sum += ((chunk_lse - target_logits) * valid).sum()
+            lse[start:end] = chunk_lse
+        num_valid = (labels != ignore_index).sum().clamp(min=1)
+
+        ctx.save_for_backward(hidden, weight, labels, lse, num_valid)
+        ctx.chunk_size = chunk_size
+        ctx.ignore_index = ignore_index
+        return loss_sum / num_valid
+
+    @staticmethod
+    def backward(ctx, grad_output):
+        hidden, weight, labels, lse, num_valid = ctx.saved_tensors
+        scale = grad_output.float() / num_valid
+        grad_hidden = torch.empty_like(hidden) if ctx.needs_input_grad[0] else None
+        grad_weight = torch.zeros(weight.shape, dtype=torch.float32, device=weight.device) if ctx.needs_input_grad[1] else None
+
+        num_tokens = hidden.shape[0]
+        for start in range(0, num_tokens, ctx.chunk_size):
+            end = min(start + ctx.chunk_size, num_tokens)
+            chunk_hidden = hidden[start:end]
+            logits = (chunk_hidden @ weight.t()).float()
+            chunk_labels = labels[start:end]
+            valid = chunk_labels != ctx.ignore_index
+            # d(lse - logit_y)/d(logits) = softmax - one_hot(y)
+            grad_logits = torch.exp(logits - lse[start:end].unsqueeze(1))
+            rows = torch.arange(end - start, device=hidden.device)
+            grad_logits[rows, chunk_labels.clamp(min=0)] -= 1.0
+            grad_logits *= (valid.float() * scale).unsqueeze(1)
+            grad_logits = grad_logits.to(hidden.dtype)
+            if grad_hidden is not None:
+                grad_hidden[start:end] = grad_logits @ weight
+            if grad_weight is not None:
+                grad_weight += (grad_logits.t() @ chunk_hidden).float()
+
+        if grad_weight is not None:
+            grad_weight = grad_weight.to(weight.dtype)
+        return grad_hidden, grad_weight, None, None, None
+
+
+def chunked_cross_entropy(hidden_states, weight, labels, chunk_size=1024, ignore_index=-100):
+    """
+    Cross-entropy of the LM head projection computed in chunks of `chunk_size` positions.
+        Args:
+            hidden_states (torch.Tensor): `[..., hidden]` final hidden states, already aligned with `labels`.
+            weight (torch.Tensor): `[vocab, hidden]` LM head weight.
+            labels (torch.LongTensor): `[...]` target token ids.
+    """
+    hidden_states = hidden_states.reshape(-1, hidden_states.shape[-1])
+    labels = labels.reshape(-1).to(hidden_states.device)
+    return ChunkedLinearCrossEntropy.apply(hidden_states, weight, labels, chunk_size, ignore_index)
+
+
+def replace_causal_lm_loss_with_chunked_loss(model, chunk_size=1024):
+    """
+    Compute the training loss of a causal LM (e.g. GPTNeoXForCausalLM) with `chunked_cross_entropy`.
+
+    When `labels` are passed, the model returns the loss only (`logits` is None). The LM head module is still called
+    (with the labels) so that hooks on it, e.g. ZeRO-3 parameter gathering, keep working.
+    """
+    base_model = model.base_model
+    lm_head = model.get_output_embeddings()
+    assert getattr(lm_head, "bias", None) is None, "The chunked loss only supports LM heads without bias."
+    original_forward = model.forward
+
+    def lm_head_forward(hidden_states, labels=None):
+        if labels is None:
+            return F.linear(hidden_states, lm_head.weight)
+        return chunked_cross_entropy(hidden_states, lm_head.weight, labels, chunk_size=chunk_size)
+
+    def forward(input_ids=None, labels=None, return_dict=None, **kwargs):
+        if labels is None:
+            return original_forward(input_ids=input_ids, return_dict=return_dict, **kwargs)
+        outputs = base_model(input_ids=input_ids, return_dict=True, **kwargs)
+        hidden_states = outputs[0]
+        # next-token prediction: shift hidden states and labels by one
+        loss = lm_head(hidden_states[:, :-1, :], labels=labels[:, 1:])
+        return CausalLMOutputWithPast(
+            loss=loss,
+            logits=None,
+            past_key_values=outputs.past_key_values,
+            hidden_states=outputs.hidden_states,
+            attentions=outputs.attentions,
+        )
+
+    lm_head.forward = lm_head_forward
+    model.forward = forward
+    return model
@@ -0,0 +1,130 @@
+"""
+Single entry point of the pipeline scripts: `python src/cli.py <command> [arguments of the script]`.
+
+A command runs its script as `__main__`, so only that script's dependencies are imported: listing the commands,
+`count-vocab`, `resources` or `pipeline --dry-run` start without torch or transformers. `startup` times cheap commands
+in fresh interpreters and fails when one exceeds the budget or imports a heavy library, to keep startup fast.
+
+    python src/cli.py count-vocab -m EleutherAI/pythia-1b
+    python src/cli.py align -h
+    python src/cli.py startup --budget 1.0
+"""
+import argparse
+import json
+import os
+import re
+import runpy
+import subprocess
+import sys
+import tempfile
+import time
+
+MAIN_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+COMMANDS = {
+    "prepare-corpus": ("script/prepare_pubmed_corpus_hf.py", "Download and format PubMed abstracts, budgeted in tokens."),
+    "dedup": ("src/dedup_corpus.py", "Remove exact and near-duplicate abstracts from corpus shards."),
+    "tokenize": ("src/process_dataset.py", "Tokenize (and pack) a corpus into a dataset on disk."),
+    "glove-corpus": ("src/convert2glove_train.py", "Extract token IDs of a tokenized dataset for GloVe."),
+    "count-vocab": ("src/count_vocab.py", "Print the vocabulary size of a model."),
+    "count-dict": ("src/count_dict.py", "Map target tokens to identical source tokens."),
+    "align": ("src/cal_trans_matrix.py", "Learn the token alignment matrix from GloVe vectors."),
+    "eval-align": ("src/eval_matrix.py", "Evaluate an alignment matrix (BLEU-1 or BERTScore)."),
+    "init-model": ("src/convert.py", "Initialize the model for the target vocabulary."),
+    "plan": ("src/distributed_planner.py", "Choose the distributed strategy and batch sizes."),
+    "train": ("src/clm_train.py", "Run the vocabulary adaptation training."),
+    "tokenizer-service": ("src/tokenizer_service.py", "Serve tokenizers over a Unix socket."),
+    "benchmark-tokenizers": ("src/tokenizer_benchmark.py", "Tokenizer throughput and compression benchmark."),
+    "resources": ("src/resource_policy.py", "Processes and threads of a pipeline stage."),
+    "pipeline": ("src/pipeline.py", "Run the out-of-date pipeline stages."),
+}
+HEAVY_MODULES = ("torch", "transformers", "datasets", "sentence_transformers", "scipy", "nltk", "tensorflow")
+IMPORT_TIME = re.compile(r"^import time:\s+\d+ \|\s+(\d+) \| (\s*)(\S+)$")
+
+
+def run_command(command, argv):
+    """Run the script of a command with `argv` as its arguments."""
+    path = os.path.join(MAIN_DIR, COMMANDS[command][0])
+    sys.argv = [path] + list(argv)
+    sys.path.insert(0, os.path.dirname(path))
+    runpy.run_path(path, run_name="__main__")
+
+
+def startup_cases(model_dir):
+    """(name, arguments) of the commands that should start without the heavy libraries."""
+    return [
+        ("commands", ["-h"]),
+        ("count-vocab", ["count-vocab", "-m", model_dir]),
+        ("resources", ["resources", "-s", "tokenize", "--print-env"]),
+        ("pipeline", ["pipeline", "--print-config"]),
+        ("align -h", ["align", "-h"]),
+        ("dedup -h", ["dedup", "-h"]),
+        ("eval-align -h", ["eval-align", "-h"]),
+        ("tokenizer-service -h", ["tokenizer-service", "-h"]),
+    ]
+
+
+def time_startup(argv, repeats=3):
+    """Best wall time of `cli.py argv` in a fresh interpreter, and the heavy modules it imported with their import time."""
+    command = [sys.executable, os.path.abspath(__file__)] + argv
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        subprocess.run(command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, check=True)
+        times.append(time.perf_counter() - start)
+    stderr = subprocess.run([sys.executable, "-X", "importtime"] + command[1:], stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True).stderr
+    heavy = {}
+    for line in stderr.splitlines():
+        match = IMPORT_TIME.match(line)
+        if match is not None and match.group(3) in HEAVY_MODULES:
+            heavy[match.group(3)] = int(match.group(1)) / 1e6
+    return min(times), heavy
+
+
+def check_startup(budget=1.0, repeats=3):
+    """Startup of every case against the budget (seconds) and without heavy imports."""
+    with tempfile.TemporaryDirectory() as model_dir:
+        with open(os.path.join(model_dir, "config.json"), "w") as f:
+            json.dump({"vocab_size": 50304}, f)
+        results = {"python": sys.version.split()[0], "budget_s": budget, "cases": {}}
+        for name, argv in startup_cases(model_dir):
+            wall_s, heavy = time_startup(argv, repeats)
+            results["cases"][name] = {"wall_s": wall_s, "heavy_imports": heavy, "ok": wall_s <= budget and not heavy}
+    results["ok"] = all(case["ok"] for case in results["cases"].values())
+    return results
+
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    parser = argparse.ArgumentParser(
+        prog="cli.py",
+        description="Run a pipeline script: `cli.py <command> -h` shows the arguments of its script.",
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        epilog="commands:\n" + "\n".join(f"  {name:<22}{help_text}" for name, (_, help_text) in COMMANDS.items())
+        + f"\n  {'startup':<22}Check that cheap commands start within a time budget.",
+    )
+    parser.add_argument("command", choices=list(COMMANDS) + ["startup"], metavar="command")
+    if not argv or argv[0] in ("-h", "--help"):
+        parser.print_help()
+        return 0
+    args = parser.parse_args(argv[:1])
+
+    if args.command != "startup":
+        run_command(args.command, argv[1:])
+        return 0
+    startup_parser = argparse.ArgumentParser(prog="cli.py startup")
+    startup_parser.add_argument("-b", "--budget", type=float, default=1.0, help="Seconds a cheap command may take to run.")
+    startup_parser.add_argument("-r", "--repeats", type=int, default=3, help="Runs of each command, the fastest counts.")
+    startup_parser.add_argument("-o", "--output", type=str, default=None, help="Where to write the results (JSON).")
+    startup_args = startup_parser.parse_args(argv[1:])
+    results = check_startup(startup_args.budget, startup_args.repeats)
+    if startup_args.output is not None:
+        with open(startup_args.output, "w") as f:
+            json.dump(results, f, indent="\t")
+    for name, case in results["cases"].items():
+        heavy = ", ".join(f"{module} {seconds:.2f} s" for module, seconds in case["heavy_imports"].items())
+        print(f"{'ok  ' if case['ok'] else 'FAIL'} {name:<22} {case['wall_s']:.2f} s" + (f"  imports {heavy}" if heavy else ""))
+    return 0 if results["ok"] else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
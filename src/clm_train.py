@@ -1,12 +1,23 @@
 from dataclasses import dataclass, field
+import json
 import os
-import subprocess
 from typing import Optional
 
 from transformers import HfArgumentParser, TrainingArguments, Trainer
 from clm_utils import *
 
-from lr_callback import LRCallback
+from phase_schedule import Phase, PhaseSchedule, PhaseScheduleCallback, PhaseTrainer, load_phases
+from sparse_embed_optim import create_sparse_embed_optimizer
+from token_provenance import load_token_provenance, parse_group_values, group_values_per_token
+from throughput_callback import InstrumentedIterableDataset, ThroughputCallback, summarize_throughput_log
+from async_checkpoint import AsyncCheckpointer, enable_async_checkpointing, shard_saved_model
+from delta_checkpoint import enable_delta_checkpointing
+from block_eval import enable_block_eval, materialize_eval_blocks, token_byte_lengths
+from mixture_dataset import TokenStoreMixture, enable_mixture_tracking
+from accelerate import PartialState
+from vocab_parallel import enable_vocab_parallel, enable_vocab_parallel_training
+from seq_length_curriculum import SeqLengthCurriculum, enable_seq_length_curriculum
+from resource_policy import apply_policy
 
 # Define and parse arguments.
 @dataclass
@@ -22,7 +33,6 @@ class ScriptArguments:
     gradient_accumulation_steps: Optional[int] = field(default=4)
     learning_rate: Optional[float] = field(default=2e-4)
     max_grad_norm: Optional[float] = field(default=0.3)
-    weight_decay: Optional[float] = field(default=0.001)
     lora_alpha: Optional[int] = field(default=16)
     lora_dropout: Optional[float] = field(default=0.1)
     lora_r: Optional[int] = field(default=64)
@@ -31,6 +41,10 @@ class ScriptArguments:
         metadata={"help": "comma separated list of target modules to apply LoRA layers to"},
     )
     max_seq_length: Optional[int] = field(default=512)
+    seq_length_warmup: Optional[str] = field(
+        default=None,
+        metadata={"help": "Sequence length curriculum `length:until_step,...` (e.g. 256:500,1024:1500), training on shorter blocks cut from the `max_seq_length` rows with the same tokens per step (see seq_length_curriculum.py)."},
+    )
     model_name: Optional[str] = field(
         default="Salesforce/codegen25-7b-multi",
         metadata={
@@ -43,6 +57,12 @@ class ScriptArguments:
             "help": "The tokenizer path that you want to load."
         },
     )
+    tokenizer_service: Optional[str] = field(
+        default=None,
+        metadata={
+            "help": "Socket of a running tokenizer_service.py, used to tokenize a text dataset on the fly instead of the local tokenizer."
+        },
+    )
     dataset_name: Optional[str] = field(
         default="timdettmers/openassistant-guanaco",
         metadata={"help": "The preference dataset to use."},
@@ -94,12 +114,35 @@ class ScriptArguments:
     max_steps: int = field(default=10000, metadata={"help": "How many optimizer update steps to take"})
     warmup_ratio: float = field(default=0.03, metadata={"help": "Fraction of steps to do a warmup for"})
     save_steps: int = field(default=10, metadata={"help": "Save checkpoint every X updates steps."})
+    save_total_limit: Optional[int] = field(default=None, metadata={"help": "Number of checkpoints to keep, the oldest are deleted. Keep all if None."})
+    async_checkpoint: Optional[bool] = field(
+        default=False,
+        metadata={"help": "Snapshot checkpoints to host memory and write them as sharded safetensors in a background thread while training continues. Stalls are logged to `checkpoint_stats.jsonl`."},
+    )
+    delta_checkpoint: Optional[bool] = field(
+        default=False,
+        metadata={"help": "Save only the trainable tensors and their optimizer state in checkpoints, with a reference to the base model `--model_name` (e.g. for the embed-only stage). Not for DeepSpeed/FSDP, which keep full checkpoints."},
+    )
+    max_shard_size: Optional[str] = field(default="10GB", metadata={"help": "Maximum size of the safetensors shards of checkpoints and of the final model."})
     eval_steps: int = field(default=10, metadata={"help": "Eval model every X steps."})
     logging_steps: int = field(default=10, metadata={"help": "Log every X updates steps."})
     output_dir: str = field(default="results", metadata={"help": "Where to store the final model."})
     use_flash_attn: Optional[bool] = field(
         default=False,
-        metadata={"help": "Enables Flash attention for training."},
+        metadata={"help": "Enables Flash attention for training (same as `--attn_implementation flash_attention_2`)."},
+    )
+    attn_implementation: Optional[str] = field(
+        default="auto",
+        metadata={"help": "Attention backend: flash_attention_2, sdpa or eager, falling back to the next one when unavailable. `auto` picks the fastest available."},
+    )
+    torch_compile: Optional[bool] = field(default=True, metadata={"help": "Compile the model with torch.compile."})
+    benchmark_steps: Optional[int] = field(
+        default=0,
+        metadata={"help": "Benchmark mode: train a tiny randomly initialized GPT-NeoX for this many steps through the real data path and Trainer, save nothing and report step time and samples/s to `benchmark.json` in the output directory. Runs on CPU without flash-attn."},
+    )
+    tiny_model_config: Optional[str] = field(
+        default=None,
+        metadata={"help": "GPTNeoXConfig overrides (JSON file or string) of the benchmark model, e.g. `{\"hidden_size\": 128, \"num_hidden_layers\": 4}`."},
     )
     use_peft_lora: Optional[bool] = field(
         default=False,
@@ -117,6 +160,18 @@ class ScriptArguments:
         default=False,
         metadata={"help": "Enables Gradient Checkpointing."},
     )
+    checkpoint_policy: Optional[str] = field(
+        default="all",
+        metadata={"help": "With `--use_gradient_checkpointing`, which activations to recompute: all (every layer), every_k:K (one layer out of K), attention, mlp, or auto (fewest layers fitting `--activation_memory_budget_gb`). See selective_checkpoint.py."},
+    )
+    activation_memory_budget_gb: Optional[float] = field(
+        default=None,
+        metadata={"help": "Activation memory budget per GPU of the auto checkpointing policy."},
+    )
+    dataset_mixture: Optional[str] = field(
+        default=None,
+        metadata={"help": "JSON file (or string) of tokenized datasets and their mixture weights per training stage, interleaved instead of `--dataset_name` (see mixture_dataset.py)."},
+    )
     dataset_text_field: str = field(default="text", metadata={"help": "Dataset field to use as input text."})
     save_on_each_node: Optional[bool] = field(
         default=False,
@@ -160,17 +215,134 @@ class ScriptArguments:
         default=0.1,
         metadata={"help": "The weight to decay the learning rate."},
     )
+    phase_schedule: Optional[str] = field(
+        default=None,
+        metadata={"help": "JSON file (or string) of training phases, each setting trainable parameters, learning rate schedule and step budget (see phase_schedule.py)."},
+    )
+    sparse_embed_optim: Optional[bool] = field(
+        default=False,
+        metadata={"help": "With `--finetune_embed_only`, use a row-sparse AdamW that only updates the embedding rows touched in each step (not for DeepSpeed or phase schedules)."},
+    )
+    token_provenance_path: Optional[str] = field(
+        default=None,
+        metadata={"help": "Provenance of the target tokens (gold / aligned / random) written by cal_trans_matrix.py."},
+    )
+    embed_row_scales: Optional[str] = field(
+        default="gold=0",
+        metadata={"help": "Learning rate scale of the embedding rows per provenance group for the sparse optimizer, e.g. `gold=0,aligned=1,random=1` (0 freezes the rows)."},
+    )
+    rare_token_sampling_steps: Optional[int] = field(
+        default=0,
+        metadata={"help": "Draw the training blocks of the first N steps with probabilities favoring rare tokens of the poorly initialized provenance groups (needs `--token_provenance_path` and a tokenized dataset, see block_sampler.py), then continue with a uniform pass. Disabled if 0."},
+    )
+    rare_token_group_weights: Optional[str] = field(
+        default="gold=0,aligned=1,random=2",
+        metadata={"help": "Need weight of the target tokens of each provenance group for rare-token sampling."},
+    )
+    rare_token_frequency_power: Optional[float] = field(
+        default=0.5,
+        metadata={"help": "The need of a token is scaled by its training-set frequency to this negative power."},
+    )
+    rare_token_mix: Optional[float] = field(
+        default=0.5,
+        metadata={"help": "Share of the sampling distribution following the block scores, the rest is uniform."},
+    )
+    rare_token_seed: Optional[int] = field(default=42, metadata={"help": "Seed of the rare-token block sampling."})
+    block_scores_path: Optional[str] = field(
+        default=None,
+        metadata={"help": "Cache of the per-block scores, defaults to `block_scores.npy` in the train split of `--dataset_name`."},
+    )
+    use_chunked_loss: Optional[bool] = field(
+        default=False,
+        metadata={"help": "Compute the LM head and cross-entropy in chunks of positions, so the full-vocab logits are never materialized."},
+    )
+    loss_chunk_size: Optional[int] = field(
+        default=1024,
+        metadata={"help": "Number of positions per chunk of the chunked loss."},
+    )
+    vocab_parallel: Optional[bool] = field(
+        default=False,
+        metadata={"help": "Shard the input embedding and LM head over the vocabulary across the DDP ranks, computing the cross-entropy in chunks of `--loss_chunk_size` positions (see vocab_parallel.py). Not for DeepSpeed, FSDP or LoRA."},
+    )
+    use_doc_boundaries: Optional[bool] = field(
+        default=False,
+        metadata={"help": "Restrict position ids and attention of packed sequences to each document. The dataset needs `doc_lens` (see `--record_doc_boundaries` of process_dataset.py)."},
+    )
+    eval_blocks: Optional[int] = field(
+        default=0,
+        metadata={"help": "Evaluate on a fixed, seeded set of this many validation blocks, reporting perplexity and bits-per-byte per token provenance group (with `--token_provenance_path`). Uses the default Trainer evaluation if 0."},
+    )
+    eval_seed: Optional[int] = field(default=42, metadata={"help": "Seed of the selection of the evaluation blocks."})
+    throughput_log_path: Optional[str] = field(
+        default=None,
+        metadata={"help": "JSONL file for per-step throughput metrics (tokens/s, MFU, dataloader wait, forward/backward/optimizer time, peak memory). Disabled if None."},
+    )
+    metrics_port: Optional[int] = field(
+        default=0,
+        metadata={"help": "Serve the latest throughput metrics in the Prometheus text format on this port of 127.0.0.1 (needs `--throughput_log_path`). Disabled if 0."},
+    )
+    throughput_sync_cuda: Optional[bool] = field(
+        default=False,
+        metadata={"help": "Synchronize CUDA at each throughput timestamp for an exact forward/backward/optimizer split (slows training down)."},
+    )
+    peak_tflops: Optional[float] = field(
+        default=None,
+        metadata={"help": "Peak TFLOPs of one device for the MFU estimate. Detected from the GPU name if None."},
+    )
+
+
+def build_phase_schedule(args):
+    is_distributed = (
+        int(os.environ.get("WORLD_SIZE", "1")) > 1 or os.environ.get("ACCELERATE_USE_DEEPSPEED", "False").lower() == "true"
+    )
+    freeze_mode = "rewrap" if is_distributed else "requires_grad"
+    if args.phase_schedule is not None:
+        return PhaseSchedule(load_phases(args.phase_schedule), freeze_mode=freeze_mode)
+    if args.release_weight:
+        # Train the first `release_step` steps as configured, then release all parameters with a decayed learning rate.
+        phases = [
+            Phase(
+                name="before_release",
+                max_steps=args.release_step,
+                learning_rate=args.learning_rate,
+                trainable=["embed"] if args.finetune_embed_only else "all",
+                lr_scheduler_type=args.lr_scheduler_type,
+                warmup_ratio=args.warmup_ratio,
+            ),
+            Phase(
+                name="release",
+                max_steps=args.max_steps - args.release_step,
+                learning_rate=args.learning_rate * args.release_decay,
+                trainable="all",
+                lr_scheduler_type=args.lr_scheduler_type,
+            ),
+        ]
+        return PhaseSchedule(phases, freeze_mode=freeze_mode)
+    return None
 
 
 def main(args):
+    phase_schedule = build_phase_schedule(args)
+    if phase_schedule is not None:
+        args.max_steps = phase_schedule.total_steps
+    if args.benchmark_steps > 0:
+        args.max_steps = args.benchmark_steps
+        args.evaluation_strategy = "no"
+        os.makedirs(args.output_dir, exist_ok=True)
+        if args.throughput_log_path is None:
+            args.throughput_log_path = os.path.join(args.output_dir, "benchmark_steps.jsonl")
+        if os.path.exists(args.throughput_log_path):
+            os.remove(args.throughput_log_path)
+
     # training arguments
     is_deepspeed_peft_enabled = (
         os.environ.get("ACCELERATE_USE_DEEPSPEED", "False").lower() == "true" and args.use_peft_lora
     )
-    save_strategy = "no" if is_deepspeed_peft_enabled else "steps"
+    save_strategy = "no" if is_deepspeed_peft_enabled or args.benchmark_steps > 0 else "steps"
     training_arguments = TrainingArguments(
         output_dir=args.output_dir,
         per_device_train_batch_size=args.per_device_train_batch_size,
+        per_device_eval_batch_size=args.per_device_eval_batch_size,
         gradient_accumulation_steps=args.gradient_accumulation_steps,
         optim=args.optim,
         learning_rate=args.learning_rate,
@@ -186,44 +358,120 @@ def main(args):
         max_steps=args.max_steps,
         eval_steps=args.eval_steps,
         save_steps=args.save_steps,
+        save_total_limit=args.save_total_limit,
         logging_steps=args.logging_steps,
-        torch_compile=True,
+        torch_compile=args.torch_compile,
         dataloader_num_workers=args.num_workers,
         # dataloader_prefetch_factor=0,
         # include_num_input_tokens_seen=True,
         # split_batches=False,
         push_to_hub=args.push_to_hub,
         save_on_each_node=args.save_on_each_node,
-        gradient_checkpointing=args.use_gradient_checkpointing,
+        # selective policies are applied to the model in create_and_prepare_model
+        gradient_checkpointing=args.use_gradient_checkpointing and args.checkpoint_policy == "all",
         resume_from_checkpoint=args.resume_from_checkpoint,
         ignore_data_skip=args.ignore_data_skip,
     )
 
+    if args.vocab_parallel and (
+        os.environ.get("ACCELERATE_USE_DEEPSPEED", "False").lower() == "true"
+        or os.environ.get("ACCELERATE_USE_FSDP", "False").lower() == "true"
+        or args.use_peft_lora
+        or args.use_chunked_loss
+        or args.sparse_embed_optim
+        or args.delta_checkpoint
+        or args.async_checkpoint
+    ):
+        raise ValueError("`--vocab_parallel` works with DDP and full checkpoints only, and computes its own chunked loss.")
+
     # model
     model, peft_config, tokenizer = create_and_prepare_model(args)
     model.config.use_cache = False
+    if args.vocab_parallel:
+        PartialState()  # sets up the process group
+        sharded = enable_vocab_parallel(model, chunk_size=args.loss_chunk_size)
+        print(f"Vocab parallel over {training_arguments.world_size} ranks: {sharded}.")
 
     # remove the gradient of non-embedding
-    if args.finetune_embed_only:
+    if args.finetune_embed_only and phase_schedule is None:
         for name, param in model.named_parameters():
             if "embed" not in name:
                 param.requires_grad = False
 
     callbacks = None
-    if args.release_weight:
-        callbacks = [LRCallback(release_step = args.release_step, decay_weight = args.release_decay)]
+    if phase_schedule is not None:
+        phase_schedule.apply_trainable(model)
+        callbacks = [PhaseScheduleCallback(phase_schedule)]
+
+    optimizers = (None, None)
+    if args.sparse_embed_optim:
+        if os.environ.get("ACCELERATE_USE_DEEPSPEED", "False").lower() == "true":
+            raise ValueError("`--sparse_embed_optim` does not work with DeepSpeed, launch without a DeepSpeed config.")
+        if phase_schedule is not None:
+            # the phase trainer builds its own optimizer over the parameter groups of every phase
+            raise ValueError("`--sparse_embed_optim` works with `--finetune_embed_only` alone, not with `--phase_schedule` or `--release_weight`.")
+        row_scale = None
+        if args.token_provenance_path is not None:
+            vocab_size = model.get_input_embeddings().weight.shape[0]
+            groups = load_token_provenance(args.token_provenance_path, vocab_size=vocab_size)
+            row_scale = group_values_per_token(groups, parse_group_values(args.embed_row_scales))
+        optimizers = (create_sparse_embed_optimizer(model, training_arguments, row_scale=row_scale), None)
 
     # datasets
-    train_dataset, eval_dataset = create_datasets(tokenizer, args)
+    with training_arguments.main_process_first(desc="creating datasets"):
+        train_dataset, eval_dataset = create_datasets(tokenizer, args, phases=phase_schedule.phases if phase_schedule is not None else None)
+    mixture = train_dataset.dataset if isinstance(train_dataset.dataset, TokenStoreMixture) else None
+    if args.throughput_log_path is not None:
+        train_dataset = InstrumentedIterableDataset(train_dataset, os.path.splitext(args.throughput_log_path)[0] + ".data.jsonl")
+        callbacks = (callbacks or []) + [
+            ThroughputCallback(
+                log_path=args.throughput_log_path,
+                seq_length=args.max_seq_length,
+                peak_tflops=args.peak_tflops,
+                metrics_port=args.metrics_port,
+                sync_cuda=args.throughput_sync_cuda,
+            )
+        ]
 
     # trainer
-    trainer = Trainer(model=model, tokenizer=tokenizer, args=training_arguments, train_dataset=train_dataset, eval_dataset=eval_dataset, callbacks=callbacks)
+    if phase_schedule is not None:
+        trainer = PhaseTrainer(model=model, tokenizer=tokenizer, args=training_arguments, train_dataset=train_dataset, eval_dataset=eval_dataset, callbacks=callbacks, phase_schedule=phase_schedule)
+    else:
+        trainer = Trainer(model=model, tokenizer=tokenizer, args=training_arguments, train_dataset=train_dataset, eval_dataset=eval_dataset, callbacks=callbacks, optimizers=optimizers)
     # trainer.accelerator.print(f"{trainer.model}")
     if args.use_peft_lora:
         trainer.model.print_trainable_parameters()
 
+    if args.vocab_parallel:
+        enable_vocab_parallel_training(trainer)
+
     if is_deepspeed_peft_enabled:
-        trainer.add_callback(SaveDeepSpeedPeftModelCallback(trainer, save_steps=args.save_steps))
+        checkpointer = AsyncCheckpointer(args.output_dir, save_total_limit=args.save_total_limit) if args.async_checkpoint else None
+        trainer.add_callback(SaveDeepSpeedPeftModelCallback(trainer, save_steps=args.save_steps, checkpointer=checkpointer))
+    elif args.delta_checkpoint:
+        if args.async_checkpoint:
+            raise ValueError("`--delta_checkpoint` and `--async_checkpoint` cannot be combined, delta checkpoints are small enough to be saved synchronously.")
+        trainable = None
+        if phase_schedule is not None:
+            trainable = lambda name: phase_schedule.phase.trains(name)
+        enable_delta_checkpointing(trainer, args.model_name, trainable=trainable)
+    elif args.async_checkpoint:
+        enable_async_checkpointing(trainer, max_shard_size=args.max_shard_size)
+
+    if mixture is not None:
+        enable_mixture_tracking(trainer, mixture)
+
+    if args.seq_length_warmup is not None:
+        curriculum = SeqLengthCurriculum.from_string(args.max_seq_length, args.seq_length_warmup)
+        enable_seq_length_curriculum(trainer, curriculum, resume_from_checkpoint=args.resume_from_checkpoint)
+
+    blocks = materialize_eval_blocks(eval_dataset, args.eval_blocks, seed=args.eval_seed) if args.eval_blocks > 0 else None
+    if blocks is not None:
+        vocab_size = model.config.vocab_size
+        token_groups = None
+        if args.token_provenance_path is not None:
+            token_groups = load_token_provenance(args.token_provenance_path, vocab_size=vocab_size)
+        enable_block_eval(trainer, blocks, token_groups=token_groups, token_bytes=token_byte_lengths(tokenizer, vocab_size))
 
     if args.use_peft_lora:
         peft_module_casting_to_bf16(trainer.model, args)
@@ -235,6 +483,14 @@ def main(args):
     # train
     trainer.train(resume_from_checkpoint=checkpoint)
 
+    if args.benchmark_steps > 0:
+        if trainer.args.process_index == 0:
+            result = summarize_throughput_log(args.throughput_log_path)
+            print(f"Benchmark: {result}")
+            with open(os.path.join(args.output_dir, "benchmark.json"), "w") as f:
+                json.dump(result, f, indent="\t")
+        return
+
     # saving final model
     if trainer.is_fsdp_enabled:
         trainer.accelerator.state.fsdp_plugin.set_state_dict_type("FULL_STATE_DICT")
@@ -256,17 +512,9 @@ def main(args):
 
     # Save everything else on main process
     if trainer.args.process_index == 0:
-        print("Sharding model if >10GB...")
+        print(f"Sharding model if >{args.max_shard_size}...")
         # FSDP/DeepSpeed save the model as a single `pytorch_model.bin` file, so we need to shard it.
-        # We run this in a subprocess to avoid interference from the accelerators.
-        subprocess.run(
-            [
-                "python",
-                "shard_checkpoint.py",
-                f"--output_dir={args.output_dir}",
-            ],
-            check=True,
-        )
+        shard_saved_model(args.output_dir, max_shard_size=args.max_shard_size)
         if "training_args.bin" in os.listdir(args.output_dir):
             os.remove(os.path.join(args.output_dir, "training_args.bin"))
 
@@ -274,4 +522,5 @@ def main(args):
 if __name__ == "__main__":
     parser = HfArgumentParser(ScriptArguments)
     args = parser.parse_args_into_dataclasses()[0]
+    apply_policy("train")
     main(args)
@@ -1,4 +1,7 @@
+import json
+import os
 import random
+import time
 import torch
 from transformers import TrainerCallback, TrainingArguments, TrainerState, TrainerControl
 from torch.utils.data import IterableDataset
@@ -12,14 +15,31 @@ from transformers import (
     AutoTokenizer,
     BitsAndBytesConfig,
     AutoTokenizer,
+    GPTNeoXConfig,
     TrainingArguments,
 )
+from transformers.utils import is_flash_attn_2_available, is_torch_sdpa_available
 import itertools
+from packing_utils import split_doc_lens, doc_lens_to_position_ids, mask_cross_document_labels
+from chunked_loss import replace_causal_lm_loss_with_chunked_loss
+from async_checkpoint import HostSnapshot
+from mixture_dataset import load_mixture, load_mixture_spec, load_mixture_state
+from block_sampler import BLOCK_SCORES_NAME, compute_block_scores, rare_token_sample_indices
+from token_provenance import parse_group_values
+from tokenizer_service import TokenizerClient
 
 class SaveDeepSpeedPeftModelCallback(TrainerCallback):
-    def __init__(self, trainer, save_steps=500):
+    """
+    Saves the adapter of a DeepSpeed PEFT model every `save_steps`. With an `AsyncCheckpointer`, the gathered state
+    dict is copied to host memory and written to `checkpoint-N` in the background, instead of every rank waiting for
+    the main process to write it to `output_dir`.
+    """
+
+    def __init__(self, trainer, save_steps=500, checkpointer=None):
         self.trainer = trainer
         self.save_steps = save_steps
+        self.checkpointer = checkpointer
+        self.snapshot = HostSnapshot() if checkpointer is not None else None
 
     def on_step_end(
         self,
@@ -30,11 +50,28 @@ class SaveDeepSpeedPeftModelCallback(TrainerCallback):
     ):
         if (state.global_step + 1) % self.save_steps == 0:
             self.trainer.accelerator.wait_for_everyone()
+            start = time.perf_counter()
             state_dict = self.trainer.accelerator.get_state_dict(self.trainer.deepspeed)
             unwrapped_model = self.trainer.accelerator.unwrap_model(self.trainer.deepspeed)
-            if self.trainer.accelerator.is_main_process:
-                unwrapped_model.save_pretrained(args.output_dir, state_dict=state_dict)
-            self.trainer.accelerator.wait_for_everyone()
+            if self.checkpointer is None:
+                if self.trainer.accelerator.is_main_process:
+                    unwrapped_model.save_pretrained(args.output_dir, state_dict=state_dict)
+                self.trainer.accelerator.wait_for_everyone()
+            elif self.trainer.accelerator.is_main_process:
+                wait_s = self.checkpointer.wait()
+                snapshot = self.snapshot(state_dict)
+
+                def write(directory):
+                    unwrapped_model.save_pretrained(directory, state_dict=snapshot)
+                    return sum(os.path.getsize(os.path.join(directory, name)) for name in os.listdir(directory))
+
+                stats = {"wait_s": wait_s, "stall_s": time.perf_counter() - start}
+                self.checkpointer.submit(state.global_step, write, stats=stats)
+        return control
+
+    def on_train_end(self, args: TrainingArguments, state: TrainerState, control: TrainerControl, **kwargs):
+        if self.checkpointer is not None:
+            self.checkpointer.close()
         return control
 
 
@@ -50,6 +87,8 @@ class ConstantLengthDataset(IterableDataset):
             chars_per_token (int): Number of characters per token used to estimate number of tokens in text buffer.
             shuffle (bool): If true, the samples in each buffer are suffled. Default is `True`.
             add_eos_token (bool): If true, each buffer is delimited with eos token. Default is `True`.
+            doc_boundaries (bool): If true, also return `position_ids` restarting at each document of a packed sequence,
+                and ignore the labels that cross a document boundary. Default is `False`.
     """
 
     def __init__(
@@ -64,6 +103,7 @@ class ConstantLengthDataset(IterableDataset):
         shuffle=True,
         add_eos_token=True,
         start_idx=0,
+        doc_boundaries=False,
     ):
         self.tokenizer = tokenizer
         self.concat_token_id = tokenizer.eos_token_id
@@ -80,20 +120,38 @@ class ConstantLengthDataset(IterableDataset):
         self.max_buffer_size = seq_length * chars_per_token * num_of_sequences
         self.shuffle = shuffle
         self.add_eos_token = add_eos_token
-    
+        self.doc_boundaries = doc_boundaries
+        if doc_boundaries and not self.need_tokenize and 'doc_lens' not in dataset.features:
+            raise ValueError("`doc_boundaries` needs a dataset processed with `--record_doc_boundaries`.")
+
+    def make_example(self, input_ids, doc_lens=None):
+        if not self.doc_boundaries:
+            return {
+                "input_ids": torch.LongTensor(input_ids),
+                "labels": torch.LongTensor(input_ids),
+            }
+        position_ids = doc_lens_to_position_ids(doc_lens)
+        return {
+            "input_ids": torch.LongTensor(input_ids),
+            "position_ids": torch.LongTensor(position_ids),
+            "labels": torch.LongTensor(mask_cross_document_labels(input_ids, position_ids)),
+        }
+
     def direct_iter(self):
         iterator = iter(self.dataset)
-        while True:
+        more_examples = True
+        while more_examples:
             buffer, buffer_len = [], 0
 
             while True:
                 if buffer_len >= self.max_buffer_size:
                     break
                 try:
-                    sample = next(iterator)[self.content_field]
+                    row = next(iterator)
+                    sample = row[self.content_field]
                     assert len(sample) == self.seq_length
-                    buffer.append(sample)
-                    buffer_len += len(buffer[-1])
+                    buffer.append((sample, row.get('doc_lens')))
+                    buffer_len += len(sample)
                 except StopIteration:
                     if self.infinite:
                         iterator = iter(self.dataset)
@@ -106,16 +164,14 @@ class ConstantLengthDataset(IterableDataset):
             # if self.shuffle:
             #     random.shuffle(examples)
 
-            for example in examples:
+            for example, doc_lens in examples:
                 self.current_size += 1
-                yield {
-                    "input_ids": torch.LongTensor(example),
-                    "labels": torch.LongTensor(example),
-                }
+                yield self.make_example(example, doc_lens)
 
     def token_iter(self):
         iterator = iter(self.dataset)
-        while True:
+        more_examples = True
+        while more_examples:
             buffer, buffer_len = [], 0
             while True:
                 if buffer_len >= self.max_buffer_size:
@@ -129,31 +185,29 @@ class ConstantLengthDataset(IterableDataset):
                     else:
                         more_examples = False
                         break
+            if not buffer:
+                break
             tokenized_inputs = self.tokenizer(buffer, truncation=False)["input_ids"]
-            all_token_ids = []
+            all_token_ids, all_doc_lens = [], []
             for tokenized_input in tokenized_inputs:
                 if self.add_eos_token:
                     tokenized_input = tokenized_input + [self.concat_token_id]
                 all_token_ids.extend(tokenized_input)
+                all_doc_lens.append(len(tokenized_input))
+            block_doc_lens = split_doc_lens(all_doc_lens, self.seq_length)
             examples = []
             for i in range(0, len(all_token_ids), self.seq_length):
                 input_ids = all_token_ids[i : i + self.seq_length]
                 if len(input_ids) == self.seq_length:
-                    examples.append(input_ids)
+                    examples.append((input_ids, block_doc_lens[i // self.seq_length]))
             if self.shuffle:
                 random.shuffle(examples)
-            for example in examples:
+            for example, doc_lens in examples:
                 self.current_size += 1
-                yield {
-                    "input_ids": torch.LongTensor(example),
-                    "labels": torch.LongTensor(example),
-                }
+                yield self.make_example(example, doc_lens)
 
     def sample_mapper(self, sample):
-        return {
-            "input_ids": torch.LongTensor(sample["input_ids"]),
-            "labels": torch.LongTensor(sample["input_ids"]),
-        }
+        return self.make_example(sample["input_ids"], sample.get("doc_lens"))
     
     def multiprocessing_iter(self):
         worker_total_num = torch.utils.data.get_worker_info().num_workers
@@ -180,12 +234,49 @@ def chars_token_ratio(dataset, tokenizer, data_column, nb_examples=400):
     return total_characters / total_tokens
 
 
-def create_datasets(tokenizer, args):
-    # dataset = load_dataset(args.dataset_name, use_auth_token=True, num_proc=args.num_workers)
-    dataset = load_from_disk(args.dataset_name)
-    train_data = dataset["train"]
-    valid_data = dataset["test"] if "test" in dataset else dataset["validation"]
+def samples_per_step(args):
+    """Blocks consumed by one optimizer step, over every process."""
+    world_size = int(os.environ.get("WORLD_SIZE", 1))
+    return args.per_device_train_batch_size * args.gradient_accumulation_steps * world_size
+
+
+def create_datasets(tokenizer, args, phases=None):
+    if args.dataset_mixture is not None:
+        if args.rare_token_sampling_steps > 0 or args.train_start_idx != 0:
+            raise ValueError("`--dataset_mixture` cannot be combined with `--rare_token_sampling_steps` or `--train_start_idx`.")
+        start_state = None
+        if args.resume_from_checkpoint is not None and args.ignore_data_skip:
+            # the Trainer does not replay the data, start the stream where the checkpoint stopped
+            start_state = load_mixture_state(args.resume_from_checkpoint)
+        train_data, valid_data = load_mixture(
+            load_mixture_spec(args.dataset_mixture),
+            samples_per_step(args),
+            phases=phases,
+            start_sample=0 if start_state is None else start_state["num_samples"],
+            start_state=start_state,
+        )
+    else:
+        # dataset = load_dataset(args.dataset_name, use_auth_token=True, num_proc=args.num_workers)
+        dataset = load_from_disk(args.dataset_name)
+        train_data = dataset["train"]
+        valid_data = dataset["test"] if "test" in dataset else dataset["validation"]
     print(f"Size of the train set: {len(train_data)}. Size of the validation set: {len(valid_data)}")
+    if args.rare_token_sampling_steps > 0:
+        if args.token_provenance_path is None or 'input_ids' not in train_data.features:
+            raise ValueError("`--rare_token_sampling_steps` needs `--token_provenance_path` and a tokenized dataset.")
+        scores = compute_block_scores(
+            train_data,
+            args.token_provenance_path,
+            len(tokenizer),
+            parse_group_values(args.rare_token_group_weights),
+            frequency_power=args.rare_token_frequency_power,
+            cache_path=args.block_scores_path or os.path.join(args.dataset_name, "train", BLOCK_SCORES_NAME),
+        )
+        num_samples = args.rare_token_sampling_steps * samples_per_step(args)
+        train_data = train_data.select(rare_token_sample_indices(scores, num_samples, mix=args.rare_token_mix, seed=args.rare_token_seed))
+    if args.tokenizer_service is not None and 'text' in train_data.features:
+        # text is tokenized by the service, the data loader workers do not need their own tokenizer
+        tokenizer = TokenizerClient(args.tokenizer_service, args.tokenizer_path if args.tokenizer_path is not None else args.model_name)
     chars_per_token = chars_token_ratio(train_data, tokenizer, args.dataset_text_field) if 'text' in train_data.features else 1
     print(f"The character to token ratio of the dataset is: {chars_per_token:.2f}")
     train_dataset = ConstantLengthDataset(
@@ -198,6 +289,7 @@ def create_datasets(tokenizer, args):
         shuffle=True,
         add_eos_token=False,
         start_idx=args.train_start_idx,
+        doc_boundaries=args.use_doc_boundaries,
     )
     valid_dataset = ConstantLengthDataset(
         tokenizer,
@@ -208,24 +300,59 @@ def create_datasets(tokenizer, args):
         content_field=args.dataset_text_field,
         shuffle=False,
         add_eos_token=False,
+        doc_boundaries=args.use_doc_boundaries,
     )
 
     return train_dataset, valid_dataset
 
 
+ATTN_IMPLEMENTATIONS = ("flash_attention_2", "sdpa", "eager")
+
+
+def resolve_attn_implementation(requested="auto"):
+    """
+    Pick the attention backend: the requested one if it can run here, else the next of flash_attention_2 > sdpa >
+    eager. "auto" starts from flash_attention_2.
+    """
+    if requested not in ("auto",) + ATTN_IMPLEMENTATIONS:
+        raise ValueError(f"Unknown attention implementation {requested}, choose from {('auto',) + ATTN_IMPLEMENTATIONS}.")
+    available = {
+        "flash_attention_2": torch.cuda.is_available() and is_flash_attn_2_available(),
+        "sdpa": is_torch_sdpa_available(),
+        "eager": True,
+    }
+    candidates = ATTN_IMPLEMENTATIONS if requested == "auto" else ATTN_IMPLEMENTATIONS[ATTN_IMPLEMENTATIONS.index(requested):]
+    attn_implementation = next(name for name in candidates if available[name])
+    if requested != "auto" and attn_implementation != requested:
+        warnings.warn(f"Attention implementation {requested} is not available, falling back to {attn_implementation}.")
+    return attn_implementation
+
+
+def create_tiny_model(args, tokenizer, attn_implementation):
+    """A randomly initialized small GPT-NeoX for `--benchmark_steps` runs, configured by `--tiny_model_config`."""
+    config = dict(hidden_size=64, num_hidden_layers=2, num_attention_heads=4, intermediate_size=256)
+    if args.tiny_model_config is not None:
+        config.update(json.load(open(args.tiny_model_config)) if os.path.isfile(args.tiny_model_config) else json.loads(args.tiny_model_config))
+    config = GPTNeoXConfig(
+        vocab_size=len(tokenizer),
+        max_position_embeddings=max(args.max_seq_length, config.pop("max_position_embeddings", 0)),
+        use_cache=not args.use_gradient_checkpointing,
+        **config,
+    )
+    return AutoModelForCausalLM.from_config(config, attn_implementation=attn_implementation)
+
+
 def create_and_prepare_model(args):
-    if args.use_flash_attn:
+    requested = args.attn_implementation
+    if args.use_flash_attn and requested == "auto":
+        requested = "flash_attention_2"
+    attn_implementation = resolve_attn_implementation(requested)
+    print(f"Attention implementation: {attn_implementation}")
+    if attn_implementation == "flash_attention_2":
         warnings.warn(
             "Flash V2 support implemented here ignores padding/attention_mask/custom_mask. \n"
             + "It is meant for continued pre-training with packing inputs to consume the entire sequence lengths."
         )
-        # from starcoder_flash_attn_monkey_patch import replace_starcoder_attn_with_flash_attn
-        from llama_flash_attn_patch import replace_llama_attn_with_flash_attn
-        # from falcon_flash_attn_monkey_patch import replace_falcon_attn_with_flash_attn
-
-        # replace_starcoder_attn_with_flash_attn()
-        replace_llama_attn_with_flash_attn()
-        # replace_falcon_attn_with_flash_attn()
     device_map = None
     bnb_config = None
     load_in_8bit = args.use_8bit_qunatization
@@ -250,20 +377,41 @@ def create_and_prepare_model(args):
     if args.use_4bit_qunatization or args.use_8bit_qunatization:
         device_map = "auto"  # {"": 0}
 
-    model = AutoModelForCausalLM.from_pretrained(
-        args.model_name,
-        load_in_8bit=load_in_8bit,
-        quantization_config=bnb_config,
-        device_map=device_map,
-        use_cache=not args.use_gradient_checkpointing,
-        attn_implementation="flash_attention_2",
-        torch_dtype=torch.bfloat16,
-        trust_remote_code=True,
-    )
-
     tokenizer = AutoTokenizer.from_pretrained(args.tokenizer_path if args.tokenizer_path is not None else args.model_name, trust_remote_code=True)
     tokenizer.pad_token = tokenizer.eos_token
 
+    if args.benchmark_steps > 0:
+        model = create_tiny_model(args, tokenizer, attn_implementation)
+    else:
+        model = AutoModelForCausalLM.from_pretrained(
+            args.model_name,
+            load_in_8bit=load_in_8bit,
+            quantization_config=bnb_config,
+            device_map=device_map,
+            use_cache=not args.use_gradient_checkpointing,
+            attn_implementation=attn_implementation,
+            # flash attention needs half precision, CPU runs stay in float32
+            torch_dtype=torch.bfloat16 if torch.cuda.is_available() else torch.float32,
+            trust_remote_code=True,
+        )
+
+    if args.use_doc_boundaries:
+        from gpt_neox_packed_attn_patch import replace_gpt_neox_attn_with_packed_attn
+
+        replace_gpt_neox_attn_with_packed_attn(model)
+
+    if args.use_gradient_checkpointing and args.checkpoint_policy != "all":
+        from selective_checkpoint import apply_checkpoint_policy
+
+        checkpointed = apply_checkpoint_policy(
+            model,
+            args.checkpoint_policy,
+            batch_size=args.per_device_train_batch_size,
+            seq_length=args.max_seq_length,
+            budget_gb=args.activation_memory_budget_gb,
+        )
+        print(f"Activation checkpointing policy {args.checkpoint_policy}: {len(checkpointed)} checkpointed modules.")
+
     peft_config = None
     if args.use_peft_lora:
         peft_config = LoraConfig(
@@ -274,13 +422,19 @@ def create_and_prepare_model(args):
             task_type="CAUSAL_LM",
             target_modules=args.lora_target_modules.split(","),
         )
-        if args.use_gradient_checkpointing:
+        if args.use_gradient_checkpointing and args.checkpoint_policy == "all":
             model.gradient_checkpointing_enable()
 
+        if args.use_chunked_loss:
+            replace_causal_lm_loss_with_chunked_loss(model, chunk_size=args.loss_chunk_size)
+
         model = get_peft_model(model, peft_config)
         model.print_trainable_parameters()
     else:
         model.resize_token_embeddings(len(tokenizer))
+        # The LM head may be replaced by the resize, so patch it afterwards.
+        if args.use_chunked_loss:
+            replace_causal_lm_loss_with_chunked_loss(model, chunk_size=args.loss_chunk_size)
 
 
     return model, peft_config, tokenizer
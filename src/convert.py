@@ -1,10 +1,9 @@
-import scipy.sparse
-from scipy.sparse import coo_matrix, csr_matrix, lil_matrix
 import json
 import torch
 from transformers import AutoTokenizer, AutoModelForCausalLM, set_seed
 import random
 import argparse
+from delta_checkpoint import write_model_fingerprint
 
 _EMBED_DICT = {
     "gpt_neox": "gpt_neox.embed_in.weight",
@@ -69,6 +68,8 @@ def trans2switch(
     src_model.load_state_dict(src_params)
     # print(f"Save parameters into {tgt_clm_path} ...")
     src_model.save_pretrained(tgt_clm_path)
+    # record the hash of the base weights, referenced by delta checkpoints
+    write_model_fingerprint(tgt_clm_path)
     # print(f"Save tokenizer into {tgt_clm_path} ...")
     tgt_tok.save_pretrained(tgt_clm_path)
 
@@ -112,6 +113,7 @@ def random_permute(
 
     src_model.load_state_dict(src_params)
     src_model.save_pretrained(tgt_clm_path)
+    write_model_fingerprint(tgt_clm_path)
     tgt_tok.save_pretrained(tgt_clm_path)
 
 def random_initial_all(
@@ -148,6 +150,7 @@ def random_initial_all(
 
     src_model.load_state_dict(src_params)
     src_model.save_pretrained(tgt_clm_path)
+    write_model_fingerprint(tgt_clm_path)
     tgt_tok.save_pretrained(tgt_clm_path)
 
 
@@ -166,6 +169,7 @@ def random_initial_aug(
     src_model.resize_token_embeddings(len(tgt_tok))
 
     src_model.save_pretrained(tgt_clm_path)
+    write_model_fingerprint(tgt_clm_path)
     tgt_tok.save_pretrained(tgt_clm_path)
 
 if __name__ == '__main__':
@@ -0,0 +1,177 @@
+"""
+Sharded text corpora: size-bounded Parquet or Arrow IPC shards with a `text` column and the token count of each
+document under the tokenizer that built the corpus (`num_tokens`, counted exactly or estimated from the characters of
+the document), listed in a manifest:
+
+    {
+        "format": "arrow",
+        "tokenizer": "EleutherAI/pythia-1b",
+        "token_counts": "exact",
+        "num_rows": 3300000,
+        "num_tokens": 1000000000,
+        "shards": [{"path": "shard-00000.arrow", "num_rows": 850000, "num_tokens": 257000000, "num_bytes": 268435456}, ...]
+    }
+
+Arrow shards are memory-mapped as they are (`datasets.Dataset.from_file`), Parquet shards are converted once into the
+`datasets` cache with one process per group of shards. Shards and the manifest are written to a temporary file and
+renamed, so a crash leaves the manifest listing complete shards only.
+"""
+import json
+import os
+
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+
+MANIFEST_NAME = "manifest.json"
+SHARD_FORMATS = ("arrow", "parquet")
+SCHEMA = pa.schema([("text", pa.string()), ("num_tokens", pa.int32())])
+
+
+def _replace_atomically(path, write):
+    tmp_path = path + ".tmp"
+    write(tmp_path)
+    with open(tmp_path, "rb") as f:
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+def read_shard(path, shard_format):
+    """The Arrow table of a shard."""
+    if shard_format == "parquet":
+        return pq.read_table(path)
+    with pa.memory_map(path) as source:
+        return pa.ipc.open_stream(source).read_all()
+
+
+def write_shard(output_dir, name, table, shard_format):
+    """Write a `text`/`num_tokens` table as the shard `name` of `output_dir`, returns its manifest entry."""
+
+    def write(path):
+        if shard_format == "parquet":
+            pq.write_table(table, path)
+        else:
+            with pa.OSFile(path, "wb") as sink, pa.ipc.new_stream(sink, table.schema) as writer:
+                writer.write_table(table)
+
+    _replace_atomically(os.path.join(output_dir, name), write)
+    return {
+        "path": name,
+        "num_rows": table.num_rows,
+        "num_tokens": int(pc.sum(table.column("num_tokens")).as_py() or 0),
+        "num_bytes": int(pc.sum(pc.binary_length(table.column("text"))).as_py() or 0),
+    }
+
+
+def write_manifest(output_dir, manifest):
+    def write(path):
+        with open(path, "w") as f:
+            json.dump(manifest, f, indent="\t")
+
+    _replace_atomically(os.path.join(output_dir, MANIFEST_NAME), write)
+
+
+class CorpusShardWriter:
+    """
+    Buffers documents and writes a shard (and the updated manifest) whenever the buffered text reaches `shard_size_mb`.
+        Args:
+            output_dir (str): Folder of the shards and the manifest.
+            shard_format (str): `arrow` or `parquet`.
+            tokenizer (str): Name of the tokenizer of the `num_tokens` counts, recorded in the manifest.
+            token_counts (str): `exact` or `estimate`, how the `num_tokens` counts were obtained.
+            num_shards (int): Number of shards of an existing manifest to keep (to resume), the other ones are deleted.
+                None starts a new corpus.
+    """
+
+    def __init__(self, output_dir, shard_format="arrow", shard_size_mb=256, tokenizer=None, token_counts="exact", num_shards=None):
+        if shard_format not in SHARD_FORMATS:
+            raise ValueError(f"Unknown shard format {shard_format}, choose from {SHARD_FORMATS}.")
+        self.output_dir = output_dir
+        self.shard_format = shard_format
+        self.shard_size = int(shard_size_mb * 2**20)
+        self.manifest = {
+            "format": shard_format,
+            "tokenizer": tokenizer,
+            "token_counts": token_counts,
+            "num_rows": 0,
+            "num_tokens": 0,
+            "shards": [],
+        }
+        os.makedirs(output_dir, exist_ok=True)
+
+        manifest_path = os.path.join(output_dir, MANIFEST_NAME)
+        if num_shards is not None and os.path.exists(manifest_path):
+            manifest, _ = load_manifest(manifest_path)
+            if manifest["format"] != shard_format:
+                raise ValueError(f"{manifest_path} holds {manifest['format']} shards, not {shard_format}.")
+            for shard in manifest["shards"][:num_shards]:
+                self._append(shard)
+        # shards of an earlier corpus, or written after the position we resume from
+        kept = {shard["path"] for shard in self.manifest["shards"]}
+        for name in os.listdir(output_dir):
+            if name.startswith("shard-") and name not in kept:
+                os.remove(os.path.join(output_dir, name))
+        self._write_manifest()
+
+        self.texts, self.num_tokens, self.buffered_bytes = [], [], 0
+
+    @property
+    def num_shards(self):
+        return len(self.manifest["shards"])
+
+    def _append(self, shard):
+        self.manifest["shards"].append(shard)
+        self.manifest["num_rows"] += shard["num_rows"]
+        self.manifest["num_tokens"] += shard["num_tokens"]
+
+    def _write_manifest(self):
+        write_manifest(self.output_dir, self.manifest)
+
+    def add(self, texts, num_tokens):
+        """Buffer documents, returns whether a shard was written (everything added so far is then durable)."""
+        self.texts.extend(texts)
+        self.num_tokens.extend(num_tokens)
+        self.buffered_bytes += sum(len(text.encode("utf-8")) for text in texts)
+        if self.buffered_bytes >= self.shard_size:
+            return self.flush()
+        return False
+
+    def flush(self):
+        """Write the buffered documents as a shard, returns whether one was written."""
+        if not self.texts:
+            return False
+        name = f"shard-{self.num_shards:05d}.{self.shard_format}"
+        table = pa.table({"text": self.texts, "num_tokens": pa.array(self.num_tokens, pa.int32())}, schema=SCHEMA)
+        self._append(write_shard(self.output_dir, name, table, self.shard_format))
+        self._write_manifest()
+        self.texts, self.num_tokens, self.buffered_bytes = [], [], 0
+        return True
+
+    def close(self):
+        return self.flush()
+
+
+def load_manifest(path):
+    """(manifest, folder of its shards) from a manifest file or the folder holding it."""
+    if os.path.isdir(path):
+        path = os.path.join(path, MANIFEST_NAME)
+    with open(path, "r") as f:
+        manifest = json.load(f)
+    return manifest, os.path.dirname(os.path.abspath(path))
+
+
+def load_manifest_dataset(path, num_proc=None, cache_dir=None):
+    """The `datasets.Dataset` (`text`, `num_tokens`) of the shards of a manifest, checked against its row count."""
+    from datasets import Dataset, concatenate_datasets, load_dataset
+
+    manifest, root = load_manifest(path)
+    files = [os.path.join(root, shard["path"]) for shard in manifest["shards"]]
+    if not files:
+        raise ValueError(f"The manifest {path} lists no shards.")
+    if manifest["format"] == "arrow":
+        dataset = concatenate_datasets([Dataset.from_file(file) for file in files])
+    else:
+        dataset = load_dataset("parquet", data_files=files, split="train", num_proc=num_proc, cache_dir=cache_dir)
+    if len(dataset) != manifest["num_rows"]:
+        raise ValueError(f"The shards of {path} hold {len(dataset)} rows, the manifest lists {manifest['num_rows']}.")
+    return dataset
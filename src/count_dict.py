@@ -1,6 +1,4 @@
 import json
-from transformers import AutoTokenizer
-import numpy as np
 import argparse
 
 def read_vocab_from_file(tok_config_path):
@@ -10,6 +8,8 @@ def read_vocab_from_file(tok_config_path):
     return vocab
 
 def read_vocab(tok_path):
+    from transformers import AutoTokenizer
+
     tok = AutoTokenizer.from_pretrained(tok_path)
     # Handle different tokenizer types:
     # - Some tokenizers have .vocab attribute (e.g., GPT2Tokenizer, GPTNeoXTokenizer)
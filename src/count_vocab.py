@@ -1,10 +1,28 @@
-from transformers import AutoConfig
 import argparse
+import json
+import os
+
+
+def vocab_size(model_path):
+    """`vocab_size` of a model config, read from its config.json (without importing transformers when it is there)."""
+    if os.path.isdir(model_path):
+        config_path = os.path.join(model_path, "config.json")
+    else:
+        from huggingface_hub import hf_hub_download
+
+        config_path = hf_hub_download(model_path, "config.json")
+    with open(config_path) as f:
+        config = json.load(f)
+    if "vocab_size" in config:
+        return config["vocab_size"]
+    # e.g. a composite config with the vocabulary in a sub-config
+    from transformers import AutoConfig
+
+    return AutoConfig.from_pretrained(model_path).vocab_size
+
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument("-m", "--model-path", type=str, default="google/gemma-2b")
     args = parser.parse_args()
-    # Load config only (avoids loading model and flash-attn dependency)
-    config = AutoConfig.from_pretrained(args.model_path)
-    print(config.vocab_size)
+    print(vocab_size(args.model_path))
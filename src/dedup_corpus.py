@@ -0,0 +1,322 @@
+"""
+Exact and near-duplicate removal for a sharded corpus (a manifest written by prepare_pubmed_corpus_hf.py
+--output-format arrow/parquet), between the corpus preparation and process_dataset.py.
+
+Every document is normalized (lowercase words, punctuation and whitespace dropped) and gets
+    - an exact hash: 64 bits of the BLAKE2b digest of the normalized text,
+    - a MinHash signature: `num_perm` 32-bit minimums of universal hashes of its word `shingle_size`-grams.
+Signatures are split into `bands` bands of `num_perm / bands` rows. Two documents with the same key in any band are
+candidates, and a candidate is a near duplicate when the fraction of equal signature entries (the MinHash estimate
+of the Jaccard similarity of their shingles) reaches `threshold`. Documents are compared in corpus order: a document
+is dropped when its exact hash was seen before, or when it is a near duplicate of the previous document of one of its
+band buckets, so the first copy is kept.
+
+Hashing runs in parallel over the shards, the matching is vectorized over all documents (one sort per band) and the
+kept documents are written shard by shard, with the same shard names. The exact hashes and signatures of the kept
+documents are added to an index (one part per run: `part-00000.exact.npy` (uint64) and `part-00000.minhash.npy`
+(uint32, `num_perm` per document, memory-mapped)), so a later increment of the corpus is checked against everything
+kept before it. Each part records the manifest it comes from (path and content hash): running the same corpus again
+checks it against the other parts only and replaces its part, so a rerun does not drop every document as a duplicate
+of itself. With 128 permutations the index takes 520 bytes per document, about 1.7 GB for the 3.3M abstracts
+of a 1B-token PubMed corpus. The fraction of documents and tokens (`num_tokens` of the manifest) removed is written
+to `dedup_report.json` next to the output manifest.
+"""
+import argparse
+import hashlib
+import json
+import os
+import re
+import zlib
+from multiprocessing import Pool
+
+import numpy as np
+import pyarrow as pa
+
+from corpus_manifest import MANIFEST_NAME, load_manifest, read_shard, write_manifest, write_shard
+from resource_policy import apply_policy
+
+INDEX_NAME = "index.json"
+REPORT_NAME = "dedup_report.json"
+MERSENNE_PRIME = np.uint64((1 << 61) - 1)
+MAX_HASH = np.uint64(0xFFFFFFFF)
+_WORD = re.compile(r"\w+")
+
+
+class MinHasher:
+    def __init__(self, num_perm=128, shingle_size=5, seed=42):
+        self.num_perm = num_perm
+        self.shingle_size = shingle_size
+        rng = np.random.default_rng(seed)
+        # a * h + b stays below 2**64 for 32-bit shingle hashes
+        self.a = rng.integers(1, 1 << 31, num_perm, dtype=np.uint64)[:, None]
+        self.b = rng.integers(0, 1 << 32, num_perm, dtype=np.uint64)[:, None]
+        self.multipliers = rng.integers(1, 1 << 63, shingle_size, dtype=np.uint64) | np.uint64(1)
+
+    def shingles(self, words):
+        """32-bit hashes of the word n-grams of a document (the whole document if it is shorter than n words)."""
+        hashes = np.fromiter((zlib.crc32(word.encode("utf-8")) for word in words), dtype=np.uint64, count=len(words))
+        n = min(self.shingle_size, max(len(hashes), 1))
+        if len(hashes) == 0:
+            return np.zeros(1, dtype=np.uint64)
+        combined = np.zeros(len(hashes) - n + 1, dtype=np.uint64)
+        for j in range(n):
+            combined += hashes[j : len(hashes) - n + 1 + j] * self.multipliers[j]
+        return (combined ^ (combined >> np.uint64(32))) & MAX_HASH
+
+    def signatures(self, shingle_sets, batch_shingles=1 << 14):
+        """[num_docs, num_perm] uint32 MinHash signatures, computed over batches of concatenated shingles."""
+        signatures = np.empty((len(shingle_sets), self.num_perm), dtype=np.uint32)
+        start = 0
+        while start < len(shingle_sets):
+            end, total = start, 0
+            while end < len(shingle_sets) and (end == start or total + len(shingle_sets[end]) <= batch_shingles):
+                total += len(shingle_sets[end])
+                end += 1
+            flat = np.concatenate(shingle_sets[start:end])
+            offsets = np.cumsum([0] + [len(shingles) for shingles in shingle_sets[start : end - 1]])
+            values = ((self.a * flat[None, :] + self.b) % MERSENNE_PRIME) & MAX_HASH
+            signatures[start:end] = np.minimum.reduceat(values, offsets, axis=1).T
+            start = end
+        return signatures
+
+
+def normalize(text):
+    return _WORD.findall(text.lower())
+
+
+def exact_hash(words):
+    return int.from_bytes(hashlib.blake2b(" ".join(words).encode("utf-8"), digest_size=8).digest(), "little")
+
+
+def _hash_shard(task):
+    """(exact hashes, signatures, token counts) of the documents of a shard, saved as .npy files in `tmp_dir`."""
+    path, shard_format, tmp_dir, index, hasher_args = task
+    hasher = MinHasher(**hasher_args)
+    table = read_shard(path, shard_format)
+    exact, shingle_sets = [], []
+    for text in table.column("text").to_pylist():
+        words = normalize(text)
+        exact.append(exact_hash(words))
+        shingle_sets.append(hasher.shingles(words))
+    prefix = os.path.join(tmp_dir, f"{index:05d}")
+    np.save(prefix + ".exact.npy", np.array(exact, dtype=np.uint64))
+    np.save(prefix + ".minhash.npy", hasher.signatures(shingle_sets))
+    np.save(prefix + ".tokens.npy", table.column("num_tokens").to_numpy().astype(np.int64))
+    return prefix
+
+
+def _filter_shard(task):
+    path, shard_format, output_dir, name, keep = task
+    table = read_shard(path, shard_format)
+    return write_shard(output_dir, name, table.filter(pa.array(keep)), shard_format)
+
+
+class DedupIndex:
+    """Exact hashes and MinHash signatures of the documents kept so far, one memory-mapped part per run."""
+
+    def __init__(self, index_dir, num_perm=128, bands=16, shingle_size=5, threshold=0.8, seed=42):
+        self.index_dir = index_dir
+        settings = {"num_perm": num_perm, "bands": bands, "shingle_size": shingle_size, "threshold": threshold, "seed": seed}
+        if num_perm % bands != 0:
+            raise ValueError(f"The {bands} bands must divide the {num_perm} permutations.")
+        self.meta = {"settings": settings, "parts": []}
+        path = os.path.join(index_dir, INDEX_NAME)
+        if os.path.exists(path):
+            with open(path, "r") as f:
+                self.meta = json.load(f)
+            if self.meta["settings"] != settings:
+                raise ValueError(f"The index {index_dir} was built with {self.meta['settings']}, not {settings}.")
+        self.settings = settings
+
+    @property
+    def num_docs(self):
+        return sum(part["num_docs"] for part in self.meta["parts"])
+
+    def parts_of(self, sources, manifest_sha1):
+        """Names of the parts added from one of `sources` or from a manifest with the same content."""
+        return [
+            part["name"]
+            for part in self.meta["parts"]
+            if part["source"] in sources or (manifest_sha1 is not None and part.get("manifest_sha1") == manifest_sha1)
+        ]
+
+    def load(self, exclude=()):
+        """(exact hashes, signatures) of the indexed documents, without the parts named in `exclude`."""
+        parts = [part for part in self.meta["parts"] if part["name"] not in exclude]
+        exact = [np.load(os.path.join(self.index_dir, part["name"] + ".exact.npy")) for part in parts]
+        signatures = [np.load(os.path.join(self.index_dir, part["name"] + ".minhash.npy"), mmap_mode="r") for part in parts]
+        num_perm = self.settings["num_perm"]
+        return (
+            np.concatenate(exact) if exact else np.zeros(0, dtype=np.uint64),
+            np.concatenate(signatures) if signatures else np.zeros((0, num_perm), dtype=np.uint32),
+        )
+
+    def add(self, exact, signatures, source=None, manifest_sha1=None, replace=()):
+        """Add a part, in place of the parts named in `replace` (their files are removed once the index is updated)."""
+        os.makedirs(self.index_dir, exist_ok=True)
+        numbers = [int(part["name"].split("-")[1]) for part in self.meta["parts"]]
+        name = f"part-{max(numbers, default=-1) + 1:05d}"
+        np.save(os.path.join(self.index_dir, name + ".exact.npy"), exact)
+        np.save(os.path.join(self.index_dir, name + ".minhash.npy"), signatures)
+        self.meta["parts"] = [part for part in self.meta["parts"] if part["name"] not in replace]
+        self.meta["parts"].append({"name": name, "num_docs": len(exact), "source": source, "manifest_sha1": manifest_sha1})
+        tmp_path = os.path.join(self.index_dir, INDEX_NAME + ".tmp")
+        with open(tmp_path, "w") as f:
+            json.dump(self.meta, f, indent="\t")
+        os.replace(tmp_path, os.path.join(self.index_dir, INDEX_NAME))
+        for old in replace:
+            for suffix in (".exact.npy", ".minhash.npy"):
+                os.remove(os.path.join(self.index_dir, old + suffix))
+
+
+def band_keys(signatures, band, rows):
+    """64-bit key of each document in one band."""
+    keys = np.full(len(signatures), band + 1, dtype=np.uint64) * np.uint64(0x9E3779B97F4A7C15)
+    for j in range(rows):
+        keys = (keys ^ signatures[:, band * rows + j].astype(np.uint64)) * np.uint64(0x100000001B3)
+    return keys
+
+
+def find_duplicates(exact, signatures, num_indexed, bands, threshold, chunk_size=1 << 20):
+    """
+    (exact duplicate mask, near duplicate mask) of the documents after the first `num_indexed` ones (the index),
+    see the module docstring.
+    """
+    num_docs = len(exact)
+    _, first = np.unique(exact, return_index=True)
+    is_first = np.zeros(num_docs, dtype=bool)
+    is_first[first] = True
+    exact_duplicate = ~is_first
+    exact_duplicate[:num_indexed] = False
+
+    # near duplicates among the documents left after exact deduplication
+    candidates = np.flatnonzero(~exact_duplicate)
+    near_duplicate = np.zeros(num_docs, dtype=bool)
+    rows = signatures.shape[1] // bands
+    for band in range(bands):
+        keys = band_keys(signatures, band, rows)[candidates]
+        order = np.argsort(keys, kind="stable")
+        same_bucket = keys[order[1:]] == keys[order[:-1]]
+        later, previous = candidates[order[1:][same_bucket]], candidates[order[:-1][same_bucket]]
+        # only documents of this run can be dropped, and only if not already found
+        selected = (later >= num_indexed) & ~near_duplicate[later]
+        later, previous = later[selected], previous[selected]
+        for start in range(0, len(later), chunk_size):
+            pair_later, pair_previous = later[start : start + chunk_size], previous[start : start + chunk_size]
+            similarity = (signatures[pair_later] == signatures[pair_previous]).mean(axis=1)
+            near_duplicate[pair_later[similarity >= threshold]] = True
+    return exact_duplicate[num_indexed:], near_duplicate[num_indexed:]
+
+
+def dedup_corpus(input_path, output_dir, index_dir, num_workers=None, num_perm=128, bands=16, shingle_size=5, threshold=0.8, seed=42):
+    """Write the deduplicated corpus of the manifest `input_path` to `output_dir` and add it to the index, returns the report."""
+    manifest, root = load_manifest(input_path)
+    shard_format = manifest["format"]
+    manifest_path = os.path.join(root, MANIFEST_NAME)
+    with open(manifest_path, "rb") as f:
+        manifest_sha1 = hashlib.sha1(f.read()).hexdigest()
+    index = DedupIndex(index_dir, num_perm=num_perm, bands=bands, shingle_size=shingle_size, threshold=threshold, seed=seed)
+    # a rerun on the same corpus is checked against the other parts only, and its part is replaced
+    previous = index.parts_of((manifest_path, root), manifest_sha1)
+    if previous:
+        print(f"{manifest_path} was already added to the index as {', '.join(previous)}, it is replaced.")
+    hasher_args = {"num_perm": num_perm, "shingle_size": shingle_size, "seed": seed}
+    os.makedirs(output_dir, exist_ok=True)
+    tmp_dir = os.path.join(output_dir, ".dedup-tmp")
+    os.makedirs(tmp_dir, exist_ok=True)
+
+    paths = [os.path.join(root, shard["path"]) for shard in manifest["shards"]]
+    with Pool(num_workers) as pool:
+        prefixes = pool.map(_hash_shard, [(path, shard_format, tmp_dir, i, hasher_args) for i, path in enumerate(paths)], chunksize=1)
+        shard_sizes = [shard["num_rows"] for shard in manifest["shards"]]
+        exact = np.concatenate([np.load(prefix + ".exact.npy") for prefix in prefixes])
+        signatures = np.concatenate([np.load(prefix + ".minhash.npy") for prefix in prefixes])
+        tokens = np.concatenate([np.load(prefix + ".tokens.npy") for prefix in prefixes])
+
+        indexed_exact, indexed_signatures = index.load(exclude=previous)
+        num_indexed = len(indexed_exact)
+        exact_duplicate, near_duplicate = find_duplicates(
+            np.concatenate([indexed_exact, exact]),
+            np.concatenate([indexed_signatures, signatures]),
+            num_indexed,
+            bands,
+            threshold,
+        )
+        keep = ~(exact_duplicate | near_duplicate)
+
+        offsets = np.cumsum([0] + shard_sizes)
+        tasks = [
+            (path, shard_format, output_dir, shard["path"], keep[offsets[i] : offsets[i + 1]])
+            for i, (path, shard) in enumerate(zip(paths, manifest["shards"]))
+        ]
+        shards = pool.map(_filter_shard, tasks, chunksize=1)
+
+    write_manifest(
+        output_dir,
+        {
+            "format": shard_format,
+            "tokenizer": manifest.get("tokenizer"),
+            "token_counts": manifest.get("token_counts", "exact"),
+            "num_rows": sum(shard["num_rows"] for shard in shards),
+            "num_tokens": sum(shard["num_tokens"] for shard in shards),
+            "shards": shards,
+        },
+    )
+    index.add(exact[keep], signatures[keep], source=manifest_path, manifest_sha1=manifest_sha1, replace=previous)
+    for prefix in prefixes:
+        for suffix in (".exact.npy", ".minhash.npy", ".tokens.npy"):
+            os.remove(prefix + suffix)
+    os.rmdir(tmp_dir)
+
+    total_tokens = int(tokens.sum())
+    report = {
+        "input": manifest_path,
+        "replaced_parts": previous,
+        "num_indexed_before": num_indexed,
+        "settings": index.settings,
+        "num_docs": len(keep),
+        "num_tokens": total_tokens,
+        "exact_duplicate_docs": int(exact_duplicate.sum()),
+        "exact_duplicate_tokens": int(tokens[exact_duplicate].sum()),
+        "near_duplicate_docs": int(near_duplicate.sum()),
+        "near_duplicate_tokens": int(tokens[near_duplicate].sum()),
+        "kept_docs": int(keep.sum()),
+        "kept_tokens": int(tokens[keep].sum()),
+    }
+    report["removed_doc_fraction"] = 1 - report["kept_docs"] / max(report["num_docs"], 1)
+    report["removed_token_fraction"] = 1 - report["kept_tokens"] / max(total_tokens, 1)
+    with open(os.path.join(output_dir, REPORT_NAME), "w") as f:
+        json.dump(report, f, indent="\t")
+    return report
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-i", "--input-path", type=str, required=True, help="Corpus manifest (or its folder) written by prepare_pubmed_corpus_hf.py.")
+    parser.add_argument("-o", "--output-dir", type=str, required=True, help="Folder of the deduplicated shards and manifest.")
+    parser.add_argument("-x", "--index-dir", type=str, default=None, help="Index of the documents kept so far, updated with this corpus. Defaults to `dedup-index` in the output folder.")
+    parser.add_argument("-n", "--num-workers", type=int, default=None, help="Defaults to one per core of the resource policy.")
+    parser.add_argument("-p", "--num-perm", type=int, default=128)
+    parser.add_argument("-b", "--bands", type=int, default=16)
+    parser.add_argument("-s", "--shingle-size", type=int, default=5, help="Words per shingle.")
+    parser.add_argument("-t", "--threshold", type=float, default=0.8, help="Estimated Jaccard similarity of near duplicates.")
+    parser.add_argument("--seed", type=int, default=42)
+
+    args = parser.parse_args()
+    plan = apply_policy("dedup")
+
+    report = dedup_corpus(
+        args.input_path,
+        args.output_dir,
+        args.index_dir or os.path.join(args.output_dir, "dedup-index"),
+        num_workers=args.num_workers or plan["num_procs"],
+        num_perm=args.num_perm,
+        bands=args.bands,
+        shingle_size=args.shingle_size,
+        threshold=args.threshold,
+        seed=args.seed,
+    )
+    print(
+        f"Kept {report['kept_docs']:,} of {report['num_docs']:,} documents: {report['exact_duplicate_docs']:,} exact and "
+        f"{report['near_duplicate_docs']:,} near duplicates removed, {100 * report['removed_token_fraction']:.2f}% of the tokens."
+    )
@@ -0,0 +1,204 @@
+"""
+Delta checkpoints: store only the trainable tensors (e.g. `embed_in` / `embed_out` in the embed-only stage) and their
+optimizer state, plus a reference to the frozen base model written by convert.py (path and SHA-256 of its weights).
+
+A delta checkpoint folder has the usual Trainer files (`optimizer.pt`, `scheduler.pt`, `rng_state.pth`,
+`trainer_state.json`, config, tokenizer) and, instead of the model weights:
+    delta.safetensors: the trainable tensors, under their state dict names.
+    delta.json: {"base_model_path", "base_sha256", "tensors"}.
+
+`load_delta_model` reassembles a model from the base and the delta, loading the delta tensors one at a time from the
+memory-mapped safetensors file, and `--resume_from_checkpoint` works on delta checkpoints when training starts from the
+same base.
+"""
+import argparse
+import hashlib
+import json
+import os
+
+import torch
+from safetensors import safe_open
+from safetensors.torch import save_file
+from transformers import AutoModelForCausalLM, PreTrainedModel
+from transformers.trainer import OPTIMIZER_NAME, SCHEDULER_NAME, TRAINER_STATE_NAME, TRAINING_ARGS_NAME
+from transformers.trainer_utils import PREFIX_CHECKPOINT_DIR
+
+DELTA_WEIGHTS_NAME = "delta.safetensors"
+DELTA_CONFIG_NAME = "delta.json"
+FINGERPRINT_NAME = "weights_sha256.json"
+
+
+def _weight_files(model_dir):
+    return sorted(
+        name for name in os.listdir(model_dir) if name.endswith(".safetensors") or (name.endswith(".bin") and name != TRAINING_ARGS_NAME)
+    )
+
+
+def fingerprint_model_dir(model_dir, chunk_size=1 << 24):
+    """SHA-256 over the weight files of a saved model, read from `weights_sha256.json` when convert.py wrote it."""
+    cached = os.path.join(model_dir, FINGERPRINT_NAME)
+    if os.path.exists(cached):
+        with open(cached, "r") as f:
+            return json.load(f)["sha256"]
+    digest = hashlib.sha256()
+    for name in _weight_files(model_dir):
+        digest.update(name.encode())
+        with open(os.path.join(model_dir, name), "rb") as f:
+            for chunk in iter(lambda: f.read(chunk_size), b""):
+                digest.update(chunk)
+    return digest.hexdigest()
+
+
+def write_model_fingerprint(model_dir):
+    """Record the SHA-256 of a saved base model next to its weights, so delta checkpoints can reference it cheaply."""
+    cached = os.path.join(model_dir, FINGERPRINT_NAME)
+    if os.path.exists(cached):
+        os.remove(cached)
+    sha256 = fingerprint_model_dir(model_dir)
+    with open(cached, "w") as f:
+        json.dump({"sha256": sha256, "files": _weight_files(model_dir)}, f, indent="\t")
+    return sha256
+
+
+def trainable_state_dict(model, trainable=None):
+    """State dict entries of the trainable parameters (`requires_grad`, or names accepted by `trainable`)."""
+    if trainable is None:
+        names = {name for name, param in model.named_parameters() if param.requires_grad}
+    else:
+        names = {name for name, _ in model.named_parameters() if trainable(name)}
+    return {name: tensor for name, tensor in model.state_dict().items() if name in names}
+
+
+def filter_optimizer_state(optimizer, params):
+    """`optimizer.state_dict()` keeping the state of `params` only; the other parameters restart from a fresh state."""
+    keep = {id(p) for p in params}
+    state_dict = optimizer.state_dict()
+    index = 0
+    kept = set()
+    for group in optimizer.param_groups:
+        for p in group["params"]:
+            if id(p) in keep:
+                kept.add(index)
+            index += 1
+    state_dict["state"] = {idx: state for idx, state in state_dict["state"].items() if idx in kept}
+    return state_dict
+
+
+def save_delta(model, save_directory, base_model_path, base_sha256=None, trainable=None):
+    os.makedirs(save_directory, exist_ok=True)
+    delta = {name: tensor.detach().contiguous().cpu() for name, tensor in trainable_state_dict(model, trainable).items()}
+    save_file(delta, os.path.join(save_directory, DELTA_WEIGHTS_NAME), metadata={"format": "pt"})
+    if os.path.isdir(base_model_path):
+        base_model_path = os.path.abspath(base_model_path)
+    with open(os.path.join(save_directory, DELTA_CONFIG_NAME), "w") as f:
+        json.dump({"base_model_path": base_model_path, "base_sha256": base_sha256, "tensors": sorted(delta)}, f, indent="\t")
+
+
+def is_delta_checkpoint(checkpoint_dir):
+    return os.path.exists(os.path.join(checkpoint_dir, DELTA_CONFIG_NAME))
+
+
+def _check_base(delta_config, base_model_path):
+    if delta_config["base_sha256"] is None or not os.path.isdir(base_model_path):
+        return
+    sha256 = fingerprint_model_dir(base_model_path)
+    if sha256 != delta_config["base_sha256"]:
+        raise ValueError(
+            f"The base model at {base_model_path} (sha256 {sha256}) is not the base of this delta checkpoint "
+            f"(sha256 {delta_config['base_sha256']})."
+        )
+
+
+def apply_delta(model, checkpoint_dir, base_model_path=None):
+    """Overwrite the tensors of `model` (loaded from the base) with the ones of a delta checkpoint, in place."""
+    with open(os.path.join(checkpoint_dir, DELTA_CONFIG_NAME), "r") as f:
+        delta_config = json.load(f)
+    _check_base(delta_config, base_model_path or delta_config["base_model_path"])
+
+    params = dict(model.named_parameters())
+    params.update(dict(model.named_buffers()))
+    with safe_open(os.path.join(checkpoint_dir, DELTA_WEIGHTS_NAME), framework="pt") as f:
+        names = list(f.keys())
+        embed_name = next((name for name in names if params.get(name) is model.get_input_embeddings().weight), None)
+        if embed_name is not None and f.get_slice(embed_name).get_shape()[0] != params[embed_name].shape[0]:
+            model.resize_token_embeddings(f.get_slice(embed_name).get_shape()[0])
+            params = dict(model.named_parameters())
+        with torch.no_grad():
+            for name in names:
+                params[name].copy_(f.get_tensor(name))
+    return model
+
+
+def load_delta_model(checkpoint_dir, base_model_path=None, **kwargs):
+    """Reassemble a full model from a delta checkpoint and its base (`from_pretrained` kwargs are passed through)."""
+    with open(os.path.join(checkpoint_dir, DELTA_CONFIG_NAME), "r") as f:
+        base_model_path = base_model_path or json.load(f)["base_model_path"]
+    model = AutoModelForCausalLM.from_pretrained(base_model_path, **kwargs)
+    return apply_delta(model, checkpoint_dir, base_model_path=base_model_path)
+
+
+def _delta_save_checkpoint(trainer, base_model_path, base_sha256, trainable, original_save_checkpoint):
+    def _save_checkpoint(model, trial, metrics=None):
+        args = trainer.args
+        unwrapped = trainer.accelerator.unwrap_model(trainer.model)
+        if trainer.is_deepspeed_enabled or trainer.is_fsdp_enabled or not isinstance(unwrapped, PreTrainedModel):
+            # the engine owns the (partitioned) optimizer state, keep full checkpoints
+            return original_save_checkpoint(model, trial, metrics=metrics)
+
+        trainer.store_flos()
+        run_dir = trainer._get_output_dir(trial=trial)
+        output_dir = os.path.join(run_dir, f"{PREFIX_CHECKPOINT_DIR}-{trainer.state.global_step}")
+        os.makedirs(output_dir, exist_ok=True)
+        if args.should_save:
+            save_delta(unwrapped, output_dir, base_model_path, base_sha256=base_sha256, trainable=trainable)
+            unwrapped.config.save_pretrained(output_dir)
+            if trainer.tokenizer is not None:
+                trainer.tokenizer.save_pretrained(output_dir)
+            torch.save(args, os.path.join(output_dir, TRAINING_ARGS_NAME))
+            if not args.save_only_model:
+                params = [p for name, p in unwrapped.named_parameters() if (p.requires_grad if trainable is None else trainable(name))]
+                torch.save(filter_optimizer_state(trainer.optimizer, params), os.path.join(output_dir, OPTIMIZER_NAME))
+                torch.save(trainer.lr_scheduler.state_dict(), os.path.join(output_dir, SCHEDULER_NAME))
+        if not args.save_only_model:
+            trainer._save_rng_state(output_dir)
+        if args.should_save:
+            trainer.state.stateful_callbacks["TrainerControl"] = trainer.control.state()
+            trainer.state.save_to_json(os.path.join(output_dir, TRAINER_STATE_NAME))
+            trainer._rotate_checkpoints(use_mtime=False, output_dir=run_dir)
+
+    return _save_checkpoint
+
+
+def _delta_load_from_checkpoint(trainer, base_model_path, original_load_from_checkpoint):
+    def _load_from_checkpoint(resume_from_checkpoint, model=None):
+        if not is_delta_checkpoint(resume_from_checkpoint):
+            return original_load_from_checkpoint(resume_from_checkpoint, model=model)
+        model = trainer.accelerator.unwrap_model(trainer.model if model is None else model)
+        apply_delta(model, resume_from_checkpoint, base_model_path=base_model_path)
+
+    return _load_from_checkpoint
+
+
+def enable_delta_checkpointing(trainer, base_model_path, trainable=None):
+    """
+    Make `trainer` write delta checkpoints against the base model it was loaded from, and resume from them.
+        Args:
+            base_model_path (str): The frozen base, e.g. the output of convert.py.
+            trainable (Callable[[str], bool]): Names of the parameters to store. Defaults to the ones requiring grad.
+    """
+    base_sha256 = fingerprint_model_dir(base_model_path) if os.path.isdir(base_model_path) else None
+    trainer._save_checkpoint = _delta_save_checkpoint(trainer, base_model_path, base_sha256, trainable, trainer._save_checkpoint)
+    trainer._load_from_checkpoint = _delta_load_from_checkpoint(trainer, base_model_path, trainer._load_from_checkpoint)
+    return base_sha256
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-c", "--checkpoint-path", type=str, required=True, help="Delta checkpoint folder.")
+    parser.add_argument("-b", "--base-model-path", type=str, default=None, help="Base model, defaults to the path recorded in the checkpoint.")
+    parser.add_argument("-o", "--output-model-path", type=str, required=True)
+
+    args = parser.parse_args()
+
+    model = load_delta_model(args.checkpoint_path, base_model_path=args.base_model_path, torch_dtype="auto")
+    model.save_pretrained(args.output_model_path)
@@ -0,0 +1,261 @@
+"""
+Pick the distributed strategy, offloading and micro-batch size of a training run from a memory estimate, and write the
+matching accelerate config.
+
+Per GPU, with `P` parameters, `T` trainable parameters, `N` GPUs and bf16 weights:
+    zero2: weights 2P, gradients 2T / N, fp32 master weights and AdamW states 12T / N.
+    zero3: (2P + 2T + 12T) / N, plus the gathered parameters of the largest modules (the embedding or a layer).
+    *_offload: the fp32 optimizer state (and fp32 gradients) live in CPU memory; zero3_offload_params also the weights.
+Activations come from the estimate of selective_checkpoint.py for the checkpointing policy and micro-batch, plus one
+layer of recomputed activations when layers are checkpointed, and `reserved_gb` covers the CUDA context, NCCL and
+communication buckets. Plain DDP is not planned: the model is loaded in bf16 and DDP would keep no fp32 master weights,
+so small updates (e.g. at the full-phase learning rate) would be rounded away.
+
+Micro-batch sizes are the divisors of the per-GPU share of the global batch, so micro-batch times gradient accumulation
+reproduces it exactly (the realized `global_batch_size` is reported, with a warning when the GPUs do not divide the
+target). Among the strategies without offloading, the one fitting the largest micro-batch wins, ties going to the least
+communication (zero2 < zero3). Offloading is only used when nothing else fits a micro-batch of 1. Every figure
+can be given on the command line (`--num-gpus`, `--gpu-memory-gb`, `--cpu-memory-gb`), so plans can be checked on a CPU
+machine.
+"""
+import argparse
+import json
+import math
+import os
+import sys
+
+import torch
+
+from selective_checkpoint import activation_bytes_per_layer, estimate_policy, parse_policy
+
+STRATEGIES = ("zero2", "zero3", "zero2_offload", "zero3_offload", "zero3_offload_params")
+
+
+def parameter_counts(config, trainable="all"):
+    """(parameters, trainable parameters, parameters of the largest layer or embedding) of a causal LM config."""
+    from accelerate import init_empty_weights
+    from transformers import AutoModelForCausalLM
+
+    with init_empty_weights():
+        model = AutoModelForCausalLM.from_config(config)
+    named = dict(model.named_parameters())
+    total = sum(param.numel() for param in named.values())
+    if trainable == "all":
+        num_trainable = total
+    elif trainable == "embed":
+        num_trainable = sum(param.numel() for name, param in named.items() if "embed" in name)
+    else:
+        raise ValueError(f"Unknown trainable subset {trainable}, choose from all / embed.")
+    largest = max(
+        [sum(param.numel() for param in layer.parameters()) for layer in model.base_model.layers]
+        + [model.get_input_embeddings().weight.numel()]
+    )
+    return total, num_trainable, largest
+
+
+def model_state_bytes(strategy, num_params, num_trainable, num_gpus, largest_module):
+    """(GPU bytes per process, CPU bytes over all processes) of weights, gradients and optimizer state."""
+    weights, grads, optim = 2 * num_params, 2 * num_trainable, 12 * num_trainable
+    if strategy == "zero2":
+        return weights + (grads + optim) / num_gpus, num_gpus * weights
+    if strategy == "zero2_offload":
+        # fp32 gradients are copied to the CPU next to the optimizer state
+        return weights + grads / num_gpus, num_gpus * weights + optim + 2 * grads
+    gathered = 2 * 2 * largest_module
+    if strategy == "zero3":
+        return (weights + grads + optim) / num_gpus + gathered, weights
+    if strategy == "zero3_offload":
+        return (weights + grads) / num_gpus + gathered, weights + optim + 2 * grads
+    if strategy == "zero3_offload_params":
+        return grads / num_gpus + gathered, 2 * weights + optim + 2 * grads
+    raise ValueError(f"Unknown strategy {strategy}, choose from {STRATEGIES}.")
+
+
+def activation_bytes(config, micro_batch_size, seq_length, checkpoint_policy="all", fused_attention=True):
+    """Activations kept for backward, plus the activations of one recomputed layer when layers are checkpointed."""
+    name, _ = parse_policy(checkpoint_policy)
+    if name == "auto":
+        # auto checkpoints at most every layer
+        checkpoint_policy, name = "all", "all"
+    estimate = estimate_policy(config, micro_batch_size, seq_length, checkpoint_policy, fused_attention=fused_attention)
+    recompute = activation_bytes_per_layer(config, micro_batch_size, seq_length, "layer", fused_attention) if name != "none" else 0
+    return estimate["activation_bytes"] + recompute
+
+
+def plan(
+    config,
+    num_gpus,
+    gpu_memory_gb,
+    cpu_memory_gb,
+    seq_length,
+    checkpoint_policy="all",
+    trainable="all",
+    global_batch_size=128,
+    max_micro_batch_size=64,
+    reserved_gb=2.0,
+    fused_attention=True,
+):
+    """Estimate every strategy and choose one, see the module docstring. Returns a JSON-serializable dict."""
+    num_params, num_trainable, largest_module = parameter_counts(config, trainable)
+    # micro-batch * gradient accumulation must give the per-GPU share exactly: when the GPUs do not divide the global
+    # batch, the share is rounded down or up, whichever fits the larger micro-batch (then the closer one)
+    share = global_batch_size / num_gpus
+    per_gpu_batches = sorted({max(1, math.floor(share)), max(1, math.ceil(share))}, key=lambda batch: abs(batch - share))
+    divisors = {batch: [size for size in range(1, min(max_micro_batch_size, batch) + 1) if batch % size == 0] for batch in per_gpu_batches}
+    candidates = sorted(set(sum(divisors.values(), [])))
+    budget = (gpu_memory_gb - reserved_gb) * 2**30
+
+    estimates = {}
+    for strategy in STRATEGIES:
+        gpu_state, cpu_state = model_state_bytes(strategy, num_params, num_trainable, num_gpus, largest_module)
+        fitting = {
+            micro_batch_size
+            for micro_batch_size in candidates
+            if cpu_state <= cpu_memory_gb * 2**30
+            and gpu_state + activation_bytes(config, micro_batch_size, seq_length, checkpoint_policy, fused_attention) <= budget
+        }
+        # max keeps the first of equal micro-batch sizes, i.e. the per-GPU batch closest to the share
+        micro_batch_size, per_gpu_batch = max(
+            ((max((size for size in divisors[batch] if size in fitting), default=0), batch) for batch in per_gpu_batches),
+            key=lambda pair: pair[0],
+        )
+        estimates[strategy] = {
+            "micro_batch_size": micro_batch_size,
+            "per_gpu_batch_size": per_gpu_batch,
+            "gpu_state_gb": gpu_state / 2**30,
+            "cpu_state_gb": cpu_state / 2**30,
+            "activation_gb": activation_bytes(config, max(micro_batch_size, 1), seq_length, checkpoint_policy, fused_attention) / 2**30,
+        }
+
+    def best(strategies):
+        # max keeps the first of equal micro-batch sizes, i.e. the least communication
+        return max(strategies, key=lambda strategy: estimates[strategy]["micro_batch_size"])
+
+    strategy = best([strategy for strategy in STRATEGIES if "offload" not in strategy])
+    if estimates[strategy]["micro_batch_size"] == 0:
+        strategy = best([strategy for strategy in STRATEGIES if "offload" in strategy])
+    micro_batch_size, per_gpu_batch = estimates[strategy]["micro_batch_size"], estimates[strategy]["per_gpu_batch_size"]
+    if micro_batch_size == 0:
+        raise ValueError(f"No strategy fits a micro-batch of 1 in {gpu_memory_gb} GB per GPU: {json.dumps(estimates)}")
+    if per_gpu_batch * num_gpus != global_batch_size:
+        print(
+            f"Warning: {num_gpus} GPUs do not divide the global batch of {global_batch_size}, training with a global batch of "
+            f"{per_gpu_batch * num_gpus} instead.",
+            file=sys.stderr,
+        )
+    return {
+        "strategy": strategy,
+        "micro_batch_size": micro_batch_size,
+        "gradient_accumulation_steps": per_gpu_batch // micro_batch_size,
+        "global_batch_size": per_gpu_batch * num_gpus,
+        "target_global_batch_size": global_batch_size,
+        "num_gpus": num_gpus,
+        "num_params": num_params,
+        "num_trainable_params": num_trainable,
+        "estimates": estimates,
+    }
+
+
+def accelerate_config(plan, mixed_precision="bf16"):
+    """The accelerate launch config of a plan."""
+    num_gpus = plan["num_gpus"]
+    config = {
+        "compute_environment": "LOCAL_MACHINE",
+        "distributed_type": "MULTI_GPU" if num_gpus > 1 else "NO",
+        "downcast_bf16": "no",
+        "machine_rank": 0,
+        "main_training_function": "main",
+        "mixed_precision": mixed_precision,
+        "num_machines": 1,
+        "num_processes": num_gpus,
+        "rdzv_backend": "static",
+        "same_network": True,
+        "tpu_env": [],
+        "tpu_use_cluster": False,
+        "tpu_use_sudo": False,
+        "use_cpu": False,
+    }
+    strategy = plan["strategy"]
+    if strategy.startswith("zero"):
+        stage = int(strategy[4])
+        config["distributed_type"] = "DEEPSPEED"
+        config["deepspeed_config"] = {
+            "deepspeed_multinode_launcher": "standard",
+            "offload_optimizer_device": "cpu" if "offload" in strategy else "none",
+            "offload_param_device": "cpu" if strategy.endswith("offload_params") else "none",
+            "zero3_init_flag": stage == 3,
+            "zero3_save_16bit_model": stage == 3,
+            "zero_stage": stage,
+        }
+    return config
+
+
+def _detect_gpus():
+    if not torch.cuda.is_available():
+        return 0, 0.0
+    return torch.cuda.device_count(), torch.cuda.get_device_properties(0).total_memory / 2**30
+
+
+def _detect_cpu_memory_gb():
+    return os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES") / 2**30
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-m", "--model-path", type=str, required=True, help="Model path or config JSON string.")
+    parser.add_argument("-s", "--seq-length", type=int, default=2048)
+    parser.add_argument("-p", "--checkpoint-policy", type=str, default="all", help="Activation checkpointing policy (see selective_checkpoint.py), `none` without checkpointing.")
+    parser.add_argument("-t", "--trainable", type=str, default="all", help="Trainable parameters: all / embed.")
+    parser.add_argument("-g", "--global-batch-size", type=int, default=128)
+    parser.add_argument("-b", "--max-micro-batch-size", type=int, default=64)
+    parser.add_argument("-n", "--num-gpus", type=int, default=None, help="Defaults to the visible GPUs.")
+    parser.add_argument("--gpu-memory-gb", type=float, default=None, help="Defaults to the memory of the first GPU.")
+    parser.add_argument("--cpu-memory-gb", type=float, default=None, help="Defaults to the physical memory.")
+    parser.add_argument("--reserved-gb", type=float, default=2.0, help="GPU memory kept for the CUDA context, NCCL and buffers.")
+    parser.add_argument("--eager-attention", action="store_true", help="Account for the attention scores of eager attention.")
+    parser.add_argument("-o", "--output-config-path", type=str, default=None, help="Where to write the accelerate config (YAML).")
+    parser.add_argument("--print-env", action="store_true", help="Print `export` lines of the plan for a shell script.")
+
+    args = parser.parse_args()
+
+    from transformers import AutoConfig, GPTNeoXConfig
+
+    if args.model_path.startswith("{"):
+        model_config = GPTNeoXConfig(**json.loads(args.model_path))
+    else:
+        model_config = AutoConfig.from_pretrained(args.model_path)
+    num_gpus, gpu_memory_gb = _detect_gpus()
+    num_gpus = args.num_gpus or max(num_gpus, 1)
+    gpu_memory_gb = args.gpu_memory_gb or gpu_memory_gb
+    if not gpu_memory_gb:
+        raise ValueError("No GPU detected, pass `--gpu-memory-gb`.")
+
+    result = plan(
+        model_config,
+        num_gpus=num_gpus,
+        gpu_memory_gb=gpu_memory_gb,
+        cpu_memory_gb=args.cpu_memory_gb or _detect_cpu_memory_gb(),
+        seq_length=args.seq_length,
+        checkpoint_policy=args.checkpoint_policy,
+        trainable=args.trainable,
+        global_batch_size=args.global_batch_size,
+        max_micro_batch_size=args.max_micro_batch_size,
+        reserved_gb=args.reserved_gb,
+        fused_attention=not args.eager_attention,
+    )
+    if args.output_config_path is not None:
+        import yaml
+
+        os.makedirs(os.path.dirname(os.path.abspath(args.output_config_path)), exist_ok=True)
+        with open(args.output_config_path, "w") as f:
+            yaml.safe_dump(accelerate_config(result), f, sort_keys=True)
+        with open(os.path.splitext(args.output_config_path)[0] + ".plan.json", "w") as f:
+            json.dump(result, f, indent="\t")
+
+    if args.print_env:
+        print(f"export DISTRIBUTED_STRATEGY={result['strategy']}")
+        print(f"export TRAIN_BS={result['micro_batch_size']}")
+        print(f"export GRADIENT_ACC={result['gradient_accumulation_steps']}")
+        print(f"export GLOBAL_BATCH_SIZE={result['global_batch_size']}")
+    else:
+        print(json.dumps(result, indent="\t"))
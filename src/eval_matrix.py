@@ -1,8 +1,13 @@
 import json
-from nltk.translate.bleu_score import sentence_bleu
-from sentence_transformers import SentenceTransformer
-from transformers import AutoTokenizer
 import argparse
+from tokenizer_service import TokenizerClient
+from resource_policy import apply_policy
+
+def load_tokenizer(tokenizer_path, tokenizer_service=None):
+    if tokenizer_service:
+        return TokenizerClient(tokenizer_service, tokenizer_path)
+    from transformers import AutoTokenizer
+    return AutoTokenizer.from_pretrained(tokenizer_path)
 
 def read_tsv(file_path):
     res = []
@@ -17,7 +22,10 @@ def eval_trans_matrix(
     eval_file_path="./data/pretrain-dataset/pythia-2-gemma-MX1K-eval",
     bleu_weights=(1, 0, 0, 0),
     tokenizer_path="EleutherAI/pythia-1b",
+    tokenizer_service=None,
 ):
+    from nltk.translate.bleu_score import sentence_bleu
+
     with open(trans_dict_path, "r") as f:
         trans = json.load(f)
 
@@ -98,7 +106,7 @@ def eval_trans_matrix(
     print(f"\n  Top 10 most-mapped-to Pythia tokens (by occurrence count):")
     # Decode tokens to see what they actually are
     try:
-        tok = AutoTokenizer.from_pretrained(tokenizer_path)
+        tok = load_tokenizer(tokenizer_path, tokenizer_service)
         for token_id, count in most_common_mappings:
             unique_bio_count = len(unique_bio_to_pythia[token_id])
             try:
@@ -130,8 +138,11 @@ def eval_bert_score(
     eval_file_path="./data/pretrain-dataset/pythia-2-gemma-MX1K-eval",
     tok_path="./data/pythia-1b",
     model_path="all-mpnet-base-v2",
+    tokenizer_service=None,
 ):
-    tok = AutoTokenizer.from_pretrained(tok_path)
+    from sentence_transformers import SentenceTransformer
+
+    tok = load_tokenizer(tok_path, tokenizer_service)
     model = SentenceTransformer(model_path)
 
     with open(trans_dict_path, "r") as f:
@@ -183,8 +194,10 @@ if __name__ == '__main__':
     parser.add_argument("-t", "--tokenizer-path", type=str, default="EleutherAI/pythia-1b")
     parser.add_argument("-b", "--bert-score-model-path", type=str, default="all-mpnet-base-v2")
     parser.add_argument("-w", "--bleu-weights", type=str, default="1,0,0,0")
+    parser.add_argument("-s", "--tokenizer-service", type=str, default=None, help="Socket of a running tokenizer_service.py to decode with.")
 
     args = parser.parse_args()
+    apply_policy("eval")
 
     if args.evaluate_method.lower() == "bleu":
         weights = tuple([float(i) for i in args.bleu_weights.split(",")])
@@ -193,7 +206,8 @@ if __name__ == '__main__':
             trans_dict_path = args.one2one_matrix_path,
             eval_file_path = args.eval_file_path,
             bleu_weights = weights,
-            tokenizer_path = args.tokenizer_path
+            tokenizer_path = args.tokenizer_path,
+            tokenizer_service = args.tokenizer_service,
         )
     elif args.evaluate_method.lower() == "bert-score" or args.evaluate_method.lower() == "bertscore":
         eval_bert_score(
@@ -201,6 +215,7 @@ if __name__ == '__main__':
             eval_file_path = args.eval_file_path,
             tok_path = args.tokenizer_path,
             model_path = args.bert_score_model_path,
+            tokenizer_service = args.tokenizer_service,
         )
     else:
         raise Exception(f"{args.evaluate_method} is not implemented.")
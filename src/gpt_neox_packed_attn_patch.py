@@ -0,0 +1,113 @@
+"""
+Document-aware attention for packed GPT-NeoX (Pythia) blocks.
+
+Packed blocks carry `position_ids` that restart from zero at each document. GPT-NeoX already uses them for the
+rotary embedding, but its attention stays causal over the whole block. This patch keeps attention inside each
+document:
+    - flash_attention_2: `position_ids` are forwarded to `_flash_attention_forward`, which unpads the batch into
+      cumulative sequence lengths and calls the variable-length kernel (`flash_attn_varlen_func`).
+    - sdpa / eager (e.g. on CPU): the attention mask is replaced by a block-diagonal causal mask.
+Non-packed inputs (monotonic `position_ids`) are left untouched.
+"""
+import warnings
+
+import torch
+
+_PACKED_STATE = {"position_ids": None, "mask_key": None, "mask": None}
+
+
+def is_packed(position_ids):
+    """Whether any row of `position_ids` restarts from zero, i.e. the block contains several documents."""
+    if position_ids is None or position_ids.dim() != 2 or position_ids.shape[-1] < 2:
+        return False
+    return bool((position_ids[:, 1:] == 0).any())
+
+
+def block_diagonal_causal_mask(position_ids, dtype=torch.bool):
+    """
+    Build a `[batch, 1, seq, seq]` mask where each token only attends to earlier tokens of its own document.
+    A boolean mask marks allowed positions with True; a floating mask is additive (0 / dtype min).
+    """
+    seq_length = position_ids.shape[-1]
+    doc_ids = torch.cumsum((position_ids == 0).to(torch.int32), dim=-1)
+    allowed = doc_ids[:, :, None] == doc_ids[:, None, :]
+    causal = torch.ones(seq_length, seq_length, dtype=torch.bool, device=position_ids.device).tril()
+    allowed = (allowed & causal)[:, None, :, :]
+    if dtype == torch.bool:
+        return allowed
+    mask = torch.zeros(allowed.shape, dtype=dtype, device=position_ids.device)
+    return mask.masked_fill(~allowed, torch.finfo(dtype).min)
+
+
+def _cached_mask(position_ids, dtype):
+    # All layers of one forward pass share the same `position_ids` tensor, so build the mask once.
+    key = (position_ids, dtype)
+    cached = _PACKED_STATE["mask_key"]
+    if cached is None or cached[0] is not position_ids or cached[1] != dtype:
+        _PACKED_STATE["mask_key"] = key
+        _PACKED_STATE["mask"] = block_diagonal_causal_mask(position_ids, dtype)
+    return _PACKED_STATE["mask"]
+
+
+def _packed_attention_pre_hook(module, args, kwargs):
+    position_ids = kwargs.get("position_ids")
+    if not is_packed(position_ids):
+        _PACKED_STATE["position_ids"] = None
+        return None
+
+    from transformers.models.gpt_neox.modeling_gpt_neox import GPTNeoXFlashAttention2, GPTNeoXSdpaAttention
+
+    if isinstance(module, GPTNeoXFlashAttention2):
+        _PACKED_STATE["position_ids"] = position_ids
+        return None
+
+    use_sdpa = (
+        isinstance(module, GPTNeoXSdpaAttention)
+        and not kwargs.get("output_attentions", False)
+        and kwargs.get("head_mask") is None
+    )
+    mask = _cached_mask(position_ids, torch.bool if use_sdpa else torch.float32)
+    attention_mask = kwargs.get("attention_mask")
+    if attention_mask is not None:
+        # Combine with a padding mask prepared by the model.
+        if use_sdpa:
+            attention_mask = attention_mask if attention_mask.dtype == torch.bool else attention_mask == 0
+            mask = mask & attention_mask
+        else:
+            mask = torch.minimum(mask, attention_mask.to(mask.dtype))
+    kwargs["attention_mask"] = mask
+    return args, kwargs
+
+
+def _patch_flash_attention_forward():
+    from transformers.models.gpt_neox import modeling_gpt_neox
+
+    original = getattr(modeling_gpt_neox, "_flash_attention_forward", None)
+    if original is None or getattr(original, "_packed_documents", False):
+        return
+
+    def _flash_attention_forward(*args, **kwargs):
+        position_ids = _PACKED_STATE["position_ids"]
+        if position_ids is not None and kwargs.get("position_ids") is None:
+            kwargs["position_ids"] = position_ids
+        return original(*args, **kwargs)
+
+    _flash_attention_forward._packed_documents = True
+    modeling_gpt_neox._flash_attention_forward = _flash_attention_forward
+
+
+def replace_gpt_neox_attn_with_packed_attn(model):
+    """
+    Restrict the attention of every GPT-NeoX attention layer of `model` to the documents given by `position_ids`.
+    Returns the hook handles so the patch can be removed.
+    """
+    from transformers.models.gpt_neox.modeling_gpt_neox import GPTNeoXAttention
+
+    _patch_flash_attention_forward()
+    handles = []
+    for module in model.modules():
+        if isinstance(module, GPTNeoXAttention):
+            handles.append(module.register_forward_pre_hook(_packed_attention_pre_hook, with_kwargs=True))
+    if not handles:
+        warnings.warn("No GPT-NeoX attention layer found, document-aware packing only affects position ids.")
+    return handles
@@ -0,0 +1,243 @@
+"""
+Weighted interleaving of several tokenized datasets (token stores written by process_dataset.py), e.g. PubMed with
+general-domain text, without concatenating or re-tokenizing them. The mixture is described by a JSON file or string:
+
+    {
+        "sources": {"pubmed": "./data/pretrain-dataset/pubmed-biogpt-tokenized",
+                    "pile": "./data/pretrain-dataset/pile00-biogpt-tokenized"},
+        "stages": [
+            {"phase": "embed_only", "weights": {"pubmed": 1.0}},
+            {"weights": {"pubmed": 0.8, "pile": 0.2}}
+        ]
+    }
+
+Each stage lasts `until_step` (or until the end of the training phase `phase`, from its step budget), the last one
+until the end of training. Sources read their memory-mapped Arrow rows in order and wrap around at the end.
+
+The source of every block is a deterministic function of its index in the training stream: within a stage, block `j`
+comes from the source furthest behind its share (`weight * (j + 1) - blocks taken`, smooth weighted round-robin), so
+any prefix of the stream follows the weights to within one block per source. The position of every source, and the
+tokens consumed from it, follow from the number of blocks trained on (`global_step * samples_per_step`), which makes
+resuming exact and lets the per-source token counts be logged (`tokens_<source>`) and saved in every checkpoint
+(`mixture_state.json`). One scheduler is advanced incrementally for the counts, and its state is saved with them, so
+neither logging, saving nor resuming replays the stream from its first block.
+"""
+import json
+import os
+
+import numpy as np
+from datasets import load_from_disk
+from transformers import TrainerCallback, TrainerControl, TrainerState, TrainingArguments
+
+MIXTURE_STATE_NAME = "mixture_state.json"
+
+
+def load_mixture_spec(spec):
+    """Load a mixture from a JSON file or a JSON string."""
+    if os.path.isfile(spec):
+        with open(spec, "r") as f:
+            spec = f.read()
+    return json.loads(spec)
+
+
+def resolve_stage_steps(stages, phases=None):
+    """Replace the `phase` of each stage by the `until_step` at the end of that phase's step budget."""
+    ends, step = {}, 0
+    for phase in phases or []:
+        step += phase.max_steps
+        ends[phase.name] = step
+    resolved = []
+    for stage in stages:
+        stage = dict(stage)
+        if "phase" in stage:
+            if stage["phase"] not in ends:
+                raise ValueError(f"The mixture stage refers to the unknown training phase {stage['phase']}.")
+            stage["until_step"] = ends[stage.pop("phase")]
+        resolved.append(stage)
+    return resolved
+
+
+class _Scheduler:
+    """Source of each block of the stream, advanced one block at a time."""
+
+    def __init__(self, names, stages, samples_per_step):
+        self.names = names
+        self.boundaries = []
+        self.weights = []
+        for stage in stages:
+            weights = np.array([float(stage["weights"].get(name, 0.0)) for name in names])
+            if weights.sum() <= 0:
+                raise ValueError(f"The mixture stage {stage} has no positive weight.")
+            self.weights.append(weights / weights.sum())
+            until_step = stage.get("until_step")
+            self.boundaries.append(None if until_step is None else until_step * samples_per_step)
+        self.index = 0
+        self.stage = 0
+        self.stage_taken = np.zeros(len(names))
+        self.taken = np.zeros(len(names), dtype=np.int64)
+
+    def next(self):
+        while self.boundaries[self.stage] is not None and self.index >= self.boundaries[self.stage] and self.stage + 1 < len(self.weights):
+            self.stage += 1
+            self.stage_taken[:] = 0
+        weights = self.weights[self.stage]
+        j = self.stage_taken.sum()
+        source = int(np.argmax(weights * (j + 1) - self.stage_taken))
+        self.stage_taken[source] += 1
+        self.taken[source] += 1
+        self.index += 1
+        return source
+
+    def advance_to(self, index):
+        while self.index < index:
+            self.next()
+        return self
+
+    def state_dict(self):
+        return {"index": self.index, "stage": self.stage, "stage_taken": self.stage_taken.tolist(), "taken": self.taken.tolist()}
+
+    def load_state_dict(self, state):
+        self.index = state["index"]
+        self.stage = state["stage"]
+        self.stage_taken = np.array(state["stage_taken"], dtype=self.stage_taken.dtype)
+        self.taken = np.array(state["taken"], dtype=np.int64)
+        return self
+
+
+class TokenStoreMixture:
+    """
+    Infinite iterable over the rows of several tokenized datasets, interleaved by weight (see the module docstring).
+    It exposes `features`, so `ConstantLengthDataset` uses it like a tokenized `datasets.Dataset`.
+        Args:
+            sources (Dict[str, datasets.Dataset]): Tokenized datasets by name (`input_ids`, optionally `doc_lens`).
+            stages (List[dict]): `{"weights": {name: weight}, "until_step": step}` stages, see `resolve_stage_steps`.
+            samples_per_step (int): Blocks per optimizer step over all processes.
+            start_sample (int): Index in the stream of the first block to read (to resume without replaying).
+            start_state (dict): Scheduler state saved at a block index not past `start_sample` (`mixture_state.json`),
+                replayed from block 0 if None.
+    """
+
+    def __init__(self, sources, stages, samples_per_step, start_sample=0, start_state=None, read_size=256):
+        self.names = list(sources)
+        self.sources = [sources[name] for name in self.names]
+        features = [set(source.features) for source in self.sources]
+        if any("input_ids" not in feature for feature in features):
+            raise ValueError("Every source of a mixture must be a tokenized dataset.")
+        self.features = self.sources[0].features if all(f == features[0] for f in features) else {"input_ids": self.sources[0].features["input_ids"]}
+        self.stages = stages
+        self.samples_per_step = samples_per_step
+        self.start_sample = start_sample
+        self.start_state = start_state
+        self.read_size = read_size
+        self.seq_lengths = [len(source[0]["input_ids"]) for source in self.sources]
+        self._tracker = None
+
+    def __len__(self):
+        return sum(len(source) for source in self.sources)
+
+    def scheduler(self, num_samples=0):
+        """A scheduler at block `num_samples`, starting from `start_state` when it is not past it."""
+        scheduler = _Scheduler(self.names, self.stages, self.samples_per_step)
+        if self.start_state is not None and self.start_state["index"] <= num_samples:
+            scheduler.load_state_dict(self.start_state)
+        return scheduler.advance_to(num_samples)
+
+    def tracker(self, num_samples):
+        """The scheduler of the consumption counts, advanced incrementally to block `num_samples`."""
+        if self._tracker is None or self._tracker.index > num_samples:
+            self._tracker = self.scheduler(num_samples)
+        return self._tracker.advance_to(num_samples)
+
+    def consumed(self, num_samples):
+        """Blocks and tokens taken from each source by the first `num_samples` blocks of the stream."""
+        taken = self.tracker(num_samples).taken
+        return {
+            name: {"blocks": int(count), "tokens": int(count) * seq_length}
+            for name, count, seq_length in zip(self.names, taken, self.seq_lengths)
+        }
+
+    def _read(self, source, position):
+        dataset = self.sources[source]
+        start = position % len(dataset)
+        rows = dataset[start : min(start + self.read_size, len(dataset))]
+        keys = [key for key in rows if key in self.features]
+        return [{key: rows[key][i] for key in keys} for i in range(len(rows["input_ids"]))]
+
+    def __iter__(self):
+        scheduler = self.scheduler(self.start_sample)
+        positions = scheduler.taken.copy()
+        buffers = [[] for _ in self.sources]
+        while True:
+            source = scheduler.next()
+            if not buffers[source]:
+                buffers[source] = self._read(source, positions[source])[::-1]
+            positions[source] += 1
+            yield buffers[source].pop()
+
+
+def load_mixture(spec, samples_per_step, phases=None, start_sample=0, start_state=None):
+    """
+    (train mixture, validation split of the first source) of a mixture spec. `start_state` is the content of the
+    `mixture_state.json` of the checkpoint to resume from, its scheduler state is used if the stages are unchanged.
+    """
+    train_sources, valid_data = {}, None
+    for name, path in spec["sources"].items():
+        dataset = load_from_disk(path)
+        train_sources[name] = dataset["train"]
+        if valid_data is None:
+            valid_data = dataset["test"] if "test" in dataset else dataset["validation"]
+    stages = resolve_stage_steps(spec["stages"], phases)
+    scheduler_state = None
+    if start_state is not None and start_state.get("stages") == stages and list(start_state.get("sources", {})) == list(train_sources):
+        scheduler_state = start_state.get("scheduler")
+    return TokenStoreMixture(train_sources, stages, samples_per_step, start_sample=start_sample, start_state=scheduler_state), valid_data
+
+
+def load_mixture_state(checkpoint_dir):
+    """The `mixture_state.json` saved in a checkpoint, None if the checkpoint has no mixture state."""
+    path = os.path.join(checkpoint_dir, MIXTURE_STATE_NAME)
+    if not os.path.exists(path):
+        return None
+    with open(path, "r") as f:
+        return json.load(f)
+
+
+
+class MixtureCallback(TrainerCallback):
+    """Saves the per-source consumption of a `TokenStoreMixture` in every checkpoint."""
+
+    def __init__(self, mixture):
+        self.mixture = mixture
+
+    def on_save(self, args: TrainingArguments, state: TrainerState, control: TrainerControl, **kwargs):
+        if state.is_world_process_zero:
+            num_samples = state.global_step * self.mixture.samples_per_step
+            checkpoint_dir = os.path.join(args.output_dir, f"checkpoint-{state.global_step}")
+            os.makedirs(checkpoint_dir, exist_ok=True)
+            with open(os.path.join(checkpoint_dir, MIXTURE_STATE_NAME), "w") as f:
+                json.dump(
+                    {
+                        "num_samples": num_samples,
+                        "stages": self.mixture.stages,
+                        "sources": self.mixture.consumed(num_samples),
+                        "scheduler": self.mixture.tracker(num_samples).state_dict(),
+                    },
+                    f,
+                    indent="\t",
+                )
+        return control
+
+
+def enable_mixture_tracking(trainer, mixture):
+    """Log the tokens consumed from each source of `mixture` as `tokens_<source>` and save them in checkpoints."""
+    log = trainer.log
+
+    def mixture_log(logs):
+        if "loss" in logs:
+            taken = mixture.tracker(trainer.state.global_step * mixture.samples_per_step).taken
+            logs = {**logs, **{f"tokens_{name}": int(count) * seq_length for name, count, seq_length in zip(mixture.names, taken, mixture.seq_lengths)}}
+        return log(logs)
+
+    trainer.log = mixture_log
+    trainer.add_callback(MixtureCallback(mixture))
+    return trainer
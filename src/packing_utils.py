@@ -0,0 +1,49 @@
+"""
+Helpers for document-boundary-aware packing.
+
+Packed blocks store `doc_lens`, the lengths of the document segments a block is cut into, so that position ids
+and attention can restart at each document instead of running across unrelated PubMed abstracts.
+"""
+
+
+def split_doc_lens(doc_lens, block_size, total_length=None):
+    """
+    Cut a stream of concatenated documents into blocks and return the segment lengths of each block.
+        Args:
+            doc_lens (List[int]): Lengths of the concatenated documents, in order.
+            block_size (int): Number of tokens per block.
+            total_length (int): Number of tokens actually kept (the remainder is dropped). Default is the sum of `doc_lens`.
+    """
+    if total_length is None:
+        total_length = sum(doc_lens)
+    blocks, current, filled = [], [], 0
+    consumed = 0
+    for doc_len in doc_lens:
+        remaining = min(doc_len, total_length - consumed)
+        while remaining > 0:
+            take = min(remaining, block_size - filled)
+            current.append(take)
+            filled += take
+            remaining -= take
+            consumed += take
+            if filled == block_size:
+                blocks.append(current)
+                current, filled = [], 0
+        if consumed >= total_length:
+            break
+    if current:
+        blocks.append(current)
+    return blocks
+
+
+def doc_lens_to_position_ids(doc_lens):
+    """Position ids restarting from zero at each document of a packed block."""
+    position_ids = []
+    for doc_len in doc_lens:
+        position_ids.extend(range(doc_len))
+    return position_ids
+
+
+def mask_cross_document_labels(labels, position_ids, ignore_index=-100):
+    """Ignore the first token of every document but the first, which would otherwise be predicted from the previous document."""
+    return [ignore_index if (i > 0 and pid == 0) else label for i, (label, pid) in enumerate(zip(labels, position_ids))]
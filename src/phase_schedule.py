@@ -0,0 +1,337 @@
+"""
+Multi-phase training schedule in a single run, e.g. the embed-only stage followed by full fine-tuning.
+
+Each phase declares which parameters are trainable, its learning rate schedule and its step budget:
+
+    [
+        {"name": "embed", "trainable": ["embed"], "max_steps": 2500, "learning_rate": 6.4e-4,
+         "lr_scheduler_type": "cosine", "warmup_ratio": 0.03, "plateau_patience": 200},
+        {"name": "full", "trainable": "all", "max_steps": 2500, "learning_rate": 5e-5,
+         "lr_scheduler_type": "cosine", "warmup_ratio": 0.03}
+    ]
+
+`requires_grad` follows the current phase, so frozen parameters cost no gradients nor optimizer state, and the
+learning rate of each parameter group is set by the current phase. The switch happens at the end of the step budget,
+or earlier when the smoothed loss plateaus (`plateau_patience` steps without an improvement of `plateau_min_delta`):
+    - freeze_mode="requires_grad" (single process): the optimizer holds every parameter from the start, grouped by the
+      phases that train it (frozen groups get a learning rate of 0), and the state of the parameters that become
+      trainable is reset in place.
+    - freeze_mode="rewrap" (DDP / DeepSpeed, which only register the parameters requiring grad when wrapping the
+      model): the training loop stops at the switch and `PhaseTrainer.train` starts it again, wrapping the model over
+      the parameters of the new phase with a fresh optimizer, so frozen parameters stay out of the gradient all-reduce
+      and the optimizer. The global step, the learning rate schedule and the data stream continue.
+A checkpoint saved at a switch in "rewrap" mode holds the optimizer of the previous phase: resuming from it restores
+the weights only and starts the new phase with a fresh optimizer.
+"""
+import gc
+import json
+import math
+import os
+from dataclasses import asdict, dataclass
+from typing import List, Union
+
+from torch.optim.lr_scheduler import LambdaLR
+from transformers import Trainer, TrainerCallback, TrainerControl, TrainerState, TrainingArguments
+from transformers.trainer import TRAINER_STATE_NAME
+from transformers.trainer_utils import get_last_checkpoint
+
+PHASE_STATE_NAME = "phase_schedule.json"
+
+
+@dataclass
+class Phase:
+    name: str
+    max_steps: int
+    learning_rate: float
+    trainable: Union[str, List[str]] = "all"
+    lr_scheduler_type: str = "cosine"
+    warmup_ratio: float = 0.0
+    plateau_patience: int = 0
+    plateau_min_delta: float = 0.0
+    plateau_ema: float = 0.9
+
+    def trains(self, param_name):
+        return self.trainable == "all" or any(key in param_name for key in self.trainable)
+
+    def lr_at(self, step):
+        """Learning rate `step` steps after the start of the phase."""
+        num_warmup_steps = math.ceil(self.warmup_ratio * self.max_steps)
+        if step < num_warmup_steps:
+            return self.learning_rate * float(step) / float(max(1, num_warmup_steps))
+        if self.lr_scheduler_type == "constant":
+            return self.learning_rate
+        progress = float(step - num_warmup_steps) / float(max(1, self.max_steps - num_warmup_steps))
+        progress = min(progress, 1.0)
+        if self.lr_scheduler_type == "linear":
+            return self.learning_rate * (1.0 - progress)
+        if self.lr_scheduler_type == "cosine":
+            return self.learning_rate * 0.5 * (1.0 + math.cos(math.pi * progress))
+        raise ValueError(f"Learning rate schedule {self.lr_scheduler_type} is not implemented.")
+
+
+def load_phases(spec):
+    """Load phases from a JSON file or a JSON string."""
+    if os.path.isfile(spec):
+        with open(spec, "r") as f:
+            spec = f.read()
+    return [Phase(**phase) for phase in json.loads(spec)]
+
+
+class PhaseSchedule:
+    def __init__(self, phases, freeze_mode="requires_grad"):
+        assert freeze_mode in ("requires_grad", "rewrap"), f"Unknown freeze mode {freeze_mode}."
+        self.phases = phases
+        self.freeze_mode = freeze_mode
+        self.current = 0
+        self.starts = [0]
+        # the phase the wrapped model and the optimizer were built for (behind `current` until a "rewrap" restart)
+        self.optimizer_phase = 0
+        # global step a restarted training loop continues from
+        self.restart_step = None
+
+    @property
+    def phase(self):
+        return self.phases[self.current]
+
+    @property
+    def total_steps(self):
+        return sum(phase.max_steps for phase in self.phases)
+
+    def membership(self, param_name):
+        return tuple(phase.trains(param_name) for phase in self.phases)
+
+    def lr_lambda(self, membership):
+        def lr_lambda(step):
+            if not membership[self.current]:
+                return 0.0
+            return self.phase.lr_at(step - self.starts[self.current])
+
+        return lr_lambda
+
+    def apply_trainable(self, model):
+        """Set `requires_grad` for the current phase."""
+        for name, param in model.named_parameters():
+            param.requires_grad = self.phase.trains(name)
+
+    def state_dict(self):
+        return {
+            "current": self.current,
+            "starts": self.starts,
+            "optimizer_phase": self.optimizer_phase,
+            "phases": [asdict(phase) for phase in self.phases],
+        }
+
+    def load_state_dict(self, state):
+        self.current = state["current"]
+        self.starts = state["starts"]
+        self.optimizer_phase = state.get("optimizer_phase", self.current)
+
+
+def _refresh_lr(lr_scheduler):
+    """Recompute the learning rates of the current step after the schedule changed."""
+    lr_scheduler = getattr(lr_scheduler, "scheduler", lr_scheduler)
+    lrs = [base_lr * lr_lambda(lr_scheduler.last_epoch) for base_lr, lr_lambda in zip(lr_scheduler.base_lrs, lr_scheduler.lr_lambdas)]
+    for param_group, lr in zip(lr_scheduler.optimizer.param_groups, lrs):
+        param_group["lr"] = lr
+    lr_scheduler._last_lr = lrs
+
+
+class PhaseScheduleCallback(TrainerCallback):
+    """
+    Switches phases at the end of their step budget or on a loss plateau, and stops after the last phase (or at a
+    switch in "rewrap" freeze mode, for `PhaseTrainer.train` to restart the training loop).
+    """
+
+    def __init__(self, schedule):
+        self.schedule = schedule
+        self.log_history = []
+        self._reset_plateau()
+
+    def _reset_plateau(self):
+        self.ema_loss = None
+        self.best_loss = None
+        self.best_step = None
+
+    def on_train_begin(self, args: TrainingArguments, state: TrainerState, control: TrainerControl, **kwargs):
+        if self.schedule.restart_step is not None:
+            state.global_step = self.schedule.restart_step
+            state.log_history = self.log_history + state.log_history
+        if kwargs.get("lr_scheduler") is not None:
+            _refresh_lr(kwargs["lr_scheduler"])
+        print(f"Training phase `{self.schedule.phase.name}` from step {state.global_step}.")
+        return control
+
+    def _advance(self, state, control, model, optimizer, lr_scheduler, reason):
+        schedule = self.schedule
+        if schedule.current + 1 >= len(schedule.phases):
+            control.should_training_stop = True
+            return
+        previous = schedule.phase
+        schedule.current += 1
+        schedule.starts.append(state.global_step)
+        if schedule.freeze_mode == "rewrap":
+            # the model is wrapped again over the parameters of the new phase when the training loop restarts
+            control.should_training_stop = True
+        else:
+            schedule.apply_trainable(model)
+            schedule.optimizer_phase = schedule.current
+            if optimizer is not None:
+                # Newly trained parameters start from a fresh optimizer state, as in a new run.
+                inner = getattr(optimizer, "optimizer", optimizer)
+                for name, param in model.named_parameters():
+                    if schedule.phase.trains(name) and not previous.trains(name):
+                        inner.state.pop(param, None)
+        _refresh_lr(lr_scheduler)
+        self._reset_plateau()
+        print(f"Step {state.global_step}: switching to training phase `{schedule.phase.name}` ({reason}).")
+
+    def on_step_end(self, args: TrainingArguments, state: TrainerState, control: TrainerControl, **kwargs):
+        schedule = self.schedule
+        if state.global_step - schedule.starts[schedule.current] >= schedule.phase.max_steps:
+            self._advance(state, control, kwargs["model"], kwargs.get("optimizer"), kwargs["lr_scheduler"], "step budget reached")
+        return control
+
+    def on_log(self, args: TrainingArguments, state: TrainerState, control: TrainerControl, logs=None, **kwargs):
+        phase = self.schedule.phase
+        if phase.plateau_patience <= 0 or logs is None or "loss" not in logs:
+            return control
+        loss = logs["loss"]
+        self.ema_loss = loss if self.ema_loss is None else phase.plateau_ema * self.ema_loss + (1 - phase.plateau_ema) * loss
+        if self.best_loss is None or self.ema_loss < self.best_loss - phase.plateau_min_delta:
+            self.best_loss, self.best_step = self.ema_loss, state.global_step
+        elif state.global_step - self.best_step >= phase.plateau_patience and self.schedule.current + 1 < len(self.schedule.phases):
+            self._advance(state, control, kwargs["model"], kwargs.get("optimizer"), kwargs["lr_scheduler"], "loss plateau")
+        return control
+
+    def on_save(self, args: TrainingArguments, state: TrainerState, control: TrainerControl, **kwargs):
+        if state.is_world_process_zero:
+            checkpoint_dir = os.path.join(args.output_dir, f"checkpoint-{state.global_step}")
+            os.makedirs(checkpoint_dir, exist_ok=True)
+            with open(os.path.join(checkpoint_dir, PHASE_STATE_NAME), "w") as f:
+                json.dump(self.schedule.state_dict(), f, indent="\t")
+        return control
+
+    def on_train_end(self, args: TrainingArguments, state: TrainerState, control: TrainerControl, **kwargs):
+        # carried over to a restarted training loop
+        self.log_history = state.log_history
+        return control
+
+
+class _ContinuedDataLoader:
+    """Iterates a data loader from where the previous iteration stopped, so a restarted training loop continues the data."""
+
+    def __init__(self, dataloader):
+        self.dataloader = dataloader
+        self.iterator = None
+
+    def __iter__(self):
+        if self.iterator is None:
+            self.iterator = iter(self.dataloader)
+        for batch in self.iterator:
+            yield batch
+        self.iterator = None
+
+    def __len__(self):
+        return len(self.dataloader)
+
+    def __getattr__(self, name):
+        return getattr(self.dataloader, name)
+
+
+class PhaseTrainer(Trainer):
+    """Trainer whose optimizer groups, learning rates and (in "rewrap" freeze mode) model wrapping follow a `PhaseSchedule`."""
+
+    def __init__(self, *args, phase_schedule=None, **kwargs):
+        self.phase_schedule = phase_schedule
+        self._continued_dataloader = None
+        self._weights_checkpoint = None
+        super().__init__(*args, **kwargs)
+
+    def train(self, resume_from_checkpoint=None, **kwargs):
+        """`Trainer.train` from the phase of the checkpoint, restarted at each phase switch in "rewrap" freeze mode."""
+        schedule = self.phase_schedule
+        if isinstance(resume_from_checkpoint, bool) and resume_from_checkpoint:
+            resume_from_checkpoint = get_last_checkpoint(self.args.output_dir)
+        if resume_from_checkpoint is not None and os.path.exists(os.path.join(resume_from_checkpoint, PHASE_STATE_NAME)):
+            with open(os.path.join(resume_from_checkpoint, PHASE_STATE_NAME), "r") as f:
+                schedule.load_state_dict(json.load(f))
+            if schedule.optimizer_phase != schedule.current:
+                # saved at a switch, with the optimizer of the previous phase: restore the weights only
+                with open(os.path.join(resume_from_checkpoint, TRAINER_STATE_NAME), "r") as f:
+                    schedule.restart_step = json.load(f)["global_step"]
+                schedule.optimizer_phase = schedule.current
+                self._weights_checkpoint, resume_from_checkpoint = resume_from_checkpoint, None
+        while True:
+            # before the model is wrapped, which registers the parameters requiring grad
+            schedule.apply_trainable(self.model)
+            output = super().train(resume_from_checkpoint=resume_from_checkpoint, **kwargs)
+            if schedule.optimizer_phase == schedule.current:
+                return output
+            # the loop stopped at a "rewrap" switch: unwrap the model and drop the optimizer of the previous phase
+            resume_from_checkpoint = None
+            schedule.optimizer_phase = schedule.current
+            schedule.restart_step = self.state.global_step
+            self.model_wrapped = self.model
+            self.optimizer, self.lr_scheduler = None, None
+            if self.is_deepspeed_enabled:
+                self.deepspeed = None
+            gc.collect()
+
+    def get_train_dataloader(self):
+        if self.phase_schedule.freeze_mode != "rewrap":
+            return super().get_train_dataloader()
+        if self._continued_dataloader is None:
+            self._continued_dataloader = _ContinuedDataLoader(super().get_train_dataloader())
+        return self._continued_dataloader
+
+    def _load_optimizer_and_scheduler(self, checkpoint):
+        if self._weights_checkpoint is None:
+            return super()._load_optimizer_and_scheduler(checkpoint)
+        # called once the model is wrapped
+        checkpoint, self._weights_checkpoint = self._weights_checkpoint, None
+        if self.is_deepspeed_enabled:
+            self.model_wrapped.load_checkpoint(
+                checkpoint, load_module_strict=True, load_optimizer_states=False, load_lr_scheduler_states=False, load_module_only=True
+            )
+        else:
+            self._load_from_checkpoint(checkpoint)
+
+    def _maybe_log_save_evaluate(self, *args, **kwargs):
+        # the first loss logged after a restart averages over the steps since the restart
+        if self.phase_schedule.restart_step is not None:
+            self._globalstep_last_logged = max(self._globalstep_last_logged, self.phase_schedule.restart_step)
+        return super()._maybe_log_save_evaluate(*args, **kwargs)
+
+    def create_optimizer(self):
+        if self.optimizer is None:
+            decay_parameters = set(self.get_decay_parameter_names(self.model))
+            groups = {}
+            for name, param in self.model.named_parameters():
+                if self.phase_schedule.freeze_mode == "rewrap" and not param.requires_grad:
+                    continue
+                key = (self.phase_schedule.membership(name), name in decay_parameters)
+                groups.setdefault(key, []).append(param)
+            self.optimizer_group_keys = list(groups.keys())
+            optimizer_cls, optimizer_kwargs = Trainer.get_optimizer_cls_and_kwargs(self.args, self.model)
+            # The schedule sets absolute learning rates on top of a base learning rate of 1.
+            optimizer_kwargs["lr"] = 1.0
+            self.optimizer = optimizer_cls(
+                [
+                    {"params": params, "weight_decay": self.args.weight_decay if decay else 0.0}
+                    for (_, decay), params in groups.items()
+                ],
+                **optimizer_kwargs,
+            )
+        return self.optimizer
+
+    def create_scheduler(self, num_training_steps, optimizer=None):
+        if self.lr_scheduler is None:
+            optimizer = self.optimizer if optimizer is None else optimizer
+            self.lr_scheduler = LambdaLR(
+                optimizer, [self.phase_schedule.lr_lambda(membership) for membership, _ in self.optimizer_group_keys]
+            )
+            if self.phase_schedule.restart_step is not None:
+                self.lr_scheduler.last_epoch = self.phase_schedule.restart_step
+                _refresh_lr(self.lr_scheduler)
+            self._created_lr_scheduler = True
+        return self.lr_scheduler
@@ -0,0 +1,496 @@
+"""
+Pipeline runner for the steps of convert2glove_corpus.sh, token_align.sh, eval_align.sh, init_model.sh,
+tokenize_dataset.sh and vocab_adaptation.sh.
+
+Each stage declares its command, the files it reads (`inputs`, and `refs`: models and tokenizers that are a local
+folder or a HuggingFace Hub name), the files it writes (`outputs`) and its parameters. A stage is skipped when the
+content hashes of its inputs (including the `src` modules its scripts import), its command and its parameters match its
+last successful run and its outputs exist, so changing e.g. the pivot count only reruns the alignment and what reads it. Stages whose inputs are ready run at the same
+time (the two tokenizations, the two GloVe trainings) and share the core budget: each gets `CPU_BUDGET` cores (see
+resource_policy.py) and the exclusive stages (model initialization and training) run alone.
+
+    python src/pipeline.py                      # every stage
+    python src/pipeline.py align --set pivot_count=500
+    python src/pipeline.py --dry-run -c my_paths.json
+
+Paths and parameters default to the ones of the shell scripts; override them with a JSON file (`-c`, see
+`--print-config`) or `--set key=value`. File hashes are cached by size and modification time and the stage records
+are kept in `state_dir`. Stage logs and the timing and resource report (wall, CPU and peak memory per stage) are written
+to `log_dir`.
+"""
+import argparse
+import ast
+import hashlib
+import json
+import os
+import shlex
+import subprocess
+import sys
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from dataclasses import dataclass, field
+from typing import Dict, List
+
+from resource_policy import available_cores
+
+MAIN_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DEFAULT_CONFIG = {
+    "glove_dir": os.path.join(os.path.dirname(MAIN_DIR), "GloVe"),
+    "cache_dir": "data/cache",
+    "train_file": "data/pretrain-corpus/pubmed-corpus.json",
+    "corpus_manifest": "",
+    "src_model": "EleutherAI/pythia-1b",
+    "src_tokenizer": "EleutherAI/pythia-1b",
+    "tgt_model": "microsoft/biogpt",
+    "tgt_tokenizer": "microsoft/biogpt",
+    "src_dataset": "data/pretrain-dataset/mix-pythia-tok",
+    "tgt_dataset": "data/pretrain-dataset/mix-biogpt-tok",
+    "src_glove_corpus": "data/pretrain-dataset/mix-pythia-glove",
+    "tgt_glove_corpus": "data/pretrain-dataset/mix-biogpt-glove",
+    "matrix_eval_path": "data/pretrain-dataset/pythia-2-biogpt-glove-eval-mix",
+    "glove_max_line_train": 1000000000,
+    "glove_max_line_eval": 1000,
+    "glove_min_len_eval": 10,
+    "src_glove_vectors": "data/vec-mix-pythia.txt",
+    "tgt_glove_vectors": "data/vec-mix-biogpt.txt",
+    "gold_path": "data/Vocab_count/biogpt2pythia.json",
+    "align_matrix_path": "data/pythia2biogpt/align_matrix.json",
+    "provenance_path": "data/pythia2biogpt/align_provenance.json",
+    "pivot_count": 300,
+    "eval_method": "bleu",
+    "bleu_weights": "1,0,0,0",
+    "bert_score_model": "all-mpnet-base-v2",
+    "init_model_path": "data/pythia2biogpt/TokAlign-Init-1B",
+    "train_dataset": "data/pretrain-dataset/pubmed-biogpt-tokenized",
+    "block_size": 2048,
+    "general_dataset": "",
+    "general_weight": 0.2,
+    "adapted_model_dir": "log/1b/0_biogpt",
+    "state_dir": "data/pipeline",
+    "log_dir": "log/pipeline",
+}
+PATH_KEYS = {
+    "glove_dir", "cache_dir", "train_file", "corpus_manifest", "src_dataset", "tgt_dataset", "src_glove_corpus",
+    "tgt_glove_corpus", "matrix_eval_path", "src_glove_vectors", "tgt_glove_vectors", "gold_path", "align_matrix_path",
+    "provenance_path", "init_model_path", "train_dataset", "general_dataset", "adapted_model_dir", "state_dir", "log_dir",
+}
+
+
+@dataclass
+class Stage:
+    name: str
+    command: str
+    inputs: List[str] = field(default_factory=list)
+    outputs: List[str] = field(default_factory=list)
+    refs: List[str] = field(default_factory=list)
+    params: Dict = field(default_factory=dict)
+    cwd: str = MAIN_DIR
+    exclusive: bool = False
+
+
+def load_config(path=None, overrides=()):
+    """The default config updated with a JSON file and `key=value` overrides, with absolute paths."""
+    config = dict(DEFAULT_CONFIG)
+    if path is not None:
+        with open(path) as f:
+            config.update(json.load(f))
+    for override in overrides:
+        key, value = override.split("=", 1)
+        if key not in DEFAULT_CONFIG:
+            raise ValueError(f"Unknown config key {key}, see --print-config.")
+        config[key] = type(DEFAULT_CONFIG[key])(value)
+    for key in PATH_KEYS:
+        if config[key]:
+            config[key] = os.path.normpath(os.path.join(MAIN_DIR, config[key]))
+    return config
+
+
+def local_imports(path, found=None):
+    """The Python files next to `path` it imports, directly or through each other (the `src` modules of a script)."""
+    found = set() if found is None else found
+    with open(path) as f:
+        tree = ast.parse(f.read(), filename=path)
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Import):
+            names = [alias.name for alias in node.names]
+        elif isinstance(node, ast.ImportFrom) and node.level == 0 and node.module:
+            names = [node.module]
+        else:
+            continue
+        for name in names:
+            module_path = os.path.join(os.path.dirname(path), name.split(".")[0] + ".py")
+            if os.path.isfile(module_path) and module_path not in found:
+                found.add(module_path)
+                local_imports(module_path, found)
+    return found
+
+
+def build_stages(config):
+    """The stages of the pipeline, in the order of the shell scripts."""
+    c = config
+    q = {key: shlex.quote(str(value)) for key, value in config.items()}
+    corpus = c["corpus_manifest"] or c["train_file"]
+    corpus_option = f"--corpus_manifest {q['corpus_manifest']}" if c["corpus_manifest"] else f"--train_file {q['train_file']}"
+    stages = []
+
+    for side in ("src", "tgt"):
+        stages.append(Stage(
+            name=f"tokenize-{side}",
+            command=(
+                f"python -u src/process_dataset.py --model_name_or_path {q[side + '_model']} --tokenizer_name {q[side + '_tokenizer']} "
+                f"{corpus_option} --only_tokenize --cache_dir {q['cache_dir']} --dataset_path_in_disk {q[side + '_dataset']} --output_dir ./log"
+            ),
+            inputs=[corpus, "src/process_dataset.py"],
+            refs=[c[side + "_model"], c[side + "_tokenizer"]],
+            outputs=[c[side + "_dataset"]],
+        ))
+    for side in ("src", "tgt"):
+        stages.append(Stage(
+            name=f"glove-corpus-{side}",
+            command=f"python src/convert2glove_train.py -s {q[side + '_dataset']} -k train -m 0 -l {q['glove_max_line_train']} -o {q[side + '_glove_corpus']}",
+            inputs=[c[side + "_dataset"], "src/convert2glove_train.py"],
+            outputs=[c[side + "_glove_corpus"]],
+            params={"glove_max_line_train": c["glove_max_line_train"]},
+        ))
+    stages.append(Stage(
+        name="glove-eval-corpus",
+        command=(
+            f"python src/convert2glove_train.py -s {q['src_dataset']} -t {q['tgt_dataset']} -k validation "
+            f"-m {q['glove_min_len_eval']} -l {q['glove_max_line_eval']} -o {q['matrix_eval_path']}"
+        ),
+        inputs=[c["src_dataset"], c["tgt_dataset"], "src/convert2glove_train.py"],
+        outputs=[c["matrix_eval_path"]],
+        params={"glove_min_len_eval": c["glove_min_len_eval"], "glove_max_line_eval": c["glove_max_line_eval"]},
+    ))
+    glove_binary = os.path.join(c["glove_dir"], "build", "glove")
+    stages.append(Stage(name="glove-build", command="make", inputs=[os.path.join(c["glove_dir"], "src")], outputs=[glove_binary], cwd=c["glove_dir"]))
+    for side in ("src", "tgt"):
+        vectors = c[side + "_glove_vectors"]
+        stages.append(Stage(
+            name=f"glove-{side}",
+            # glove writes `<save file>.txt`
+            command=f"bash {shlex.quote(os.path.join(MAIN_DIR, 'script', 'train_glove.sh'))} {q[side + '_glove_corpus']} {shlex.quote(os.path.splitext(vectors)[0])}",
+            inputs=[c[side + "_glove_corpus"], glove_binary, "script/train_glove.sh"],
+            outputs=[vectors],
+            cwd=c["glove_dir"],
+        ))
+    stages.append(Stage(
+        name="count-dict",
+        command=f"python src/count_dict.py -s {q['src_tokenizer']} -t {q['tgt_tokenizer']} -o {q['gold_path']}",
+        inputs=["src/count_dict.py"],
+        refs=[c["src_tokenizer"], c["tgt_tokenizer"]],
+        outputs=[c["gold_path"]],
+    ))
+    stages.append(Stage(
+        name="align",
+        command=(
+            f"python src/cal_trans_matrix.py -s {q['src_glove_vectors']} -s1 $(python src/count_vocab.py -m {q['src_model']}) "
+            f"-t {q['tgt_glove_vectors']} -s2 $(python src/count_vocab.py -m {q['tgt_model']}) -r -n {q['pivot_count']} "
+            f"-g {q['gold_path']} -o {q['align_matrix_path']} -p {q['provenance_path']}"
+        ),
+        inputs=[c["src_glove_vectors"], c["tgt_glove_vectors"], c["gold_path"], "src/cal_trans_matrix.py", "src/count_vocab.py"],
+        refs=[c["src_model"], c["tgt_model"]],
+        outputs=[c["align_matrix_path"], c["provenance_path"]],
+        params={"pivot_count": c["pivot_count"]},
+    ))
+    stages.append(Stage(
+        name="eval-align",
+        command=(
+            f"python src/eval_matrix.py -e {q['eval_method']} -m {q['align_matrix_path']} -f {q['matrix_eval_path']} "
+            f"-t {q['src_tokenizer']} -b {q['bert_score_model']} -w {q['bleu_weights']}"
+        ),
+        inputs=[c["align_matrix_path"], c["matrix_eval_path"], "src/eval_matrix.py"],
+        refs=[c["src_tokenizer"]],
+        params={"eval_method": c["eval_method"], "bleu_weights": c["bleu_weights"], "bert_score_model": c["bert_score_model"]},
+    ))
+    stages.append(Stage(
+        name="init-model",
+        command=f"python src/convert.py -m {q['align_matrix_path']} -s {q['src_model']} -t {q['tgt_tokenizer']} -o {q['init_model_path']}",
+        inputs=[c["align_matrix_path"], "src/convert.py"],
+        refs=[c["src_model"], c["tgt_tokenizer"]],
+        outputs=[c["init_model_path"]],
+        exclusive=True,
+    ))
+    stages.append(Stage(
+        name="tokenize-train",
+        command=(
+            f"python -u src/process_dataset.py --model_name_or_path {q['init_model_path']} --tokenizer_name {q['init_model_path']} "
+            f"{corpus_option} --cache_dir {q['cache_dir']} --dataset_path_in_disk {q['train_dataset']} "
+            f"--block_size {q['block_size']} --output_dir ./log"
+        ),
+        inputs=[corpus, c["init_model_path"], "src/process_dataset.py"],
+        outputs=[c["train_dataset"]],
+        params={"block_size": c["block_size"]},
+    ))
+    general = f"GENERAL_DATASET_PATH={q['general_dataset']} GENERAL_WEIGHT={q['general_weight']} " if c["general_dataset"] else ""
+    stages.append(Stage(
+        name="vocab-adaptation",
+        # the paths come from the config, the hyper-parameters are the ones of the script
+        command=(
+            f"MODEL_NAME={q['init_model_path']} DATASET_PATH={q['train_dataset']} TGT_PROVENANCE_PATH={q['provenance_path']} "
+            f"MODEL_DIR={q['adapted_model_dir']} BLOCK_SIZE={q['block_size']} {general}sh script/vocab_adaptation.sh"
+        ),
+        inputs=[c["init_model_path"], c["train_dataset"], c["provenance_path"], "script/vocab_adaptation.sh", "src/clm_train.py", "src/distributed_planner.py"]
+        + ([c["general_dataset"]] if c["general_dataset"] else []),
+        outputs=[c["adapted_model_dir"]],
+        params={"block_size": c["block_size"], **({"general_weight": c["general_weight"]} if c["general_dataset"] else {})},
+        exclusive=True,
+    ))
+    for stage in stages:
+        stage.inputs = [os.path.join(MAIN_DIR, path) for path in stage.inputs]
+        # a change in a module imported by a stage's script reruns the stage too
+        scripts = [path for path in stage.inputs if path.endswith(".py") and os.path.isfile(path)]
+        stage.inputs += sorted(set().union(*(local_imports(path) for path in scripts)) - set(stage.inputs))
+    return stages
+
+
+class HashCache:
+    """Content hashes of files and folders, recomputed only for files whose size or modification time changed."""
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.entries = {}
+        if os.path.exists(path):
+            with open(path) as f:
+                self.entries = json.load(f)
+
+    def file_hash(self, path):
+        stat = os.stat(path)
+        with self.lock:
+            entry = self.entries.get(path)
+        if entry is not None and entry[:2] == [stat.st_size, stat.st_mtime_ns]:
+            return entry[2]
+        digest = hashlib.sha1()
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(1 << 20), b""):
+                digest.update(chunk)
+        with self.lock:
+            self.entries[path] = [stat.st_size, stat.st_mtime_ns, digest.hexdigest()]
+        return digest.hexdigest()
+
+    def hash(self, path):
+        """sha1 of a file, or of the relative paths and hashes of the files in a folder."""
+        if os.path.isfile(path):
+            return self.file_hash(path)
+        digest = hashlib.sha1()
+        for root, dirs, files in os.walk(path):
+            dirs.sort()
+            for name in sorted(files):
+                file_path = os.path.join(root, name)
+                digest.update(f"{os.path.relpath(file_path, path)}:{self.file_hash(file_path)}\n".encode())
+        return digest.hexdigest()
+
+    def save(self):
+        with self.lock:
+            entries = dict(self.entries)
+        with open(self.path + ".tmp", "w") as f:
+            json.dump(entries, f)
+        os.replace(self.path + ".tmp", self.path)
+
+
+def stage_key(stage, hashes):
+    """Hash of the command, parameters and input contents of a stage."""
+    missing = [path for path in stage.inputs if not os.path.exists(path)]
+    if missing:
+        raise FileNotFoundError(f"Stage {stage.name} is missing its inputs {missing}.")
+    fingerprint = {
+        "command": stage.command,
+        "params": stage.params,
+        "inputs": {path: hashes.hash(path) for path in stage.inputs},
+        # a Hub name stands for itself
+        "refs": {ref: hashes.hash(ref) if os.path.exists(ref) else ref for ref in stage.refs},
+    }
+    return hashlib.sha1(json.dumps(fingerprint, sort_keys=True).encode()).hexdigest()
+
+
+def _record_path(config, stage):
+    return os.path.join(config["state_dir"], f"{stage.name}.json")
+
+
+def load_record(config, stage):
+    path = _record_path(config, stage)
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        return json.load(f)
+
+
+def run_stage(stage, cores, log_path):
+    """Run the command of a stage with `cores` cores, returns its exit code and resource usage."""
+    env = dict(os.environ, CPU_BUDGET=str(cores), PYTHONUNBUFFERED="1")
+    start = time.perf_counter()
+    with open(log_path, "w") as log:
+        log.write(f"$ (cd {stage.cwd} && {stage.command})\n")
+        log.flush()
+        process = subprocess.Popen(stage.command, shell=True, cwd=stage.cwd, env=env, stdout=log, stderr=subprocess.STDOUT)
+        # the usage of the command and of every process it waited for
+        _, status, usage = os.wait4(process.pid, 0)
+        process.returncode = os.waitstatus_to_exitcode(status)
+    return process.returncode, {
+        "wall_s": time.perf_counter() - start,
+        "user_s": usage.ru_utime,
+        "sys_s": usage.ru_stime,
+        "max_rss_mb": usage.ru_maxrss / 1024,
+        "cores": cores,
+    }
+
+
+def select_stages(stages, targets):
+    """The `targets` and every stage they read from, in pipeline order."""
+    producers = {output: stage for stage in stages for output in stage.outputs}
+    by_name = {stage.name: stage for stage in stages}
+    unknown = [target for target in targets if target not in by_name]
+    if unknown:
+        raise ValueError(f"Unknown stages {unknown}, choose from {list(by_name)}.")
+    selected, todo = set(), list(targets) or list(by_name)
+    while todo:
+        name = todo.pop()
+        if name not in selected:
+            selected.add(name)
+            todo.extend(producers[path].name for path in by_name[name].inputs if path in producers)
+    return [stage for stage in stages if stage.name in selected]
+
+
+def run_pipeline(config, targets=(), force=(), cores=None, jobs=None, dry_run=False, stages=None):
+    """Run the stages (defaults to `build_stages(config)`) that are out of date, returns the report."""
+    os.makedirs(config["state_dir"], exist_ok=True)
+    os.makedirs(config["log_dir"], exist_ok=True)
+    stages = build_stages(config) if stages is None else stages
+    producers = {output: stage.name for stage in stages for output in stage.outputs}
+    stages = select_stages(stages, targets)
+    upstream = {stage.name: {producers[path] for path in stage.inputs if path in producers} for stage in stages}
+    hashes = HashCache(os.path.join(config["state_dir"], "hashes.json"))
+    cores = cores or available_cores()
+    jobs = jobs or len(stages)
+
+    report = {"cores": cores, "stages": {}}
+    status = {}
+    pending, running = list(stages), {}
+    start = time.perf_counter()
+
+    def finish(stage, state, **info):
+        status[stage.name] = state
+        report["stages"][stage.name] = {"status": state, **info}
+        print(f"[pipeline] {stage.name}: {state}" + (f" ({info['reason']})" if "reason" in info else ""), flush=True)
+
+    def check(stage):
+        """Whether a ready stage is up to date (finishing it), or its key if it has to run."""
+        states = {status[name] for name in upstream[stage.name]}
+        if dry_run and "would run" in states:
+            finish(stage, "would run", reason="after its upstream stages")
+            return None
+        try:
+            key = stage_key(stage, hashes)
+        except FileNotFoundError as e:
+            finish(stage, "failed", reason=str(e))
+            return None
+        record = load_record(config, stage)
+        if stage.name not in force and record is not None and record["key"] == key and all(os.path.exists(path) for path in stage.outputs):
+            finish(stage, "cached", saved_s=record["usage"]["wall_s"])
+            return None
+        if dry_run:
+            finish(stage, "would run", reason="forced" if stage.name in force else "inputs, command or parameters changed" if record else "never run")
+            return None
+        return key
+
+    keys = {}
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        while pending or running:
+            progressed = False
+            for stage in list(pending):
+                states = {status.get(name) for name in upstream[stage.name]}
+                if states & {"failed", "blocked"}:
+                    pending.remove(stage)
+                    finish(stage, "blocked", reason="an upstream stage failed")
+                    progressed = True
+                elif None not in states and stage.name not in keys:
+                    key = check(stage)
+                    if key is None:
+                        pending.remove(stage)
+                        progressed = True
+                    else:
+                        keys[stage.name] = key
+            if progressed:
+                continue
+
+            # stages to run: exclusive ones alone with every core, the others share the free cores
+            ready = [stage for stage in pending if stage.name in keys]
+            busy = sum(allocation for _, allocation, _ in running.values())
+            if any(stage.exclusive for stage, _, _ in running.values()):
+                ready = []
+            elif ready and ready[0].exclusive:
+                ready = [] if running else ready[:1]
+            else:
+                ready = [stage for stage in ready if not stage.exclusive][:max(0, min(cores - busy, jobs - len(running)))]
+            free = cores if ready and ready[0].exclusive else cores - busy
+            for i, stage in enumerate(ready):
+                allocation = free // len(ready) + (i < free % len(ready))
+                pending.remove(stage)
+                print(f"[pipeline] {stage.name}: running on {allocation} core(s)", flush=True)
+                future = executor.submit(run_stage, stage, allocation, os.path.join(config["log_dir"], f"{stage.name}.log"))
+                running[future] = (stage, allocation, time.perf_counter() - start)
+            if not running:
+                break
+
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                stage, _, started_s = running.pop(future)
+                returncode, usage = future.result()
+                usage["started_s"] = started_s
+                log_path = os.path.join(config["log_dir"], f"{stage.name}.log")
+                if returncode == 0:
+                    record = {"key": keys[stage.name], "usage": usage, "outputs": {path: hashes.hash(path) for path in stage.outputs if os.path.exists(path)}}
+                    with open(_record_path(config, stage), "w") as f:
+                        json.dump(record, f, indent="\t")
+                    finish(stage, "done", log=log_path, **usage)
+                else:
+                    if os.path.exists(_record_path(config, stage)):
+                        os.remove(_record_path(config, stage))
+                    finish(stage, "failed", reason=f"exit code {returncode}, see {log_path}", log=log_path, **usage)
+            hashes.save()
+
+    report["wall_s"] = time.perf_counter() - start
+    hashes.save()
+    if not dry_run:
+        with open(os.path.join(config["log_dir"], "report.json"), "w") as f:
+            json.dump(report, f, indent="\t")
+    return report
+
+
+def format_report(report):
+    lines = [f"{'stage':<20} {'status':<10} {'cores':>5} {'start s':>8} {'wall s':>9} {'cpu s':>9} {'max RSS MB':>10}"]
+    for name, info in report["stages"].items():
+        if "wall_s" in info:
+            lines.append(
+                f"{name:<20} {info['status']:<10} {info['cores']:>5} {info['started_s']:>8.1f} {info['wall_s']:>9.1f} "
+                f"{info['user_s'] + info['sys_s']:>9.1f} {info['max_rss_mb']:>10.0f}"
+            )
+        else:
+            lines.append(f"{name:<20} {info['status']:<10}" + (f" saved {info['saved_s']:.1f} s" if "saved_s" in info else ""))
+    lines.append(f"Total {report['wall_s']:.1f} s on {report['cores']} core(s)")
+    return "\n".join(lines)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("stages", nargs="*", help="Stages to bring up to date with the ones they read from, defaults to every stage.")
+    parser.add_argument("-c", "--config", type=str, default=None, help="JSON file of config overrides.")
+    parser.add_argument("--set", type=str, action="append", default=[], help="key=value config override (repeatable).")
+    parser.add_argument("-f", "--force", type=str, action="append", default=[], help="Rerun this stage even if it is up to date (repeatable).")
+    parser.add_argument("-n", "--cores", type=int, default=None, help="Core budget shared by the stages running together, defaults to CPU_BUDGET or the available CPUs.")
+    parser.add_argument("-j", "--jobs", type=int, default=None, help="Stages running together at most.")
+    parser.add_argument("--dry-run", action="store_true", help="Print which stages would run.")
+    parser.add_argument("--print-config", action="store_true")
+
+    args = parser.parse_args()
+    config = load_config(args.config, args.set)
+
+    if args.print_config:
+        print(json.dumps(config, indent="\t"))
+        sys.exit(0)
+    report = run_pipeline(config, args.stages, set(args.force), args.cores, args.jobs, args.dry_run)
+    if not args.dry_run:
+        print(format_report(report))
+    sys.exit(int(any(info["status"] in ("failed", "blocked") for info in report["stages"].values())))
@@ -53,6 +53,11 @@ from datasets import Features, Sequence, Value
 # import llama
 import pandas as pd
 
+from corpus_manifest import load_manifest, load_manifest_dataset
+from packing_utils import split_doc_lens
+from resource_policy import apply_policy
+from tokenizer_service import TokenizerClient
+
 # Will error if the minimal version of Transformers is not installed. Remove at your own risks.
 check_min_version("4.21.0.dev0")
 
@@ -155,6 +160,15 @@ class DataTrainingArguments:
         default=None, metadata={"help": "Loading binary dataset processed from disk."}
     )
     train_file: Optional[str] = field(default=None, metadata={"help": "The input training data file (a text file)."})
+    corpus_manifest: Optional[str] = field(
+        default=None,
+        metadata={
+            "help": (
+                "Manifest of a sharded corpus written by prepare_pubmed_corpus_hf.py --output-format arrow/parquet, "
+                "read instead of --train_file."
+            )
+        },
+    )
 
     validation_file: Optional[str] = field(
         default=None,
@@ -203,7 +217,7 @@ class DataTrainingArguments:
     )
     preprocessing_num_workers: Optional[int] = field(
         default=None,
-        metadata={"help": "The number of processes to use for the preprocessing."},
+        metadata={"help": "The number of processes to use for the preprocessing, defaults to one per core of the resource policy."},
     )
     keep_linebreaks: bool = field(
         default=True, metadata={"help": "Whether to keep line breaks when using TXT files or not."}
@@ -220,10 +234,27 @@ class DataTrainingArguments:
             "help": "If want to add new vocabs to tokenizer, the path of new vocabs"
         }
     )
+    record_doc_boundaries: bool = field(
+        default=False,
+        metadata={
+            "help": "Store the document lengths of each packed block (`doc_lens`) for document-aware attention."
+        },
+    )
+    tokenizer_service: Optional[str] = field(
+        default=None,
+        metadata={
+            "help": (
+                "Socket of a running tokenizer_service.py: the tokenization workers send their texts to it instead of "
+                "each holding a copy of the tokenizer."
+            )
+        },
+    )
 
     def __post_init__(self):
-        if self.dataset_name is None and self.train_file is None and self.validation_file is None:
-            raise ValueError("Need either a dataset name or a training/validation file.")
+        if self.dataset_name is None and self.train_file is None and self.validation_file is None and self.corpus_manifest is None:
+            raise ValueError("Need either a dataset name, a training/validation file or a corpus manifest.")
+        if self.tokenizer_service is not None and self.new_vocab_path is not None:
+            raise ValueError("The tokenizer service does not know the tokens of `new_vocab_path`.")
         else:
             if self.train_file is not None:
                 extension = self.train_file.split(".")[-1]
@@ -243,7 +274,24 @@ def prepare_dataset(tokenizer, data_args, model_args, training_args, logger):
     #
     # In distributed training, the load_dataset function guarantee that only one local process can concurrently
     # download the dataset.
-    if data_args.dataset_name is not None:
+    if data_args.corpus_manifest is not None:
+        # Memory-mapped shards of a sharded corpus (Parquet shards are converted once, one process per group of shards)
+        manifest, _ = load_manifest(data_args.corpus_manifest)
+        logger.info(
+            f"Corpus manifest {data_args.corpus_manifest}: {len(manifest['shards'])} {manifest['format']} shards, "
+            f"{manifest['num_rows']} documents, {manifest['num_tokens']} tokens ({manifest['tokenizer']})"
+        )
+        corpus = load_manifest_dataset(
+            data_args.corpus_manifest, num_proc=data_args.preprocessing_num_workers, cache_dir=model_args.cache_dir
+        )
+        num_validation = int(round(len(corpus) * data_args.validation_split_percentage / 100))
+        raw_datasets = datasets.DatasetDict(
+            {
+                "train": corpus.select(range(num_validation, len(corpus))),
+                "validation": corpus.select(range(num_validation)),
+            }
+        )
+    elif data_args.dataset_name is not None:
         # Downloading and loading a dataset from the hub.
         raw_datasets = load_dataset(
             data_args.dataset_name,
@@ -327,10 +375,12 @@ def prepare_dataset(tokenizer, data_args, model_args, training_args, logger):
 
     # since this will be pickled to avoid _LazyModule error in Hasher force logger loading before tokenize_function
     tok_logger = transformers.utils.logging.get_logger("transformers.tokenization_utils_base")
+    # the client pickles to the service socket, the workers then share the service's tokenizer
+    encoder = TokenizerClient(data_args.tokenizer_service, tokenizer.name_or_path) if data_args.tokenizer_service else tokenizer
 
     def tokenize_function(examples):
         with CaptureLogger(tok_logger) as cl:
-            output = tokenizer(examples[text_column_name])
+            output = encoder(examples[text_column_name])
         # clm input could be much much longer than block_size
         if "Token indices sequence length is longer than the" in cl.out:
             tok_logger.warning(
@@ -385,6 +435,9 @@ def prepare_dataset(tokenizer, data_args, model_args, training_args, logger):
             k: [t[i : i + block_size] for i in range(0, total_length, block_size)]
             for k, t in concatenated_examples.items()
         }
+        if data_args.record_doc_boundaries:
+            doc_lens = [len(ids) for ids in examples["input_ids"]]
+            result["doc_lens"] = split_doc_lens(doc_lens, block_size, total_length)
 
         # without labels for saving space
         # result["labels"] = result["input_ids"].copy()
@@ -394,6 +447,8 @@ def prepare_dataset(tokenizer, data_args, model_args, training_args, logger):
         "input_ids": Sequence(Value("int32")),
         "attention_mask": Sequence(Value("bool")),
     })
+    if data_args.record_doc_boundaries:
+        features["doc_lens"] = Sequence(Value("int32"))
 
     # Note that with `batched=True`, this map processes 1,000 texts together, so group_texts throws away a remainder
     # for each of those groups of 1,000 texts. You can adjust that batch_size here but a higher value might be slower
@@ -470,6 +525,10 @@ def main():
     else:
         model_args, data_args, training_args = parser.parse_args_into_dataclasses()
 
+    plan = apply_policy("tokenize")
+    if data_args.preprocessing_num_workers is None:
+        data_args.preprocessing_num_workers = plan["num_procs"]
+
     # Setup logging
     logging.basicConfig(
         format="%(asctime)s - %(levelname)s - %(name)s - %(message)s",
@@ -0,0 +1,226 @@
+"""
+CPU resource policy of the pipeline stages: how many processes a stage runs and how many threads each of them gives to
+BLAS / OpenMP, torch and the Rust thread pool of fast tokenizers, so the stages stop oversubscribing the cores (e.g.
+`datasets.map` workers that each run a tokenizer, BLAS and torch on every core).
+
+    stage      processes          BLAS / OpenMP / torch threads   tokenizer threads
+    tokenize   cores              1                               1       datasets.map / Pool tokenization workers
+    corpus     cores (max 32)     1                               1       prepare_pubmed_corpus_hf.py workers
+    dedup      cores              1                               1       dedup_corpus.py workers
+    service    1                  1                               cores   tokenizer_service.py
+    linalg     1                  cores                           1       cal_trans_matrix.py
+    train      local ranks        cores / ranks                   1       cores / ranks - 1 data loader workers per rank
+    eval       1                  cores                           cores
+
+The core budget defaults to the CPUs this process may run on, or `CPU_BUDGET` when set (e.g. to leave cores to
+another stage running at the same time). Entry points call `apply_policy(stage)` at startup: it exports the thread
+variables (inherited by the processes started afterwards), limits torch and, with `threadpoolctl` installed, the BLAS
+libraries already loaded, and prints what it chose. Variables already set in the environment are kept. Shell scripts
+get the same choices with `eval "$(python src/resource_policy.py -s tokenize --print-env)"` (`NUM_WORKERS` and the
+thread variables; for training, the data loader workers of each rank), and `--benchmark` compares a stage under the policy with the previous defaults.
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import sys
+import time
+
+STAGES = {
+    "tokenize": {"procs": "cores", "threads": 1, "tokenizer_threads": 1},
+    "corpus": {"procs": "cores", "max_procs": 32, "threads": 1, "tokenizer_threads": 1},
+    "dedup": {"procs": "cores", "threads": 1, "tokenizer_threads": 1},
+    "service": {"procs": 1, "threads": 1, "tokenizer_threads": "cores"},
+    "linalg": {"procs": 1, "threads": "cores", "tokenizer_threads": 1},
+    "train": {"procs": "ranks", "threads": "share", "tokenizer_threads": 1, "loader_workers": True},
+    "eval": {"procs": 1, "threads": "cores", "tokenizer_threads": "cores"},
+}
+THREAD_VARIABLES = ("OMP_NUM_THREADS", "MKL_NUM_THREADS", "OPENBLAS_NUM_THREADS", "NUMEXPR_NUM_THREADS", "VECLIB_MAXIMUM_THREADS")
+
+
+def available_cores():
+    """`CPU_BUDGET`, or the CPUs this process may run on."""
+    if os.environ.get("CPU_BUDGET"):
+        return max(1, int(os.environ["CPU_BUDGET"]))
+    if hasattr(os, "sched_getaffinity"):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
+
+
+def plan_resources(stage, cores=None, ranks=None):
+    """
+    Processes, threads per process and the environment of a stage on `cores` cores (`ranks` processes to train).
+    `num_workers` is the worker count of a script: its processes, or the data loader workers of each training rank
+    (the rank's share of the cores, one being left to the rank itself).
+    """
+    if stage not in STAGES:
+        raise ValueError(f"Unknown stage {stage}, choose from {sorted(STAGES)}.")
+    policy = STAGES[stage]
+    cores = cores or available_cores()
+    ranks = ranks or int(os.environ.get("LOCAL_WORLD_SIZE", 1))
+    share = max(1, cores // ranks)
+
+    def resolve(value):
+        return {"cores": cores, "ranks": ranks, "share": share}.get(value, value)
+
+    num_procs = min(resolve(policy["procs"]), policy.get("max_procs", cores))
+    threads, tokenizer_threads = resolve(policy["threads"]), resolve(policy["tokenizer_threads"])
+    env = {variable: str(threads) for variable in THREAD_VARIABLES}
+    env["TOKENIZERS_PARALLELISM"] = "true" if tokenizer_threads > 1 else "false"
+    env["RAYON_NUM_THREADS"] = str(tokenizer_threads)
+    return {
+        "stage": stage,
+        "cores": cores,
+        "num_procs": num_procs,
+        "num_workers": max(1, share - 1) if policy.get("loader_workers") else num_procs,
+        "threads": threads,
+        "tokenizer_threads": tokenizer_threads,
+        "env": env,
+    }
+
+
+def _limit_loaded_libraries(threads):
+    limited = []
+    if "torch" in sys.modules:
+        import torch
+
+        torch.set_num_threads(threads)
+        limited.append("torch")
+    if "numpy" in sys.modules:
+        try:
+            from threadpoolctl import threadpool_limits
+        except ImportError:
+            # the BLAS already loaded keeps its threads, processes started afterwards read the variables
+            return limited
+        threadpool_limits(threads)
+        limited.append("blas")
+    return limited
+
+
+def apply_policy(stage, cores=None, ranks=None, verbose=True):
+    """Apply the plan of a stage to this process and the ones it starts (see the module docstring), returns the plan."""
+    plan = plan_resources(stage, cores, ranks)
+    kept = {}
+    for variable, value in plan["env"].items():
+        if variable in os.environ and os.environ[variable] != value:
+            kept[variable] = os.environ[variable]
+        else:
+            os.environ[variable] = value
+    threads = int(os.environ["OMP_NUM_THREADS"]) if os.environ["OMP_NUM_THREADS"].isdigit() else plan["threads"]
+    limited = _limit_loaded_libraries(threads)
+    plan["kept"] = kept
+    if verbose:
+        message = (
+            f"[resource policy] {stage} on {plan['cores']} cores: {plan['num_procs']} process(es), {plan['threads']} "
+            f"BLAS/torch thread(s) and {plan['tokenizer_threads']} tokenizer thread(s) each"
+        )
+        if limited:
+            message += f", limited {'/'.join(limited)} in this process"
+        if kept:
+            message += f", kept {' '.join(f'{key}={value}' for key, value in kept.items())} from the environment"
+        print(message, flush=True)
+    return plan
+
+
+def _tokenize_stage(path, num_docs, num_proc):
+    from datasets import Dataset, disable_caching
+    from transformers import AutoTokenizer
+
+    from tokenizer_benchmark import generate_sample
+
+    disable_caching()
+    tokenizer = AutoTokenizer.from_pretrained(path)
+    dataset = Dataset.from_dict({"text": generate_sample(num_docs)})
+    start = time.perf_counter()
+    dataset.map(lambda examples: tokenizer(examples["text"]), batched=True, num_proc=num_proc, remove_columns=["text"])
+    return num_docs / (time.perf_counter() - start), "docs/s"
+
+
+def _matmul_rank(size, steps, barrier):
+    import torch
+
+    a, b = torch.randn(size, size), torch.randn(size, size)
+    barrier.wait()
+    for _ in range(steps):
+        a = torch.tanh(a @ b)
+
+
+def _train_stage(size, steps, ranks):
+    context = multiprocessing.get_context("spawn")
+    barrier = context.Barrier(ranks + 1)
+    processes = [context.Process(target=_matmul_rank, args=(size, steps, barrier)) for _ in range(ranks)]
+    for process in processes:
+        process.start()
+    barrier.wait()
+    start = time.perf_counter()
+    for process in processes:
+        process.join()
+    return ranks * steps * 2 * size**3 / (time.perf_counter() - start) / 1e9, "GFLOP/s"
+
+
+def _run_stage(queue, env, stage, kwargs):
+    os.environ.update(env)
+    if stage == "tokenize":
+        queue.put(_tokenize_stage(**kwargs))
+    else:
+        queue.put(_train_stage(**kwargs))
+
+
+def run_isolated(stage, env, **kwargs):
+    """(throughput, unit) of a benchmark stage in a fresh process with `env` (unset variables are removed)."""
+    context = multiprocessing.get_context("spawn")
+    saved = {variable: os.environ.pop(variable) for variable in list(THREAD_VARIABLES) + ["TOKENIZERS_PARALLELISM", "RAYON_NUM_THREADS"] if variable in os.environ}
+    try:
+        queue = context.Queue()
+        process = context.Process(target=_run_stage, args=(queue, env, stage, kwargs))
+        process.start()
+        result = queue.get()
+        process.join()
+    finally:
+        os.environ.update(saved)
+    return result
+
+
+def benchmark(stage, cores, tokenizer_path=None, num_docs=4000, ranks=2, size=512, steps=20):
+    """The throughput of a stage with the previous defaults and under the policy."""
+    plan = plan_resources("tokenize" if stage == "tokenize" else "train", cores, ranks)
+    if stage == "tokenize":
+        # the shell scripts ran 75% of the cores as `datasets.map` workers, each with its own tokenizer thread pool
+        defaults = {"num_proc": max(1, cores * 3 // 4)}
+        configs = {"defaults": ({}, defaults), "policy": (plan["env"], {"num_proc": plan["num_procs"]})}
+        kwargs = {"path": tokenizer_path, "num_docs": num_docs}
+    else:
+        # every rank used torch's default intra-op threads (all cores)
+        configs = {"defaults": ({}, {}), "policy": (plan["env"], {})}
+        kwargs = {"size": size, "steps": steps, "ranks": ranks}
+    results = {"stage": stage, "cores": cores}
+    for name, (env, config) in configs.items():
+        throughput, unit = run_isolated(stage, env, **kwargs, **config)
+        results[name] = {"throughput": throughput, "unit": unit, "env": env, **config}
+    results["speedup"] = results["policy"]["throughput"] / results["defaults"]["throughput"]
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-s", "--stage", type=str, default="tokenize", choices=sorted(STAGES))
+    parser.add_argument("-c", "--cores", type=int, default=None, help="Core budget, defaults to CPU_BUDGET or the available CPUs.")
+    parser.add_argument("-r", "--ranks", type=int, default=None, help="Processes of the train stage, defaults to LOCAL_WORLD_SIZE.")
+    parser.add_argument("--print-env", action="store_true", help="Print `export` lines of the plan for a shell script.")
+    parser.add_argument("--benchmark", action="store_true", help="Compare the tokenize or train stage with the previous defaults.")
+    parser.add_argument("-k", "--tokenizer-path", type=str, default=None, help="Tokenizer of the tokenize benchmark.")
+    parser.add_argument("-n", "--num-docs", type=int, default=4000, help="Documents of the tokenize benchmark.")
+
+    args = parser.parse_args()
+
+    if args.benchmark:
+        if args.stage not in ("tokenize", "train") or (args.stage == "tokenize" and args.tokenizer_path is None):
+            parser.error("--benchmark runs the tokenize (with -k) or train stage.")
+        print(json.dumps(benchmark(args.stage, args.cores or available_cores(), args.tokenizer_path, args.num_docs, args.ranks or 2), indent="\t"))
+    elif args.print_env:
+        plan = plan_resources(args.stage, args.cores, args.ranks)
+        print(f"export NUM_WORKERS={plan['num_workers']}")
+        for variable, value in plan["env"].items():
+            print(f"export {variable}={os.environ.get(variable, value)}")
+    else:
+        print(json.dumps(plan_resources(args.stage, args.cores, args.ranks), indent="\t"))
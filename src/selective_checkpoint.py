@@ -0,0 +1,241 @@
+"""
+Selective activation checkpointing for GPT-NeoX (and LLaMA-style) decoders.
+
+`model.gradient_checkpointing_enable()` recomputes every layer. A policy recomputes only part of the model:
+    all: every decoder layer (the Hugging Face behavior).
+    every_k:K: one layer out of K.
+    attention / mlp: only the attention or MLP block of every layer.
+    auto: the fewest evenly spaced full layers that fit the activations of the decoder layers in
+        `--activation_memory_budget_gb`, from the estimate below; an error if even `all` does not fit.
+
+Activation memory per layer follows Korthikanti et al. (2022), with the coefficients measured on the Hugging Face
+GPT-NeoX implementation (rotary embeddings, SDPA), in bytes for 16-bit activations without dropout masks, with `s`
+tokens per sequence, `b` sequences, hidden size `h` and `a` heads:
+    attention: 16 * s * b * h (+ 5 * a * s^2 * b for the scores with eager attention)
+    mlp: 18 * s * b * h (4h intermediate size)
+    layer norms: 2 * s * b * h
+    LM head and loss (once): s * b * (4 * vocab + 2 * h), the float32 logits dominate
+A checkpointed block only keeps its input (2 * s * b * h) and is recomputed once in the backward pass.
+
+Run as a script to measure every policy on a tiny model (activation bytes kept for backward, step time), compare with
+the estimate, and extrapolate the estimate (scaled by the measured / estimated ratio) to a real config.
+"""
+import argparse
+import json
+import time
+
+import torch
+from torch.utils.checkpoint import checkpoint
+
+POLICIES = ("none", "all", "every_k", "attention", "mlp", "auto")
+
+
+def _decoder_layers(model):
+    if hasattr(model, "get_base_model"):
+        model = model.get_base_model()
+    return model.base_model.layers
+
+
+def _block(layer, kind):
+    names = {"attention": ("attention", "self_attn"), "mlp": ("mlp",)}[kind]
+    return next(getattr(layer, name) for name in names if hasattr(layer, name))
+
+
+def _checkpoint_module(module):
+    forward = module.forward
+
+    def checkpointed_forward(*args, **kwargs):
+        if not torch.is_grad_enabled():
+            return forward(*args, **kwargs)
+        return checkpoint(forward, *args, use_reentrant=False, **kwargs)
+
+    module.forward = checkpointed_forward
+
+
+def parse_policy(policy):
+    """`"every_k:2"` -> `("every_k", 2)`, `"mlp"` -> `("mlp", None)`."""
+    name, _, value = policy.partition(":")
+    if name not in POLICIES:
+        raise ValueError(f"Unknown checkpointing policy {policy}, choose from {POLICIES}.")
+    if name == "every_k":
+        return name, int(value or 2)
+    return name, None
+
+
+def activation_bytes_per_layer(config, batch_size, seq_length, block="layer", fused_attention=True, dtype_bytes=2):
+    """Estimated activations kept for backward by one layer (`block`: layer / attention / mlp / norms / input)."""
+    sbh = seq_length * batch_size * config.hidden_size * dtype_bytes / 2
+    attention = 16 * sbh
+    if not fused_attention:
+        attention += 5 * config.num_attention_heads * seq_length ** 2 * batch_size * dtype_bytes / 2
+    sizes = {"attention": attention, "mlp": 18 * sbh, "norms": 2 * sbh, "input": 2 * sbh}
+    sizes["layer"] = sizes["attention"] + sizes["mlp"] + sizes["norms"]
+    return sizes[block]
+
+
+def checkpointed_layers(num_layers, policy, budget_bytes=None, per_layer=None, per_checkpointed_layer=None):
+    """Indices of the layers fully checkpointed by `every_k` / `all` / `auto`."""
+    name, k = parse_policy(policy)
+    if name == "none":
+        return []
+    if name == "all":
+        return list(range(num_layers))
+    if name == "every_k":
+        return list(range(0, num_layers, k))
+    if name == "auto":
+        if num_layers * per_checkpointed_layer > budget_bytes:
+            raise ValueError(
+                f"Checkpointing all {num_layers} layers still keeps {num_layers * per_checkpointed_layer / 2**30:.2f} GB of "
+                f"activations, more than the budget of {budget_bytes / 2**30:.2f} GB: lower the micro-batch size or the "
+                f"sequence length, or raise `--activation_memory_budget_gb`."
+            )
+        for n in range(num_layers + 1):
+            if (num_layers - n) * per_layer + n * per_checkpointed_layer <= budget_bytes:
+                break
+        # spread the n checkpointed layers evenly
+        return sorted({int(i * num_layers / n) for i in range(n)}) if n > 0 else []
+    return []
+
+
+def estimate_policy(config, batch_size, seq_length, policy, budget_bytes=None, fused_attention=True, dtype_bytes=2):
+    """
+    Estimated activation memory (bytes, all layers) and step FLOPs relative to no checkpointing (forward + backward
+    = 3 forward passes, plus one forward of every recomputed block).
+    """
+    kwargs = dict(config=config, batch_size=batch_size, seq_length=seq_length, fused_attention=fused_attention, dtype_bytes=dtype_bytes)
+    layer, block_input = activation_bytes_per_layer(block="layer", **kwargs), activation_bytes_per_layer(block="input", **kwargs)
+    h, s, b = config.hidden_size, seq_length, batch_size
+    attention_flops = 8 * s * b * h * h + 4 * s * s * b * h
+    mlp_flops = 16 * s * b * h * h
+    num_layers = config.num_hidden_layers
+
+    name, _ = parse_policy(policy)
+    if name in ("attention", "mlp"):
+        memory = num_layers * (layer - activation_bytes_per_layer(block=name, **kwargs) + block_input)
+        recompute = num_layers * (attention_flops if name == "attention" else mlp_flops)
+    else:
+        layers = checkpointed_layers(num_layers, policy, budget_bytes=budget_bytes, per_layer=layer, per_checkpointed_layer=block_input)
+        memory = (num_layers - len(layers)) * layer + len(layers) * block_input
+        recompute = len(layers) * (attention_flops + mlp_flops)
+    memory += s * b * (4 * config.vocab_size + h * dtype_bytes)
+    forward = num_layers * (attention_flops + mlp_flops)
+    return {"activation_bytes": memory, "relative_step_flops": (3 * forward + recompute) / (3 * forward)}
+
+
+def apply_checkpoint_policy(model, policy, batch_size=None, seq_length=None, budget_gb=None):
+    """
+    Checkpoint the blocks selected by `policy` with non-reentrant `torch.utils.checkpoint` (no need for inputs that
+    require grad, so it works with frozen embeddings). Returns the names of the checkpointed modules.
+    """
+    name, _ = parse_policy(policy)
+    layers = _decoder_layers(model)
+    config = model.config
+    if name in ("attention", "mlp"):
+        modules = [_block(layer, name) for layer in layers]
+    else:
+        budget_bytes = None
+        per_layer = per_checkpointed_layer = None
+        if name == "auto":
+            if budget_gb is None or batch_size is None or seq_length is None:
+                raise ValueError("The `auto` checkpointing policy needs a memory budget, the micro-batch size and the sequence length.")
+            budget_bytes = budget_gb * 2**30
+            fused_attention = getattr(config, "_attn_implementation", "eager") != "eager"
+            dtype_bytes = next(model.parameters()).element_size()
+            per_layer = activation_bytes_per_layer(config, batch_size, seq_length, "layer", fused_attention, dtype_bytes)
+            per_checkpointed_layer = activation_bytes_per_layer(config, batch_size, seq_length, "input", fused_attention, dtype_bytes)
+        indices = checkpointed_layers(len(layers), policy, budget_bytes, per_layer, per_checkpointed_layer)
+        modules = [layers[i] for i in indices]
+    for module in modules:
+        _checkpoint_module(module)
+    names = {id(module): module_name for module_name, module in model.named_modules()}
+    return [names[id(module)] for module in modules]
+
+
+def measure_step(model, input_ids, steps=3):
+    """Activation bytes kept for backward (distinct storages) and mean forward + backward time of `model`."""
+    saved = {}
+    param_storages = {p.untyped_storage().data_ptr() for p in model.parameters()}
+
+    def pack(tensor):
+        storage = tensor.untyped_storage()
+        if storage.data_ptr() not in param_storages:
+            saved[storage.data_ptr()] = storage.nbytes()
+        return tensor
+
+    elapsed = []
+    for step in range(steps + 1):
+        saved.clear()
+        start = time.perf_counter()
+        with torch.autograd.graph.saved_tensors_hooks(pack, lambda tensor: tensor):
+            loss = model(input_ids=input_ids, labels=input_ids).loss
+        activation_bytes = sum(saved.values())
+        loss.backward()
+        model.zero_grad(set_to_none=True)
+        if step > 0:
+            elapsed.append(time.perf_counter() - start)
+    return {"activation_bytes": activation_bytes, "step_time_s": sum(elapsed) / len(elapsed)}
+
+
+def benchmark(policies, tiny_config, batch_size, seq_length, real_config=None, real_batch_size=None, real_seq_length=None, budget_gb=None, steps=3):
+    """
+    Measure each policy on a tiny GPT-NeoX (float32, CPU friendly) against its estimate, and extrapolate to
+    `real_config` (16-bit) by scaling the estimate with the measured / estimated ratio of the tiny model.
+    """
+    from transformers import AutoModelForCausalLM, GPTNeoXConfig
+
+    config = GPTNeoXConfig(**tiny_config)
+    input_ids = torch.randint(0, config.vocab_size, (batch_size, seq_length))
+    budget_bytes = None if budget_gb is None else budget_gb * 2**30
+    results = {}
+    for policy in ["none"] + [policy for policy in policies if policy != "none"]:
+        torch.manual_seed(0)
+        model = AutoModelForCausalLM.from_config(config, attn_implementation="sdpa")
+        model.train()
+        apply_checkpoint_policy(model, policy, batch_size=batch_size, seq_length=seq_length, budget_gb=budget_gb)
+        measured = measure_step(model, input_ids, steps=steps)
+        measured["relative_step_time"] = measured["step_time_s"] / results["none"]["measured"]["step_time_s"] if results else 1.0
+        estimated = estimate_policy(config, batch_size, seq_length, policy, budget_bytes=budget_bytes, dtype_bytes=4)
+        result = {"measured": measured, "estimated": estimated}
+        if real_config is not None:
+            scale = measured["activation_bytes"] / estimated["activation_bytes"]
+            real = estimate_policy(real_config, real_batch_size, real_seq_length, policy, budget_bytes=budget_bytes)
+            result["extrapolated"] = {"activation_gb": scale * real["activation_bytes"] / 2**30, "relative_step_flops": real["relative_step_flops"]}
+        results[policy] = result
+        print(policy, json.dumps(result))
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-p", "--policies", type=str, default="all,every_k:2,attention,mlp")
+    parser.add_argument("-c", "--tiny-config", type=str, default='{"vocab_size": 1024, "hidden_size": 128, "num_hidden_layers": 4, "num_attention_heads": 4, "intermediate_size": 512}')
+    parser.add_argument("-b", "--batch-size", type=int, default=4)
+    parser.add_argument("-s", "--seq-length", type=int, default=256)
+    parser.add_argument("-m", "--real-model-path", type=str, default=None, help="Config to extrapolate to (model path or GPTNeoXConfig JSON), e.g. EleutherAI/pythia-1b.")
+    parser.add_argument("--real-batch-size", type=int, default=16)
+    parser.add_argument("--real-seq-length", type=int, default=2048)
+    parser.add_argument("--budget-gb", type=float, default=None, help="Activation memory budget of the auto policy.")
+    parser.add_argument("-n", "--steps", type=int, default=3)
+
+    args = parser.parse_args()
+
+    real_config = None
+    if args.real_model_path is not None:
+        from transformers import AutoConfig, GPTNeoXConfig
+
+        if args.real_model_path.startswith("{"):
+            real_config = GPTNeoXConfig(**json.loads(args.real_model_path))
+        else:
+            real_config = AutoConfig.from_pretrained(args.real_model_path)
+
+    benchmark(
+        policies=args.policies.split(","),
+        tiny_config=json.loads(args.tiny_config),
+        batch_size=args.batch_size,
+        seq_length=args.seq_length,
+        real_config=real_config,
+        real_batch_size=args.real_batch_size,
+        real_seq_length=args.real_seq_length,
+        budget_gb=args.budget_gb,
+        steps=args.steps,
+    )
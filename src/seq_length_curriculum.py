@@ -0,0 +1,127 @@
+"""
+Sequence-length warmup: train on short blocks first and grow them on a step schedule, e.g. `256:500,512:1500,1024:3000`
+trains on 256-token blocks until step 500, 512-token blocks until step 1500, 1024-token blocks until step 3000 and
+`--max_seq_length` blocks afterwards.
+
+Every batch is still read from the tokenized dataset at `--max_seq_length` (the same memory-mapped Arrow rows, nothing
+is re-tokenized) and each `[batch_size, max_seq_length]` micro-batch is cut into `[batch_size * max_seq_length / L, L]`
+blocks of the current length `L`, so the tokens per optimizer step stay constant while the attention span (and its cost)
+shrinks. With `--use_doc_boundaries`, the positions of the document cut at the start of a block restart at 0.
+
+The block length is a function of the global step, and the schedule is saved in every checkpoint
+(`seq_length_curriculum.json`) and restored from it on resume.
+"""
+import json
+import os
+
+import torch
+from transformers import TrainerCallback, TrainerControl, TrainerState, TrainingArguments
+
+CURRICULUM_STATE_NAME = "seq_length_curriculum.json"
+
+
+class SeqLengthCurriculum:
+    def __init__(self, max_seq_length, stages):
+        """`stages`: (seq_length, until_step) pairs, the block length is `max_seq_length` after the last one."""
+        self.max_seq_length = max_seq_length
+        self.stages = sorted((int(seq_length), int(until_step)) for seq_length, until_step in stages)
+        for seq_length, _ in self.stages:
+            if seq_length > max_seq_length or max_seq_length % seq_length != 0:
+                raise ValueError(f"The curriculum block length {seq_length} must divide the maximum sequence length {max_seq_length}.")
+        steps = [until_step for _, until_step in self.stages]
+        if steps != sorted(steps):
+            raise ValueError(f"The block lengths of the curriculum {self.stages} must grow with the steps.")
+
+    @classmethod
+    def from_string(cls, max_seq_length, spec):
+        """Parse `"256:500,512:1500"` (block length:until step)."""
+        stages = [stage.split(":") for stage in spec.split(",") if stage.strip()]
+        return cls(max_seq_length, stages)
+
+    def seq_length_at(self, step):
+        for seq_length, until_step in self.stages:
+            if step < until_step:
+                return seq_length
+        return self.max_seq_length
+
+    def state_dict(self):
+        return {"max_seq_length": self.max_seq_length, "stages": self.stages}
+
+    def load_state_dict(self, state):
+        self.max_seq_length = state["max_seq_length"]
+        self.stages = [tuple(stage) for stage in state["stages"]]
+
+
+def split_blocks(inputs, seq_length):
+    """Cut a batch of `[batch_size, S]` tensors into `[batch_size * S / seq_length, seq_length]` blocks."""
+    _, max_seq_length = inputs["input_ids"].shape
+    if seq_length >= max_seq_length:
+        return inputs
+    outputs = {}
+    for key, value in inputs.items():
+        if isinstance(value, torch.Tensor) and value.dim() == 2 and value.shape[1] == max_seq_length:
+            value = value.reshape(-1, seq_length)
+        outputs[key] = value
+    if "position_ids" in outputs:
+        position_ids = outputs["position_ids"]
+        # the document cut at the start of each block restarts at position 0
+        leading = (position_ids == 0).cumsum(dim=-1) == 0
+        outputs["position_ids"] = torch.where(leading, position_ids - position_ids[:, :1], position_ids)
+    return outputs
+
+
+class SeqLengthCurriculumCallback(TrainerCallback):
+    """Restores the curriculum on resume and saves it in every checkpoint."""
+
+    def __init__(self, curriculum, resume_from_checkpoint=None):
+        self.curriculum = curriculum
+        self.resume_from_checkpoint = resume_from_checkpoint
+
+    def on_train_begin(self, args: TrainingArguments, state: TrainerState, control: TrainerControl, **kwargs):
+        if self.resume_from_checkpoint is not None:
+            path = os.path.join(self.resume_from_checkpoint, CURRICULUM_STATE_NAME)
+            if os.path.exists(path):
+                with open(path, "r") as f:
+                    saved = json.load(f)
+                if saved != json.loads(json.dumps(self.curriculum.state_dict())):
+                    print(f"Resuming the sequence length curriculum of the checkpoint: {saved['stages']}.")
+                self.curriculum.load_state_dict(saved)
+        print(f"Training on {self.curriculum.seq_length_at(state.global_step)}-token blocks from step {state.global_step}.")
+        return control
+
+    def on_step_end(self, args: TrainingArguments, state: TrainerState, control: TrainerControl, **kwargs):
+        seq_length = self.curriculum.seq_length_at(state.global_step)
+        if seq_length != self.curriculum.seq_length_at(state.global_step - 1):
+            print(f"Step {state.global_step}: switching to {seq_length}-token blocks.")
+        return control
+
+    def on_save(self, args: TrainingArguments, state: TrainerState, control: TrainerControl, **kwargs):
+        if state.is_world_process_zero:
+            checkpoint_dir = os.path.join(args.output_dir, f"checkpoint-{state.global_step}")
+            os.makedirs(checkpoint_dir, exist_ok=True)
+            with open(os.path.join(checkpoint_dir, CURRICULUM_STATE_NAME), "w") as f:
+                json.dump(self.curriculum.state_dict(), f, indent="\t")
+        return control
+
+
+def enable_seq_length_curriculum(trainer, curriculum, resume_from_checkpoint=None):
+    """
+    Cut the training batches of `trainer` to the block length of the current step, and log it as `seq_length`.
+    The micro-batch grows as the blocks shrink, so `per_device_train_batch_size` is the batch size at full length.
+    """
+    training_step = trainer.training_step
+    log = trainer.log
+
+    def curriculum_training_step(model, inputs):
+        return training_step(model, split_blocks(inputs, curriculum.seq_length_at(trainer.state.global_step)))
+
+    def curriculum_log(logs):
+        if "loss" in logs:
+            # logged after the step counter moved past the last training step
+            logs = {**logs, "seq_length": curriculum.seq_length_at(trainer.state.global_step - 1)}
+        return log(logs)
+
+    trainer.training_step = curriculum_training_step
+    trainer.log = curriculum_log
+    trainer.add_callback(SeqLengthCurriculumCallback(curriculum, resume_from_checkpoint=resume_from_checkpoint))
+    return trainer
@@ -0,0 +1,194 @@
+"""
+Row-sparse (lazy) AdamW for the embed-only stage of vocabulary adaptation.
+
+Only the rows of `embed_in` / `embed_out` whose gradient is non-zero in the current step are updated, each with its own
+step count for bias correction, as in lazy Adam. Rows can additionally be frozen or down-weighted per token through a
+`row_scale` (e.g. by alignment provenance): frozen rows get no optimizer state at all, which cuts the Adam state memory
+by the frozen fraction of the vocabulary.
+
+The saving in update work only applies to `embed_in`: the softmax gives every row of `embed_out` a dense gradient in
+every step, so all its (non-frozen) rows are updated each step and the lazy update saves nothing for the LM head.
+
+The optimizer reads `param.grad` directly, so it is meant for single-GPU / DDP runs, not DeepSpeed ZeRO.
+"""
+import argparse
+import time
+
+import torch
+
+
+class SparseRowAdamW(torch.optim.Optimizer):
+    """
+    AdamW over the rows of 2-D parameters (embedding matrices).
+        Args:
+            params: Parameters or parameter groups. A group may carry a `row_scale` tensor of shape `[num_rows]`
+                that multiplies the learning rate of each row; rows with a scale of 0 are frozen.
+            lr (float): Learning rate.
+            betas (Tuple[float, float]): Adam coefficients.
+            eps (float): Adam epsilon.
+            weight_decay (float): Decoupled weight decay, applied to updated rows only.
+    """
+
+    def __init__(self, params, lr=1e-3, betas=(0.9, 0.999), eps=1e-8, weight_decay=0.0):
+        defaults = dict(lr=lr, betas=betas, eps=eps, weight_decay=weight_decay, row_scale=None)
+        super().__init__(params, defaults)
+        for group in self.param_groups:
+            for p in group["params"]:
+                if p.dim() != 2:
+                    raise ValueError(f"SparseRowAdamW only supports 2-D parameters, got shape {tuple(p.shape)}.")
+
+    def _init_state(self, p, row_scale):
+        state = self.state[p]
+        num_rows = p.shape[0]
+        if row_scale is None:
+            rows = torch.arange(num_rows, device=p.device)
+        else:
+            rows = torch.nonzero(row_scale > 0, as_tuple=False).flatten()
+        # slot[i] is the index of row i in the compact state tensors, -1 for frozen rows.
+        slot = torch.full((num_rows,), -1, dtype=torch.long, device=p.device)
+        slot[rows] = torch.arange(rows.numel(), device=p.device)
+        state["slot"] = slot
+        state["step"] = torch.zeros(rows.numel(), dtype=torch.float32, device=p.device)
+        state["exp_avg"] = torch.zeros((rows.numel(), p.shape[1]), dtype=torch.float32, device=p.device)
+        state["exp_avg_sq"] = torch.zeros((rows.numel(), p.shape[1]), dtype=torch.float32, device=p.device)
+        return state
+
+    def load_state_dict(self, state_dict):
+        # `Optimizer.load_state_dict` casts every state tensor but `step` to the dtype of its parameter, which would turn
+        # `slot` into floats and the fp32 moments into bf16: keep the saved tensors, moved to the parameter's device.
+        saved = state_dict["state"]
+        ids = [i for group in state_dict["param_groups"] for i in group["params"]]
+        super().load_state_dict(state_dict)
+        params = [p for group in self.param_groups for p in group["params"]]
+        for i, p in zip(ids, params):
+            if i in saved:
+                self.state[p] = {
+                    key: value.to(p.device, copy=True) if torch.is_tensor(value) else value for key, value in saved[i].items()
+                }
+
+    @torch.no_grad()
+    def step(self, closure=None):
+        loss = None
+        if closure is not None:
+            with torch.enable_grad():
+                loss = closure()
+
+        for group in self.param_groups:
+            beta1, beta2 = group["betas"]
+            row_scale = group["row_scale"]
+            for p in group["params"]:
+                if p.grad is None:
+                    continue
+                grad = p.grad
+                if grad.is_sparse:
+                    grad = grad.coalesce().to_dense()
+                scale = None if row_scale is None else row_scale.to(p.device)
+                state = self.state[p]
+                if len(state) == 0:
+                    state = self._init_state(p, scale)
+
+                slot = state["slot"]
+                touched = torch.nonzero(grad.ne(0).any(dim=1) & (slot >= 0), as_tuple=False).flatten()
+                if touched.numel() == 0:
+                    continue
+                idx = slot[touched]
+                grad_rows = grad[touched].float()
+
+                step = state["step"][idx] + 1
+                state["step"][idx] = step
+                exp_avg = state["exp_avg"][idx].mul_(beta1).add_(grad_rows, alpha=1 - beta1)
+                exp_avg_sq = state["exp_avg_sq"][idx].mul_(beta2).addcmul_(grad_rows, grad_rows, value=1 - beta2)
+                state["exp_avg"][idx] = exp_avg
+                state["exp_avg_sq"][idx] = exp_avg_sq
+
+                bias_correction1 = 1 - beta1 ** step
+                bias_correction2 = 1 - beta2 ** step
+                denom = (exp_avg_sq / bias_correction2.unsqueeze(1)).sqrt_().add_(group["eps"])
+                update = (exp_avg / bias_correction1.unsqueeze(1)) / denom
+
+                lr = torch.full((touched.numel(),), group["lr"], dtype=torch.float32, device=p.device)
+                if scale is not None:
+                    lr = lr * scale[touched].float()
+                rows = p[touched].float()
+                if group["weight_decay"] != 0:
+                    rows.mul_(1 - lr.unsqueeze(1) * group["weight_decay"])
+                rows.sub_(lr.unsqueeze(1) * update)
+                p[touched] = rows.to(p.dtype)
+
+        return loss
+
+
+def create_sparse_embed_optimizer(model, args, row_scale=None):
+    """
+    Build a `SparseRowAdamW` over the trainable embedding matrices of `model` (`--finetune_embed_only`).
+    `row_scale` (array of shape `[vocab]`) applies to every matrix with that many rows.
+    """
+    params = [p for p in model.parameters() if p.requires_grad]
+    if any(p.dim() != 2 for p in params):
+        raise ValueError("The sparse embedding optimizer only supports embedding matrices, use it with `--finetune_embed_only`.")
+    groups = []
+    for p in params:
+        scale = None
+        if row_scale is not None and len(row_scale) == p.shape[0]:
+            scale = torch.as_tensor(row_scale, dtype=torch.float32)
+        groups.append({"params": [p], "row_scale": scale})
+    return SparseRowAdamW(groups, lr=args.learning_rate, weight_decay=args.weight_decay)
+
+
+def optimizer_state_bytes(optimizer):
+    total = 0
+    for state in optimizer.state.values():
+        for value in state.values():
+            if torch.is_tensor(value):
+                total += value.numel() * value.element_size()
+    return total
+
+
+def benchmark(vocab_size, hidden_size, tokens_per_step, frozen_ratio, steps, device):
+    """Per-step time and optimizer state size of `SparseRowAdamW` against dense `torch.optim.AdamW`."""
+    results = {}
+    for name in ["adamw", "sparse"]:
+        torch.manual_seed(0)
+        weight = torch.nn.Parameter(torch.randn(vocab_size, hidden_size, device=device))
+        if name == "adamw":
+            optimizer = torch.optim.AdamW([weight], lr=1e-3)
+        else:
+            row_scale = (torch.rand(vocab_size) >= frozen_ratio).float()
+            optimizer = SparseRowAdamW([{"params": [weight], "row_scale": row_scale}], lr=1e-3)
+        elapsed = 0.0
+        for _ in range(steps):
+            token_ids = torch.randint(0, vocab_size, (tokens_per_step,), device=device)
+            loss = torch.nn.functional.embedding(token_ids, weight).sum()
+            loss.backward()
+            if device == "cuda":
+                torch.cuda.synchronize()
+            start = time.perf_counter()
+            optimizer.step()
+            optimizer.zero_grad(set_to_none=True)
+            if device == "cuda":
+                torch.cuda.synchronize()
+            elapsed += time.perf_counter() - start
+        results[name] = (elapsed / steps, optimizer_state_bytes(optimizer))
+        print(f"{name}: {1000 * elapsed / steps:.2f} ms/step, optimizer state {optimizer_state_bytes(optimizer) / 2**20:.1f} MB")
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-v", "--vocab-size", type=int, default=42384)
+    parser.add_argument("-d", "--hidden-size", type=int, default=2048)
+    parser.add_argument("-t", "--tokens-per-step", type=int, default=16384)
+    parser.add_argument("-f", "--frozen-ratio", type=float, default=0.5, help="Fraction of rows frozen (e.g. gold overlap tokens).")
+    parser.add_argument("-n", "--steps", type=int, default=10)
+    parser.add_argument("--device", type=str, default="cuda" if torch.cuda.is_available() else "cpu")
+
+    args = parser.parse_args()
+
+    benchmark(
+        vocab_size=args.vocab_size,
+        hidden_size=args.hidden_size,
+        tokens_per_step=args.tokens_per_step,
+        frozen_ratio=args.frozen_ratio,
+        steps=args.steps,
+        device=args.device,
+    )
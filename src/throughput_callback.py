@@ -0,0 +1,296 @@
+"""
+Training throughput instrumentation: tokens/s, estimated model FLOPs utilization (MFU), dataloader wait,
+forward / backward / optimizer split and peak memory per optimizer step.
+
+Metrics of every step are appended to a JSONL file and the latest values are served in the Prometheus text format
+(`/metrics`) when a port is given. Nothing is hooked unless the callback is added to the Trainer.
+
+Step timeline (main process), with the CUDA stream synchronized at each timestamp when `sync_cuda` is set (otherwise
+the split only shows when the host waits for the GPU):
+    data wait: from the end of the previous micro-batch (or of logging / saving) to the model forward.
+    forward: the top-level model forward (activation recomputation of gradient checkpointing counts as backward).
+    backward: from the end of the forward to the optimizer step (or the end of the micro-batch); includes clipping.
+    optimizer: the optimizer step.
+"""
+import json
+import os
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+import torch
+from torch.utils.data import IterableDataset
+from transformers import TrainerCallback, TrainerControl, TrainerState, TrainingArguments
+
+# Dense bf16 peak TFLOPs per device, used when `peak_tflops` is not given.
+_PEAK_TFLOPS = {
+    "H100": 989.0,
+    "A100": 312.0,
+    "A10G": 125.0,
+    "L40S": 362.0,
+    "L4": 121.0,
+    "V100": 125.0,
+    "4090": 165.0,
+}
+
+
+def detect_peak_tflops():
+    if not torch.cuda.is_available():
+        return None
+    name = torch.cuda.get_device_name()
+    for key, tflops in _PEAK_TFLOPS.items():
+        if key in name:
+            return tflops
+    return None
+
+
+def gpt_neox_flops_per_token(model, seq_length):
+    """
+    Model FLOPs per trained token (forward + backward) for a GPT-NeoX style decoder: 6 * N + 12 * L * H * S, with N the
+    parameters used in matmuls (all but the input embedding) and the second term the attention scores.
+    """
+    config = model.config
+    num_params = sum(p.numel() for p in model.parameters())
+    num_params -= model.get_input_embeddings().weight.numel()
+    return 6 * num_params + 12 * config.num_hidden_layers * config.hidden_size * seq_length
+
+
+def format_prometheus(metrics, prefix="clm_train"):
+    lines = []
+    for key, value in metrics.items():
+        if isinstance(value, (int, float)):
+            lines.append(f"# TYPE {prefix}_{key} gauge")
+            lines.append(f"{prefix}_{key} {value}")
+    return "\n".join(lines) + "\n"
+
+
+class _MetricsServer:
+    def __init__(self, port):
+        self.metrics = {}
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.rstrip("/") != "/metrics":
+                    self.send_response(404)
+                    self.end_headers()
+                    return
+                body = format_prometheus(server.metrics).encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.httpd = HTTPServer(("127.0.0.1", port), Handler)
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self.thread.start()
+
+    def close(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+class ThroughputCallback(TrainerCallback):
+    """
+    Records per-step throughput metrics.
+        Args:
+            log_path (str): JSONL file the metrics of every optimizer step are appended to (main process only).
+            seq_length (int): Tokens per sample, used for the attention term of the FLOPs estimate.
+            peak_tflops (float): Peak TFLOPs of one device for MFU. Detected from the GPU name if None.
+            metrics_port (int): Serve the latest metrics at `http://127.0.0.1:port/metrics` (local only). Disabled if 0.
+            sync_cuda (bool): Synchronize CUDA at each timestamp, needed for a meaningful split of the step time but
+                slows training down, so off by default.
+    """
+
+    def __init__(self, log_path=None, seq_length=2048, peak_tflops=None, metrics_port=0, sync_cuda=False):
+        self.log_path = log_path
+        self.seq_length = seq_length
+        self.peak_tflops = peak_tflops if peak_tflops is not None else detect_peak_tflops()
+        self.metrics_port = metrics_port
+        self.sync_cuda = sync_cuda and torch.cuda.is_available()
+        self.server = None
+        self.handles = []
+        self._reset_step()
+        self._last_end = None
+
+    def _now(self):
+        if self.sync_cuda:
+            torch.cuda.synchronize()
+        return time.perf_counter()
+
+    def _reset_step(self):
+        self.step_start = None
+        self.tokens = 0
+        self.samples = 0
+        self.data_wait = 0.0
+        self.forward = 0.0
+        self.backward = 0.0
+        self.optimizer = 0.0
+        self._forward_start = None
+        self._forward_end = None
+        self._optimizer_start = None
+
+    def _forward_pre_hook(self, module, args, kwargs):
+        now = self._now()
+        if self.step_start is None:
+            self.step_start = self._last_end if self._last_end is not None else now
+        if self._last_end is not None:
+            self.data_wait += now - self._last_end
+        input_ids = kwargs.get("input_ids", args[0] if args else None)
+        if input_ids is not None:
+            self.tokens += input_ids.numel()
+            self.samples += input_ids.shape[0]
+        self._forward_start = now
+
+    def _forward_hook(self, module, args, kwargs, output):
+        self._forward_end = self._now()
+        self.forward += self._forward_end - self._forward_start
+
+    def _optimizer_pre_hook(self, optimizer, args, kwargs):
+        self._optimizer_start = self._now()
+        if self._forward_end is not None:
+            self.backward += self._optimizer_start - self._forward_end
+            self._forward_end = None
+
+    def on_train_begin(self, args: TrainingArguments, state: TrainerState, control: TrainerControl, **kwargs):
+        model = kwargs["model"]
+        self.flops_per_token = gpt_neox_flops_per_token(model, self.seq_length)
+        self.world_size = args.world_size
+        self.handles.append(model.register_forward_pre_hook(self._forward_pre_hook, with_kwargs=True))
+        self.handles.append(model.register_forward_hook(self._forward_hook, with_kwargs=True))
+        optimizer = kwargs.get("optimizer")
+        inner = getattr(optimizer, "optimizer", optimizer)
+        if isinstance(inner, torch.optim.Optimizer):
+            self.handles.append(inner.register_step_pre_hook(self._optimizer_pre_hook))
+        if state.is_world_process_zero and self.metrics_port:
+            self.server = _MetricsServer(self.metrics_port)
+        if torch.cuda.is_available():
+            torch.cuda.reset_peak_memory_stats()
+        self._last_end = self._now()
+        return control
+
+    def on_substep_end(self, args: TrainingArguments, state: TrainerState, control: TrainerControl, **kwargs):
+        now = self._now()
+        if self._forward_end is not None:
+            self.backward += now - self._forward_end
+            self._forward_end = None
+        self._last_end = now
+        return control
+
+    def on_optimizer_step(self, args: TrainingArguments, state: TrainerState, control: TrainerControl, **kwargs):
+        now = self._now()
+        if self._optimizer_start is not None:
+            self.optimizer += now - self._optimizer_start
+        elif self._forward_end is not None:
+            # DeepSpeed runs backward and the optimizer step inside the engine.
+            self.backward += now - self._forward_end
+        self._forward_end = None
+        self._optimizer_start = None
+        return control
+
+    def on_step_end(self, args: TrainingArguments, state: TrainerState, control: TrainerControl, **kwargs):
+        now = self._now()
+        step_time = now - (self.step_start if self.step_start is not None else now)
+        tokens = self.tokens * self.world_size
+        metrics = {
+            "step": state.global_step,
+            "step_time_s": step_time,
+            "tokens": tokens,
+            "tokens_per_s": tokens / step_time if step_time > 0 else 0.0,
+            "samples_per_s": self.samples * self.world_size / step_time if step_time > 0 else 0.0,
+            "data_wait_s": self.data_wait,
+            "forward_s": self.forward,
+            "backward_s": self.backward,
+            "optimizer_s": self.optimizer,
+        }
+        if self.peak_tflops and step_time > 0:
+            achieved = self.flops_per_token * self.tokens / step_time
+            metrics["mfu"] = achieved / (self.peak_tflops * 1e12)
+        if torch.cuda.is_available():
+            metrics["peak_memory_gb"] = torch.cuda.max_memory_allocated() / 2**30
+            torch.cuda.reset_peak_memory_stats()
+        else:
+            import resource
+
+            metrics["peak_memory_gb"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 2**20
+
+        if state.is_world_process_zero:
+            if self.log_path is not None:
+                with open(self.log_path, "a") as f:
+                    f.write(json.dumps(metrics) + "\n")
+            if self.server is not None:
+                self.server.metrics = metrics
+        self._reset_step()
+        self._last_end = self._now()
+        return control
+
+    def on_log(self, args: TrainingArguments, state: TrainerState, control: TrainerControl, **kwargs):
+        # Logging and saving happen after `on_step_end`, do not count them as dataloader wait.
+        self._last_end = self._now()
+        return control
+
+    on_save = on_log
+
+    def on_train_end(self, args: TrainingArguments, state: TrainerState, control: TrainerControl, **kwargs):
+        for handle in self.handles:
+            handle.remove()
+        self.handles = []
+        if self.server is not None:
+            self.server.close()
+            self.server = None
+        return control
+
+
+def summarize_throughput_log(path, skip_steps=1):
+    """Median step time and mean rates of a `ThroughputCallback` log, ignoring the first `skip_steps` (warm-up)."""
+    with open(path, "r") as f:
+        steps = [json.loads(line) for line in f]
+    steps = steps[skip_steps:] if len(steps) > skip_steps else steps
+    step_times = sorted(step["step_time_s"] for step in steps)
+    return {
+        "steps": len(steps),
+        "median_step_time_s": step_times[len(step_times) // 2],
+        "samples_per_s": sum(step["samples_per_s"] for step in steps) / len(steps),
+        "tokens_per_s": sum(step["tokens_per_s"] for step in steps) / len(steps),
+        "data_wait_s": sum(step["data_wait_s"] for step in steps) / len(steps),
+        "peak_memory_gb": max(step["peak_memory_gb"] for step in steps),
+    }
+
+
+class InstrumentedIterableDataset(IterableDataset):
+    """
+    Wraps an iterable dataset (e.g. `ConstantLengthDataset`) and records the time spent producing samples in the
+    process iterating it (a dataloader worker, or the main process with `num_workers=0`). Every `report_every`
+    samples, a line `{"worker", "samples", "produce_s", "max_sample_s"}` is appended to `log_path`, which shows the
+    stalls of buffer refills.
+    """
+
+    def __init__(self, dataset, log_path, report_every=1000):
+        self.dataset = dataset
+        self.log_path = log_path
+        self.report_every = report_every
+
+    def __iter__(self):
+        worker_info = torch.utils.data.get_worker_info()
+        worker_id = worker_info.id if worker_info is not None else -1
+        iterator = iter(self.dataset)
+        samples, produce, max_sample = 0, 0.0, 0.0
+        while True:
+            start = time.perf_counter()
+            try:
+                sample = next(iterator)
+            except StopIteration:
+                break
+            elapsed = time.perf_counter() - start
+            samples += 1
+            produce += elapsed
+            max_sample = max(max_sample, elapsed)
+            if samples % self.report_every == 0:
+                with open(self.log_path, "a") as f:
+                    f.write(json.dumps({"worker": worker_id, "pid": os.getpid(), "samples": samples, "produce_s": produce, "max_sample_s": max_sample}) + "\n")
+                produce, max_sample = 0.0, 0.0
+            yield sample
@@ -0,0 +1,55 @@
+"""
+How each target token was initialized by the alignment (written by cal_trans_matrix.py):
+    - gold: exact overlap with the source vocabulary (count_dict.py), copied as is.
+    - aligned: mapped to the most similar source token by GloVe similarity.
+    - random: no GloVe vector, mapped to a random source token.
+"""
+import json
+
+import numpy as np
+
+PROVENANCE_GROUPS = ("gold", "aligned", "random")
+UNKNOWN_GROUP = -1
+
+
+def save_token_provenance(provenance, path):
+    """Save a `{group: [target token ids]}` dict."""
+    with open(path, "w") as f:
+        json.dump({group: sorted(provenance.get(group, [])) for group in PROVENANCE_GROUPS}, f)
+
+
+def load_token_provenance(path, vocab_size=None):
+    """
+    Load the provenance file as a compact per-token array of group indices into `PROVENANCE_GROUPS`.
+    Tokens missing from the file (e.g. added when resizing to `len(tokenizer)`) get `UNKNOWN_GROUP`.
+    """
+    with open(path, "r") as f:
+        provenance = json.load(f)
+    max_id = max((max(ids) for ids in provenance.values() if ids), default=-1)
+    vocab_size = max_id + 1 if vocab_size is None else vocab_size
+    groups = np.full(vocab_size, UNKNOWN_GROUP, dtype=np.int8)
+    for group_idx, group in enumerate(PROVENANCE_GROUPS):
+        ids = np.asarray(provenance.get(group, []), dtype=np.int64)
+        groups[ids[ids < vocab_size]] = group_idx
+    return groups
+
+
+def parse_group_values(spec, default=1.0):
+    """Parse `"gold=0,aligned=1,random=2"` into a `{group: float}` dict covering every group."""
+    values = {group: default for group in PROVENANCE_GROUPS}
+    if not spec:
+        return values
+    for item in spec.split(","):
+        group, value = item.split("=")
+        group = group.strip()
+        if group not in PROVENANCE_GROUPS:
+            raise ValueError(f"Unknown provenance group {group}, choose from {PROVENANCE_GROUPS}.")
+        values[group] = float(value)
+    return values
+
+
+def group_values_per_token(groups, values, unknown_value=1.0):
+    """Map the per-token group array to a float32 array of per-group values (e.g. learning rate scales)."""
+    table = np.array([values[group] for group in PROVENANCE_GROUPS] + [unknown_value], dtype=np.float32)
+    # UNKNOWN_GROUP (-1) indexes the last entry of the table.
+    return table[groups.astype(np.int64)]
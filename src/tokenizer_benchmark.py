@@ -0,0 +1,285 @@
+"""
+Tokenizer throughput and compression benchmark, run offline against locally saved tokenizers, with a JSON baseline to
+catch regressions (e.g. after a `transformers` or `tokenizers` upgrade):
+
+    python src/tokenizer_benchmark.py -t pythia=./data/tokenizers/pythia-1b -t biogpt=./data/tokenizers/biogpt \\
+        -o ./log/tokenizer_benchmark.json --baseline ./log/tokenizer_benchmark.baseline.json
+
+The sample is a JSONL / text file (`--sample`) or PubMed-like abstracts generated from a seed, so every run encodes the
+same texts. For each tokenizer, the sample is encoded once to get its compression (characters and bytes per token,
+tokens per document), then timed for every batch size, process count and thread count of the grid: the sample is
+split over the processes, each one loading the tokenizer itself and encoding its share in batches, with the Rust
+thread pool of fast tokenizers limited to the thread count (slow tokenizers only run with 1 thread). Throughput is the
+documents (tokens) of the sample over the time of the slowest process, the best of `--repeats` runs.
+
+With `--baseline`, every run is compared to the baseline: a token count that differs (the tokenizer output changed) or
+a throughput lower by more than `--tolerance` is a regression, reported with a non-zero exit code.
+`--update-baseline` writes the results as the new baseline.
+"""
+import argparse
+import hashlib
+import json
+import multiprocessing
+import os
+import platform
+import sys
+import time
+
+import numpy as np
+
+# the benchmark never downloads anything
+os.environ.setdefault("HF_HUB_OFFLINE", "1")
+os.environ.setdefault("TRANSFORMERS_OFFLINE", "1")
+
+BATCH_SIZES = (1, 32, 1000)
+SECTIONS = ("BACKGROUND", "OBJECTIVE", "METHODS", "RESULTS", "CONCLUSIONS")
+WORDS = (
+    "patients", "treatment", "study", "cells", "expression", "protein", "clinical", "cancer", "disease", "risk",
+    "analysis", "associated", "increased", "significantly", "compared", "group", "effect", "levels", "receptor",
+    "tumor", "therapy", "activity", "gene", "mice", "response", "model", "infection", "cohort", "randomized",
+    "trial", "inflammatory", "mortality", "diagnosis", "mutation", "pathway", "signaling", "chronic", "acute",
+    "hospital", "outcomes", "phenotype", "genome", "sequencing", "antibody", "vaccine", "dose", "plasma", "serum",
+    "hypertension", "diabetes", "myocardial", "infarction", "carcinoma", "lymphocytes", "cytokine", "apoptosis",
+    "mitochondrial", "neuronal", "cerebral", "renal", "hepatic", "pulmonary", "cardiovascular", "glucose",
+    "insulin", "metabolic", "oxidative", "stress", "transcription", "regulation", "inhibitor", "kinase",
+    "resistance", "prevalence", "incidence", "intervention", "placebo", "follow-up", "baseline", "adverse",
+    "the", "of", "and", "in", "to", "with", "was", "were", "for", "by", "on", "that", "this", "from", "is", "as",
+    "these", "between", "after", "than", "not", "or", "we", "our", "which", "both", "during", "within",
+)
+GENES = ("TP53", "BRCA1", "EGFR", "KRAS", "IL-6", "TNF-alpha", "HER2", "VEGF", "PD-L1", "mTOR", "NF-kappaB", "CD4+")
+UNITS = ("mg/kg", "mmol/L", "ng/mL", "%", "years", "weeks", "mm Hg", "microM")
+
+
+def generate_sample(num_docs, seed=0):
+    """PubMed-like abstracts: sections of sentences with medical words, gene names, numbers, units and statistics."""
+    rng = np.random.default_rng(seed)
+    docs = []
+    for _ in range(num_docs):
+        target_chars = int(rng.lognormal(np.log(1400), 0.35))
+        parts = []
+        num_chars = 0
+        section = 0
+        while num_chars < target_chars:
+            if section < len(SECTIONS) and (not parts or rng.random() < 0.2):
+                parts.append(f"{SECTIONS[section]}:")
+                section += 1
+            words = list(rng.choice(WORDS, size=rng.integers(8, 30)))
+            for _ in range(rng.integers(0, 3)):
+                position = rng.integers(0, len(words))
+                choice = rng.integers(0, 3)
+                if choice == 0:
+                    words.insert(position, str(rng.choice(GENES)))
+                elif choice == 1:
+                    words.insert(position, f"{rng.uniform(0, 500):.1f} {rng.choice(UNITS)}")
+                else:
+                    words.insert(position, f"(p < 0.{rng.integers(1, 50):02d}, n = {rng.integers(10, 5000)})")
+            sentence = " ".join(words)
+            parts.append(sentence[0].upper() + sentence[1:] + ".")
+            num_chars += len(parts[-1]) + 1
+        docs.append(" ".join(parts))
+    return docs
+
+
+def load_sample(path=None, num_docs=2000, seed=0):
+    """(texts, description) of the benchmark sample."""
+    if path is not None:
+        from tokenizer_service import read_texts
+
+        texts = read_texts(path, num_docs)
+        source = os.path.abspath(path)
+    else:
+        texts = generate_sample(num_docs, seed)
+        source = f"generated (seed {seed})"
+    digest = hashlib.sha1("\n".join(texts).encode("utf-8")).hexdigest()
+    return texts, {"source": source, "num_docs": len(texts), "num_chars": sum(map(len, texts)), "sha1": digest}
+
+
+def load_local_tokenizer(path):
+    from transformers import AutoTokenizer
+
+    return AutoTokenizer.from_pretrained(path, local_files_only=True, trust_remote_code=True)
+
+
+def compression(tokenizer, texts):
+    """Characters, UTF-8 bytes and tokens (without special tokens) of the sample and their ratios."""
+    num_tokens = sum(len(ids) for ids in tokenizer(texts, add_special_tokens=False)["input_ids"])
+    num_chars = sum(map(len, texts))
+    num_bytes = sum(len(text.encode("utf-8")) for text in texts)
+    return {
+        "num_tokens": num_tokens,
+        "chars_per_token": num_chars / num_tokens,
+        "bytes_per_token": num_bytes / num_tokens,
+        "tokens_per_doc": num_tokens / len(texts),
+    }
+
+
+# Tokenizer of a benchmark process, the time it took to load and the barrier the processes start encoding at
+# (initialized once per process)
+_tokenizer = None
+_load_s = None
+_barrier = None
+
+
+def _init_worker(path, barrier):
+    global _tokenizer, _load_s, _barrier
+    _barrier = barrier
+    start = time.perf_counter()
+    _tokenizer = load_local_tokenizer(path)
+    _tokenizer(["warm up"])
+    _load_s = time.perf_counter() - start
+
+
+def _encode_share(task):
+    texts, batch_size = task
+    # every share waits for the others, so each one is encoded by its own process at the same time
+    _barrier.wait()
+    start = time.perf_counter()
+    num_tokens = 0
+    for i in range(0, len(texts), batch_size):
+        num_tokens += sum(map(len, _tokenizer(texts[i : i + batch_size], add_special_tokens=False)["input_ids"]))
+    return time.perf_counter() - start, num_tokens, _load_s
+
+
+def run(path, texts, batch_size, num_procs, num_threads, repeats=3):
+    """Throughput of `num_procs` processes with `num_threads` tokenizer threads each, the best of `repeats` runs."""
+    # spawned processes start their own Rust thread pool, sized by these variables
+    env = {"RAYON_NUM_THREADS": str(num_threads), "RAYON_RS_NUM_CPUS": str(num_threads), "TOKENIZERS_PARALLELISM": "true" if num_threads > 1 else "false"}
+    saved = {key: os.environ.get(key) for key in env}
+    os.environ.update(env)
+    try:
+        context = multiprocessing.get_context("spawn")
+        with context.Pool(num_procs, initializer=_init_worker, initargs=(path, context.Barrier(num_procs))) as pool:
+            shares = [(texts[i::num_procs], batch_size) for i in range(num_procs)]
+            best = None
+            for _ in range(repeats):
+                results = pool.map(_encode_share, shares, chunksize=1)
+                elapsed = max(result[0] for result in results)
+                if best is None or elapsed < best[0]:
+                    best = (elapsed, sum(result[1] for result in results), max(result[2] for result in results))
+    finally:
+        for key, value in saved.items():
+            if value is None:
+                os.environ.pop(key, None)
+            else:
+                os.environ[key] = value
+    elapsed, num_tokens, load_s = best
+    return {
+        "batch_size": batch_size,
+        "num_procs": num_procs,
+        "num_threads": num_threads,
+        "docs_per_s": len(texts) / elapsed,
+        "tokens_per_s": num_tokens / elapsed,
+        "num_tokens": num_tokens,
+        "load_s": load_s,
+    }
+
+
+def run_key(result):
+    return f"batch{result['batch_size']}-procs{result['num_procs']}-threads{result['num_threads']}"
+
+
+def benchmark(tokenizers, texts, batch_sizes=BATCH_SIZES, proc_counts=(1,), thread_counts=(1,), repeats=3):
+    """Compression and the throughput grid of each tokenizer, see the module docstring."""
+    results = {}
+    for name, path in tokenizers.items():
+        start = time.perf_counter()
+        tokenizer = load_local_tokenizer(path)
+        load_s = time.perf_counter() - start
+        result = {"path": os.path.abspath(path), "class": type(tokenizer).__name__, "is_fast": tokenizer.is_fast, "vocab_size": len(tokenizer), "load_s": load_s}
+        result.update(compression(tokenizer, texts))
+        result["runs"] = {}
+        for num_procs in proc_counts:
+            for num_threads in thread_counts if tokenizer.is_fast else (1,):
+                for batch_size in batch_sizes:
+                    measured = run(path, texts, batch_size, num_procs, num_threads, repeats)
+                    result["runs"][run_key(measured)] = measured
+                    print(
+                        f"{name:>12} batch {batch_size:>5} procs {num_procs:>3} threads {num_threads:>3}: "
+                        f"{measured['docs_per_s']:>10,.0f} docs/s {measured['tokens_per_s']:>12,.0f} tokens/s",
+                        flush=True,
+                    )
+        results[name] = result
+    return results
+
+
+def environment():
+    import tokenizers
+    import transformers
+
+    return {
+        "python": platform.python_version(),
+        "transformers": transformers.__version__,
+        "tokenizers": tokenizers.__version__,
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+    }
+
+
+def compare(results, baseline, tolerance=0.15):
+    """Regressions of `results` against `baseline`: changed token counts and throughput drops beyond `tolerance`."""
+    regressions = []
+    if baseline["sample"]["sha1"] != results["sample"]["sha1"]:
+        return [{"reason": "the baseline was measured on another sample"}]
+    for name, result in results["tokenizers"].items():
+        if name not in baseline["tokenizers"]:
+            continue
+        reference = baseline["tokenizers"][name]
+        if result["num_tokens"] != reference["num_tokens"]:
+            regressions.append({"tokenizer": name, "reason": "token count changed", "baseline": reference["num_tokens"], "value": result["num_tokens"]})
+        for key, run_result in result["runs"].items():
+            if key not in reference["runs"]:
+                continue
+            expected = reference["runs"][key]["docs_per_s"]
+            if run_result["docs_per_s"] < (1 - tolerance) * expected:
+                regressions.append(
+                    {"tokenizer": name, "run": key, "reason": "slower", "baseline": expected, "value": run_result["docs_per_s"]}
+                )
+    return regressions
+
+
+def _parse_ints(value):
+    return [int(item) for item in value.split(",")]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-t", "--tokenizer", type=str, action="append", required=True, help="name=path of a locally saved tokenizer (repeatable).")
+    parser.add_argument("-s", "--sample", type=str, default=None, help="JSONL or text file of the sample, generated PubMed-like abstracts if unset.")
+    parser.add_argument("-n", "--num-docs", type=int, default=2000, help="Documents of the sample.")
+    parser.add_argument("--seed", type=int, default=0, help="Seed of the generated sample.")
+    parser.add_argument("-b", "--batch-sizes", type=str, default=",".join(map(str, BATCH_SIZES)))
+    parser.add_argument("-p", "--procs", type=str, default="1", help="Comma-separated process counts.")
+    parser.add_argument("-j", "--threads", type=str, default="1", help="Comma-separated tokenizer thread counts (fast tokenizers).")
+    parser.add_argument("-r", "--repeats", type=int, default=3)
+    parser.add_argument("-o", "--output", type=str, default=None, help="Where to write the results (JSON).")
+    parser.add_argument("--baseline", type=str, default=None, help="Baseline results to compare with.")
+    parser.add_argument("--update-baseline", action="store_true", help="Write the results to --baseline instead of comparing.")
+    parser.add_argument("--tolerance", type=float, default=0.15, help="Relative throughput drop reported as a regression.")
+
+    args = parser.parse_args()
+
+    tokenizers = dict(value.split("=", 1) if "=" in value else (os.path.basename(value.rstrip("/")), value) for value in args.tokenizer)
+    texts, sample = load_sample(args.sample, args.num_docs, args.seed)
+    print(f"Sample: {sample['num_docs']:,} documents, {sample['num_chars']:,} characters, {sample['source']}")
+    results = {"environment": environment(), "sample": sample}
+    results["tokenizers"] = benchmark(
+        tokenizers, texts, _parse_ints(args.batch_sizes), _parse_ints(args.procs), _parse_ints(args.threads), args.repeats
+    )
+    for name, result in results["tokenizers"].items():
+        print(f"{name}: {result['chars_per_token']:.3f} chars/token, {result['tokens_per_doc']:.1f} tokens/doc, {result['vocab_size']:,} tokens")
+
+    regressions = []
+    if args.baseline is not None and not args.update_baseline:
+        with open(args.baseline, "r") as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        results["regressions"] = regressions
+        for regression in regressions:
+            print(f"REGRESSION: {json.dumps(regression)}")
+        if not regressions:
+            print(f"No regression against {args.baseline}")
+    for path in [args.output] + ([args.baseline] if args.update_baseline else []):
+        if path is not None:
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+            with open(path, "w") as f:
+                json.dump(results, f, indent="\t")
+    sys.exit(1 if regressions else 0)
@@ -0,0 +1,494 @@
+"""
+Local tokenizer service: one process loads each tokenizer once and serves many clients over a Unix socket, instead of
+every corpus-prep worker, `datasets.map` worker and data loader loading its own copy:
+
+    python src/tokenizer_service.py -s /tmp/tokenizers.sock -t microsoft/biogpt -t pythia=EleutherAI/pythia-1b
+
+Tokenizers are served by name, the names given with `-t [name=]path` or any other path (loaded on first use). The
+requests of all clients for a tokenizer are queued and encoded together, up to `--max-batch-texts` texts or
+`--max-wait-ms` after the first one: fast (Rust) tokenizers encode a batch on all cores themselves, slow (Python)
+tokenizers such as BioGPT's are split over `--num-procs` processes holding a copy each.
+
+`TokenizerClient(socket_path, name)` is called like a `transformers` tokenizer (`client(texts)["input_ids"]`, `decode`,
+`batch_decode`, `eos_token_id`, `len(client)`...) and pickles to its socket path and name, so it can be handed to
+worker processes, which connect on first use. process_dataset.py (`--tokenizer_service`), clm_train.py
+(`--tokenizer_service`) and prepare_pubmed_corpus_hf.py (`--tokenizer-service`) switch to it; `--benchmark` compares
+it with a tokenizer per process.
+
+Messages are a header (byte sizes of a JSON body and of a binary body, two uint32) followed by the bodies; token ids
+are sent as int32 sequence lengths followed by the concatenated int32 ids.
+"""
+import argparse
+import itertools
+import json
+import math
+import multiprocessing
+import os
+import queue
+import signal
+import socket
+import socketserver
+import struct
+import sys
+import threading
+import time
+
+import numpy as np
+
+from resource_policy import apply_policy
+
+HEADER = struct.Struct("<II")
+INFO_KEYS = (
+    "name_or_path",
+    "is_fast",
+    "vocab_size",
+    "model_max_length",
+    "model_input_names",
+    "bos_token_id",
+    "eos_token_id",
+    "pad_token_id",
+    "unk_token_id",
+)
+
+
+def _recv_exact(sock, size):
+    buffer = bytearray(size)
+    view, received = memoryview(buffer), 0
+    while received < size:
+        n = sock.recv_into(view[received:])
+        if n == 0:
+            raise ConnectionError("The tokenizer service connection was closed.")
+        received += n
+    return buffer
+
+
+def send_message(sock, message, blob=b""):
+    body = json.dumps(message).encode("utf-8")
+    sock.sendall(HEADER.pack(len(body), len(blob)) + body)
+    if blob:
+        sock.sendall(blob)
+
+
+def recv_message(sock):
+    body_size, blob_size = HEADER.unpack(_recv_exact(sock, HEADER.size))
+    message = json.loads(_recv_exact(sock, body_size).decode("utf-8"))
+    return message, _recv_exact(sock, blob_size) if blob_size else b""
+
+
+def pack_ids(ids):
+    """int32 lengths followed by the concatenated ids of a list of token id lists."""
+    lengths = np.fromiter(map(len, ids), dtype=np.int32, count=len(ids))
+    flat = np.fromiter(itertools.chain.from_iterable(ids), dtype=np.int32, count=int(lengths.sum()))
+    return lengths.tobytes() + flat.tobytes()
+
+
+def unpack_ids(blob, num_sequences):
+    lengths = np.frombuffer(blob, dtype=np.int32, count=num_sequences)
+    flat = np.frombuffer(blob, dtype=np.int32, offset=4 * num_sequences).tolist()
+    offsets = [0] + np.cumsum(lengths).tolist()
+    return [flat[start:end] for start, end in zip(offsets[:-1], offsets[1:])]
+
+
+def load_tokenizer(path):
+    from transformers import AutoTokenizer
+
+    return AutoTokenizer.from_pretrained(path, trust_remote_code=True)
+
+
+def encode(tokenizer, texts, add_special_tokens=True):
+    """Token ids of each text, as `tokenizer(texts)["input_ids"]` without truncation."""
+    if not texts:
+        return []
+    return tokenizer(
+        texts, add_special_tokens=add_special_tokens, return_attention_mask=False, return_token_type_ids=False
+    )["input_ids"]
+
+
+# Tokenizer of the encoding processes of a slow tokenizer (initialized once per process)
+_process_tokenizer = None
+
+
+def _init_encoder(path):
+    global _process_tokenizer
+    _process_tokenizer = load_tokenizer(path)
+
+
+def _encode_chunk(chunk):
+    texts, add_special_tokens = chunk
+    return encode(_process_tokenizer, texts, add_special_tokens)
+
+
+class _Request:
+    def __init__(self, texts, add_special_tokens):
+        self.texts = texts
+        self.add_special_tokens = add_special_tokens
+        self.result = None
+        self.error = None
+        self.done = threading.Event()
+
+
+class _Backend:
+    """One tokenizer of the service, with the queue its requests are batched from."""
+
+    def __init__(self, path, num_procs, max_batch_texts, max_wait_ms):
+        self.tokenizer = load_tokenizer(path)
+        self.num_procs = num_procs
+        self.max_batch_texts = max_batch_texts
+        self.max_wait = max_wait_ms / 1000
+        self.pool = None
+        if not self.tokenizer.is_fast and num_procs > 1:
+            # spawned, as the service already runs threads
+            context = multiprocessing.get_context("spawn")
+            self.pool = context.Pool(processes=num_procs, initializer=_init_encoder, initargs=(path,))
+        self.info = {key: getattr(self.tokenizer, key) for key in INFO_KEYS}
+        self.info["len"] = len(self.tokenizer)
+        self.queue = queue.Queue()
+        threading.Thread(target=self._run, daemon=True).start()
+
+    def submit(self, texts, add_special_tokens=True):
+        request = _Request(texts, add_special_tokens)
+        self.queue.put(request)
+        request.done.wait()
+        if request.error is not None:
+            raise RuntimeError(request.error)
+        return request.result
+
+    def _next_batch(self):
+        requests = [self.queue.get()]
+        num_texts = len(requests[0].texts)
+        deadline = time.monotonic() + self.max_wait
+        while num_texts < self.max_batch_texts:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                requests.append(self.queue.get(timeout=timeout))
+            except queue.Empty:
+                break
+            num_texts += len(requests[-1].texts)
+        return requests
+
+    def _encode(self, texts, add_special_tokens):
+        if self.pool is None:
+            return encode(self.tokenizer, texts, add_special_tokens)
+        size = math.ceil(len(texts) / self.num_procs)
+        chunks = [(texts[start : start + size], add_special_tokens) for start in range(0, len(texts), size)]
+        return list(itertools.chain.from_iterable(self.pool.map(_encode_chunk, chunks)))
+
+    def _run(self):
+        while True:
+            requests = self._next_batch()
+            for add_special_tokens in {request.add_special_tokens for request in requests}:
+                group = [request for request in requests if request.add_special_tokens == add_special_tokens]
+                try:
+                    ids = self._encode([text for request in group for text in request.texts], add_special_tokens)
+                except Exception as e:
+                    ids = None
+                    for request in group:
+                        request.error = f"{type(e).__name__}: {e}"
+                start = 0
+                for request in group:
+                    if ids is not None:
+                        request.result = ids[start : start + len(request.texts)]
+                        start += len(request.texts)
+                    request.done.set()
+
+
+class TokenizerService:
+    """
+    The tokenizers of the service, by name.
+        Args:
+            tokenizers (Dict[str, str]): Paths of the tokenizers to load up front, by name. Other names are loaded as
+                paths on first use.
+            num_procs (int): Encoding processes of each slow tokenizer (fast tokenizers use all cores themselves).
+            max_batch_texts (int): Texts encoded together at most.
+            max_wait_ms (float): Time requests wait for others to be batched with.
+    """
+
+    def __init__(self, tokenizers=None, num_procs=None, max_batch_texts=4096, max_wait_ms=2.0):
+        self.paths = dict(tokenizers or {})
+        self.num_procs = num_procs or os.cpu_count()
+        self.max_batch_texts = max_batch_texts
+        self.max_wait_ms = max_wait_ms
+        self.backends = {}
+        self.lock = threading.Lock()
+        for name in self.paths:
+            self.backend(name)
+
+    def backend(self, name):
+        with self.lock:
+            if name not in self.backends:
+                self.backends[name] = _Backend(self.paths.get(name, name), self.num_procs, self.max_batch_texts, self.max_wait_ms)
+            return self.backends[name]
+
+    def handle(self, message):
+        """(reply, binary body) of a request."""
+        backend = self.backend(message["tokenizer"])
+        op = message["op"]
+        if op == "info":
+            return backend.info, b""
+        if op == "decode":
+            texts = backend.tokenizer.batch_decode(message["ids"], skip_special_tokens=message.get("skip_special_tokens", False))
+            return {"texts": texts}, b""
+        if op in ("encode", "count"):
+            ids = backend.submit(message["texts"], message.get("add_special_tokens", True))
+            if op == "count":
+                return {"num_sequences": len(ids)}, np.fromiter(map(len, ids), dtype=np.int32, count=len(ids)).tobytes()
+            return {"num_sequences": len(ids)}, pack_ids(ids)
+        raise ValueError(f"Unknown tokenizer service operation {op}.")
+
+
+class _Handler(socketserver.BaseRequestHandler):
+    def handle(self):
+        while True:
+            try:
+                message, _ = recv_message(self.request)
+            except ConnectionError:
+                return
+            try:
+                reply, blob = self.server.service.handle(message)
+            except Exception as e:
+                reply, blob = {"error": f"{type(e).__name__}: {e}"}, b""
+            send_message(self.request, reply, blob)
+
+
+def serve(socket_path, service):
+    """Serve `service` on a Unix socket (readable by the current user only) until interrupted."""
+    if os.path.exists(socket_path):
+        os.remove(socket_path)
+    server = socketserver.ThreadingUnixStreamServer(socket_path, _Handler)
+    server.daemon_threads = True
+    server.service = service
+    os.chmod(socket_path, 0o600)
+    # a terminated service removes its socket too
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    print(f"Serving {sorted(service.paths) or 'tokenizers on demand'} on {socket_path}", file=sys.stderr, flush=True)
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        os.remove(socket_path)
+
+
+def _serve_process(socket_path, tokenizers, num_procs, max_batch_texts, max_wait_ms):
+    # the service encodes on all cores, whatever the process it was started from did
+    os.environ["TOKENIZERS_PARALLELISM"] = "true"
+    serve(socket_path, TokenizerService(tokenizers, num_procs, max_batch_texts, max_wait_ms))
+
+
+def start_service(socket_path, tokenizers=None, num_procs=None, max_batch_texts=4096, max_wait_ms=2.0, timeout=300):
+    """Start the service in a background process, returns the process (to `terminate`) once clients can connect."""
+    # not a daemon, so it can start the encoding processes of slow tokenizers
+    process = multiprocessing.get_context("spawn").Process(
+        target=_serve_process, args=(socket_path, tokenizers, num_procs, max_batch_texts, max_wait_ms)
+    )
+    process.start()
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+                sock.connect(socket_path)
+            return process
+        except (FileNotFoundError, ConnectionRefusedError):
+            if not process.is_alive() or time.monotonic() > deadline:
+                raise RuntimeError(f"The tokenizer service on {socket_path} did not start.")
+            time.sleep(0.1)
+
+
+class TokenizerClient:
+    """
+    A tokenizer of the service on `socket_path`, used like a `transformers` tokenizer (without truncation, padding or
+    tensors). The attributes in `INFO_KEYS` and `len()` come from the service on first use.
+    """
+
+    def __init__(self, socket_path, name):
+        self.socket_path = str(socket_path)
+        self.name = name
+        self._sock = None
+        self._pid = None
+        self._info = None
+
+    def __getstate__(self):
+        return {"socket_path": self.socket_path, "name": self.name, "info": self._info}
+
+    def __setstate__(self, state):
+        self.__init__(state["socket_path"], state["name"])
+        self._info = state["info"]
+
+    def __repr__(self):
+        return f"TokenizerClient(socket_path={self.socket_path!r}, name={self.name!r})"
+
+    def _request(self, message):
+        # a forked process opens its own connection
+        if self._sock is None or self._pid != os.getpid():
+            self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self._sock.connect(self.socket_path)
+            self._pid = os.getpid()
+        send_message(self._sock, {**message, "tokenizer": self.name})
+        reply, blob = recv_message(self._sock)
+        if "error" in reply:
+            raise RuntimeError(f"Tokenizer service {self.socket_path}: {reply['error']}")
+        return reply, blob
+
+    def close(self):
+        if self._sock is not None and self._pid == os.getpid():
+            self._sock.close()
+        self._sock = None
+
+    @property
+    def info(self):
+        if self._info is None:
+            self._info, _ = self._request({"op": "info"})
+        return self._info
+
+    def __getattr__(self, key):
+        if key in INFO_KEYS:
+            return self.info[key]
+        raise AttributeError(f"{type(self).__name__} has no attribute {key}")
+
+    def __len__(self):
+        return self.info["len"]
+
+    def encode_batch(self, texts, add_special_tokens=True):
+        """Token ids of each text."""
+        reply, blob = self._request({"op": "encode", "texts": list(texts), "add_special_tokens": add_special_tokens})
+        return unpack_ids(blob, reply["num_sequences"])
+
+    def count(self, texts, add_special_tokens=True):
+        """Number of tokens of each text (the ids are not sent back)."""
+        reply, blob = self._request({"op": "count", "texts": list(texts), "add_special_tokens": add_special_tokens})
+        return np.frombuffer(blob, dtype=np.int32, count=reply["num_sequences"]).tolist()
+
+    def __call__(self, text, add_special_tokens=True, truncation=False, return_attention_mask=None, return_token_type_ids=None, **kwargs):
+        from transformers import BatchEncoding
+
+        unsupported = sorted(key for key, value in kwargs.items() if value not in (None, False))
+        if truncation or unsupported:
+            raise ValueError(f"The tokenizer service does not support {unsupported or ['truncation']}.")
+        single = isinstance(text, str)
+        input_ids = self.encode_batch([text] if single else text, add_special_tokens)
+        encoding = {"input_ids": input_ids}
+        names = self.info["model_input_names"]
+        if return_token_type_ids or (return_token_type_ids is None and "token_type_ids" in names):
+            encoding["token_type_ids"] = [[0] * len(ids) for ids in input_ids]
+        if return_attention_mask or (return_attention_mask is None and "attention_mask" in names):
+            encoding["attention_mask"] = [[1] * len(ids) for ids in input_ids]
+        if single:
+            encoding = {key: value[0] for key, value in encoding.items()}
+        return BatchEncoding(encoding)
+
+    def batch_decode(self, sequences, skip_special_tokens=False):
+        ids = [[int(token_id) for token_id in sequence] for sequence in sequences]
+        reply, _ = self._request({"op": "decode", "ids": ids, "skip_special_tokens": skip_special_tokens})
+        return reply["texts"]
+
+    def decode(self, token_ids, skip_special_tokens=False):
+        return self.batch_decode([token_ids], skip_special_tokens=skip_special_tokens)[0]
+
+
+def tokenizer_or_client(path, service=None):
+    """A `TokenizerClient` of `path` when a service socket is given, otherwise the tokenizer itself."""
+    return TokenizerClient(service, path) if service else load_tokenizer(path)
+
+
+def read_texts(path, limit=None):
+    """Texts of a JSONL file (`text` or `abstract` field) or of a plain text file (one per line)."""
+    texts = []
+    with open(path, "r", encoding="utf-8") as f:
+        for line in itertools.islice(f, limit):
+            if path.endswith((".json", ".jsonl")):
+                row = json.loads(line)
+                line = row.get("text", row.get("abstract"))
+            texts.append(line.rstrip("\n"))
+    return texts
+
+
+def _bench_worker(task):
+    import resource
+
+    socket_path, name, texts, batch_size = task
+    start = time.perf_counter()
+    tokenizer = tokenizer_or_client(name, socket_path)
+    len(tokenizer)
+    load_s = time.perf_counter() - start
+    latencies, num_tokens, checksum = [], 0, 0
+    for i in range(0, len(texts), batch_size):
+        start = time.perf_counter()
+        ids = tokenizer(texts[i : i + batch_size], add_special_tokens=False, return_attention_mask=False)["input_ids"]
+        latencies.append(time.perf_counter() - start)
+        num_tokens += sum(map(len, ids))
+        checksum = (checksum + sum(sum(sequence) for sequence in ids)) % 2**61
+    return load_s, latencies, num_tokens, checksum, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def benchmark(name, texts, num_clients, batch_size, socket_path=None):
+    """Throughput, latency and worker memory of `num_clients` processes encoding `texts` (with the service on `socket_path`, or a tokenizer each)."""
+    # imported before forking in both cases, so clients only pay for loading their tokenizer
+    import transformers  # noqa: F401
+
+    shares = [(socket_path, name, texts[i::num_clients], batch_size) for i in range(num_clients)]
+    start = time.perf_counter()
+    with multiprocessing.get_context("fork").Pool(num_clients) as pool:
+        results = pool.map(_bench_worker, shares)
+    wall_s = time.perf_counter() - start
+    latencies = np.concatenate([np.array(result[1]) for result in results]) * 1000
+    num_tokens = sum(result[2] for result in results)
+    return {
+        "wall_s": wall_s,
+        "texts_per_s": len(texts) / wall_s,
+        "tokens_per_s": num_tokens / wall_s,
+        "load_s_mean": float(np.mean([result[0] for result in results])),
+        "latency_ms_p50": float(np.percentile(latencies, 50)),
+        "latency_ms_p99": float(np.percentile(latencies, 99)),
+        "worker_max_rss_mb_mean": float(np.mean([result[4] for result in results])),
+        "num_tokens": num_tokens,
+        "checksum": sum(result[3] for result in results) % 2**61,
+    }
+
+
+def _parse_tokenizers(values):
+    tokenizers = {}
+    for value in values or []:
+        name, _, path = value.partition("=")
+        tokenizers[name] = path or name
+    return tokenizers
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-s", "--socket-path", type=str, default="/tmp/tokenizers.sock")
+    parser.add_argument("-t", "--tokenizer", type=str, action="append", help="[name=]path of a tokenizer to load up front (repeatable).")
+    parser.add_argument("-n", "--num-procs", type=int, default=None, help="Encoding processes of each slow tokenizer, defaults to the core budget of the resource policy.")
+    parser.add_argument("--max-batch-texts", type=int, default=4096, help="Texts of all clients encoded together at most.")
+    parser.add_argument("--max-wait-ms", type=float, default=2.0, help="Time a request waits for others to be batched with.")
+    parser.add_argument("--benchmark", action="store_true", help="Compare the service with a tokenizer per process (the first -t) and exit.")
+    parser.add_argument("-i", "--benchmark-texts", type=str, default=None, help="JSONL or text file of the benchmark texts.")
+    parser.add_argument("--benchmark-limit", type=int, default=20000, help="Texts read from --benchmark-texts.")
+    parser.add_argument("-c", "--benchmark-clients", type=int, default=4, help="Client processes of the benchmark.")
+    parser.add_argument("-b", "--benchmark-batch-size", type=int, default=64, help="Texts per request of the benchmark.")
+    parser.add_argument("-o", "--benchmark-output", type=str, default=None, help="Where to write the benchmark results (JSON).")
+
+    args = parser.parse_args()
+    tokenizers = _parse_tokenizers(args.tokenizer)
+
+    if not args.benchmark:
+        plan = apply_policy("service")
+        serve(args.socket_path, TokenizerService(tokenizers, args.num_procs or plan["cores"], args.max_batch_texts, args.max_wait_ms))
+    else:
+        if not tokenizers or args.benchmark_texts is None:
+            parser.error("--benchmark needs -t and --benchmark-texts.")
+        name, path = next(iter(tokenizers.items()))
+        texts = read_texts(args.benchmark_texts, args.benchmark_limit)
+        results = {"tokenizer": path, "num_texts": len(texts), "num_clients": args.benchmark_clients, "batch_size": args.benchmark_batch_size}
+        results["per_process"] = benchmark(path, texts, args.benchmark_clients, args.benchmark_batch_size)
+        service = start_service(args.socket_path, tokenizers, args.num_procs, args.max_batch_texts, args.max_wait_ms)
+        try:
+            results["service"] = benchmark(name, texts, args.benchmark_clients, args.benchmark_batch_size, args.socket_path)
+        finally:
+            service.terminate()
+            service.join()
+        results["identical"] = results["per_process"]["checksum"] == results["service"]["checksum"]
+        if args.benchmark_output is not None:
+            with open(args.benchmark_output, "w") as f:
+                json.dump(results, f, indent="\t")
+        print(json.dumps(results, indent="\t"))
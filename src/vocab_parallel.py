@@ -0,0 +1,425 @@
+"""
+Vocabulary-parallel input embedding, LM head and cross-entropy over the data-parallel ranks (DDP).
+
+With a large target vocabulary (e.g. Gemma, 256k tokens) the replicated `embed_in` / `embed_out`, their gradients,
+optimizer states and the full-vocab logits dominate the memory of every rank. Here rank `r` of `p` only holds the rows
+`[r * V_p, (r + 1) * V_p)` of both matrices (`V_p = ceil(V / p)`, the last shard padded):
+    embedding: the token ids of every rank are gathered, each rank looks up the ones in its slice, and the partial
+        embeddings are reduce-scattered back to the rank owning each token.
+    LM head + cross-entropy: the final hidden states of every rank are gathered and each rank projects them on its
+        slice, `chunk_size` positions at a time; the log-sum-exp is combined across ranks with an all-reduce of the
+        max and then of the sum of exponentials (and of the target logit), so the full-vocab logits are never
+        materialized. The backward pass recomputes the logits of each chunk.
+The gradients of the shards already sum the contributions of every rank's tokens (scaled by `1 / p`, as DDP averages),
+so they are excluded from the DDP all-reduce. Every rank must call the model with batches of the same shape.
+
+`enable_vocab_parallel_training` adapts a `Trainer`: gradient clipping uses the global norm over the shards,
+checkpoints store the full gathered matrices (loaded back into the shards on resume) and the optimizer state of each
+rank's shards in `vocab_parallel_optimizer-<rank>.pt`.
+
+Run as a script to check the loss, logits and gradients against the unsharded model on CPU processes (gloo).
+"""
+import argparse
+import math
+import os
+
+import torch
+import torch.distributed as dist
+import torch.nn as nn
+import torch.nn.functional as F
+from transformers.modeling_outputs import CausalLMOutputWithPast
+
+VOCAB_PARALLEL_OPTIMIZER_NAME = "vocab_parallel_optimizer-{rank}.pt"
+
+
+def _all_gather(tensor, group=None):
+    tensors = [torch.empty_like(tensor) for _ in range(dist.get_world_size(group))]
+    dist.all_gather(tensors, tensor.contiguous(), group=group)
+    return torch.cat(tensors)
+
+
+def _reduce_scatter(tensor, group=None):
+    """Sum over ranks of `tensor` and keep this rank's slice of the first dimension."""
+    world_size, rank = dist.get_world_size(group), dist.get_rank(group)
+    if dist.get_backend(group) == "nccl":
+        output = torch.empty((tensor.shape[0] // world_size,) + tensor.shape[1:], dtype=tensor.dtype, device=tensor.device)
+        dist.reduce_scatter_tensor(output, tensor.contiguous(), group=group)
+        return output
+    # gloo has no reduce-scatter
+    tensor = tensor.clone()
+    dist.all_reduce(tensor, group=group)
+    return tensor.chunk(world_size)[rank].contiguous()
+
+
+def _check_same_shape(tensor, group):
+    sizes = _all_gather(torch.tensor([tensor.numel()], device=tensor.device), group)
+    if (sizes != sizes[0]).any():
+        raise ValueError(f"Vocab parallelism needs batches of the same shape on every rank, got {sizes.tolist()} elements.")
+
+
+class _VocabParallelEmbeddingFunction(torch.autograd.Function):
+    @staticmethod
+    def forward(ctx, input_ids, weight, vocab_start, group):
+        ids = _all_gather(input_ids.reshape(-1), group)
+        local = ids - vocab_start
+        in_shard = (local >= 0) & (local < weight.shape[0])
+        embeddings = F.embedding(local.clamp(0, weight.shape[0] - 1), weight) * in_shard.unsqueeze(1).to(weight.dtype)
+        ctx.save_for_backward(local, in_shard)
+        ctx.group = group
+        ctx.num_rows = weight.shape[0]
+        return _reduce_scatter(embeddings, group).view(*input_ids.shape, weight.shape[1])
+
+    @staticmethod
+    def backward(ctx, grad_output):
+        local, in_shard = ctx.saved_tensors
+        grad_all = _all_gather(grad_output.reshape(-1, grad_output.shape[-1]), ctx.group)
+        grad_weight = torch.zeros(ctx.num_rows, grad_all.shape[1], dtype=torch.float32, device=grad_all.device)
+        grad_weight.index_add_(0, local[in_shard], grad_all[in_shard].float())
+        # DDP averages the gradients of the replicated parameters
+        grad_weight /= dist.get_world_size(ctx.group)
+        return None, grad_weight.to(grad_output.dtype), None, None
+
+
+class _VocabParallelCrossEntropyFunction(torch.autograd.Function):
+    """Mean cross-entropy of this rank's tokens, with the LM head weight sharded over the vocabulary."""
+
+    @staticmethod
+    def forward(ctx, hidden, weight, labels, vocab_start, vocab_size, chunk_size, ignore_index, group):
+        hidden_all = _all_gather(hidden, group)
+        labels_all = _all_gather(labels, group)
+        num_rows = weight.shape[0]
+        # padding rows of the last shard are excluded from the softmax
+        pad_mask = torch.arange(vocab_start, vocab_start + num_rows, device=hidden.device) >= vocab_size
+        lse = torch.empty(hidden_all.shape[0], dtype=torch.float32, device=hidden.device)
+        targets = torch.empty_like(lse)
+        for start in range(0, hidden_all.shape[0], chunk_size):
+            end = min(start + chunk_size, hidden_all.shape[0])
+            logits = (hidden_all[start:end] @ weight.t()).float().masked_fill(pad_mask, float("-inf"))
+            local = labels_all[start:end] - vocab_start
+            in_shard = (local >= 0) & (local < num_rows)
+            target = logits.gather(1, local.clamp(0, num_rows - 1).unsqueeze(1)).squeeze(1) * in_shard
+            logits_max = logits.max(dim=-1).values
+            dist.all_reduce(logits_max, op=dist.ReduceOp.MAX, group=group)
+            # sum of exponentials and target logit (held by a single rank) in one all-reduce
+            sums = torch.stack([torch.exp(logits - logits_max.unsqueeze(1)).sum(dim=-1), target])
+            dist.all_reduce(sums, group=group)
+            lse[start:end] = logits_max + torch.log(sums[0])
+            targets[start:end] = sums[1]
+
+        rank, num_tokens = dist.get_rank(group), hidden.shape[0]
+        own = slice(rank * num_tokens, (rank + 1) * num_tokens)
+        valid = labels != ignore_index
+        num_valid = valid.sum().clamp(min=1)
+        loss = ((lse[own] - targets[own]) * valid).sum() / num_valid
+
+        ctx.save_for_backward(hidden_all, weight, labels_all, lse, num_valid)
+        ctx.vocab_start, ctx.vocab_size = vocab_start, vocab_size
+        ctx.chunk_size, ctx.ignore_index, ctx.group = chunk_size, ignore_index, group
+        return loss
+
+    @staticmethod
+    def backward(ctx, grad_output):
+        hidden_all, weight, labels_all, lse, num_valid = ctx.saved_tensors
+        group, world_size = ctx.group, dist.get_world_size(ctx.group)
+        num_rows = weight.shape[0]
+        # every token is scaled by the loss gradient and valid-token count of the rank owning it
+        scales = _all_gather((grad_output.float() / num_valid).reshape(1), group)
+        token_scales = scales.repeat_interleave(hidden_all.shape[0] // world_size)
+        pad_mask = torch.arange(ctx.vocab_start, ctx.vocab_start + num_rows, device=hidden_all.device) >= ctx.vocab_size
+
+        grad_hidden_all = torch.empty_like(hidden_all)
+        grad_weight = torch.zeros(weight.shape, dtype=torch.float32, device=weight.device)
+        for start in range(0, hidden_all.shape[0], ctx.chunk_size):
+            end = min(start + ctx.chunk_size, hidden_all.shape[0])
+            chunk_hidden = hidden_all[start:end]
+            logits = (chunk_hidden @ weight.t()).float().masked_fill(pad_mask, float("-inf"))
+            # d(lse - logit_y)/d(logits) = softmax - one_hot(y), on this rank's slice of the vocabulary
+            grad_logits = torch.exp(logits - lse[start:end].unsqueeze(1))
+            labels = labels_all[start:end]
+            local = labels - ctx.vocab_start
+            in_shard = (local >= 0) & (local < num_rows)
+            rows = torch.arange(end - start, device=hidden_all.device)[in_shard]
+            grad_logits[rows, local[in_shard]] -= 1.0
+            grad_logits *= ((labels != ctx.ignore_index).float() * token_scales[start:end]).unsqueeze(1)
+            grad_logits = grad_logits.to(hidden_all.dtype)
+            grad_hidden_all[start:end] = grad_logits @ weight
+            grad_weight += (grad_logits.t() @ chunk_hidden).float()
+
+        grad_hidden = _reduce_scatter(grad_hidden_all, group)
+        # DDP averages the gradients of the replicated parameters
+        grad_weight /= world_size
+        return grad_hidden, grad_weight.to(weight.dtype), None, None, None, None, None, None
+
+
+class VocabParallelEmbedding(nn.Module):
+    """Input embedding holding the rows `[vocab_start, vocab_start + weight.shape[0])` of this rank."""
+
+    def __init__(self, weight, vocab_start, vocab_size, group=None):
+        super().__init__()
+        self.weight = nn.Parameter(weight, requires_grad=weight.requires_grad)
+        self.vocab_start, self.vocab_size, self.group = vocab_start, vocab_size, group
+
+    def forward(self, input_ids):
+        _check_same_shape(input_ids, self.group)
+        return _VocabParallelEmbeddingFunction.apply(input_ids, self.weight, self.vocab_start, self.group)
+
+
+class VocabParallelLMHead(nn.Module):
+    """
+    LM head holding the rows `[vocab_start, vocab_start + weight.shape[0])` of this rank. Returns the mean
+    cross-entropy when called with `labels`, else the full-vocab logits of this rank's positions.
+    """
+
+    def __init__(self, weight, vocab_start, vocab_size, group=None, chunk_size=1024):
+        super().__init__()
+        self.weight = nn.Parameter(weight, requires_grad=weight.requires_grad)
+        self.vocab_start, self.vocab_size, self.group, self.chunk_size = vocab_start, vocab_size, group, chunk_size
+
+    def forward(self, hidden_states, labels=None, ignore_index=-100):
+        hidden = hidden_states.reshape(-1, hidden_states.shape[-1])
+        _check_same_shape(hidden, self.group)
+        if labels is not None:
+            labels = labels.reshape(-1).to(hidden.device)
+            return _VocabParallelCrossEntropyFunction.apply(
+                hidden, self.weight, labels, self.vocab_start, self.vocab_size, self.chunk_size, ignore_index, self.group
+            )
+        # evaluation / inference only: every rank projects every position on its slice, then the slices are gathered
+        with torch.no_grad():
+            world_size, rank, num_tokens = dist.get_world_size(self.group), dist.get_rank(self.group), hidden.shape[0]
+            logits = _all_gather(hidden, self.group) @ self.weight.t()
+            # [shard, rank, position, row] -> this rank's positions over every shard
+            logits = _all_gather(logits, self.group).view(world_size, world_size, num_tokens, -1)[:, rank]
+            logits = logits.permute(1, 0, 2).reshape(num_tokens, -1)[:, : self.vocab_size]
+            return logits.view(*hidden_states.shape[:-1], self.vocab_size)
+
+
+def _shard_rows(weight, group):
+    world_size, rank = dist.get_world_size(group), dist.get_rank(group)
+    vocab_size = weight.shape[0]
+    rows = math.ceil(vocab_size / world_size)
+    shard = weight.new_zeros(rows, weight.shape[1])
+    start = rank * rows
+    end = min(start + rows, vocab_size)
+    if end > start:
+        shard[: end - start] = weight[start:end]
+    return shard, start, vocab_size
+
+
+def _gather_rows(module):
+    """Full `[vocab_size, hidden]` matrix of a sharded module (collective)."""
+    return _all_gather(module.weight.detach(), module.group)[: module.vocab_size]
+
+
+def _state_dict_hook(module, state_dict, prefix, local_metadata):
+    if getattr(module, "_full_weight", None) is not None:
+        state_dict[prefix + "weight"] = module._full_weight
+    return state_dict
+
+
+def _load_state_dict_pre_hook(module):
+    def hook(state_dict, prefix, local_metadata, strict, missing_keys, unexpected_keys, error_msgs):
+        key = prefix + "weight"
+        if key in state_dict and state_dict[key].shape[0] == module.vocab_size:
+            rows = module.weight.shape[0]
+            shard = module.weight.new_zeros(module.weight.shape)
+            full = state_dict[key][module.vocab_start : module.vocab_start + rows]
+            shard[: full.shape[0]] = full
+            state_dict[key] = shard
+
+    return hook
+
+
+def enable_vocab_parallel(model, group=None, chunk_size=1024):
+    """
+    Shard the input embedding and LM head of a causal LM (e.g. GPTNeoXForCausalLM) over the ranks of `group`, in
+    place. Parameter names are unchanged. Returns the names of the sharded parameters.
+    """
+    if not dist.is_initialized():
+        raise ValueError("Vocab parallelism needs an initialized process group (launch with accelerate / torchrun).")
+    embedding, lm_head = model.get_input_embeddings(), model.get_output_embeddings()
+    if getattr(lm_head, "bias", None) is not None or embedding.weight is lm_head.weight:
+        raise ValueError("Vocab parallelism supports untied LM heads without bias.")
+
+    modules = []
+    for module_cls, old in ((VocabParallelEmbedding, embedding), (VocabParallelLMHead, lm_head)):
+        shard, start, vocab_size = _shard_rows(old.weight.detach(), group)
+        kwargs = {"chunk_size": chunk_size} if module_cls is VocabParallelLMHead else {}
+        module = module_cls(shard.requires_grad_(old.weight.requires_grad), start, vocab_size, group=group, **kwargs)
+        module._register_state_dict_hook(_state_dict_hook)
+        module._register_load_state_dict_pre_hook(_load_state_dict_pre_hook(module))
+        modules.append(module)
+    model.set_input_embeddings(modules[0])
+    model.set_output_embeddings(modules[1])
+
+    base_model, lm_head = model.base_model, modules[1]
+    original_forward = model.forward
+
+    def forward(input_ids=None, labels=None, return_dict=None, **kwargs):
+        if labels is None:
+            return original_forward(input_ids=input_ids, return_dict=return_dict, **kwargs)
+        outputs = base_model(input_ids=input_ids, return_dict=True, **kwargs)
+        # next-token prediction: shift hidden states and labels by one
+        loss = lm_head(outputs[0][:, :-1, :], labels=labels[:, 1:])
+        return CausalLMOutputWithPast(
+            loss=loss,
+            logits=None,
+            past_key_values=outputs.past_key_values,
+            hidden_states=outputs.hidden_states,
+            attentions=outputs.attentions,
+        )
+
+    model.forward = forward
+    names = [name for name, param in model.named_parameters() if any(param is module.weight for module in modules)]
+    # the shards are different on every rank, DDP must not average them
+    model._ddp_params_and_buffers_to_ignore = names
+    return names
+
+
+def vocab_parallel_modules(model):
+    return [module for module in model.modules() if isinstance(module, (VocabParallelEmbedding, VocabParallelLMHead))]
+
+
+def gather_full_weights(model):
+    """Attach the full matrices to the sharded modules, so `state_dict()` returns them (collective)."""
+    for module in vocab_parallel_modules(model):
+        module._full_weight = _gather_rows(module)
+
+
+def release_full_weights(model):
+    for module in vocab_parallel_modules(model):
+        module._full_weight = None
+
+
+def clip_grad_norm_(parameters, max_norm, shard_params, group=None):
+    """Clip by the norm of every gradient, the ones of the vocab shards summed over the ranks."""
+    shard_ids = {id(p) for p in shard_params}
+    grads = [p.grad for p in parameters if p.grad is not None]
+    replicated = [p.grad for p in parameters if p.grad is not None and id(p) not in shard_ids]
+    shard_grads = [p.grad for p in shard_params if p.grad is not None]
+    device = grads[0].device
+    replicated_sq = sum((g.detach().float().norm() ** 2 for g in replicated), torch.zeros((), device=device))
+    shard_sq = sum((g.detach().float().norm() ** 2 for g in shard_grads), torch.zeros((), device=device))
+    dist.all_reduce(shard_sq, group=group)
+    total_norm = torch.sqrt(replicated_sq + shard_sq)
+    clip_coef = torch.clamp(max_norm / (total_norm + 1e-6), max=1.0)
+    for g in grads:
+        g.detach().mul_(clip_coef.to(g.dtype))
+    return total_norm
+
+
+def enable_vocab_parallel_training(trainer):
+    """Global-norm clipping, full-matrix checkpoints and per-rank shard optimizer states for a vocab-parallel model."""
+    model = trainer.model
+    modules = vocab_parallel_modules(model)
+    shard_params = [module.weight for module in modules]
+    rank = dist.get_rank()
+
+    accelerator = trainer.accelerator
+
+    def accelerator_clip_grad_norm_(parameters, max_norm, norm_type=2):
+        accelerator.unscale_gradients()
+        return clip_grad_norm_(list(parameters), max_norm, shard_params, group=modules[0].group)
+
+    save_model = trainer.save_model
+
+    def vocab_parallel_save_model(output_dir=None, _internal_call=False):
+        # every rank takes part in the gather, the main process writes the full matrices
+        gather_full_weights(model)
+        try:
+            save_model(output_dir, _internal_call=_internal_call)
+        finally:
+            release_full_weights(model)
+
+    save_optimizer_and_scheduler = trainer._save_optimizer_and_scheduler
+
+    def vocab_parallel_save_optimizer_and_scheduler(output_dir):
+        save_optimizer_and_scheduler(output_dir)
+        os.makedirs(output_dir, exist_ok=True)
+        state = [trainer.optimizer.state.get(param, {}) for param in shard_params]
+        torch.save(state, os.path.join(output_dir, VOCAB_PARALLEL_OPTIMIZER_NAME.format(rank=rank)))
+
+    load_optimizer_and_scheduler = trainer._load_optimizer_and_scheduler
+
+    def vocab_parallel_load_optimizer_and_scheduler(checkpoint):
+        load_optimizer_and_scheduler(checkpoint)
+        path = None if checkpoint is None else os.path.join(checkpoint, VOCAB_PARALLEL_OPTIMIZER_NAME.format(rank=rank))
+        if path is not None and os.path.exists(path):
+            # the main process's optimizer file holds its own shards, restore this rank's
+            for param, state in zip(shard_params, torch.load(path, map_location=shard_params[0].device)):
+                trainer.optimizer.state[param] = state
+
+    accelerator.clip_grad_norm_ = accelerator_clip_grad_norm_
+    trainer.save_model = vocab_parallel_save_model
+    trainer._save_optimizer_and_scheduler = vocab_parallel_save_optimizer_and_scheduler
+    trainer._load_optimizer_and_scheduler = vocab_parallel_load_optimizer_and_scheduler
+    return trainer
+
+
+def _check(rank, world_size, port, vocab_size, chunk_size, tolerance=1e-4):
+    """
+    Compare one vocab-parallel training step with the unsharded model on `world_size` gloo processes, raises when an
+    error exceeds `tolerance`.
+    """
+    from transformers import GPTNeoXConfig, GPTNeoXForCausalLM
+
+    os.environ.update(MASTER_ADDR="127.0.0.1", MASTER_PORT=str(port))
+    dist.init_process_group("gloo", rank=rank, world_size=world_size)
+    config = GPTNeoXConfig(vocab_size=vocab_size, hidden_size=32, num_hidden_layers=2, num_attention_heads=4, intermediate_size=64)
+    torch.manual_seed(0)
+    reference = GPTNeoXForCausalLM(config)
+    model = GPTNeoXForCausalLM(config)
+    model.load_state_dict(reference.state_dict())
+    sharded = enable_vocab_parallel(model, chunk_size=chunk_size)
+
+    generator = torch.Generator().manual_seed(100 + rank)
+    input_ids = torch.randint(0, vocab_size, (2, 16), generator=generator)
+    labels = input_ids.clone()
+    labels[0, :5] = -100
+
+    ref_loss = reference(input_ids=input_ids, labels=labels).loss
+    ref_loss.backward()
+    loss = model(input_ids=input_ids, labels=labels).loss
+    loss.backward()
+    with torch.no_grad():
+        ref_logits = reference(input_ids=input_ids).logits
+        logits = model(input_ids=input_ids).logits
+
+    errors = {"loss": (loss - ref_loss).abs().item(), "logits": (logits - ref_logits).abs().max().item()}
+    ref_params = dict(reference.named_parameters())
+    grad_error = 0.0
+    for name, param in model.named_parameters():
+        ref_grad = ref_params[name].grad.clone()
+        dist.all_reduce(ref_grad)
+        ref_grad /= world_size
+        grad = param.grad.clone()
+        if name in sharded:
+            grad = _all_gather(grad)[:vocab_size]
+        else:
+            # the DDP all-reduce of the replicated parameters
+            dist.all_reduce(grad)
+            grad /= world_size
+        grad_error = max(grad_error, (grad - ref_grad).abs().max().item())
+    errors["grad"] = grad_error
+
+    gather_full_weights(model)
+    state_dict = model.state_dict()
+    release_full_weights(model)
+    errors["state_dict"] = max((state_dict[name] - ref_params[name]).abs().max().item() for name in sharded)
+    if rank == 0:
+        print(f"{world_size} ranks, vocab {vocab_size}, max abs errors: {errors}")
+    dist.destroy_process_group()
+    if max(errors.values()) > tolerance:
+        raise AssertionError(f"Vocab-parallel errors above {tolerance} on rank {rank}: {errors}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-n", "--num-processes", type=int, default=2)
+    parser.add_argument("-v", "--vocab-size", type=int, default=101, help="Not a multiple of the process count, to check the padding of the last shard.")
+    parser.add_argument("-c", "--chunk-size", type=int, default=7)
+    parser.add_argument("-p", "--port", type=int, default=29512)
+    parser.add_argument("-t", "--tolerance", type=float, default=1e-4, help="Largest absolute error accepted.")
+
+    args = parser.parse_args()
+
+    torch.multiprocessing.spawn(_check, args=(args.num_processes, args.port, args.vocab_size, args.chunk_size, args.tolerance), nprocs=args.num_processes)
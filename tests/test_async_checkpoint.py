@@ -0,0 +1,118 @@
+import json
+import os
+
+import pytest
+import torch
+from datasets import Dataset
+from safetensors.torch import load_file, save_file
+from transformers import GPTNeoXConfig, GPTNeoXForCausalLM, Trainer, TrainingArguments
+
+from async_checkpoint import STATS_NAME, AsyncCheckpointer, commit_checkpoint, enable_async_checkpointing, shard_saved_model
+
+
+def tiny_model():
+    torch.manual_seed(0)
+    config = GPTNeoXConfig(
+        vocab_size=64, hidden_size=32, num_hidden_layers=2, num_attention_heads=4, intermediate_size=64, max_position_embeddings=64
+    )
+    return GPTNeoXForCausalLM(config)
+
+
+def write_tensor(value):
+    def write(directory):
+        save_file({"x": torch.full((4,), float(value))}, os.path.join(directory, "x.safetensors"))
+        return 16
+
+    return write
+
+
+def test_rotation_and_stats(tmp_path):
+    checkpointer = AsyncCheckpointer(str(tmp_path), save_total_limit=2)
+    for step in (1, 2, 3):
+        checkpointer.wait()
+        checkpointer.submit(step, write_tensor(step), stats={"stall_s": 0.0})
+    checkpointer.close()
+
+    assert sorted(os.listdir(tmp_path)) == ["checkpoint-2", "checkpoint-3", STATS_NAME]
+    for step in (2, 3):
+        assert load_file(str(tmp_path / f"checkpoint-{step}" / "x.safetensors"))["x"].tolist() == [float(step)] * 4
+    with open(tmp_path / STATS_NAME) as f:
+        stats = [json.loads(line) for line in f]
+    assert [entry["step"] for entry in stats] == [1, 2, 3] and all(entry["bytes"] == 16 for entry in stats)
+
+
+def test_failed_write_is_not_committed(tmp_path):
+    def fail(directory):
+        raise OSError("disk full")
+
+    checkpointer = AsyncCheckpointer(str(tmp_path))
+    checkpointer.submit(1, fail)
+    with pytest.raises(RuntimeError, match="write failed"):
+        checkpointer.wait()
+    assert not os.path.exists(tmp_path / "checkpoint-1")
+
+
+def test_commit_replaces_an_existing_checkpoint(tmp_path):
+    final_dir, staging_dir = tmp_path / "checkpoint-1", tmp_path / "checkpoint-1.tmp"
+    final_dir.mkdir()
+    (final_dir / "weights").write_text("old")
+    (final_dir / "extra.json").write_text("{}")
+    staging_dir.mkdir()
+    (staging_dir / "weights").write_text("new")
+    commit_checkpoint(str(staging_dir), str(final_dir))
+    # files written by other writers are kept, the rest is replaced
+    assert sorted(os.listdir(tmp_path)) == ["checkpoint-1"]
+    assert (final_dir / "weights").read_text() == "new" and (final_dir / "extra.json").read_text() == "{}"
+
+
+def test_shard_saved_model(tmp_path):
+    model = tiny_model()
+    model.save_pretrained(str(tmp_path))
+    shard_saved_model(str(tmp_path), max_shard_size="20KB")
+    assert not os.path.exists(tmp_path / "model.safetensors")
+    assert os.path.exists(tmp_path / "model.safetensors.index.json")
+    reloaded = GPTNeoXForCausalLM.from_pretrained(str(tmp_path))
+    for name, tensor in model.state_dict().items():
+        torch.testing.assert_close(reloaded.state_dict()[name], tensor)
+
+
+@pytest.mark.filterwarnings("ignore:Environment variable TORCH_FORCE_NO_WEIGHTS_ONLY_LOAD")
+def test_trainer_round_trip(tmp_path, monkeypatch):
+    # transformers 4.44 reads its RNG state file with the `torch.load` defaults of older torch versions
+    monkeypatch.setenv("TORCH_FORCE_NO_WEIGHTS_ONLY_LOAD", "1")
+    input_ids = torch.randint(0, 64, (32, 8), generator=torch.Generator().manual_seed(1)).tolist()
+    dataset = Dataset.from_dict({"input_ids": input_ids, "labels": input_ids})
+
+    def trainer(output_dir, max_steps):
+        args = TrainingArguments(
+            output_dir=str(output_dir),
+            per_device_train_batch_size=2,
+            max_steps=max_steps,
+            save_steps=2,
+            save_total_limit=2,
+            use_cpu=True,
+            report_to=[],
+            seed=0,
+        )
+        return Trainer(model=tiny_model(), args=args, train_dataset=dataset)
+
+    reference = trainer(tmp_path / "output", 6)
+    enable_async_checkpointing(reference, max_shard_size="20KB")
+    reference.train()
+    assert sorted(os.listdir(tmp_path / "output")) == ["checkpoint-4", "checkpoint-6", STATS_NAME]
+    checkpoint = tmp_path / "output" / "checkpoint-6"
+    assert os.path.exists(checkpoint / "model.safetensors.index.json")
+
+    # the sharded weights and the optimizer state are the ones of the trained model
+    saved = GPTNeoXForCausalLM.from_pretrained(str(checkpoint))
+    for name, param in reference.model.named_parameters():
+        torch.testing.assert_close(dict(saved.named_parameters())[name], param)
+    optimizer_state = torch.load(checkpoint / "optimizer.pt", weights_only=True)
+    for saved_state, state in zip(optimizer_state["state"].values(), reference.optimizer.state_dict()["state"].values()):
+        torch.testing.assert_close(saved_state["exp_avg"], state["exp_avg"])
+
+    # resuming from the middle checkpoint ends on the same weights
+    resumed = trainer(tmp_path / "resumed", 6)
+    resumed.train(resume_from_checkpoint=str(tmp_path / "output" / "checkpoint-4"))
+    for name, param in resumed.model.named_parameters():
+        torch.testing.assert_close(param, dict(reference.model.named_parameters())[name])
@@ -0,0 +1,58 @@
+import math
+
+import numpy as np
+import pytest
+import torch
+import torch.nn.functional as F
+from transformers import GPTNeoXConfig, GPTNeoXForCausalLM
+
+from block_eval import evaluate_blocks
+from token_provenance import PROVENANCE_GROUPS
+
+
+def test_evaluate_blocks_matches_per_token_cross_entropy():
+    torch.manual_seed(0)
+    config = GPTNeoXConfig(
+        vocab_size=64, hidden_size=32, num_hidden_layers=2, num_attention_heads=4, intermediate_size=64, max_position_embeddings=64
+    )
+    model = GPTNeoXForCausalLM(config).eval()
+    input_ids = torch.randint(0, 64, (5, 12))
+    labels = input_ids.clone()
+    labels[0, 3:6] = -100
+    rng = np.random.default_rng(0)
+    token_groups = rng.integers(-1, len(PROVENANCE_GROUPS), 64)
+    token_bytes = rng.integers(1, 5, 64)
+
+    metrics = evaluate_blocks(
+        model, {"input_ids": input_ids, "labels": labels}, batch_size=2, token_groups=token_groups, token_bytes=token_bytes, chunk_size=5
+    )
+
+    with torch.no_grad():
+        logits = model(input_ids=input_ids).logits[:, :-1].reshape(-1, 64)
+    targets = labels[:, 1:].reshape(-1)
+    valid = targets != -100
+    losses = F.cross_entropy(logits, targets.clamp(min=0), reduction="none")[valid].double().numpy()
+    targets = targets[valid].numpy()
+    assert metrics["loss"] == pytest.approx(losses.mean(), rel=1e-5)
+    assert metrics["perplexity"] == pytest.approx(math.exp(losses.mean()), rel=1e-5)
+    assert metrics["bpb"] == pytest.approx(losses.sum() / math.log(2) / token_bytes[targets].sum(), rel=1e-5)
+    for group, name in enumerate(("unknown",) + tuple(PROVENANCE_GROUPS), start=-1):
+        in_group = token_groups[targets] == group
+        if not in_group.any():
+            assert f"{name}_perplexity" not in metrics
+            continue
+        assert metrics[f"{name}_perplexity"] == pytest.approx(math.exp(losses[in_group].mean()), rel=1e-5)
+        assert metrics[f"{name}_bpb"] == pytest.approx(losses[in_group].sum() / math.log(2) / token_bytes[targets[in_group]].sum(), rel=1e-5)
+        assert metrics[f"{name}_token_frac"] == pytest.approx(in_group.mean())
+
+
+def test_evaluate_blocks_without_groups():
+    torch.manual_seed(0)
+    config = GPTNeoXConfig(vocab_size=32, hidden_size=16, num_hidden_layers=1, num_attention_heads=2, intermediate_size=32)
+    model = GPTNeoXForCausalLM(config).eval()
+    input_ids = torch.randint(0, 32, (3, 8))
+    metrics = evaluate_blocks(model, {"input_ids": input_ids, "labels": input_ids})
+    with torch.no_grad():
+        expected = model(input_ids=input_ids, labels=input_ids).loss.item()
+    assert set(metrics) == {"loss", "perplexity"}
+    assert metrics["loss"] == pytest.approx(expected, rel=1e-5)
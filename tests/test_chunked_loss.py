@@ -0,0 +1,48 @@
+import pytest
+import torch
+import torch.nn.functional as F
+from transformers import GPTNeoXConfig, GPTNeoXForCausalLM
+
+from chunked_loss import chunked_cross_entropy, replace_causal_lm_loss_with_chunked_loss
+
+
+@pytest.mark.parametrize("chunk_size", [1, 7, 64])
+def test_chunked_cross_entropy_matches_cross_entropy(chunk_size):
+    torch.manual_seed(0)
+    hidden = torch.randn(2, 12, 16, requires_grad=True)
+    weight = torch.randn(50, 16, requires_grad=True)
+    labels = torch.randint(0, 50, (2, 12))
+    labels[0, :3] = -100
+
+    loss = chunked_cross_entropy(hidden, weight, labels, chunk_size=chunk_size)
+    grad_hidden, grad_weight = torch.autograd.grad(loss, (hidden, weight))
+    expected = F.cross_entropy((hidden @ weight.t()).reshape(-1, 50), labels.reshape(-1))
+    expected_grad_hidden, expected_grad_weight = torch.autograd.grad(expected, (hidden, weight))
+
+    torch.testing.assert_close(loss, expected)
+    torch.testing.assert_close(grad_hidden, expected_grad_hidden)
+    torch.testing.assert_close(grad_weight, expected_grad_weight)
+
+
+def test_causal_lm_chunked_loss_matches_model_loss():
+    torch.manual_seed(0)
+    config = GPTNeoXConfig(
+        vocab_size=64, hidden_size=32, num_hidden_layers=2, num_attention_heads=4, intermediate_size=64, max_position_embeddings=64
+    )
+    model = GPTNeoXForCausalLM(config)
+    input_ids = torch.randint(0, 64, (2, 10))
+    labels = input_ids.clone()
+    labels[1, 6:] = -100
+
+    expected = model(input_ids=input_ids, labels=labels).loss
+    expected_grads = torch.autograd.grad(expected, [model.embed_out.weight, model.gpt_neox.embed_in.weight])
+    replace_causal_lm_loss_with_chunked_loss(model, chunk_size=3)
+    outputs = model(input_ids=input_ids, labels=labels)
+    grads = torch.autograd.grad(outputs.loss, [model.embed_out.weight, model.gpt_neox.embed_in.weight])
+
+    assert outputs.logits is None
+    torch.testing.assert_close(outputs.loss, expected)
+    for grad, expected_grad in zip(grads, expected_grads):
+        torch.testing.assert_close(grad, expected_grad)
+    # without labels, the model still returns the logits
+    assert model(input_ids=input_ids).logits.shape == (2, 10, 64)
@@ -0,0 +1,16 @@
+import subprocess
+import sys
+
+from cli import COMMANDS, MAIN_DIR, check_startup
+
+
+def test_cheap_commands_start_without_heavy_imports():
+    # a loose time budget: the check is that no heavy library is imported, timings vary on shared machines
+    results = check_startup(budget=5.0, repeats=1)
+    assert {name: case["heavy_imports"] for name, case in results["cases"].items() if case["heavy_imports"]} == {}
+    assert results["ok"], results
+
+
+def test_command_list():
+    output = subprocess.run([sys.executable, f"{MAIN_DIR}/src/cli.py", "-h"], capture_output=True, text=True, check=True).stdout
+    assert all(command in output for command in list(COMMANDS) + ["startup"])
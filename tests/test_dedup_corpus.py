@@ -0,0 +1,95 @@
+import json
+import random
+
+import numpy as np
+import pyarrow as pa
+
+from corpus_manifest import load_manifest, read_shard, write_manifest, write_shard
+from dedup_corpus import DedupIndex, MinHasher, dedup_corpus, exact_hash, find_duplicates, normalize
+
+WORDS = [f"w{i}" for i in range(1000)]
+
+
+def document(seed, num_words=200):
+    rng = random.Random(seed)
+    return " ".join(rng.choice(WORDS) for _ in range(num_words))
+
+
+def near_copy(text, position=100):
+    words = text.split()
+    words[position] = "changed"
+    return " ".join(words)
+
+
+def hash_documents(texts, hasher):
+    words = [normalize(text) for text in texts]
+    return np.array([exact_hash(w) for w in words], dtype=np.uint64), hasher.signatures([hasher.shingles(w) for w in words])
+
+
+def write_corpus(path, shards):
+    path.mkdir()
+    entries = []
+    for i, texts in enumerate(shards):
+        table = pa.table({"text": texts, "num_tokens": [len(text.split()) for text in texts]})
+        entries.append(write_shard(str(path), f"shard-{i:05d}.arrow", table, "arrow"))
+    write_manifest(str(path), {"format": "arrow", "tokenizer": None, "token_counts": "exact", "shards": entries})
+    return str(path)
+
+
+def kept_texts(output_dir):
+    manifest, root = load_manifest(output_dir)
+    return [text for shard in manifest["shards"] for text in read_shard(f"{root}/{shard['path']}", "arrow").column("text").to_pylist()]
+
+
+def test_minhash_similarity():
+    hasher = MinHasher()
+    text = document(0)
+    _, signatures = hash_documents([text, near_copy(text), document(1)], hasher)
+    assert (signatures[0] == signatures[1]).mean() > 0.8
+    assert (signatures[0] == signatures[2]).mean() < 0.2
+
+
+def test_find_duplicates_keeps_the_first_copy():
+    hasher = MinHasher()
+    a, b = document(0), document(1)
+    # exact duplicates up to case and punctuation, and a near duplicate
+    texts = [a, b, a.upper() + ".", near_copy(b), document(2)]
+    exact, signatures = hash_documents(texts, hasher)
+    exact_duplicate, near_duplicate = find_duplicates(exact, signatures, 0, bands=16, threshold=0.8)
+    assert exact_duplicate.tolist() == [False, False, True, False, False]
+    assert near_duplicate.tolist() == [False, False, False, True, False]
+
+    # against an index holding the first two documents, only the new ones can be dropped
+    exact_duplicate, near_duplicate = find_duplicates(exact, signatures, 2, bands=16, threshold=0.8)
+    assert exact_duplicate.tolist() == [True, False, False]
+    assert near_duplicate.tolist() == [False, True, False]
+
+
+def test_incremental_run_and_rerun(tmp_path):
+    first = [document(i) for i in range(10)]
+    first_input = write_corpus(tmp_path / "first", [first[:6], first[6:] + [first[0], near_copy(first[1])]])
+    index_dir = str(tmp_path / "index")
+    report = dedup_corpus(first_input, str(tmp_path / "first-dedup"), index_dir, num_workers=2)
+    assert (report["exact_duplicate_docs"], report["near_duplicate_docs"], report["kept_docs"]) == (1, 1, 10)
+    assert kept_texts(str(tmp_path / "first-dedup")) == first
+
+    # a later increment is checked against the documents kept before it
+    second = [document(i) for i in range(10, 15)]
+    second_input = write_corpus(tmp_path / "second", [second + [first[2], near_copy(first[3], 50)]])
+    report = dedup_corpus(second_input, str(tmp_path / "second-dedup"), index_dir, num_workers=2)
+    assert report["num_indexed_before"] == 10
+    assert (report["exact_duplicate_docs"], report["near_duplicate_docs"]) == (1, 1)
+    assert kept_texts(str(tmp_path / "second-dedup")) == second
+
+    # running the first corpus again replaces its part instead of dropping every document as a duplicate of itself
+    report = dedup_corpus(first_input, str(tmp_path / "first-dedup"), index_dir, num_workers=2)
+    assert report["kept_docs"] == 10 and report["replaced_parts"] == ["part-00000"]
+    assert kept_texts(str(tmp_path / "first-dedup")) == first
+    index = DedupIndex(index_dir)
+    assert [part["name"] for part in index.meta["parts"]] == ["part-00001", "part-00002"]
+    assert index.num_docs == 15
+    with open(tmp_path / "index" / "index.json") as f:
+        assert len(json.load(f)["parts"]) == 2
+    assert sorted(path.name for path in (tmp_path / "index").glob("*.npy")) == [
+        "part-00001.exact.npy", "part-00001.minhash.npy", "part-00002.exact.npy", "part-00002.minhash.npy"
+    ]
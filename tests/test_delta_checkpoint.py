@@ -0,0 +1,96 @@
+import os
+
+import pytest
+import torch
+from datasets import Dataset
+from transformers import GPTNeoXConfig, GPTNeoXForCausalLM, Trainer, TrainingArguments
+
+from delta_checkpoint import (
+    DELTA_WEIGHTS_NAME,
+    apply_delta,
+    enable_delta_checkpointing,
+    fingerprint_model_dir,
+    load_delta_model,
+    save_delta,
+    write_model_fingerprint,
+)
+
+TRAINABLE = ("gpt_neox.embed_in.weight", "embed_out.weight")
+
+
+def tiny_model(seed=0):
+    torch.manual_seed(seed)
+    config = GPTNeoXConfig(
+        vocab_size=64, hidden_size=32, num_hidden_layers=2, num_attention_heads=4, intermediate_size=64, max_position_embeddings=64
+    )
+    return GPTNeoXForCausalLM(config)
+
+
+def save_base(path, seed=0):
+    tiny_model(seed).save_pretrained(str(path))
+    write_model_fingerprint(str(path))
+    return str(path)
+
+
+def embed_only_trainer(base_path, output_dir):
+    model = GPTNeoXForCausalLM.from_pretrained(base_path)
+    for name, param in model.named_parameters():
+        param.requires_grad = name in TRAINABLE
+    input_ids = torch.randint(0, 64, (32, 8), generator=torch.Generator().manual_seed(1)).tolist()
+    args = TrainingArguments(
+        output_dir=str(output_dir),
+        per_device_train_batch_size=2,
+        max_steps=4,
+        save_steps=2,
+        use_cpu=True,
+        report_to=[],
+        seed=0,
+    )
+    trainer = Trainer(model=model, args=args, train_dataset=Dataset.from_dict({"input_ids": input_ids, "labels": input_ids}))
+    enable_delta_checkpointing(trainer, base_path)
+    return trainer
+
+
+@pytest.mark.filterwarnings("ignore:Environment variable TORCH_FORCE_NO_WEIGHTS_ONLY_LOAD")
+def test_delta_round_trip(tmp_path, monkeypatch):
+    # transformers 4.44 reads its RNG state file with the `torch.load` defaults of older torch versions
+    monkeypatch.setenv("TORCH_FORCE_NO_WEIGHTS_ONLY_LOAD", "1")
+    base_path = save_base(tmp_path / "base")
+    trainer = embed_only_trainer(base_path, tmp_path / "output")
+    trainer.train()
+    checkpoint = os.path.join(str(tmp_path / "output"), "checkpoint-4")
+    assert not os.path.exists(os.path.join(checkpoint, "model.safetensors"))
+    assert os.path.getsize(os.path.join(checkpoint, DELTA_WEIGHTS_NAME)) < os.path.getsize(os.path.join(base_path, "model.safetensors"))
+
+    # the base plus the delta is the trained model
+    rebuilt = load_delta_model(checkpoint)
+    for name, tensor in trainer.model.state_dict().items():
+        torch.testing.assert_close(rebuilt.state_dict()[name], tensor)
+
+    # the optimizer state of the trainable tensors is saved as is
+    saved_state = torch.load(os.path.join(checkpoint, "optimizer.pt"), weights_only=True)["state"]
+    state = trainer.optimizer.state_dict()["state"]
+    assert sorted(saved_state) == sorted(state) and len(state) == len(TRAINABLE)
+    for index in state:
+        for key in ("exp_avg", "exp_avg_sq", "step"):
+            torch.testing.assert_close(saved_state[index][key], state[index][key])
+
+    # resuming from the middle delta checkpoint ends on the same weights
+    resumed = embed_only_trainer(base_path, tmp_path / "resumed")
+    resumed.train(resume_from_checkpoint=os.path.join(str(tmp_path / "output"), "checkpoint-2"))
+    for name, tensor in resumed.model.state_dict().items():
+        torch.testing.assert_close(tensor, trainer.model.state_dict()[name])
+
+
+def test_other_base_is_rejected(tmp_path):
+    base_path = save_base(tmp_path / "base")
+    checkpoint = str(tmp_path / "delta")
+    save_delta(tiny_model(), checkpoint, base_path, base_sha256=fingerprint_model_dir(base_path), trainable=lambda name: name in TRAINABLE)
+
+    other_path = save_base(tmp_path / "other", seed=1)
+    with pytest.raises(ValueError, match="is not the base of this delta checkpoint"):
+        load_delta_model(checkpoint, base_model_path=other_path)
+    with pytest.raises(ValueError, match="is not the base of this delta checkpoint"):
+        apply_delta(GPTNeoXForCausalLM.from_pretrained(other_path), checkpoint, base_model_path=other_path)
+    # the recorded base is accepted
+    assert isinstance(load_delta_model(checkpoint), GPTNeoXForCausalLM)
@@ -0,0 +1,43 @@
+import pytest
+from transformers import GPTNeoXConfig
+
+from distributed_planner import STRATEGIES, accelerate_config, plan
+
+# pythia-1b
+CONFIG = GPTNeoXConfig(
+    vocab_size=50304, hidden_size=2048, num_hidden_layers=16, num_attention_heads=8, intermediate_size=8192, max_position_embeddings=2048
+)
+
+
+def test_1b_on_8x80gb(capsys):
+    result = plan(CONFIG, num_gpus=8, gpu_memory_gb=80, cpu_memory_gb=1000, seq_length=2048, global_batch_size=128)
+    assert (result["strategy"], result["micro_batch_size"], result["gradient_accumulation_steps"]) == ("zero2", 16, 1)
+    assert result["global_batch_size"] == 128
+    assert capsys.readouterr().err == ""
+    config = accelerate_config(result)
+    assert config["distributed_type"] == "DEEPSPEED" and config["deepspeed_config"]["zero_stage"] == 2
+    assert config["deepspeed_config"]["offload_optimizer_device"] == "none"
+
+
+def test_1b_on_3x24gb_rounds_the_global_batch(capsys):
+    result = plan(CONFIG, num_gpus=3, gpu_memory_gb=24, cpu_memory_gb=1000, seq_length=2048, global_batch_size=128)
+    assert (result["strategy"], result["micro_batch_size"], result["gradient_accumulation_steps"]) == ("zero2", 21, 2)
+    assert (result["global_batch_size"], result["target_global_batch_size"]) == (126, 128)
+    assert "global batch of 126" in capsys.readouterr().err
+
+
+def test_1b_on_2x8gb_falls_back_to_offloading():
+    result = plan(CONFIG, num_gpus=2, gpu_memory_gb=8, cpu_memory_gb=200, seq_length=2048, global_batch_size=128)
+    assert all(result["estimates"][strategy]["micro_batch_size"] == 0 for strategy in STRATEGIES if "offload" not in strategy)
+    assert (result["strategy"], result["micro_batch_size"], result["gradient_accumulation_steps"]) == ("zero2_offload", 4, 16)
+    assert accelerate_config(result)["deepspeed_config"]["offload_optimizer_device"] == "cpu"
+
+
+def test_nothing_fits():
+    with pytest.raises(ValueError, match="No strategy fits"):
+        plan(CONFIG, num_gpus=1, gpu_memory_gb=4, cpu_memory_gb=8, seq_length=2048)
+
+
+def test_ddp_is_not_planned():
+    # the model is loaded in bf16: DDP would train without fp32 master weights
+    assert "ddp" not in STRATEGIES
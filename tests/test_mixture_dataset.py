@@ -0,0 +1,77 @@
+import itertools
+import json
+from types import SimpleNamespace
+
+from datasets import Dataset, DatasetDict
+
+from mixture_dataset import MixtureCallback, TokenStoreMixture, load_mixture, load_mixture_state, resolve_stage_steps
+
+SEQ_LENGTHS = {"pubmed": 4, "general": 6}
+
+
+def source(name, num_rows):
+    # the first token tells the source, the second the row
+    tag = list(SEQ_LENGTHS).index(name)
+    return Dataset.from_dict({"input_ids": [[tag, row] + [0] * (SEQ_LENGTHS[name] - 2) for row in range(num_rows)]})
+
+
+def sources():
+    return {"pubmed": source("pubmed", 7), "general": source("general", 5)}
+
+
+STAGES = [{"weights": {"pubmed": 1.0}, "until_step": 2}, {"weights": {"pubmed": 0.75, "general": 0.25}}]
+
+
+def take(mixture, num_blocks):
+    return [(row["input_ids"][0], row["input_ids"][1]) for row in itertools.islice(iter(mixture), num_blocks)]
+
+
+def test_interleaving_is_deterministic_and_follows_the_weights():
+    mixture = TokenStoreMixture(sources(), STAGES, samples_per_step=4, read_size=3)
+    blocks = take(mixture, 48)
+    assert blocks == take(TokenStoreMixture(sources(), STAGES, samples_per_step=4, read_size=5), 48)
+    # the first stage (2 steps of 4 blocks) only reads pubmed
+    assert all(tag == 0 for tag, _ in blocks[:8])
+    for end in range(9, 49):
+        general = sum(tag == 1 for tag, _ in blocks[8:end])
+        assert abs(general - 0.25 * (end - 8)) <= 1
+    # every source reads its rows in order and wraps around
+    assert [row for tag, row in blocks if tag == 1] == [i % 5 for i in range(10)]
+    assert [row for tag, row in blocks if tag == 0][:10] == [i % 7 for i in range(10)]
+
+
+def test_per_source_token_accounting():
+    mixture = TokenStoreMixture(sources(), STAGES, samples_per_step=4)
+    blocks = take(mixture, 40)
+    for num_samples in (0, 8, 13, 40, 20):
+        consumed = mixture.consumed(num_samples)
+        for tag, name in enumerate(SEQ_LENGTHS):
+            count = sum(block_tag == tag for block_tag, _ in blocks[:num_samples])
+            assert consumed[name] == {"blocks": count, "tokens": count * SEQ_LENGTHS[name]}
+
+
+def test_resume_from_saved_state(tmp_path):
+    paths = {}
+    for name, dataset in sources().items():
+        paths[name] = str(tmp_path / name)
+        DatasetDict({"train": dataset, "test": dataset.select(range(2))}).save_to_disk(paths[name])
+    phases = [SimpleNamespace(name="embed_only", max_steps=2), SimpleNamespace(name="full", max_steps=10)]
+    spec = {"sources": paths, "stages": [{"phase": "embed_only", "weights": {"pubmed": 1.0}}, STAGES[1]]}
+    assert resolve_stage_steps(spec["stages"], phases) == STAGES
+
+    mixture, _ = load_mixture(spec, samples_per_step=4, phases=phases)
+    blocks = take(mixture, 40)
+    # a checkpoint at step 5 saves the consumption and the scheduler state
+    state = SimpleNamespace(global_step=5, is_world_process_zero=True)
+    MixtureCallback(mixture).on_save(SimpleNamespace(output_dir=str(tmp_path / "run")), state, None)
+    saved = load_mixture_state(str(tmp_path / "run" / "checkpoint-5"))
+    assert saved["num_samples"] == 20 and saved["scheduler"]["index"] == 20
+    assert saved["sources"] == mixture.consumed(20)
+    assert json.loads(json.dumps(saved)) == saved
+
+    resumed, _ = load_mixture(spec, samples_per_step=4, phases=phases, start_sample=saved["num_samples"], start_state=saved)
+    assert resumed.start_state == saved["scheduler"]
+    assert take(resumed, 20) == blocks[20:]
+    # a mixture with other stages does not reuse the saved scheduler, it replays the stream instead
+    changed = dict(spec, stages=[{"weights": {"pubmed": 1.0}}])
+    assert load_mixture(changed, samples_per_step=4, phases=phases, start_sample=20, start_state=saved)[0].start_state is None
@@ -0,0 +1,59 @@
+import pytest
+import torch
+from datasets import Dataset
+from transformers import GPTNeoXConfig, GPTNeoXForCausalLM
+
+from clm_utils import ConstantLengthDataset
+from gpt_neox_packed_attn_patch import block_diagonal_causal_mask, replace_gpt_neox_attn_with_packed_attn
+from packing_utils import doc_lens_to_position_ids, mask_cross_document_labels, split_doc_lens
+
+
+def test_split_doc_lens():
+    assert split_doc_lens([3, 5, 2], 4) == [[3, 1], [4], [2]]
+    # the remainder beyond `total_length` is dropped
+    assert split_doc_lens([3, 5, 2], 4, total_length=8) == [[3, 1], [4]]
+    assert doc_lens_to_position_ids([3, 1]) == [0, 1, 2, 0]
+    assert mask_cross_document_labels([7, 8, 9, 10], [0, 1, 2, 0]) == [7, 8, 9, -100]
+
+
+def test_constant_length_dataset_doc_boundaries():
+    dataset = Dataset.from_dict({"input_ids": [[1, 2, 3, 4, 5, 6]], "doc_lens": [[2, 4]]})
+
+    class Tokenizer:
+        eos_token_id = 0
+
+    example = next(iter(ConstantLengthDataset(Tokenizer(), dataset, seq_length=6, doc_boundaries=True, shuffle=False)))
+    assert example["position_ids"].tolist() == [0, 1, 0, 1, 2, 3]
+    assert example["labels"].tolist() == [1, 2, -100, 4, 5, 6]
+
+
+def test_block_diagonal_causal_mask():
+    mask = block_diagonal_causal_mask(torch.tensor([[0, 1, 0, 1]]))[0, 0]
+    expected = torch.tensor([[1, 0, 0, 0], [1, 1, 0, 0], [0, 0, 1, 0], [0, 0, 1, 1]], dtype=torch.bool)
+    assert torch.equal(mask, expected)
+
+
+@pytest.mark.parametrize("attn_implementation", ["eager", "sdpa"])
+def test_packed_block_matches_separate_documents(attn_implementation):
+    torch.manual_seed(0)
+    config = GPTNeoXConfig(
+        vocab_size=64, hidden_size=32, num_hidden_layers=2, num_attention_heads=4, intermediate_size=64, max_position_embeddings=64
+    )
+    config._attn_implementation = attn_implementation
+    model = GPTNeoXForCausalLM(config).eval()
+    doc_lens = [5, 7, 4]
+    documents = [torch.randint(0, 64, (1, doc_len)) for doc_len in doc_lens]
+    input_ids = torch.cat(documents, dim=1)
+    position_ids = torch.tensor([doc_lens_to_position_ids(doc_lens)])
+
+    with torch.no_grad():
+        separate = torch.cat([model(input_ids=document).logits for document in documents], dim=1)
+        handles = replace_gpt_neox_attn_with_packed_attn(model)
+        packed = model(input_ids=input_ids, position_ids=position_ids).logits
+        for handle in handles:
+            handle.remove()
+        unpatched = model(input_ids=input_ids, position_ids=position_ids).logits
+
+    torch.testing.assert_close(packed, separate, rtol=1e-4, atol=1e-5)
+    # without the patch, the later documents attend to the earlier ones
+    assert not torch.allclose(unpatched[:, doc_lens[0]:], separate[:, doc_lens[0]:], atol=1e-4)
@@ -0,0 +1,122 @@
+import os
+
+import pytest
+import torch
+from datasets import Dataset
+from transformers import GPTNeoXConfig, GPTNeoXForCausalLM, TrainerCallback, TrainingArguments
+
+from phase_schedule import Phase, PhaseSchedule, PhaseScheduleCallback, PhaseTrainer
+
+EMBED = "gpt_neox.embed_in.weight"
+LAYER = "gpt_neox.layers.0.mlp.dense_h_to_4h.weight"
+
+
+def tiny_model():
+    torch.manual_seed(0)
+    config = GPTNeoXConfig(
+        vocab_size=64, hidden_size=32, num_hidden_layers=2, num_attention_heads=4, intermediate_size=64, max_position_embeddings=64
+    )
+    return GPTNeoXForCausalLM(config)
+
+
+def dataset(num_rows=32, same_rows=False):
+    generator = torch.Generator().manual_seed(1)
+    rows = torch.randint(0, 64, (1 if same_rows else num_rows, 8), generator=generator).repeat(num_rows if same_rows else 1, 1).tolist()
+    return Dataset.from_dict({"input_ids": rows, "labels": rows})
+
+
+def phases(embed_steps=3, full_steps=3, embed_lr=1e-2, plateau_patience=0):
+    return [
+        Phase(name="embed", trainable=["embed"], max_steps=embed_steps, learning_rate=embed_lr, lr_scheduler_type="constant", plateau_patience=plateau_patience),
+        Phase(name="full", trainable="all", max_steps=full_steps, learning_rate=1e-3, lr_scheduler_type="linear", warmup_ratio=0.5),
+    ]
+
+
+class Recorder(TrainerCallback):
+    """Trainable flags, learning rates and parameter copies at the start of every step."""
+
+    def __init__(self):
+        self.steps = {}
+
+    def on_step_begin(self, args, state, control, model=None, optimizer=None, **kwargs):
+        params = dict(model.named_parameters())
+        self.steps[state.global_step] = {
+            "requires_grad": {name: params[name].requires_grad for name in (EMBED, LAYER)},
+            "lrs": sorted({group["lr"] for group in optimizer.param_groups if group["lr"] > 0}),
+            "num_optimized": sum(len(group["params"]) for group in optimizer.param_groups),
+            "layer": params[LAYER].detach().clone(),
+        }
+
+
+def train(tmp_path, schedule, data, resume_from_checkpoint=None, save_steps=100):
+    recorder = Recorder()
+    args = TrainingArguments(
+        output_dir=str(tmp_path / "output"),
+        per_device_train_batch_size=2,
+        max_steps=schedule.total_steps,
+        logging_steps=1,
+        save_steps=save_steps,
+        use_cpu=True,
+        report_to=[],
+        seed=0,
+    )
+    trainer = PhaseTrainer(
+        model=tiny_model(), args=args, train_dataset=data, callbacks=[PhaseScheduleCallback(schedule), recorder], phase_schedule=schedule
+    )
+    trainer.train(resume_from_checkpoint=resume_from_checkpoint)
+    return trainer, recorder.steps
+
+
+def expected_lr(step):
+    return [1e-2] if step < 3 else [phases()[1].lr_at(step - 3)] if step > 3 else []
+
+
+@pytest.mark.parametrize("freeze_mode", ["requires_grad", "rewrap"])
+def test_phase_switch(tmp_path, freeze_mode):
+    schedule = PhaseSchedule(phases(), freeze_mode=freeze_mode)
+    trainer, steps = train(tmp_path, schedule, dataset())
+
+    assert trainer.state.global_step == 6 and schedule.starts == [0, 3]
+    for step, record in steps.items():
+        full = step >= 3
+        assert record["requires_grad"] == {EMBED: True, LAYER: full}
+        # the full phase warms up from 0 at its first step
+        assert record["lrs"] == pytest.approx(expected_lr(step))
+    # frozen layers do not move in the embed phase, and train in the full phase
+    assert torch.equal(steps[0]["layer"], steps[3]["layer"])
+    assert not torch.equal(steps[4]["layer"], steps[5]["layer"])
+    if freeze_mode == "rewrap":
+        # the restarted loop optimizes the parameters of the new phase only, with a fresh optimizer
+        assert steps[0]["num_optimized"] == 2 and steps[3]["num_optimized"] == len(list(trainer.model.parameters()))
+    losses = [entry["step"] for entry in trainer.state.log_history if "loss" in entry]
+    assert losses == [1, 2, 3, 4, 5, 6]
+
+
+def test_plateau_switch(tmp_path):
+    # a learning rate of 0 keeps the loss of the repeated batch constant, so it plateaus at once
+    schedule = PhaseSchedule(phases(embed_steps=100, full_steps=2, embed_lr=0.0, plateau_patience=2))
+    trainer, steps = train(tmp_path, schedule, dataset(same_rows=True))
+    assert schedule.starts == [0, 3]
+    assert trainer.state.global_step == 5
+    assert [steps[step]["requires_grad"][LAYER] for step in range(5)] == [False, False, False, True, True]
+
+
+@pytest.mark.filterwarnings("ignore:Environment variable TORCH_FORCE_NO_WEIGHTS_ONLY_LOAD")
+def test_resume_in_the_second_phase(tmp_path, monkeypatch):
+    # transformers 4.44 reads its RNG state file with the `torch.load` defaults of older torch versions
+    monkeypatch.setenv("TORCH_FORCE_NO_WEIGHTS_ONLY_LOAD", "1")
+    data = dataset()
+    reference, reference_steps = train(tmp_path, PhaseSchedule(phases()), data, save_steps=4)
+    checkpoint = os.path.join(str(tmp_path / "output"), "checkpoint-4")
+    assert os.path.exists(os.path.join(checkpoint, "phase_schedule.json"))
+
+    schedule = PhaseSchedule(phases())
+    resumed, steps = train(tmp_path / "resumed", schedule, data, resume_from_checkpoint=checkpoint)
+    assert schedule.current == 1 and schedule.starts == [0, 3]
+    assert sorted(steps) == [4, 5]
+    for step in (4, 5):
+        assert steps[step]["requires_grad"] == {EMBED: True, LAYER: True}
+        assert steps[step]["lrs"] == pytest.approx(reference_steps[step]["lrs"])
+        torch.testing.assert_close(steps[step]["layer"], reference_steps[step]["layer"])
+    for name, param in resumed.model.named_parameters():
+        torch.testing.assert_close(param, dict(reference.model.named_parameters())[name])
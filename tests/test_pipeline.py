@@ -0,0 +1,64 @@
+import os
+
+from pipeline import MAIN_DIR, Stage, build_stages, load_config, run_pipeline
+
+
+def make_stages(tmp_path, param=1):
+    path = lambda name: str(tmp_path / name)
+    return [
+        Stage(
+            name="a",
+            command=f"sleep 0.5; cat in.txt > a.txt; echo {param} >> a.txt; echo $CPU_BUDGET > a.cores",
+            inputs=[path("in.txt")], outputs=[path("a.txt")], params={"param": param}, cwd=str(tmp_path),
+        ),
+        Stage(
+            name="b",
+            command="sleep 0.5; cp in.txt b.txt; echo $CPU_BUDGET > b.cores",
+            inputs=[path("in.txt")], outputs=[path("b.txt")], cwd=str(tmp_path),
+        ),
+        Stage(
+            name="c",
+            command="cat a.txt > c.txt; echo $CPU_BUDGET > c.cores",
+            inputs=[path("a.txt")], outputs=[path("c.txt")], cwd=str(tmp_path), exclusive=True,
+        ),
+        Stage(name="d", command="exit 1", inputs=[path("b.txt")], outputs=[path("d.txt")], cwd=str(tmp_path)),
+        Stage(name="e", command="cp d.txt e.txt", inputs=[path("d.txt")], outputs=[path("e.txt")], cwd=str(tmp_path)),
+    ]
+
+
+def statuses(report):
+    return {name: info["status"] for name, info in report["stages"].items()}
+
+
+def test_run_pipeline(tmp_path):
+    (tmp_path / "in.txt").write_text("input\n")
+    config = {"state_dir": str(tmp_path / "state"), "log_dir": str(tmp_path / "log")}
+
+    report = run_pipeline(config, cores=4, stages=make_stages(tmp_path))
+    assert statuses(report) == {"a": "done", "b": "done", "c": "done", "d": "failed", "e": "blocked"}
+    # the independent stages ran at the same time on half of the cores each, the exclusive one alone on every core
+    a, b = report["stages"]["a"], report["stages"]["b"]
+    assert a["started_s"] < b["started_s"] + b["wall_s"] and b["started_s"] < a["started_s"] + a["wall_s"]
+    assert [(tmp_path / f"{name}.cores").read_text().strip() for name in "abc"] == ["2", "2", "4"]
+
+    # nothing changed: the successful stages are cached, the failed one runs again
+    report = run_pipeline(config, cores=4, stages=make_stages(tmp_path))
+    assert statuses(report) == {"a": "cached", "b": "cached", "c": "cached", "d": "failed", "e": "blocked"}
+
+    # a parameter change reruns its stage and what reads its output
+    report = run_pipeline(config, cores=4, stages=make_stages(tmp_path, param=2), targets=["c"])
+    assert statuses(report) == {"a": "done", "c": "done"}
+    assert (tmp_path / "c.txt").read_text() == "input\n2\n"
+
+    # an input change reruns every stage reading it
+    (tmp_path / "in.txt").write_text("changed\n")
+    report = run_pipeline(config, cores=4, stages=make_stages(tmp_path, param=2), dry_run=True)
+    assert statuses(report) == {"a": "would run", "b": "would run", "c": "would run", "d": "would run", "e": "would run"}
+
+
+def test_training_stage_inputs():
+    config = load_config(overrides=["general_dataset=data/pretrain-dataset/pile00-biogpt-tokenized"])
+    stage = {stage.name: stage for stage in build_stages(config)}["vocab-adaptation"]
+    assert config["general_dataset"] in stage.inputs and stage.params["general_weight"] == 0.2
+    # the modules imported by the training script are inputs too
+    assert os.path.join(MAIN_DIR, "src", "phase_schedule.py") in stage.inputs
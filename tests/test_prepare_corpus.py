@@ -0,0 +1,102 @@
+import functools
+import json
+import os
+import subprocess
+import sys
+import threading
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+from tokenizers import Tokenizer, models, pre_tokenizers
+from transformers import PreTrainedTokenizerFast
+
+SCRIPT = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "script", "prepare_pubmed_corpus_hf.py")
+WORDS = [f"word{i}" for i in range(20)]
+
+
+def abstract(index):
+    return " ".join(WORDS[(index + offset) % len(WORDS)] for offset in range(10 + index % 5))
+
+
+@pytest.fixture(scope="module")
+def tokenizer_dir(tmp_path_factory):
+    """A word-level tokenizer saved locally: one token per word."""
+    path = tmp_path_factory.mktemp("tokenizer")
+    tokenizer = Tokenizer(models.WordLevel({"[UNK]": 0, **{word: i + 1 for i, word in enumerate(WORDS)}}, unk_token="[UNK]"))
+    tokenizer.pre_tokenizer = pre_tokenizers.WhitespaceSplit()
+    PreTrainedTokenizerFast(tokenizer_object=tokenizer, unk_token="[UNK]", clean_up_tokenization_spaces=False).save_pretrained(path)
+    return str(path)
+
+
+@pytest.fixture(scope="module")
+def source_dir(tmp_path_factory):
+    """Two JSONL shards of abstracts, with empty and too short ones that are skipped."""
+    path = tmp_path_factory.mktemp("source")
+    index = 0
+    for shard in range(2):
+        with open(path / f"shard-{shard}.jsonl", "w") as f:
+            for row in range(25):
+                text = "" if row == 3 else "too short" if row == 7 else abstract(index)
+                f.write(json.dumps({"abstract": text}) + "\n")
+                index += 1
+    return path
+
+
+class QuietHandler(SimpleHTTPRequestHandler):
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def http_source(source_dir):
+    """The shards served over HTTP on 127.0.0.1, a stand-in for remote data files."""
+    server = ThreadingHTTPServer(("127.0.0.1", 0), functools.partial(QuietHandler, directory=str(source_dir)))
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield [f"http://127.0.0.1:{server.server_port}/shard-{shard}.jsonl" for shard in range(2)]
+    server.shutdown()
+    server.server_close()
+
+
+def prepare(tokenizer_dir, output_file, target_tokens, *source):
+    env = dict(os.environ, HF_DATASETS_OFFLINE="1", HF_HUB_OFFLINE="1", CPU_BUDGET="2")
+    subprocess.run(
+        [sys.executable, SCRIPT, "--streaming", "-k", tokenizer_dir, "-o", str(output_file), "-t", str(target_tokens), "-b", "4", "-n", "2", *source],
+        env=env, check=True, stdout=subprocess.DEVNULL,
+    )
+    with open(output_file) as f:
+        texts = [json.loads(line)["text"] for line in f]
+    with open(str(output_file) + ".cursor.json") as f:
+        return texts, json.load(f)
+
+
+def expected_texts(source_dir):
+    texts = []
+    for shard in range(2):
+        with open(source_dir / f"shard-{shard}.jsonl") as f:
+            texts.extend(row["abstract"] for row in map(json.loads, f) if len(row["abstract"]) >= 50)
+    return texts
+
+
+def test_local_directory_source(tokenizer_dir, source_dir, tmp_path):
+    texts, cursor = prepare(tokenizer_dir, tmp_path / "corpus.json", 10**9, "-s", str(source_dir))
+    expected = expected_texts(source_dir)
+    assert texts == expected
+    assert cursor["shard_index"] == 2
+    assert cursor["total_abstracts"] == len(expected) and cursor["skipped_empty"] == 2 and cursor["skipped_short"] == 2
+    assert cursor["total_tokens"] == sum(len(text.split()) for text in expected)
+
+
+def test_http_data_files_resume(tokenizer_dir, source_dir, http_source, tmp_path):
+    output_file = tmp_path / "corpus.json"
+    texts, cursor = prepare(tokenizer_dir, output_file, 200, "-d", *http_source)
+    expected = expected_texts(source_dir)
+    # stops at the first batch reaching the budget, before the end of the source
+    assert 200 <= cursor["total_tokens"] < sum(len(text.split()) for text in expected)
+    assert texts == expected[: len(texts)]
+    assert cursor["shards"] == http_source
+
+    # a larger budget resumes from the cursor, without duplicating the abstracts already written
+    texts, cursor = prepare(tokenizer_dir, output_file, 10**9, "-d", *http_source)
+    assert texts == expected
+    assert cursor["shard_index"] == 2 and cursor["total_abstracts"] == len(expected)
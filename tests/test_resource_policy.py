@@ -0,0 +1,14 @@
+from resource_policy import plan_resources
+
+
+def test_train_stage_shares_the_cores_between_ranks():
+    plan = plan_resources("train", cores=32, ranks=4)
+    assert (plan["num_procs"], plan["threads"], plan["num_workers"]) == (4, 8, 7)
+    assert plan["env"]["OMP_NUM_THREADS"] == "8" and plan["env"]["TOKENIZERS_PARALLELISM"] == "false"
+    # more ranks than cores still leaves one loader worker per rank
+    assert plan_resources("train", cores=2, ranks=4)["num_workers"] == 1
+
+
+def test_worker_stages_use_one_process_per_core():
+    assert plan_resources("tokenize", cores=8)["num_workers"] == 8
+    assert plan_resources("corpus", cores=64)["num_workers"] == 32
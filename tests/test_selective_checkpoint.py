@@ -0,0 +1,28 @@
+import pytest
+import torch
+from transformers import GPTNeoXConfig, GPTNeoXForCausalLM
+
+from selective_checkpoint import activation_bytes_per_layer, apply_checkpoint_policy, checkpointed_layers
+
+
+def test_auto_policy_fits_the_budget():
+    # 10 bytes per layer, 2 once checkpointed
+    assert checkpointed_layers(4, "auto", budget_bytes=40, per_layer=10, per_checkpointed_layer=2) == []
+    assert checkpointed_layers(4, "auto", budget_bytes=25, per_layer=10, per_checkpointed_layer=2) == [0, 2]
+    assert checkpointed_layers(4, "auto", budget_bytes=8, per_layer=10, per_checkpointed_layer=2) == [0, 1, 2, 3]
+    with pytest.raises(ValueError, match="Checkpointing all 4 layers"):
+        checkpointed_layers(4, "auto", budget_bytes=7, per_layer=10, per_checkpointed_layer=2)
+
+
+def test_apply_auto_policy():
+    torch.manual_seed(0)
+    config = GPTNeoXConfig(
+        vocab_size=64, hidden_size=32, num_hidden_layers=2, num_attention_heads=4, intermediate_size=64, max_position_embeddings=64
+    )
+    config._attn_implementation = "sdpa"
+    per_layer = activation_bytes_per_layer(config, 2, 16, "layer", dtype_bytes=4)
+    model = GPTNeoXForCausalLM(config)
+    names = apply_checkpoint_policy(model, "auto", batch_size=2, seq_length=16, budget_gb=1.5 * per_layer / 2**30)
+    assert names == ["gpt_neox.layers.0"]
+    with pytest.raises(ValueError, match="raise `--activation_memory_budget_gb`"):
+        apply_checkpoint_policy(GPTNeoXForCausalLM(config), "auto", batch_size=2, seq_length=16, budget_gb=1e-9)
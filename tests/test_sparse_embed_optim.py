@@ -0,0 +1,88 @@
+import io
+
+import torch
+
+from sparse_embed_optim import SparseRowAdamW
+
+
+def _step(weight, optimizer, token_ids):
+    torch.nn.functional.embedding(token_ids, weight).float().pow(2).sum().backward()
+    optimizer.step()
+    optimizer.zero_grad(set_to_none=True)
+
+
+def _optimizer(weight, row_scale):
+    return SparseRowAdamW([{"params": [weight], "row_scale": row_scale}], lr=1e-2, weight_decay=0.01)
+
+
+def test_save_load_step_round_trip():
+    torch.manual_seed(0)
+    # more rows than bf16 represents exactly as integers, so a cast `slot` would point at the wrong rows
+    vocab_size, hidden_size = 600, 8
+    row_scale = (torch.arange(vocab_size) % 3 != 0).float()
+    batches = [torch.randint(0, vocab_size, (64,)) for _ in range(4)]
+    initial = torch.randn(vocab_size, hidden_size).to(torch.bfloat16)
+
+    reference = torch.nn.Parameter(initial.clone())
+    reference_optimizer = _optimizer(reference, row_scale)
+    for token_ids in batches:
+        _step(reference, reference_optimizer, token_ids)
+
+    weight = torch.nn.Parameter(initial.clone())
+    optimizer = _optimizer(weight, row_scale)
+    for token_ids in batches[:2]:
+        _step(weight, optimizer, token_ids)
+    buffer = io.BytesIO()
+    torch.save(optimizer.state_dict(), buffer)
+    buffer.seek(0)
+
+    resumed = _optimizer(weight, row_scale)
+    resumed.load_state_dict(torch.load(buffer))
+    state = resumed.state[weight]
+    assert state["slot"].dtype == torch.long
+    assert state["exp_avg"].dtype == torch.float32 and state["exp_avg_sq"].dtype == torch.float32
+    assert torch.equal(state["slot"], optimizer.state[weight]["slot"])
+    for token_ids in batches[2:]:
+        _step(weight, resumed, token_ids)
+
+    assert torch.equal(weight, reference)
+    assert torch.equal(state["exp_avg"], reference_optimizer.state[reference]["exp_avg"])
+
+
+def test_matches_dense_adamw_on_touched_rows():
+    torch.manual_seed(0)
+    vocab_size, hidden_size = 32, 8
+    # rows 0-7 are frozen (gold rows), rows 8-15 learn at half the rate
+    row_scale = torch.ones(vocab_size)
+    row_scale[:8] = 0.0
+    row_scale[8:16] = 0.5
+    token_ids = torch.tensor([1, 2, 9, 10, 20, 21, 21])
+    initial = torch.randn(vocab_size, hidden_size)
+
+    weight = torch.nn.Parameter(initial.clone())
+    optimizer = _optimizer(weight, row_scale)
+    _step(weight, optimizer, token_ids)
+    dense = {}
+    for lr in (1e-2, 5e-3):
+        dense[lr] = torch.nn.Parameter(initial.clone())
+        _step(dense[lr], torch.optim.AdamW([dense[lr]], lr=lr, weight_decay=0.01), token_ids)
+
+    torch.testing.assert_close(weight[[20, 21]], dense[1e-2][[20, 21]])
+    torch.testing.assert_close(weight[[9, 10]], dense[5e-3][[9, 10]])
+    # frozen rows stay fixed although their tokens are in the batch, and have no state
+    touched = torch.tensor([9, 10, 20, 21])
+    untouched = torch.ones(vocab_size, dtype=torch.bool)
+    untouched[touched] = False
+    assert torch.equal(weight[untouched], initial[untouched])
+    state = optimizer.state[weight]
+    assert (state["slot"][:8] == -1).all() and state["exp_avg"].shape == (vocab_size - 8, hidden_size)
+    # only the touched rows have a step count and moments
+    slots = state["slot"][untouched & (row_scale > 0)]
+    assert (state["step"][slots] == 0).all() and (state["exp_avg"][slots] == 0).all() and (state["exp_avg_sq"][slots] == 0).all()
+    assert (state["step"][state["slot"][touched]] == 1).all()
+
+    # a step that touches other rows leaves the state of the earlier ones as it was
+    exp_avg = state["exp_avg"].clone()
+    _step(weight, optimizer, torch.tensor([30]))
+    assert state["step"][state["slot"][30]] == 1
+    assert torch.equal(state["exp_avg"][state["slot"][touched]], exp_avg[state["slot"][touched]])
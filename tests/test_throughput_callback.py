@@ -0,0 +1,80 @@
+import json
+import socket
+import urllib.request
+
+import torch
+from datasets import Dataset
+from transformers import GPTNeoXConfig, GPTNeoXForCausalLM, Trainer, TrainerCallback, TrainingArguments
+
+from throughput_callback import InstrumentedIterableDataset, ThroughputCallback, summarize_throughput_log
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+class ScrapeCallback(TrainerCallback):
+    """Fetches `/metrics` after the throughput callback updated it."""
+
+    def __init__(self, port):
+        self.port = port
+        self.pages = []
+
+    def on_step_end(self, args, state, control, **kwargs):
+        with urllib.request.urlopen(f"http://127.0.0.1:{self.port}/metrics", timeout=5) as response:
+            self.pages.append(response.read().decode())
+
+
+def test_throughput_callback_on_cpu(tmp_path):
+    torch.manual_seed(0)
+    config = GPTNeoXConfig(
+        vocab_size=64, hidden_size=32, num_hidden_layers=2, num_attention_heads=4, intermediate_size=64, max_position_embeddings=64
+    )
+    model = GPTNeoXForCausalLM(config)
+    input_ids = torch.randint(0, 64, (16, 8)).tolist()
+    dataset = Dataset.from_dict({"input_ids": input_ids, "labels": input_ids})
+    log_path = str(tmp_path / "throughput.jsonl")
+    port = free_port()
+    scrape = ScrapeCallback(port)
+    training_args = TrainingArguments(
+        output_dir=str(tmp_path / "output"),
+        per_device_train_batch_size=2,
+        gradient_accumulation_steps=2,
+        max_steps=3,
+        use_cpu=True,
+        report_to=[],
+        save_strategy="no",
+    )
+    callback = ThroughputCallback(log_path=log_path, seq_length=8, peak_tflops=1.0, metrics_port=port)
+    trainer = Trainer(model=model, args=training_args, train_dataset=dataset, callbacks=[callback, scrape])
+    trainer.train()
+
+    with open(log_path) as f:
+        steps = [json.loads(line) for line in f]
+    assert [step["step"] for step in steps] == [1, 2, 3]
+    for step in steps:
+        # two micro-batches of 2 samples of 8 tokens per optimizer step
+        assert step["tokens"] == 32
+        assert step["forward_s"] > 0 and step["backward_s"] > 0 and step["optimizer_s"] > 0
+        assert step["forward_s"] + step["backward_s"] + step["optimizer_s"] + step["data_wait_s"] <= step["step_time_s"] * 1.01
+        assert 0 < step["mfu"] < 1
+    assert len(scrape.pages) == 3
+    assert "clm_train_tokens 32" in scrape.pages[-1]
+    assert summarize_throughput_log(log_path)["steps"] == 2
+
+    # the hooks and the server are gone after training
+    assert callback.handles == [] and callback.server is None
+    with socket.socket() as sock:
+        assert sock.connect_ex(("127.0.0.1", port)) != 0
+
+
+def test_instrumented_iterable_dataset(tmp_path):
+    log_path = str(tmp_path / "producer.jsonl")
+    dataset = InstrumentedIterableDataset(range(5), log_path, report_every=2)
+    assert list(dataset) == list(range(5))
+    with open(log_path) as f:
+        reports = [json.loads(line) for line in f]
+    assert [report["samples"] for report in reports] == [2, 4]
+    assert all(report["worker"] == -1 for report in reports)
@@ -0,0 +1,18 @@
+import socket
+
+import pytest
+import torch
+
+from vocab_parallel import _check
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+@pytest.mark.parametrize("num_processes,vocab_size,chunk_size", [(2, 101, 7), (3, 64, 1000)])
+def test_vocab_parallel_matches_unsharded_model(num_processes, vocab_size, chunk_size):
+    # each gloo process compares the loss, logits, gradients and gathered state dict with the unsharded model
+    torch.multiprocessing.spawn(_check, args=(num_processes, free_port(), vocab_size, chunk_size, 1e-4), nprocs=num_processes)